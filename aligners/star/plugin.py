@@ -3,9 +3,14 @@ import sys
 import os
 import imp
 import re
-import subprocess
-from time import sleep
+import threading
 import glob
+import json
+from contextlib import contextmanager
+
+# the modules of the utils directory are loaded as the components load them (see component_utils.py), so they are shared with the components
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'components'))
+import component_utils
 
 
 # define a custom, descriptive exception:
@@ -16,14 +21,27 @@ class IncorrectParameterSubstitutionException(Exception):
 class AlignmentScriptErrorException(Exception):
 	pass
 
-# in case the script never gets a chance to run due to memory-restricted 'lockouts'
-class AlignmentTimeoutException(Exception):
-	pass
-
 # in case BAM files were not found after alignment
 class BAMFileNotFoundException(Exception):
 	pass
 
+# if the genome could not be loaded into (or removed from) shared memory
+class SharedGenomeException(Exception):
+	pass
+
+
+# the value of genome_load_mode (in the config file) which loads the genome into shared memory once per run.
+SHARED_GENOME_MODE = 'shared'
+
+# the value of sorted_bam_mode (in the config file) which has STAR write the sorted BAM directly
+STREAMED_BAM_MODE = 'streamed'
+
+# STAR reports each stage of an alignment (loading the genome, mapping, sorting the BAM) as a line like 'Oct 17 10:15:00 ..... started mapping'
+STAR_PROGRESS_PATTERN = re.compile('\.\.\.\.\. (.+)$')
+
+# the genome index files that STAR loads into memory
+GENOME_INDEX_FILES = ['Genome', 'SA', 'SAindex']
+
 
 def run(name, project):
 	"""
@@ -35,8 +53,12 @@ def run(name, project):
 	utils_dir = project.parameters.get('utils_dir')
 
 	# load the parser and the util_methods modules:
-	config_parser = load_remote_module('config_parser', utils_dir)
-	util_methods = load_remote_module('util_methods', utils_dir)
+	config_parser = component_utils.load_remote_module('config_parser', utils_dir)
+	util_methods = component_utils.load_remote_module('util_methods', utils_dir)
+	resource_manager = component_utils.load_remote_module('resource_manager', utils_dir)
+	bam_levels = component_utils.load_remote_module('bam_levels', utils_dir)
+	result_cache = component_utils.load_remote_module('result_cache', utils_dir)
+	process_runner = component_utils.load_remote_module('process_runner', utils_dir)
 
 	# parse the configuration file
 	parse_config_file(project, util_methods, config_parser)
@@ -47,115 +69,350 @@ def run(name, project):
 	# read the template into a string object:
 	template_string = get_template(project.parameters.get('template_script'))
 
+	# only the BAM levels needed downstream are created by the alignment script:
+	required_bam_levels = bam_levels.get_required_levels(project.parameters)
+	logging.info('The alignments will create these BAM levels: %s' % required_bam_levels)
+	template_string = inject_parameter('%BAM_LEVELS%', ' '.join(required_bam_levels), template_string)
+
 	# inject the general (non sample-specific) parameters into the template script:
 	general_template_string = fill_out_general_template_portion(project, template_string)
 	
+	# alignments whose inputs match an earlier run are restored from the result cache instead of being re-run:
+	cache = result_cache.create_result_cache(project.parameters)
+	# when restarting, only the samples whose reads, parameters, or alignments changed since the last run are aligned again:
+	samples_to_align = util_methods.get_samples_to_run(project, name)
+	cache_keys = get_alignment_cache_keys(project, samples_to_align, general_template_string, cache, util_methods, result_cache)
+
 	alignment_script_paths = []
-	for sample in project.samples:
+	script_to_sample = {}
+	aligned_samples = []
+	for sample in samples_to_align:
 		# extract the path to the sample directory via the fastq file:
 		sample_dir_path = os.path.dirname(sample.read_1_fastq)
 		
-		# define, create, and assign the path to the alignment output directory:
+		# define, create, and assign the path to the alignment output directory.  A sample aligned by an earlier run 
+		# already has an alignment directory, which is reused:
 		align_dir_path = os.path.join(sample_dir_path, project.parameters.get('alignment_dir'))
-		util_methods.create_directory(align_dir_path)
+		util_methods.create_directory(align_dir_path, overwrite = hasattr(sample, 'alignment_dir'))
 		sample.alignment_dir = align_dir_path # note assigning member attribute to this sample
 
+		# a sample whose alignment finished before an earlier run failed is not aligned again:
+		if journal_entry_valid(sample, project.parameters, required_bam_levels):
+			logging.info('Alignment of sample %s already finished in an earlier run.  Skipping.' % sample.sample_name)
+			continue
+
+		if cache and cache.fetch(cache_keys[sample.sample_name], output_dir = align_dir_path):
+			logging.info('Alignment of sample %s was restored from the result cache.' % sample.sample_name)
+			continue
+		aligned_samples.append(sample)
+
 		# fill out the remainder of the script template and write to the sample directory:
 		align_script_string = fill_out_sample_specific_portion(sample, general_template_string)
 		align_script_path = os.path.join(sample_dir_path, sample.sample_name + '.star_align.sh')
 		with open(align_script_path, 'w') as outfile:
 			outfile.write(align_script_string)
 		alignment_script_paths.append(align_script_path)
+		script_to_sample[align_script_path] = sample
+
+	# as each alignment finishes, its outputs are checked and recorded in the sample's journal, so a restart only re-runs the unfinished samples
+	def journal(script_path):
+		write_journal_entry(script_to_sample[script_path], project.parameters, required_bam_levels)
+
+	if len(alignment_script_paths) > 0:
+		runner = process_runner.create_runner(project.parameters, name)
+		memory_per_job = get_job_memory(project.parameters)
+		resources = create_alignment_resources(project.parameters, resource_manager, runner, len(alignment_script_paths), memory_per_job)
+		if project.parameters.get('genome_load_mode') == SHARED_GENOME_MODE:
+			with shared_genome(project.parameters, resources):
+				execute_alignments(alignment_script_paths, project.parameters, resources, runner, memory_per_job, journal)
+		else:
+			execute_alignments(alignment_script_paths, project.parameters, resources, runner, memory_per_job, journal)
+
+	if cache:
+		for sample in aligned_samples:
+			output_files = [os.path.join(sample.alignment_dir, f) for f in os.listdir(sample.alignment_dir)]
+			cache.store(cache_keys[sample.sample_name], output_files)
 
-	execute_alignments(alignment_script_paths, project.parameters)
-	register_bam_files(project, util_methods.case_insensitive_glob)
+	register_bam_files(project, required_bam_levels, util_methods.case_insensitive_glob)
 	return [None] # needs to return a list
 
 
-def register_bam_files(project, glob_method):
+def get_alignment_cache_keys(project, samples, general_template_string, cache, util_methods, result_cache):
+	"""
+	Returns a dictionary mapping each sample name to the result cache key for its alignment.  The key covers the reads (by content), 
+	the genome index and GTF, the tools, the general portion of the alignment script (tool paths and parameters), and the read-group information.
+	Reading the FASTQ files takes a while, so the keys are computed in parallel.  Returns an empty dictionary if there is no cache.
 	"""
-	This finds all the bam files created by the alignment step and adds them to the respective Sample objects
+	if not cache:
+		return {}
+	params = project.parameters
+	general_parts = ['star', general_template_string,
+			result_cache.IdentityOf(params.get('star_genome_index')),
+			result_cache.ContentOf(params.get('gtf')),
+			result_cache.IdentityOf(params.get('star_align')),
+			result_cache.IdentityOf(params.get('samtools')),
+			result_cache.IdentityOf(params.get('picard'))]
+	executor = util_methods.create_sample_executor(params)
+	for sample in samples:
+		key_parts = general_parts + [sample.sample_name, sample.flowcell_id, sample.lane, sample.index, result_cache.ContentOf(sample.read_1_fastq)]
+		if sample.read_2_fastq:
+			key_parts.append(result_cache.ContentOf(sample.read_2_fastq))
+		executor.submit(sample.sample_name, cache.fingerprint, key_parts)
+	return executor.wait()
+
+
+def register_bam_files(project, required_bam_levels, glob_method):
+	"""
+	This finds the bam files created by the alignment step at each of the required levels (e.g. 'sort.primary') and adds them to the respective Sample objects
 	"""
 	logging.info('Registering BAM files with their respective samples')
 	for sample in project.samples:
-		bam_files = glob_method(os.path.join(sample.alignment_dir, '*bam'))
+		bam_files = []
+		for level in required_bam_levels:
+			found_files = glob_method(os.path.join(sample.alignment_dir, sample.sample_name + '.' + level + '.bam'))
+			if len(found_files) == 1:
+				bam_files.extend(found_files)
+			else:
+				logging.info('Could not find the %s BAM file in %s. ' % (level, sample.alignment_dir))
+				raise BAMFileNotFoundException
 		logging.info('For sample %s, found: %s' % (sample.sample_name, bam_files))
-		if len(bam_files) > 0:
-			sample.bamfiles = bam_files
-		else:
-			logging.info('Could not find any BAM files in %s. ' % sample.alignment_dir)
-			raise BAMFileNotFoundException
+		sample.bamfiles = bam_files
+
+
 
+def create_alignment_resources(params, resource_manager, runner, script_count, memory_per_job):
+	"""
+	Returns the ResourceManager which admits the alignments.  When the alignments are submitted to a cluster scheduler (or a work queue), the
+	scheduler (or the workers) decides where and when each one runs, so they are all admitted at once (and submitted together as an array job).
+	"""
+	if runner.scheduler:
+		if params.get('genome_load_mode') == SHARED_GENOME_MODE:
+			logging.error('The genome cannot be loaded into shared memory when the alignments run on the cluster.  Set genome_load_mode = NoSharedMemory.')
+			raise SharedGenomeException('Shared genome mode cannot be used with a batch job backend.')
+		return resource_manager.ResourceManager(memory_per_job*script_count, int(params.get('star_threads'))*script_count)
+	return resource_manager.create_resource_manager(params.get('max_memory'), params.get('max_cpus'))
+
+
+def get_job_memory(params):
+	"""
+	Returns the memory (in GB) to reserve for each alignment
+	"""
+	if params.get('genome_load_mode') == SHARED_GENOME_MODE:
+		# the alignments share a single copy of the genome (reserved separately), so each only needs memory for its own buffers
+		memory = float(params.get('shared_genome_job_memory'))
+	else:
+		memory = float(params.get('min_memory'))
+
+	# STAR holds the reads in memory while sorting them
+	if params.get('sorted_bam_mode') == STREAMED_BAM_MODE:
+		memory += float(params.get('sort_memory'))
+	return memory
+
+
+def get_genome_memory(genome_index_dir):
+	"""
+	Returns the size (in GB) of the genome index files that STAR loads into memory
+	"""
+	total_bytes = sum([os.path.getsize(os.path.join(genome_index_dir, f)) for f in GENOME_INDEX_FILES if os.path.isfile(os.path.join(genome_index_dir, f))])
+	return total_bytes/(1024.0**3)
 
 
-def assert_memory_reasonable(min_mem_necessary):
+def call_star_genome_load(params, load_option):
 	"""
-	This method does a dirty check on the system memory to see that there is a reasonable amount of RAM avaialable
+	Calls STAR with only the --genomeLoad option (e.g. LoadAndExit or Remove), which loads/removes the shared memory copy of the genome.
+	Returns the exit status of STAR.
 	"""
+	work_dir = os.path.join(params.get('output_location'), params.get('shared_genome_dir'))
+	if not os.path.isdir(work_dir):
+		os.makedirs(work_dir)
+	command = [params.get('star_align'), '--genomeDir', params.get('star_genome_index'), '--genomeLoad', load_option, '--outFileNamePrefix', work_dir + os.sep]
+	runner = component_utils.load_remote_module('process_runner', params.get('utils_dir')).create_runner(params)
+	return runner.run('star.genomeLoad.' + load_option, command).returncode
+
+
+@contextmanager
+def shared_genome(params, resources):
+	"""
+	Loads the genome into shared memory for the duration of the 'with' block, and removes it at the end, even if the alignments fail.
+	A marker file in the output directory records that the genome is loaded.  If a previous run died without removing its copy 
+	(e.g. the process was killed), the marker is still there and the stale copy is removed before loading again.  If that copy cannot be
+	removed, the marker is kept (it is the only record of the copy) and the alignments do not start.
+	The memory for the single shared copy is reserved with the ResourceManager for the whole block.
+	"""
+	marker = os.path.join(params.get('output_location'), params.get('shared_genome_marker'))
+	if os.path.isfile(marker):
+		logging.info('Found %s from a previous run-- removing the genome it left in shared memory.' % marker)
+		if call_star_genome_load(params, 'Remove') != 0:
+			logging.error('Could not remove the genome a previous run left in shared memory (see %s).  Remove it by hand with STAR --genomeLoad Remove, '
+				'then delete that file.' % marker)
+			raise SharedGenomeException('Could not remove the genome a previous run left in shared memory.  Check the log.')
+		os.remove(marker)
+
+	genome_memory = get_genome_memory(params.get('star_genome_index'))
+	resources.reserve(genome_memory, 0)
 	try:
-		# the memory is passed in GB- we need to compare to MB, so multiply by 1000:
-		min_mem_necessary = float(min_mem_necessary)* 1000
-		call = 'free -m -o'
-		output = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE)
-		for line in output.stdout:
-			if line.startswith('Mem:'):
-				text,total,used,free,shared,buffers,cached = line.strip().split()
-				break
-	
-		available = int(free) + int(cached)
-		if available > min_mem_necessary:
-			return True
-		else:
-			logging.info('Via parsing "free" output, it seems there is less than %s MB of RAM available.' % min_mem_necessary)
-			return False
+		logging.info('Loading the genome at %s into shared memory (%.1f GB)' % (params.get('star_genome_index'), genome_memory))
+		if call_star_genome_load(params, 'LoadAndExit') != 0:
+			raise SharedGenomeException('Could not load the genome into shared memory.  Check the log.')
+		with open(marker, 'w') as outfile:
+			outfile.write(params.get('star_genome_index') + '\n')
+		yield
+	finally:
+		if os.path.isfile(marker):
+			logging.info('Removing the genome from shared memory.')
+			if call_star_genome_load(params, 'Remove') == 0:
+				os.remove(marker)
+			else:
+				logging.error('Could not remove the genome from shared memory.  It will be removed when the pipeline is restarted, or remove it by hand with STAR --genomeLoad Remove')
+		resources.release(genome_memory, 0)
+
+
+def get_journal_path(sample, params):
+	return os.path.join(sample.alignment_dir, sample.sample_name + '.' + params.get('journal_suffix'))
+
+
+def get_expected_outputs(sample, required_bam_levels):
+	"""
+	The files a finished alignment has: the BAM file (and its index) at each required level, and STAR's final log
+	"""
+	outputs = []
+	for level in required_bam_levels:
+		bam = os.path.join(sample.alignment_dir, sample.sample_name + '.' + level + '.bam')
+		outputs.extend([bam, bam + '.bai'])
+	outputs.append(os.path.join(sample.alignment_dir, sample.sample_name + '.Log.final.out'))
+	return outputs
+
+
+def file_stamps(paths):
+	"""
+	Returns a dictionary mapping each existing path to its [size, modification time]
+	"""
+	return {p: [os.path.getsize(p), os.path.getmtime(p)] for p in paths if os.path.isfile(p)}
+
+
+def parse_star_log(log_path):
+	"""
+	Parses STAR's Log.final.out, which has lines like 'Uniquely mapped reads % |	85.12%'.  Returns a dictionary of the entries.
+	"""
+	entries = {}
+	with open(log_path) as log:
+		for line in log:
+			if '|' in line:
+				key, value = line.split('|', 1)
+				entries[key.strip()] = value.strip()
+	return entries
+
+
+def write_journal_entry(sample, params, required_bam_levels):
+	"""
+	Checks that a finished alignment left all of its outputs and records them (with the reads they came from) in the sample's journal.
+	Raises an exception if anything is missing, so the alignment counts as failed.
+	"""
+	outputs = get_expected_outputs(sample, required_bam_levels)
+	missing = [p for p in outputs if not os.path.isfile(p)]
+	if len(missing) > 0:
+		logging.error('The alignment of sample %s finished, but these files are missing: %s' % (sample.sample_name, missing))
+		raise BAMFileNotFoundException('Missing alignment outputs for sample %s' % sample.sample_name)
+	star_log = parse_star_log(outputs[-1])
+	if 'Uniquely mapped reads %' not in star_log:
+		logging.error('Could not find the mapping rate in the STAR log (%s) for sample %s' % (outputs[-1], sample.sample_name))
+		raise AlignmentScriptErrorException('Incomplete STAR log for sample %s' % sample.sample_name)
+
+	fastq_files = [f for f in [sample.read_1_fastq, sample.read_2_fastq] if f]
+	entry = {'fastq_files': file_stamps(fastq_files), 'outputs': file_stamps(outputs), 'star_log': star_log}
+	journal_path = get_journal_path(sample, params)
+	with open(journal_path + '.tmp', 'w') as journal:
+		json.dump(entry, journal, indent = 1)
+	os.rename(journal_path + '.tmp', journal_path)
+	logging.info('Alignment of sample %s is complete (%s uniquely mapped).' % (sample.sample_name, star_log['Uniquely mapped reads %']))
+
+
+def journal_entry_valid(sample, params, required_bam_levels):
+	"""
+	Returns True if the sample's journal says its alignment finished, and its reads and outputs have not changed since
+	"""
+	if not hasattr(sample, 'alignment_dir'):
+		return False
+	journal_path = get_journal_path(sample, params)
+	if not os.path.isfile(journal_path):
+		return False
+	try:
+		with open(journal_path) as journal:
+			entry = json.load(journal)
 	except ValueError:
-		logging.error('Could not convert the "memory" argument parsed from the STAR config file as a float.')
-		raise ex
-	except Exception as ex:
-		logging.error('Some exception occurred while inspecting the system memory for sufficient capacity.')
-		raise ex
+		logging.warning('Could not read the alignment journal at %s.  The sample will be aligned again.' % journal_path)
+		return False
+	fastq_files = [f for f in [sample.read_1_fastq, sample.read_2_fastq] if f]
+	outputs = get_expected_outputs(sample, required_bam_levels)
+	return entry['fastq_files'] == file_stamps(fastq_files) and entry['outputs'] == file_stamps(outputs) and len(entry['outputs']) == len(outputs)
 
 
-def execute_alignments(alignment_script_paths, params):
+def execute_alignments(alignment_script_paths, params, resources, runner, memory_per_job = None, on_success = None):
 	"""
-	This method starts and monitors the alignment subprocesses.  
-	Since STAR is RAM-intensive, jobs are run sequentially instead of in parallel.
+	This method starts and monitors the alignment subprocesses, which are run by the ProcessRunner ('runner') on this machine or the cluster.  
+	Since STAR is RAM-intensive, each alignment reserves memory and cpu slots from the ResourceManager ('resources') before it starts.
+	Alignments run concurrently as long as their reservations fit, and a waiting alignment is admitted as soon as a running one finishes.
+	If an alignment fails, no new alignments are started.
+	By default, each alignment reserves 'min_memory' GB.  Pass memory_per_job to override (e.g. when the genome is in shared memory).
+	If given, on_success is called with the script path as each alignment succeeds.  If it raises an exception, the alignment counts as failed.
 	"""
 	try: 
-		sleeptime = 60 * float(params.get('wait_length'))
+		if memory_per_job is None:
+			memory_per_job = float(params.get('min_memory'))
+		cpus_per_job = int(params.get('star_threads'))
 	except ValueError as ex:
 		logging.error('Could not parse one of the arguments from the configuration file as the proper number:')
 		logging.error(ex.message)
 		raise ex 
 
+	failed_scripts = []
+	workers = []
 	for script_path in alignment_script_paths:
-		attempt_counter = 0
 		os.chmod(script_path, 0774)
-		while True: 
-			if assert_memory_reasonable(params.get('min_memory')):
-				logging.info('Executing alignment script at: %s' % script_path)
-				process = subprocess.Popen(script_path, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-				break				
-			elif attempt_counter < int(params.get('wait_cycles')):
-				logging.info('Since memory was not adequate to run STAR, wait for %s minutes' % params.get('wait_length'))
-				logging.info('This is attempt number %s on running the script at %s' % (attempt_counter + 1, script_path))
-				attempt_counter += 1
-				sleep(sleeptime)
-			else:
-				logging.warning('After waiting for %s periods of %s minutes each, still could not get enough reasonable memory to run STAR.')
-				raise AlignmentTimeoutException('Timeout on running the script at %s' % script_path)
-				
-		stdout, stderr = process.communicate()
-		logging.info('STDOUT from script at %s' % script_path)
-		logging.info(stdout)
-		logging.info('STDERR from script at %s' % script_path)
-		logging.info(stderr)
-		
-		if process.returncode != 0:			
-			logging.error('The STAR alignment process had non-zero exit status. Check the log for details.')
-			raise AlignmentScriptErrorException('Error during STAR alignment')
 
+		# blocks until a running alignment releases enough memory/cpus:
+		resources.reserve(memory_per_job, cpus_per_job)
+		if len(failed_scripts) > 0:
+			resources.release(memory_per_job, cpus_per_job)
+			break
+		worker = threading.Thread(target = run_alignment_script, args = (runner, script_path, resources, memory_per_job, cpus_per_job, failed_scripts, on_success))
+		worker.start()
+		workers.append(worker)
+
+	[w.join() for w in workers]
 
+	if len(failed_scripts) > 0:
+		logging.error('The STAR alignment process had non-zero exit status for: %s.  Check the log for details.' % ', '.join(failed_scripts))
+		raise AlignmentScriptErrorException('Error during STAR alignment')
+
+
+def run_alignment_script(runner, script_path, resources, memory, cpus, failed_scripts, on_success = None):
+	"""
+	Runs a single alignment script and releases its reservation when finished.  Failures are recorded by appending to failed_scripts.
+	"""
+	try:
+		logging.info('Executing alignment script at: %s' % script_path)
+		result = runner.run(os.path.splitext(os.path.basename(script_path))[0], script_path, progress_parsers = [parse_star_progress], memory = memory, cpus = cpus)
+		if result.returncode != 0:
+			failed_scripts.append(script_path)
+		elif on_success:
+			on_success(script_path)
+	except Exception as ex:
+		logging.error('Exception while running the alignment script at %s: %s' % (script_path, ex))
+		failed_scripts.append(script_path)
+	finally:
+		resources.release(memory, cpus)
+
+
+
+
+def parse_star_progress(line):
+	"""
+	Picks out STAR's progress messages from the output of an alignment script
+	"""
+	match = STAR_PROGRESS_PATTERN.search(line)
+	if match:
+		return 'STAR ' + match.group(1).strip()
 
 
 def get_template(script_name):
@@ -219,6 +476,19 @@ def fill_out_general_template_portion(project, template_string):
 	template_string = inject_parameter('%PICARD_DIR%', project.parameters.get('picard'), template_string)
 	template_string = inject_parameter('%GTF%', project.parameters.get('gtf'), template_string)
 	template_string = inject_parameter('%GENOME_INDEX%', project.parameters.get('star_genome_index'), template_string)
+	template_string = inject_parameter('%NUM_THREADS%', project.parameters.get('star_threads'), template_string)
+
+	# alignments attach to the shared copy of the genome if it was loaded beforehand:
+	if project.parameters.get('genome_load_mode') == SHARED_GENOME_MODE:
+		template_string = inject_parameter('%GENOME_LOAD%', 'LoadAndKeep', template_string)
+	else:
+		template_string = inject_parameter('%GENOME_LOAD%', 'NoSharedMemory', template_string)
+
+	# parameters for STAR's sorted BAM output (STAR wants the sorting memory in bytes)
+	template_string = inject_parameter('%SORTED_BAM_MODE%', project.parameters.get('sorted_bam_mode'), template_string)
+	template_string = inject_parameter('%SORT_THREADS%', project.parameters.get('sort_threads'), template_string)
+	template_string = inject_parameter('%SORT_MEMORY%', int(float(project.parameters.get('sort_memory'))*1024**3), template_string)
+	template_string = inject_parameter('%BAM_COMPRESSION%', project.parameters.get('bam_compression'), template_string)
 
 	return template_string
 
@@ -231,18 +501,3 @@ def parse_config_file(project, util_methods, config_parser):
 	this_directory = os.path.dirname(os.path.realpath(__file__))
 	config_filepath = util_methods.locate_config(this_directory)
 	project.parameters.add(config_parser.read_config(config_filepath, section = project.parameters.get('genome')))
-
-
-
-def load_remote_module(module_name, location):
-	"""
-	Loads and returns the module given by 'module_name' that resides in the given location
-	"""
-	sys.path.append(location)
-	try:
-		fileobj, filename, description = imp.find_module(module_name, [location])
-		module = imp.load_module(module_name, fileobj, filename, description)
-		return module
-	except ImportError as ex:
-		logging.error('Could not import module %s at location %s' % (module_name, location))
-		raise ex
@@ -21,6 +21,13 @@ PAIRED=%PAIRED%
 OUTDIR=%OUTDIR%
 GTF=%GTF%
 GENOME_INDEX=%GENOME_INDEX% 
+NUM_THREADS=%NUM_THREADS%
+GENOME_LOAD=%GENOME_LOAD%
+SORTED_BAM_MODE=%SORTED_BAM_MODE%
+SORT_THREADS=%SORT_THREADS%
+SORT_MEMORY=%SORT_MEMORY%
+BAM_COMPRESSION=%BAM_COMPRESSION%
+BAM_LEVELS="%BAM_LEVELS%"
 FCID=%FCID%
 LANE=%LANE%
 INDEX=%INDEX%
@@ -30,31 +37,53 @@ INDEX=%INDEX%
 NUM0=0
 NUM1=1
 
+# junctions from the GTF are inserted at alignment time.  A genome in shared memory cannot be modified, 
+# so in that case the index must have been generated with the GTF.
+if [ "$GENOME_LOAD" == "NoSharedMemory" ]; then
+    SJDB_ARGS="--sjdbGTFfile $GTF"
+else
+    SJDB_ARGS=""
+fi
+
+# in 'streamed' mode STAR adds the read groups and writes the coordinate-sorted BAM itself,
+# so the uncompressed SAM is never written.  Otherwise, STAR writes a SAM which is sorted by Picard below.
+if [ "$SORTED_BAM_MODE" == "streamed" ]; then
+    OUTPUT_ARGS="--outSAMtype BAM SortedByCoordinate \
+         --outBAMsortingThreadN $SORT_THREADS \
+         --limitBAMsortRAM $SORT_MEMORY \
+         --outBAMcompression $BAM_COMPRESSION \
+         --outSAMattrRGline ID:$FCID.Lane$LANE LB:$SAMPLE_NAME PL:ILLUMINA PU:$INDEX SM:$SAMPLE_NAME CN:CCCB"
+else
+    OUTPUT_ARGS=""
+fi
+
 #############################################################
 #Run alignments with STAR
 if [ $PAIRED -eq $NUM0 ]; then
     echo "run single-end alignment for " $SAMPLE_NAME
     $STAR --genomeDir $GENOME_INDEX \
          --readFilesIn $FASTQFILEA \
-         --runThreadN 4 \
+         --runThreadN $NUM_THREADS \
          --readFilesCommand zcat \
-         --genomeLoad NoSharedMemory \
-         --sjdbGTFfile $GTF \
+         --genomeLoad $GENOME_LOAD \
+         $SJDB_ARGS \
 	 --outSAMstrandField intronMotif \
 	 --outFilterIntronMotifs RemoveNoncanonical \
 	 --outFilterType BySJout \
+         $OUTPUT_ARGS \
          --outFileNamePrefix $OUTDIR'/'$SAMPLE_NAME'.' || { echo 'Failed during single-end alignment. Exiting.  '; exit 1; }
 elif [ $PAIRED -eq $NUM1 ]; then
     echo "run paired alignement for " $SAMPLE_NAME
     $STAR --genomeDir $GENOME_INDEX \
          --readFilesIn $FASTQFILEA $FASTQFILEB \
-         --runThreadN 4 \
+         --runThreadN $NUM_THREADS \
          --readFilesCommand zcat \
-         --genomeLoad NoSharedMemory \
-         --sjdbGTFfile $GTF \
+         --genomeLoad $GENOME_LOAD \
+         $SJDB_ARGS \
 	 --outSAMstrandField intronMotif \
 	 --outFilterIntronMotifs RemoveNoncanonical \
 	 --outFilterType BySJout \
+         $OUTPUT_ARGS \
          --outFileNamePrefix $OUTDIR'/'$SAMPLE_NAME'.' || { echo 'Failed during paired-end alignment. Exiting.  '; exit 1; }
 else
     echo "Did not specify single- or paired-end option."
@@ -71,8 +100,12 @@ SORTED_BAM=$BASE'.sort.bam'
 TMPDIR=$OUTDIR/tmp
 
 
-#add read-group lines, sort, and convert to BAM:
-java -Xmx8g -jar $PICARD_DIR/AddOrReplaceReadGroups.jar \
+if [ "$SORTED_BAM_MODE" == "streamed" ]; then
+    # STAR already wrote the sorted BAM with read groups-- just give it the usual name
+    mv $BASE'.Aligned.sortedByCoord.out.bam' $SORTED_BAM || { echo 'Failed while renaming the sorted BAM created by STAR. Exiting.  '; exit 1; }
+else
+    #add read-group lines, sort, and convert to BAM:
+    java -Xmx8g -jar $PICARD_DIR/AddOrReplaceReadGroups.jar \
 	  I=$DEFAULT_SAM \
 	  o=$SORTED_BAM \
 	  VALIDATION_STRINGENCY=LENIENT \
@@ -84,20 +117,29 @@ java -Xmx8g -jar $PICARD_DIR/AddOrReplaceReadGroups.jar \
 	  RGPU=$INDEX \
 	  RGSM=$SAMPLE_NAME \
 	  RGCN='CCCB'  || { echo 'Failed during Picard tools sort and change headers. Exiting.  '; exit 1; }
+fi
 
 
 # create index on the raw, sorted bam:
 $SAMTOOLS index $SORTED_BAM  || { echo 'Failed during samtools index step. Exiting.  '; exit 1; }
 
+# the BAM 'levels' needed downstream (space-separated).  The sorted BAM is always created; the filtered BAM files
+# are only created if requested (any other level can be created later from the sorted BAM, if needed)
+function level_requested {
+    [[ " $BAM_LEVELS " == *" $1 "* ]]
+}
+
 # make a new bam file with only primary alignments
 SORTED_AND_PRIMARY_FILTERED_BAM=$BASE.sort.primary.bam
-$SAMTOOLS view -b -F 0x0100 $SORTED_BAM > $SORTED_AND_PRIMARY_FILTERED_BAM  || { echo 'Failed while filtering for primary alignments. Exiting.  '; exit 1; }
-$SAMTOOLS index $SORTED_AND_PRIMARY_FILTERED_BAM || { echo 'Failed while indexing primary alignment BAM file. Exiting.  '; exit 1; }
+if level_requested sort.primary; then
+    $SAMTOOLS view -b -F 0x0100 $SORTED_BAM > $SORTED_AND_PRIMARY_FILTERED_BAM  || { echo 'Failed while filtering for primary alignments. Exiting.  '; exit 1; }
+    $SAMTOOLS index $SORTED_AND_PRIMARY_FILTERED_BAM || { echo 'Failed while indexing primary alignment BAM file. Exiting.  '; exit 1; }
+fi
 
-# Create a de-duped BAM file (may or may not want, but do it anyway) 	
+# Create a de-duped BAM file
 DEDUPED_PRIMARY_SORTED_BAM=$BASE.sort.primary.dedup.bam
-	
-java -Xmx8g -jar $PICARD_DIR/MarkDuplicates.jar \
+if level_requested sort.primary.dedup; then
+    java -Xmx8g -jar $PICARD_DIR/MarkDuplicates.jar \
 	INPUT=$SORTED_AND_PRIMARY_FILTERED_BAM \
 	OUTPUT=$DEDUPED_PRIMARY_SORTED_BAM \
 	ASSUME_SORTED=TRUE \
@@ -106,10 +148,11 @@ java -Xmx8g -jar $PICARD_DIR/MarkDuplicates.jar \
 	METRICS_FILE=$DEDUPED_PRIMARY_SORTED_BAM.metrics.out \
 	VALIDATION_STRINGENCY=LENIENT  || { echo 'Failed while marking and removing duplicates. Exiting.  '; exit 1; }
 
-$SAMTOOLS index $DEDUPED_PRIMARY_SORTED_BAM  || { echo 'Failed while indexing deduplicated BAM file. Exiting.  '; exit 1; }
+    $SAMTOOLS index $DEDUPED_PRIMARY_SORTED_BAM  || { echo 'Failed while indexing deduplicated BAM file. Exiting.  '; exit 1; }
+fi
 
-#cleanup
-rm $DEFAULT_SAM &
+#cleanup (there is no SAM file in 'streamed' mode)
+rm -f $DEFAULT_SAM &
 
 #remove the empty tmp directories that STAR did not cleanup
 rmdir $BASE'._tmp'
@@ -0,0 +1,272 @@
+"""
+Runs the pipeline (rnaseq_pipeline.py) end to end on synthetic projects of increasing size, with stub executables standing in for
+the external tools (see stub_tool.py), and reports how long each stage took and how much of that was spent outside the tools.
+
+For each project size, the pipeline is copied to the work directory and configured to use the stubs and the synthetic genome, a
+project is generated (see synthetic_project.py), and the pipeline is run.  The timings come from the run profile the pipeline
+writes (run_profile.json):
+	wall		how long the stage (component) ran
+	tool busy	how long at least one of the stage's tools was running
+	overhead	wall - tool busy: the time the stage spent in python (scheduling, parsing, plotting, writing files)
+The overall overhead also includes building the pipeline and writing the report, which happen outside of the stages.
+
+Since the stubs do almost no work, the overhead is what grows when the python side scales badly with the number of samples.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from ConfigParser import RawConfigParser
+
+import synthetic_project
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_HOME = os.path.dirname(BENCHMARK_DIR)
+STUB_TOOL = os.path.join(BENCHMARK_DIR, 'stub_tool.py')
+
+# the executables the pipeline calls, all of which are replaced by stub_tool.py
+STUBBED_TOOLS = ['STAR', 'samtools', 'java', 'featureCounts', 'Rscript', 'bedtools', 'pdflatex', 'bibtex']
+
+# the parts of the pipeline's tree which are not needed to run it
+IGNORED_PATHS = ['.git', 'tests', 'benchmarks', 'test_output', '*.pyc']
+
+DEFAULT_SAMPLE_COUNTS = [10, 100, 1000]
+
+# the file (in the work directory) the results are written to
+RESULTS_FILE = 'benchmark_results.json'
+
+
+class BenchmarkException(Exception):
+	pass
+
+
+def set_config_values(config_filepath, section, values):
+	"""
+	Sets the given options in a section of a configuration file (which is created if missing).  The values are written as-is.
+	"""
+	parser = RawConfigParser()
+	parser.read(config_filepath)
+	if section != 'DEFAULT' and not parser.has_section(section):
+		parser.add_section(section)
+	for k, v in values.items():
+		parser.set(section, k, v)
+	with open(config_filepath, 'w') as f:
+		parser.write(f)
+
+
+def create_stubs(bin_dir):
+	"""
+	Writes an executable for each of the stubbed tools to bin_dir, which calls stub_tool.py with the tool's name
+	"""
+	if not os.path.isdir(bin_dir):
+		os.makedirs(bin_dir)
+	for tool in STUBBED_TOOLS:
+		path = os.path.join(bin_dir, tool)
+		with open(path, 'w') as f:
+			f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, STUB_TOOL, tool))
+		os.chmod(path, 0755)
+
+
+def install_pipeline(pipeline_dir, bin_dir, reference, alignment_slots, counting_mode = 'per_sample'):
+	"""
+	Copies the pipeline to pipeline_dir and configures the copy to call the stubs in bin_dir and to know about the synthetic genome.
+	STAR is given 1 GB and 1 cpu per alignment, and alignment_slots of each in total, so the number of alignments running at once
+	does not depend on the machine running the benchmark.  featureCounts runs in the given counting_mode (see feature_counts.cfg).
+	"""
+	if os.path.isdir(pipeline_dir):
+		shutil.rmtree(pipeline_dir)
+	shutil.copytree(PIPELINE_HOME, pipeline_dir, ignore = shutil.ignore_patterns(*IGNORED_PATHS))
+	genome = synthetic_project.GENOME_NAME
+	stub = lambda tool: os.path.join(bin_dir, tool)
+
+	set_config_values(os.path.join(pipeline_dir, 'genome_info', 'genome_info.cfg'), genome, {'gtf': reference['gtf'],
+			'genome_fasta': reference['genome_fasta'],
+			'genome_source_link': 'synthetic',
+			'chromosomes': ','.join(synthetic_project.CHROMOSOMES)})
+	star_cfg = os.path.join(pipeline_dir, 'aligners', 'star', 'star.cfg')
+	set_config_values(star_cfg, 'DEFAULT', {'star_align': stub('STAR'),
+			'samtools': stub('samtools'),
+			'picard': bin_dir,
+			'min_memory': '1',
+			'star_threads': '1',
+			'max_memory': str(alignment_slots),
+			'max_cpus': str(alignment_slots)})
+	set_config_values(star_cfg, genome, {'star_genome_index': reference['star_genome_index']})
+	set_config_values(os.path.join(pipeline_dir, 'components', 'feature_counts', 'feature_counts.cfg'), 'COMPONENT_SPECIFIC', {'feature_counts': stub('featureCounts'),
+			'counting_mode': counting_mode})
+	set_config_values(os.path.join(pipeline_dir, 'components', 'rna_seQC', 'rna_seqc.cfg'), genome, {'rnaseqc_gtf': reference['gtf']})
+	set_config_values(os.path.join(pipeline_dir, 'components', 'gsea', 'gsea.cfg'), 'COMPONENT_SPECIFIC', {'acceptable_genomes': genome + ','})
+	set_config_values(os.path.join(pipeline_dir, 'components', 'pdf_report', 'report.cfg'), 'COMPONENT_SPECIFIC', {'samtools': stub('samtools'),
+			'bedtools_path': stub('bedtools')})
+
+
+def stub_environment(bin_dir, options):
+	"""
+	Returns the environment for the pipeline: the stubs come first on the PATH, and are configured by the STUB_* variables (see stub_tool.py)
+	"""
+	env = dict(os.environ)
+	env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+	env['STUB_LATENCY'] = str(options['latency'])
+	for tool, latency in options['tool_latency']:
+		env['STUB_LATENCY_' + tool.upper()] = str(latency)
+	env['STUB_BAM_SIZE'] = str(options['bam_size'])
+	env['STUB_GENES'] = str(options['gene_count'])
+	env['STUB_CHROMOSOMES'] = ','.join(synthetic_project.CHROMOSOMES)
+	env['STUB_COVERAGE_ROWS'] = str(options['coverage_rows'])
+	return env
+
+
+def busy_time(tasks):
+	"""
+	Returns the time during which at least one of the tasks was running (i.e. the length of the union of their intervals)
+	"""
+	intervals = sorted([(t['start'], t['start'] + t['wall_time']) for t in tasks])
+	total = 0.0
+	current_start, current_end = None, None
+	for start, end in intervals:
+		if current_end is None or start > current_end:
+			if current_end is not None:
+				total += current_end - current_start
+			current_start, current_end = start, end
+		else:
+			current_end = max(current_end, end)
+	if current_end is not None:
+		total += current_end - current_start
+	return total
+
+
+def summarize(profile, launched, wall_time):
+	"""
+	Summarizes the run profile of a run that was launched at 'launched' and took wall_time seconds in total
+	"""
+	stages = []
+	for component in profile['components']:
+		tasks = [t for t in profile['tasks'] if t.get('component') == component['name']]
+		tool_busy = busy_time(tasks)
+		stages.append({'name': component['name'],
+			'wall_time': component['wall_time'],
+			'tool_busy_time': tool_busy,
+			'overhead': component['wall_time'] - tool_busy,
+			'task_count': component['task_count'],
+			'task_wall_time': component['task_wall_time'] or 0.0})
+	first_start = min([c['start'] for c in profile['components']]) if profile['components'] else launched + wall_time
+	tool_busy = busy_time(profile['tasks'])
+	return {'wall_time': wall_time,
+		'startup_time': first_start - launched,
+		'tool_busy_time': tool_busy,
+		'overhead': wall_time - tool_busy,
+		'task_count': len(profile['tasks']),
+		'pipeline_max_rss': profile['pipeline_max_rss'],
+		'stages': stages}
+
+
+def run_pipeline(pipeline_dir, project, output_dir, env, paired):
+	"""
+	Runs the pipeline on the project and returns (exit status, launch time, wall time)
+	"""
+	command = [sys.executable, os.path.join(pipeline_dir, 'rnaseq_pipeline.py'), 'run',
+			'-d', project['project_directory'],
+			'-g', synthetic_project.GENOME_NAME,
+			'-o', output_dir,
+			'-s', project['sample_annotation_file']]
+	if paired:
+		command.append('-paired')
+	logging.info('Running: %s' % ' '.join(command))
+	launched = time.time()
+	with open(os.devnull, 'w') as devnull:
+		returncode = subprocess.call(command, env = env, stdout = devnull, stderr = subprocess.STDOUT)
+	return returncode, launched, time.time() - launched
+
+
+def run_benchmark(sample_count, work_dir, options):
+	"""
+	Generates a project with sample_count samples in work_dir, runs the pipeline on it, and returns the summary of the run
+	"""
+	run_dir = os.path.join(work_dir, '%d_samples' % sample_count)
+	if os.path.isdir(run_dir):
+		shutil.rmtree(run_dir)
+	bin_dir = os.path.join(run_dir, 'bin')
+	output_dir = os.path.join(run_dir, 'output')
+
+	generation_start = time.time()
+	project = synthetic_project.create_project(os.path.join(run_dir, 'project'), sample_count,
+				reads_per_sample = options['reads_per_sample'],
+				paired = options['paired'],
+				gene_count = options['gene_count'])
+	logging.info('Generated %d samples in %.1f s' % (sample_count, time.time() - generation_start))
+
+	create_stubs(bin_dir)
+	install_pipeline(os.path.join(run_dir, 'pipeline'), bin_dir, project, options['alignment_slots'], options.get('counting_mode', 'per_sample'))
+	returncode, launched, wall_time = run_pipeline(os.path.join(run_dir, 'pipeline'), project, output_dir, stub_environment(bin_dir, options), options['paired'])
+
+	profile_path = os.path.join(output_dir, 'run_profile.json')
+	if not os.path.isfile(profile_path):
+		raise BenchmarkException('The pipeline (exit status %d) did not write a run profile for %d samples.  See the log in %s' % (returncode, sample_count, output_dir))
+	with open(profile_path) as f:
+		summary = summarize(json.load(f), launched, wall_time)
+	summary.update({'samples': sample_count, 'returncode': returncode, 'output_location': output_dir})
+	return summary
+
+
+def format_summary(summary):
+	lines = ['%d samples: %.1f s in total, %.1f s of it in the tools, %.1f s overhead (%.3f s per sample), %.1f s startup, %d tasks, peak memory %.0f MB%s' % (
+			summary['samples'], summary['wall_time'], summary['tool_busy_time'], summary['overhead'], summary['overhead']/summary['samples'],
+			summary['startup_time'], summary['task_count'], summary['pipeline_max_rss'],
+			'' if summary['returncode'] == 0 else '  ** FAILED with exit status %d, see %s **' % (summary['returncode'], summary['output_location']))]
+	lines.append('\t%-16s %10s %10s %10s %8s %12s' % ('stage', 'wall (s)', 'busy (s)', 'overhead', 'tasks', 'task sum (s)'))
+	for stage in summary['stages']:
+		lines.append('\t%-16s %10.2f %10.2f %10.2f %8d %12.2f' % (stage['name'], stage['wall_time'], stage['tool_busy_time'], stage['overhead'], stage['task_count'], stage['task_wall_time']))
+	return '\n'.join(lines)
+
+
+def parse_tool_latency(value):
+	try:
+		tool, latency = value.split('=')
+		return (tool, float(latency))
+	except ValueError:
+		raise argparse.ArgumentTypeError('Expected TOOL=SECONDS, e.g. STAR=2.5, but got %s' % value)
+
+
+def setup_args():
+	parser = argparse.ArgumentParser(description = 'Benchmarks the pipeline end to end on synthetic projects, with stubs in place of the external tools.')
+	parser.add_argument('-n', '--samples', type = int, nargs = '+', default = DEFAULT_SAMPLE_COUNTS, help = 'The project sizes (number of samples) to run.', dest = 'sample_counts')
+	parser.add_argument('-w', '--work-dir', default = None, help = 'Where to put the projects and pipeline output.  Defaults to a temporary directory, removed afterwards.', dest = 'work_dir')
+	parser.add_argument('--latency', type = float, default = 0.0, help = 'Seconds each tool call takes.', dest = 'latency')
+	parser.add_argument('--tool-latency', type = parse_tool_latency, action = 'append', default = [], help = 'Seconds the calls to one tool take, as TOOL=SECONDS (repeatable).', dest = 'tool_latency')
+	parser.add_argument('--bam-size', type = int, default = synthetic_project.DEFAULT_BAM_SIZE, help = 'The size (in bytes) of the BAM files the stubs write.', dest = 'bam_size')
+	parser.add_argument('--reads', type = int, default = synthetic_project.DEFAULT_READS_PER_SAMPLE, help = 'The number of reads in each FASTQ file.', dest = 'reads_per_sample')
+	parser.add_argument('--genes', type = int, default = synthetic_project.DEFAULT_GENE_COUNT, help = 'The number of genes in the count files.', dest = 'gene_count')
+	parser.add_argument('--coverage-rows', type = int, default = 100, help = 'The number of coverage (bedGraph) lines per chromosome.', dest = 'coverage_rows')
+	parser.add_argument('--alignment-slots', type = int, default = multiprocessing.cpu_count(), help = 'The number of alignments that may run at once.', dest = 'alignment_slots')
+	parser.add_argument('--counting-mode', default = 'per_sample', choices = ['per_sample', 'cohort'], help = 'How featureCounts is run (see feature_counts.cfg).', dest = 'counting_mode')
+	parser.add_argument('-paired', action = 'store_true', default = False, help = 'Use paired-end samples.', dest = 'paired')
+	return parser
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level = logging.INFO, format = '%(asctime)s:%(levelname)s:%(message)s')
+	options = vars(setup_args().parse_args())
+	work_dir = options['work_dir'] or tempfile.mkdtemp(prefix = 'rnaseq_benchmark.')
+	work_dir = os.path.abspath(work_dir)
+
+	results = []
+	try:
+		for sample_count in options['sample_counts']:
+			summary = run_benchmark(sample_count, work_dir, options)
+			results.append(summary)
+			print(format_summary(summary))
+		with open(os.path.join(work_dir, RESULTS_FILE), 'w') as f:
+			json.dump({'options': options, 'results': results}, f, indent = 2)
+		if options['work_dir']:
+			print('Results are in %s' % os.path.join(work_dir, RESULTS_FILE))
+	finally:
+		if not options['work_dir']:
+			shutil.rmtree(work_dir)
+	sys.exit(0 if all([r['returncode'] == 0 for r in results]) else 1)
@@ -0,0 +1,324 @@
+"""
+A stand-in for the external tools the pipeline calls (STAR, samtools, Picard and the other java tools, featureCounts, Rscript, bedtools,
+and latex).  It is called as 'stub_tool.py TOOL ARGS...', where ARGS are what the pipeline would pass to the real tool.  Each stub waits
+for a configurable time and then writes the output files the pipeline expects, of a configurable size, so the pipeline can run end to end
+without any of the tools (or real data).
+
+The stubs are configured through environment variables:
+	STUB_LATENCY		seconds each call takes (default 0)
+	STUB_LATENCY_<TOOL>	seconds the calls of one tool take, e.g. STUB_LATENCY_STAR (overrides STUB_LATENCY)
+	STUB_BAM_SIZE		the size (in bytes) of the BAM files written by STAR and Picard.  SAM files are four times this size.
+	STUB_GENES		the number of genes in the count files
+	STUB_CHROMOSOMES	the chromosomes reported by samtools idxstats and bedtools (comma-separated)
+	STUB_COVERAGE_ROWS	the number of bedGraph lines bedtools writes for each chromosome
+"""
+
+import os
+import sys
+import time
+import gzip
+import shutil
+import math
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_project
+
+STAR_LOG_TEMPLATE = """                                 Started job on |	%(date)s
+                             Started mapping on |	%(date)s
+                                    Finished on |	%(date)s
+                          Number of input reads |	%(reads)d
+                      Average input read length |	50
+                    UNIQUE READS:
+                   Uniquely mapped reads number |	%(unique)d
+                        Uniquely mapped reads %% |	%(unique_pct).2f%%
+                    MULTI-MAPPING READS:
+        Number of reads mapped to multiple loci |	0
+             %% of reads mapped to multiple loci |	%(multi_pct).2f%%
+             %% of reads mapped to too many loci |	%(too_many_pct).2f%%
+                    UNMAPPED READS:
+       %% of reads unmapped: too many mismatches |	%(mismatch_pct).2f%%
+                 %% of reads unmapped: too short |	%(short_pct).2f%%
+                     %% of reads unmapped: other |	%(other_pct).2f%%
+"""
+
+
+class StubException(Exception):
+	pass
+
+
+def get_setting(name, default):
+	value = os.environ.get(name, '')
+	return value if value != '' else default
+
+
+def bam_size():
+	return int(get_setting('STUB_BAM_SIZE', synthetic_project.DEFAULT_BAM_SIZE))
+
+
+def chromosomes():
+	return [c.strip() for c in get_setting('STUB_CHROMOSOMES', ','.join(synthetic_project.CHROMOSOMES)).split(',') if c.strip()]
+
+
+def flag_values(args):
+	"""
+	Maps each '-flag' or '--flag' in args to the list of values following it
+	"""
+	values = {}
+	flag = None
+	for arg in args:
+		if arg.startswith('-') and len(arg) > 1 and not arg[1].isdigit():
+			flag = arg.lstrip('-')
+			values[flag] = []
+		elif flag is not None:
+			values[flag].append(arg)
+	return values
+
+
+def picard_values(args):
+	"""
+	Picard takes its arguments as KEY=VALUE (the keys are case-insensitive)
+	"""
+	return {k.upper(): v for k, v in [a.split('=', 1) for a in args if '=' in a]}
+
+
+def write_text(path, contents):
+	with open(path, 'w') as f:
+		f.write(contents)
+
+
+def count_reads(fastq_path):
+	"""
+	Reads through the (gzipped) FASTQ file like an aligner would, and returns the number of reads in it
+	"""
+	lines = 0
+	with gzip.open(fastq_path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024**2), ''):
+			lines += chunk.count('\n')
+	return lines/4
+
+
+def star(args):
+	values = flag_values(args)
+	prefix = values['outFileNamePrefix'][0]
+	genome_load = values.get('genomeLoad', ['NoSharedMemory'])[0]
+	if genome_load in ('LoadAndExit', 'Remove'):
+		print('..... %s the genome in %s' % ('loaded' if genome_load == 'LoadAndExit' else 'removed', values['genomeDir'][0]))
+		write_text(prefix + 'Log.out', 'genomeLoad %s\n' % genome_load)
+		return
+
+	print('..... started STAR run')
+	reads = count_reads(values['readFilesIn'][0])
+	print('..... started mapping')
+	if not os.path.isdir(prefix + '_tmp'):
+		os.makedirs(prefix + '_tmp')
+	if 'BAM' in values.get('outSAMtype', []):
+		print('..... started sorting BAM')
+		synthetic_project.write_bam(prefix + 'Aligned.sortedByCoord.out.bam', bam_size())
+	else:
+		with open(prefix + 'Aligned.out.sam', 'w') as f:
+			f.write('@HD\tVN:1.4\n')
+			f.write('@CO\t' + 'N' * max(0, 4*bam_size() - 16) + '\n')
+	print('..... finished successfully')
+
+	rng = random.Random(prefix)
+	unique = rng.uniform(70, 90)
+	multi = rng.uniform(2, 10)
+	too_many = rng.uniform(0, 2)
+	mismatch = rng.uniform(0, 2)
+	short = rng.uniform(0, 100 - unique - multi - too_many - mismatch)
+	date = time.strftime('%b %d %H:%M:%S')
+	write_text(prefix + 'Log.final.out', STAR_LOG_TEMPLATE % {'date': date, 'reads': reads, 'unique': int(reads*unique/100), 'unique_pct': unique,
+		'multi_pct': multi, 'too_many_pct': too_many, 'mismatch_pct': mismatch, 'short_pct': short, 'other_pct': 100 - unique - multi - too_many - mismatch - short})
+	write_text(prefix + 'Log.out', 'STAR %s\n' % ' '.join(args))
+	write_text(prefix + 'Log.progress.out', '')
+	write_text(prefix + 'SJ.out.tab', '')
+
+
+def samtools(args):
+	command = args[0]
+	if command == 'index':
+		synthetic_project.write_bam(args[1] + '.bai', 1024)
+	elif command == 'view':
+		with open(args[-1], 'rb') as f:
+			shutil.copyfileobj(f, sys.stdout)
+	elif command == 'idxstats':
+		rng = random.Random(args[1])
+		for chrom in chromosomes():
+			sys.stdout.write('%s\t%d\t%d\t0\n' % (chrom, synthetic_project.CHROMOSOME_LENGTH, rng.randint(1000, 100000)))
+		sys.stdout.write('*\t0\t0\t%d\n' % rng.randint(0, 1000))
+	else:
+		raise StubException('samtools %s is not stubbed' % command)
+
+
+def picard(tool, args):
+	values = picard_values(args)
+	if tool == 'AddOrReplaceReadGroups':
+		synthetic_project.write_bam(values['O'], bam_size())
+	elif tool == 'MarkDuplicates':
+		shutil.copyfile(values['INPUT'], values['OUTPUT'])
+		write_text(values['METRICS_FILE'], '## METRICS CLASS\tnet.sf.picard.sam.DuplicationMetrics\n')
+	else:
+		raise StubException('Picard %s is not stubbed' % tool)
+
+
+def java(args):
+	"""
+	Dispatches on the jar (java -jar X.jar ...) or the main class (java -cp X.jar some.Class ...)
+	"""
+	program = None
+	program_args = []
+	i = 0
+	while i < len(args):
+		arg = args[i]
+		if arg == '-jar':
+			program = os.path.splitext(os.path.basename(args[i + 1]))[0]
+			program_args = args[i + 2:]
+			break
+		elif arg in ('-cp', '-classpath'):
+			i += 1
+		elif not arg.startswith('-'):
+			program = arg.split('.')[-1]
+			program_args = args[i + 1:]
+			break
+		i += 1
+
+	if program in ('AddOrReplaceReadGroups', 'MarkDuplicates'):
+		picard(program, program_args)
+	elif program.startswith('RNA-SeQC'):
+		output_dir = flag_values(program_args)['o'][0]
+		if not os.path.isdir(output_dir):
+			os.makedirs(output_dir)
+		write_text(os.path.join(output_dir, 'report.html'), '<html><body>RNA-SeQC report</body></html>\n')
+	elif program == 'Gsea':
+		values = flag_values(program_args)
+		report_dir = os.path.join(values['out'][0], '%s.Gsea.%d' % (values['rpt_label'][0], int(time.time()*1000)))
+		os.makedirs(report_dir)
+		write_text(os.path.join(report_dir, 'index.html'), '<html><body>GSEA report</body></html>\n')
+	else:
+		raise StubException('java program %s is not stubbed' % program)
+
+
+def feature_counts(args):
+	values = flag_values(args)
+	# the BAM files follow the output file
+	output_path, bams = values['o'][0], values['o'][1:]
+	gene_count = int(get_setting('STUB_GENES', synthetic_project.DEFAULT_GENE_COUNT))
+	# the counts only depend on the sample, so the count files of a sample's BAM files look alike
+	totals = synthetic_project.write_count_table(output_path, bams, gene_count, [os.path.basename(bam).split('.')[0] for bam in bams])
+	for total in totals:
+		print('|| Successfully assigned alignments : %d (85.0%%) ||' % total)
+
+
+def write_deseq_results(count_matrix_path, output_path):
+	with open(count_matrix_path) as f:
+		genes = [line.split('\t')[0] for i, line in enumerate(f) if i > 0]
+	rng = random.Random(output_path)
+	with open(output_path, 'w') as f:
+		f.write(',baseMean,log2FoldChange,lfcSE,stat,pvalue,padj\n')
+		for gene in genes:
+			p = rng.random()
+			f.write('%s,%.3f,%.3f,0.5,1.0,%.4g,%.4g\n' % (gene, rng.uniform(1, 1000), rng.gauss(0, 2), p, min(1.0, p*2)))
+
+
+def write_vst_table(count_matrix_path, annotation_path, output_path):
+	"""
+	Writes log2(count + 1) of the annotated samples in place of their variance-stabilized counts
+	"""
+	with open(annotation_path) as f:
+		annotated = [line.split('\t')[0] for line in f if line.strip()]
+	with open(count_matrix_path) as f:
+		columns = f.readline().rstrip('\n').split('\t')
+		selected = [columns.index(s) for s in annotated if s in columns]
+		with open(output_path, 'w') as output:
+			output.write('\t'.join(['Gene'] + [columns[j] for j in selected]) + '\n')
+			for line in f:
+				fields = line.rstrip('\n').split('\t')
+				output.write('\t'.join([fields[0]] + ['%.4f' % math.log(int(fields[j]) + 1, 2) for j in selected]) + '\n')
+
+
+def r_worker():
+	"""
+	Speaks the protocol of utils/r_worker.R: the latency of the call is that of starting R, and the scripts it is given run without it
+	"""
+	print('R_WORKER READY')
+	sys.stdout.flush()
+	for line in iter(sys.stdin.readline, ''):
+		fields = line.rstrip('\n').split('\t')
+		if fields[0] == 'PING':
+			print('R_WORKER PONG')
+		elif fields[0] == 'RUN':
+			before = os.times()
+			status = 0
+			with open(fields[1], 'w') as output:
+				try:
+					rscript(fields[2:])
+				except Exception as ex:
+					output.write('Error: %s\n' % ex)
+					status = 1
+			used = os.times()
+			print('R_WORKER DONE %d %.3f %.3f' % (status, used[0] - before[0], used[1] - before[1]))
+		sys.stdout.flush()
+
+
+def rscript(args):
+	script = os.path.basename(args[0])
+	if script == 'r_worker.R':
+		# args: the packages to load
+		r_worker()
+	elif script == 'normalize.R':
+		# args: raw count matrix, normalized count matrix, sample annotation
+		shutil.copyfile(args[1], args[2])
+	elif script == 'deseq_batch.R':
+		# args: count matrix, sample annotation, contrasts file (control, experimental, output file per line)
+		with open(args[3]) as f:
+			for line in f:
+				ctrl, exp, output_path = line.rstrip('\n').split('\t')
+				write_deseq_results(args[1], output_path)
+	elif script == 'deseq_vst.R':
+		# args: count matrix, sample annotation, output file
+		write_vst_table(args[1], args[2], args[3])
+	elif script.startswith('deseq'):
+		# args: count matrix, sample annotation, control condition, experimental condition, output file
+		write_deseq_results(args[1], args[5])
+	else:
+		raise StubException('R script %s is not stubbed' % script)
+
+
+def bedtools(args):
+	rows = int(get_setting('STUB_COVERAGE_ROWS', 100))
+	rng = random.Random(flag_values(args)['ibam'][0])
+	step = synthetic_project.CHROMOSOME_LENGTH/rows
+	for chrom in chromosomes():
+		for i in range(rows):
+			sys.stdout.write('%s\t%d\t%d\t%d\n' % (chrom, i*step, (i + 1)*step, rng.randint(0, 50)))
+
+
+def pdflatex(args):
+	name = args[-1][:-len('.tex')] if args[-1].endswith('.tex') else args[-1]
+	write_text(name + '.pdf', '%PDF-1.4\n%%EOF\n')
+
+
+def bibtex(args):
+	write_text(args[-1] + '.bbl', '')
+
+
+TOOLS = {'STAR': star, 'samtools': samtools, 'java': java, 'featureCounts': feature_counts, 'Rscript': rscript,
+	'bedtools': bedtools, 'pdflatex': pdflatex, 'bibtex': bibtex}
+
+
+def main(argv):
+	tool = argv[1]
+	latency = float(get_setting('STUB_LATENCY_' + tool.upper(), get_setting('STUB_LATENCY', 0)))
+	if latency > 0:
+		time.sleep(latency)
+	try:
+		TOOLS[tool](argv[2:])
+	except Exception as ex:
+		sys.stderr.write('stub %s failed on %s: %s\n' % (tool, ' '.join(argv[2:]), ex))
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,175 @@
+"""
+Creates synthetic projects for benchmarking the pipeline: Sample_* directories with gzipped FASTQ files, a sample annotation,
+and a small reference (GTF, FASTA, and STAR index) for a 'synthetic' genome.  With prealigned = True, each sample also gets
+fake BAM files and featureCounts-format count files, laid out the way the STAR aligner leaves them.
+
+The files only have to look right to the pipeline-- the stub tools (see stub_tool.py) never actually align or count anything.
+"""
+
+import os
+import sys
+import gzip
+import random
+import argparse
+
+# mirror the default project configuration (project_configurations/default_project.cfg)
+SAMPLE_DIR_PREFIX = 'Sample_'
+READ_1_FASTQ_TAG = '_R1_.final.fastq.gz'
+READ_2_FASTQ_TAG = '_R2_.final.fastq.gz'
+
+# the name the synthetic genome is configured under, and its chromosomes
+GENOME_NAME = 'synthetic'
+CHROMOSOMES = ['chr1', 'chr2', 'chr3']
+CHROMOSOME_LENGTH = 1000000
+
+ANNOTATION_FILE = 'sample_annotation.txt'
+REFERENCE_DIR = 'reference'
+ALIGNMENT_DIR = 'star_align'
+BAM_LEVELS = ['sort', 'sort.primary']
+
+DEFAULT_READ_LENGTH = 50
+DEFAULT_READS_PER_SAMPLE = 1000
+DEFAULT_GENE_COUNT = 2000
+DEFAULT_BAM_SIZE = 64*1024
+
+# the bytes a BAM file starts with (the BGZF header).  Nothing reads past them.
+BAM_MAGIC = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+
+def sample_names(sample_count):
+	return ['S%04d' % i for i in range(1, sample_count + 1)]
+
+
+def gene_names(gene_count):
+	return ['GENE%05d' % i for i in range(1, gene_count + 1)]
+
+
+def write_fastq(path, sample_name, read_count, read_length = DEFAULT_READ_LENGTH):
+	"""
+	Writes a gzipped FASTQ file with read_count random reads
+	"""
+	rng = random.Random(path)
+	quality = 'I' * read_length
+	with gzip.open(path, 'wb', compresslevel = 1) as f:
+		for i in range(read_count):
+			bases = ''.join([rng.choice('ACGT') for j in range(read_length)])
+			f.write('@%s.%d\n%s\n+\n%s\n' % (sample_name, i, bases, quality))
+
+
+def write_bam(path, size):
+	"""
+	Writes a fake BAM file of (about) size bytes
+	"""
+	with open(path, 'wb') as f:
+		f.write(BAM_MAGIC)
+		remaining = max(0, size - len(BAM_MAGIC))
+		chunk = '\0' * min(remaining, 1024**2)
+		while remaining > 0:
+			f.write(chunk[:remaining])
+			remaining -= len(chunk)
+
+
+def write_count_file(path, bam_path, gene_count, seed):
+	"""
+	Writes a count file in featureCounts' format (a comment line, a header, then one line per gene with the count in the 7th column)
+	and its .summary file.  The counts are random, but the same seed always gives the same counts.  Returns the total count.
+	"""
+	return write_count_table(path, [bam_path], gene_count, [seed])[0]
+
+
+def write_count_table(path, bam_paths, gene_count, seeds):
+	"""
+	Writes a count file for several BAM files at once, as featureCounts does when given more than one: a column of counts (from the
+	7th column on) for each BAM file, with the counts of each drawn using the corresponding seed.  Returns the total counts.
+	"""
+	rngs = [random.Random(seed) for seed in seeds]
+	totals = [0] * len(bam_paths)
+	with open(path, 'w') as f:
+		f.write('# Program:featureCounts v1.4.4; Command:"featureCounts" "-o" "%s" %s\n' % (path, ' '.join(['"%s"' % b for b in bam_paths])))
+		f.write('\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length'] + bam_paths) + '\n')
+		for i, gene in enumerate(gene_names(gene_count)):
+			counts = [int(rng.expovariate(1.0/200)) for rng in rngs]
+			totals = [t + c for t, c in zip(totals, counts)]
+			start = (i * 1000) % CHROMOSOME_LENGTH + 1
+			f.write('\t'.join([gene, CHROMOSOMES[i % len(CHROMOSOMES)], str(start), str(start + 999), '+', '1000'] + [str(c) for c in counts]) + '\n')
+	with open(path + '.summary', 'w') as f:
+		f.write('Status\t%s\nAssigned\t%s\nUnassigned_NoFeatures\t%s\n' % ('\t'.join(bam_paths), '\t'.join(map(str, totals)), '\t'.join([str(t/10) for t in totals])))
+	return totals
+
+
+def create_reference(reference_dir, gene_count = DEFAULT_GENE_COUNT):
+	"""
+	Writes the GTF, FASTA, and STAR index for the synthetic genome.  Returns a dictionary of their paths.
+	"""
+	if not os.path.isdir(reference_dir):
+		os.makedirs(reference_dir)
+	gtf = os.path.join(reference_dir, 'genes.gtf')
+	with open(gtf, 'w') as f:
+		for i, gene in enumerate(gene_names(gene_count)):
+			start = (i * 1000) % CHROMOSOME_LENGTH + 1
+			attributes = 'gene_id "%s"; transcript_id "%s.1"; gene_name "%s";' % (gene, gene, gene)
+			f.write('\t'.join([CHROMOSOMES[i % len(CHROMOSOMES)], 'synthetic', 'exon', str(start), str(start + 999), '.', '+', '.', attributes]) + '\n')
+	fasta = os.path.join(reference_dir, 'genome.fa')
+	with open(fasta, 'w') as f:
+		for chrom in CHROMOSOMES:
+			f.write('>%s\n' % chrom)
+			f.write(('ACGT' * 15 + '\n') * 10)
+	star_index = os.path.join(reference_dir, 'star_index')
+	if not os.path.isdir(star_index):
+		os.makedirs(star_index)
+	for index_file in ['Genome', 'SA', 'SAindex', 'chrName.txt']:
+		with open(os.path.join(star_index, index_file), 'w') as f:
+			f.write('\n'.join(CHROMOSOMES) + '\n')
+	return {'gtf': gtf, 'genome_fasta': fasta, 'star_genome_index': star_index}
+
+
+def create_project(project_dir, sample_count, condition_count = 2, reads_per_sample = DEFAULT_READS_PER_SAMPLE, paired = False,
+		prealigned = False, gene_count = DEFAULT_GENE_COUNT, bam_size = DEFAULT_BAM_SIZE):
+	"""
+	Creates a project with sample_count samples, split evenly between condition_count conditions, in project_dir.
+	Returns a dictionary with the paths to the sample annotation file and the reference files, and the sample names.
+	"""
+	if not os.path.isdir(project_dir):
+		os.makedirs(project_dir)
+	names = sample_names(sample_count)
+	conditions = ['Condition%d' % (i + 1) for i in range(condition_count)]
+
+	with open(os.path.join(project_dir, ANNOTATION_FILE), 'w') as f:
+		for i, name in enumerate(names):
+			f.write('%s\t%s\n' % (name, conditions[i % condition_count]))
+
+	for name in names:
+		sample_dir = os.path.join(project_dir, SAMPLE_DIR_PREFIX + name)
+		if not os.path.isdir(sample_dir):
+			os.makedirs(sample_dir)
+		write_fastq(os.path.join(sample_dir, name + READ_1_FASTQ_TAG), name, reads_per_sample)
+		if paired:
+			write_fastq(os.path.join(sample_dir, name + READ_2_FASTQ_TAG), name, reads_per_sample)
+		if prealigned:
+			alignment_dir = os.path.join(sample_dir, ALIGNMENT_DIR)
+			if not os.path.isdir(alignment_dir):
+				os.makedirs(alignment_dir)
+			for level in BAM_LEVELS:
+				bam = os.path.join(alignment_dir, '%s.%s.bam' % (name, level))
+				write_bam(bam, bam_size)
+				write_bam(bam + '.bai', 1024)
+				write_count_file(os.path.join(alignment_dir, '%s.%s.counts' % (name, level)), bam, gene_count, name)
+
+	project = {'project_directory': project_dir, 'sample_annotation_file': os.path.join(project_dir, ANNOTATION_FILE), 'samples': names}
+	project.update(create_reference(os.path.join(project_dir, REFERENCE_DIR), gene_count))
+	return project
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Creates a synthetic project for benchmarking the pipeline.')
+	parser.add_argument('project_directory', help = 'The directory in which to create the project.')
+	parser.add_argument('-n', '--samples', type = int, default = 10, help = 'The number of samples.', dest = 'sample_count')
+	parser.add_argument('--conditions', type = int, default = 2, help = 'The number of conditions the samples are split between.', dest = 'condition_count')
+	parser.add_argument('--reads', type = int, default = DEFAULT_READS_PER_SAMPLE, help = 'The number of reads in each FASTQ file.', dest = 'reads_per_sample')
+	parser.add_argument('--genes', type = int, default = DEFAULT_GENE_COUNT, help = 'The number of genes in the GTF and count files.', dest = 'gene_count')
+	parser.add_argument('--bam-size', type = int, default = DEFAULT_BAM_SIZE, help = 'The size (in bytes) of the fake BAM files.', dest = 'bam_size')
+	parser.add_argument('-paired', action = 'store_true', default = False, help = 'Create paired-end FASTQ files.', dest = 'paired')
+	parser.add_argument('-prealigned', action = 'store_true', default = False, help = 'Also create BAM and count files for each sample.', dest = 'prealigned')
+	args = vars(parser.parse_args())
+	project = create_project(os.path.abspath(args.pop('project_directory')), **args)
+	sys.stdout.write('Created %d samples in %s\n' % (len(project['samples']), project['project_directory']))
@@ -1,18 +1,31 @@
 import imp
+import os
 import sys
+import logging
+import threading
+
+# load_remote_module(...) loads one module at a time (see there)
+MODULE_LOAD_LOCK = threading.RLock()
 
 def load_remote_module(module_name, location):
 	"""
-	Loads and returns the module given by 'module_name' that resides in the given location
+	Loads and returns the module given by 'module_name' that resides in the given location.  A module which was already loaded from there
+	is returned as it is: components run at the same time (in threads), and executing a shared module again would redefine its classes
+	and globals while the other components are using them.
 	"""
-	sys.path.append(location)
-	try:
-		fileobj, filename, description = imp.find_module(module_name, [location])
-		module = imp.load_module(module_name, fileobj, filename, description)
-		return module
-	except ImportError as ex:
-		logging.error('Could not import module %s at location %s' % (module_name, location))
-		raise ex
+	with MODULE_LOAD_LOCK:
+		if location not in sys.path:
+			sys.path.append(location)
+		module = sys.modules.get(module_name)
+		if module is not None and os.path.dirname(os.path.realpath(getattr(module, '__file__', ''))) == os.path.realpath(location):
+			return module
+		try:
+			fileobj, filename, description = imp.find_module(module_name, [location])
+			module = imp.load_module(module_name, fileobj, filename, description)
+			return module
+		except ImportError as ex:
+			logging.error('Could not import module %s at location %s' % (module_name, location))
+			raise ex
 
 
 def parse_config_file(project, component_dir, section = 'DEFAULT'):
@@ -0,0 +1,197 @@
+import logging
+import sys
+import os
+import csv
+import json
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+# the figures are drawn without pyplot, so that each one is independent of the others
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib import cm
+from scipy.cluster import hierarchy
+from scipy.spatial import distance
+
+# as the DESeq scripts drew them (with gplots' heatmap.2): the shortest side of the image (pixels) and the colors (RColorBrewer's GnBu,
+# spread over 100 shades)
+SHORTEST_DIMENSION = 1200
+HEATMAP_COLORS = matplotlib.colors.ListedColormap(cm.get_cmap('GnBu')(np.linspace(0, 1, 100)))
+
+# the sample heatmap shows the distances between the samples (as in DESeq's vignette), with the closest samples darkest
+DISTANCE_COLORS = matplotlib.colors.ListedColormap(cm.get_cmap('GnBu')(np.linspace(1, 0, 100)))
+
+DPI = 100
+BASE_FONT_SIZE = 8 # points, scaled by the text size the DESeq scripts computed
+
+# the fractions of the figure taken by the dendrograms and by the labels (right and bottom)
+DENDROGRAM_FRACTION = 0.15
+LABEL_FRACTION = 0.2
+
+# each heatmap is drawn by running this file as a script (see render_heatmaps(...)), given a file with the plot method and its arguments,
+# which is written next to the heatmap
+SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+TASK_FILE_SUFFIX = '.task.json'
+
+
+def read_adjusted_pvalues(results_path):
+	"""
+	Returns the genes of a DESeq results file, in order, and their adjusted p-values (NaN where they are missing)
+	"""
+	genes = []
+	values = []
+	with open(results_path) as f:
+		reader = csv.reader(f)
+		column = next(reader).index('padj')
+		for row in reader:
+			genes.append(row[0])
+			values.append(np.nan if row[column] == 'NA' else float(row[column]))
+	return genes, np.array(values)
+
+
+def top_genes(adjusted_pvalues, gene_count):
+	"""
+	Returns the rows of the genes with the smallest adjusted p-values (missing ones last), as order(res$padj)[1:NUM_GENES]
+	"""
+	order = np.argsort(np.where(np.isnan(adjusted_pvalues), np.inf, adjusted_pvalues), kind = 'mergesort')
+	return order[:gene_count]
+
+
+def cluster_order(values):
+	"""
+	Returns the order of the rows of values from a complete-linkage clustering of their euclidean distances (as heatmap.2's default), and the linkage
+	"""
+	if len(values) < 2:
+		return np.arange(len(values)), None
+	linkage = hierarchy.linkage(values, method = 'complete')
+	return hierarchy.leaves_list(linkage), linkage
+
+
+def font_size(label_count):
+	"""
+	Returns the size of the labels, as the DESeq scripts set it for their heatmaps
+	"""
+	return BASE_FONT_SIZE*(1.5 + 1/np.log10(label_count)) if label_count > 1 else BASE_FONT_SIZE
+
+
+def plot_clustered_heatmap(values, row_labels, column_labels, row_linkage, column_linkage, width, height, text_size, colors, path):
+	"""
+	Draws values as a heatmap of the given size (pixels), with the rows and columns in the order of their clusterings (either of which may
+	be None) and their dendrograms on the left and top
+	"""
+	row_order = hierarchy.leaves_list(row_linkage) if row_linkage is not None else np.arange(len(row_labels))
+	column_order = hierarchy.leaves_list(column_linkage) if column_linkage is not None else np.arange(len(column_labels))
+
+	figure = Figure(figsize = (width/float(DPI), height/float(DPI)), dpi = DPI)
+	FigureCanvasAgg(figure)
+	map_size = 1 - DENDROGRAM_FRACTION - LABEL_FRACTION
+	heatmap_axes = figure.add_axes([DENDROGRAM_FRACTION, LABEL_FRACTION, map_size, map_size])
+	heatmap_axes.imshow(values[row_order][:, column_order], aspect = 'auto', interpolation = 'nearest', cmap = colors, origin = 'lower')
+	heatmap_axes.yaxis.tick_right()
+	heatmap_axes.set_yticks(range(len(row_order)))
+	heatmap_axes.set_yticklabels([row_labels[i] for i in row_order], fontsize = text_size)
+	heatmap_axes.set_xticks(range(len(column_order)))
+	heatmap_axes.set_xticklabels([column_labels[j] for j in column_order], fontsize = text_size, rotation = 90)
+
+	for linkage, box, orientation in [(row_linkage, [0, LABEL_FRACTION, DENDROGRAM_FRACTION, map_size], 'left'),
+			(column_linkage, [DENDROGRAM_FRACTION, LABEL_FRACTION + map_size, map_size, DENDROGRAM_FRACTION], 'top')]:
+		if linkage is not None:
+			axes = figure.add_axes(box)
+			hierarchy.dendrogram(linkage, orientation = orientation, ax = axes, no_labels = True, color_threshold = 0, above_threshold_color = 'black')
+			axes.set_axis_off()
+	figure.savefig(path, dpi = DPI)
+
+
+def plot_contrast_heatmap(vst_path, genes, samples, results_path, contrast_samples, gene_count, path):
+	"""
+	Draws the heatmap of a contrast, as the DESeq scripts did: the variance-stabilized counts of the contrast's samples for the gene_count
+	genes with the smallest adjusted p-values in its results, with the genes and samples clustered.  The variance-stabilized counts
+	(of the given genes and samples) are read from the .npy file at vst_path, which is memory-mapped so only the rows shown are read.
+	"""
+	vst = np.load(vst_path, mmap_mode = 'r')
+	result_genes, adjusted_pvalues = read_adjusted_pvalues(results_path)
+	gene_index = dict([(g, i) for i, g in enumerate(genes)])
+	sample_index = dict([(s, j) for j, s in enumerate(samples)])
+	shown = [result_genes[i] for i in top_genes(adjusted_pvalues, gene_count)]
+	values = np.asarray(vst[[gene_index[g] for g in shown]])[:, [sample_index[s] for s in contrast_samples]]
+
+	# the image is longest in the direction with more labels (usually the genes), as in the DESeq scripts
+	ratio = 0.25*gene_count/len(contrast_samples)
+	width, height = SHORTEST_DIMENSION, SHORTEST_DIMENSION*ratio
+	if ratio < 1:
+		width, height = height, width
+	plot_clustered_heatmap(values, shown, contrast_samples, cluster_order(values)[1], cluster_order(values.T)[1], width, height,
+		font_size(gene_count), HEATMAP_COLORS, path)
+
+
+def plot_sample_heatmap(vst_path, genes, samples, path):
+	"""
+	Draws the euclidean distances between the samples' variance-stabilized counts (of the given genes and samples, from the .npy file at
+	vst_path), clustered by them
+	"""
+	vst = np.load(vst_path, mmap_mode = 'r')
+	distances = distance.pdist(np.asarray(vst).T)
+	linkage = hierarchy.linkage(distances, method = 'complete')
+	plot_clustered_heatmap(distance.squareform(distances), samples, samples, linkage, linkage, SHORTEST_DIMENSION, SHORTEST_DIMENSION,
+		font_size(len(samples)), DISTANCE_COLORS, path)
+
+
+# the plot methods a task file can name
+PLOT_METHODS = dict([(method.__name__, method) for method in [plot_contrast_heatmap, plot_sample_heatmap]])
+
+
+def render(task):
+	"""
+	Draws one heatmap, given as a (label, plot method, args) tuple.  Returns its label and the error message if it failed (otherwise None).
+	"""
+	label, method, args = task
+	try:
+		method(*args)
+		return label, None
+	except Exception as ex:
+		logging.exception('Heatmap %s failed' % label)
+		return label, '%s: %s' % (type(ex).__name__, ex)
+
+
+def render_in_process(runner, label, method, args):
+	"""
+	Draws one heatmap with a new python process running this file, through the runner (so its output goes to a log file of its own).
+	Raises an exception if it failed.
+	"""
+	task_path = args[-1] + TASK_FILE_SUFFIX
+	with open(task_path, 'w') as f:
+		json.dump({'label': label, 'method': method.__name__, 'args': args}, f, default = lambda value: value.tolist())
+	try:
+		result = runner.run('heatmap.' + label, [sys.executable, SCRIPT, task_path])
+	finally:
+		os.remove(task_path)
+	if result.returncode != 0:
+		raise Exception('Drawing the heatmap failed with exit status %d (see %s)' % (result.returncode, result.log_path))
+
+
+def render_heatmaps(tasks, executor, runner):
+	"""
+	Draws the heatmaps, given as (label, plot method, args) tuples, as many at a time as the executor (a SampleTaskExecutor) runs.  Drawing
+	holds python's interpreter lock, so each heatmap is drawn by a process of its own.  These are new processes rather than forks of the
+	pipeline, which could inherit locks (e.g. of the logging module) held by its other threads.  Every heatmap is attempted; returns
+	the (label, error message) of each one which failed.
+	"""
+	for label, method, args in tasks:
+		executor.submit(label, render_in_process, runner, label, method, args)
+	try:
+		executor.wait()
+	except Exception as ex:
+		if getattr(ex, 'failures', None) is None:
+			raise
+		return [(label, str(error)) for label, error in ex.failures]
+	return []
+
+
+if __name__ == '__main__':
+	# draws the heatmap of a task file written by render_in_process(...)
+	logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
+	with open(sys.argv[1]) as f:
+		task = json.load(f)
+	label, error = render((task['label'], PLOT_METHODS[task['method']], task['args']))
+	sys.exit(1 if error else 0)
@@ -2,13 +2,19 @@ import logging
 import sys
 import os
 import imp
-import subprocess
-import numpy as np
-import pandas as pd
+import multiprocessing
 
+sys.path.append( os.path.dirname( os.path.abspath(__file__) ) )
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
 
 import component_utils
+import deseq_heatmaps
+
+# the deseq_mode (in deseq.cfg) which runs all the contrasts of a count matrix in one R session
+BATCH_MODE = 'batch'
+
+# the deseq_mode which runs the contrasts in python (see differential_expression.py in the utils), without R
+NATIVE_MODE = 'native'
 
 class NoCountMatricesException(Exception):
 	pass
@@ -16,6 +22,12 @@ class NoCountMatricesException(Exception):
 class MissingCountMatrixFileException(Exception):
 	pass
 
+class DeseqContrastException(Exception):
+	pass
+
+class DeseqHeatmapException(Exception):
+	pass
+
 
 def run(name, project):
 	logging.info('Beginning DESeq differential expression analysis...')
@@ -38,10 +50,39 @@ def run(name, project):
 	# create the final output directory, if possible
 	util_methods.create_directory(output_dir, overwrite = True)
 
-	deseq_output_files, heatmap_files = call_deseq(project, component_params)
+	# contrasts whose inputs match an earlier run are restored from the result cache
+	result_cache = component_utils.load_remote_module('result_cache', utils_dir)
 
-	# write a summary of the number of differentially expressed genes
-	create_diff_exp_summary(deseq_output_files, project, component_params)
+	# the output of R goes to a log file for each contrast:
+	process_runner = component_utils.load_remote_module('process_runner', utils_dir)
+	runner = process_runner.create_runner(project.parameters, name)
+
+	# the contrasts (or, in batch mode, the R sessions) run in parallel-- as many at a time as there are cores and memory for:
+	task_executor = component_utils.load_remote_module('task_executor', utils_dir)
+	resource_manager = component_utils.load_remote_module('resource_manager', utils_dir)
+	worker_count = get_worker_count(project.parameters, component_params, runner, task_executor, resource_manager)
+	logging.info('Running up to %d DESeq processes at a time' % worker_count)
+	executor = task_executor.SampleTaskExecutor(worker_count)
+
+	# the native mode reads each count matrix once (through the count_matrix module) for all its contrasts
+	count_matrix = component_utils.load_remote_module('count_matrix', utils_dir)
+	differential_expression = component_utils.load_remote_module('differential_expression', utils_dir)
+
+	deseq_output_files, heatmap_files = call_deseq(project, component_params, result_cache, runner, executor, count_matrix, differential_expression)
+
+	# the heatmaps are drawn from the variance-stabilized counts of each count matrix, each by a process of its own (up to heatmap_max_workers at a time)
+	heatmap_executor = task_executor.SampleTaskExecutor(get_heatmap_worker_count(component_params))
+	create_heatmaps(project, component_params, result_cache, runner, heatmap_executor, count_matrix, differential_expression, heatmap_files)
+
+	# all the results go into one store, indexed by gene and contrast (see the query subcommand), from which the summary of the number
+	# of differentially expressed genes is written
+	diff_exp_store = component_utils.load_remote_module('diff_exp_store', utils_dir)
+	store = diff_exp_store.create_store(os.path.join(output_dir, component_params.get('results_store')))
+	try:
+		store_results(store, deseq_output_files, project, component_params)
+		create_diff_exp_summary(store, project, component_params)
+	finally:
+		store.close()
 
 	# change permissions:
 	[os.chmod(f,0775) for f in deseq_output_files.values()]
@@ -53,69 +94,147 @@ def run(name, project):
 	return [ c1, c2 ]
 
 
-def create_diff_exp_summary(deseq_files, project, component_params):
+def describe_contrasts(deseq_files, project, component_params):
+	"""
+	Returns the (contrast, BAM level, control condition, experimental condition, results file) of each DESeq results file.  deseq_files maps
+	the contrast bases (e.g. 'B_vs_A.sort.primary') to the files, as returned by call_deseq(...).
+	"""
+	described = []
+	for contrast_base, path in sorted(deseq_files.items()):
+		for ctrl_condition, exp_condition in project.contrasts:
+			contrast = exp_condition + component_params.get('deseq_contrast_flag') + ctrl_condition
+			if contrast_base.startswith(contrast + '.'):
+				described.append((contrast, contrast_base[len(contrast) + 1:], ctrl_condition, exp_condition, path))
+				break
+	return described
+
+
+def store_results(store, deseq_files, project, component_params):
 	"""
-	This method writes a simple tab-delimited output file summarizing the number of up/down regulated genes.
+	Loads the results of every contrast into the store
+	"""
+	for contrast, bam_level, ctrl_condition, exp_condition, path in describe_contrasts(deseq_files, project, component_params):
+		store.add_results(contrast, bam_level, ctrl_condition, exp_condition, path)
+
+
+def create_diff_exp_summary(store, project, component_params):
+	"""
+	This method writes a simple tab-delimited output file summarizing the number of up/down regulated genes (at the BAM level used for the
+	analysis), counted by the results store with the thresholds in the configuration.
 	"""
-	target_suffix = project.parameters.get('bam_filter_level') + '.' + component_params.get('deseq_output_tag')
 	summary_filepath = os.path.join(component_params.get('deseq_output_dir'), component_params.get('summary_file'))
 	project.diff_exp_summary_filepath = summary_filepath
+	summary = store.summarize(float(component_params.get('summary_padj_threshold')), float(component_params.get('summary_min_log2_fold_change')),
+		project.parameters.get('bam_filter_level'))
 	with open(summary_filepath, 'w') as outfile:
-		for f in deseq_files.values():
-			if f.endswith(target_suffix):
-				project.parameters.get('bam_filter_level') + '.' + component_params.get('deseq_output_tag')
-				exp_condition, ctrl_condition = os.path.basename(f).split('.')[0].split(component_params.get('deseq_contrast_flag'))
+		for contrast, bam_level, ctrl_condition, exp_condition, upreg_count, downreg_count in summary:
+			outfile.write('\t'.join([ctrl_condition, exp_condition, str(upreg_count), str(downreg_count)]) + '\n')
+
 
-				# load the data and count
-				data = pd.read_table(f, sep=',')
-				downreg_count = np.sum((data['padj']<=0.05) & (data['log2FoldChange'] < 0))
-				upreg_count = np.sum((data['padj']<=0.05) & (data['log2FoldChange'] > 0))
-				outfile.write('\t'.join([ctrl_condition, exp_condition, str(upreg_count), str(downreg_count)]) + '\n')
+def get_worker_count(params, component_params, runner, task_executor, resource_manager):
+	"""
+	Returns the number of DESeq processes to run at the same time: deseq_max_workers if that is set, otherwise as many as there are cores
+	for, and memory for (deseq_memory per process).  When the processes are submitted to a cluster scheduler or a work queue, it decides
+	where they run, so its limit (see task_executor.get_worker_count) is used instead.  The R scripts run on this machine by a pool of R workers
+	cannot run more at once than the pool has workers, so the count is capped at its size.
+	"""
+	if runner.scheduler:
+		return task_executor.get_worker_count(params)
+	max_workers = int(component_params.get('deseq_max_workers'))
+	if max_workers <= 0:
+		memory_limit = int(resource_manager.get_available_memory()/float(component_params.get('deseq_memory')))
+		max_workers = max(1, min(multiprocessing.cpu_count(), memory_limit))
+	if runner.r_workers and component_params.get('deseq_mode') != NATIVE_MODE:
+		return min(max_workers, runner.r_workers.size)
+	return max_workers
+
+
+def dispatch(executor, label, method, *args):
+	"""
+	Runs the method by the executor (which collects any failure under the label), or right away if there is no executor
+	"""
+	if executor:
+		executor.submit(label, method, *args)
+	else:
+		method(*args)
 
 
-def call_deseq(project, component_params):
+def read_sample_annotations(annotation_filepath):
+	"""
+	Returns the (sample, condition) pairs of the sample annotation file, in order
 	"""
-	Creates the calls and executes the system calls for running the DGE analysis
+	with open(annotation_filepath) as annotation_file:
+		return [(line.strip().split('\t')[0], line.strip().split('\t')[-1]) for line in annotation_file if line.strip()]
+
+
+def get_contrast_annotations(annotation_filepath, conditions):
+	"""
+	Returns the lines of the sample annotation file (in order) for the samples in the given conditions.  These are the only annotations
+	the DESeq script uses for a contrast, so changing the annotations of other samples does not invalidate its cached results.
+	"""
+	with open(annotation_filepath) as annotation_file:
+		return [line.strip() for line in annotation_file if line.strip() and line.strip().split('\t')[-1] in conditions]
+
+
+def get_contrasts(project, component_params, count_matrix_filepath):
+	"""
+	Returns the base of the count matrix file's name (e.g. '.sorted.primary.dedup.') and a (contrast pair, contrast base, output file,
+	heatmap file) tuple for each contrast of the count matrix
+	"""
+	base = os.path.basename(count_matrix_filepath)
+
+	# a raw count file might have a name like 'raw_count_matrix.sorted.primary.dedup.counts'
+	# these operations trim the ends so we are left with '.sorted.primary.dedup.' (note the leading and trailing dots)
+	base = base.lstrip(project.parameters.get('raw_count_matrix_file_prefix'))
+	base = base.rstrip(project.parameters.get('feature_counts_file_extension'))
+
+	contrasts = []
+	for contrast_pair in project.contrasts:
+		ctrl_condition = contrast_pair[0]
+		exp_condition = contrast_pair[1]
+
+		# construct the full path to the output deseq file and heatmap file
+		contrast_prefix = exp_condition + component_params.get('deseq_contrast_flag') + ctrl_condition
+		contrast_base =  contrast_prefix + base
+		output_deseq_file = os.path.join(component_params.get('deseq_output_dir'), contrast_base + component_params.get('deseq_output_tag'))
+		output_deseq_heatmap = os.path.join(component_params.get('deseq_output_dir'), contrast_base + component_params.get('heatmap_file_tag'))
+		contrasts.append((contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap))
+	return base, contrasts
+
+
+def call_deseq(project, component_params, result_cache, runner, executor = None, count_matrix = None, differential_expression = None):
+	"""
+	Creates the calls and executes the system calls for running the DGE analysis.  If given, the executor runs the calls in parallel, and
+	if any of them fail, raises an exception (once the others have finished) which lists each failed contrast.
+	The count_matrix and differential_expression modules are only needed in native mode.  Returns the results file of each contrast, and
+	the heatmap file each will have (the heatmaps are drawn by create_heatmaps(...)).
 	"""
 	deseq_output_files = {}
 	heatmap_files = {}
 	try:
+		cache = result_cache.create_result_cache(project.parameters)
 		# there is one count matrix per 'type' of BAM file (e.g. counts for deduped, deduped+primary filtered, etc.)
 		for count_matrix_filepath in project.raw_count_matrices:
 			if os.path.isfile(count_matrix_filepath):
 				logging.info('Located raw count matrix at %s ' % count_matrix_filepath)
-				base = os.path.basename(count_matrix_filepath)
-
-				# a raw count file might have a name like 'raw_count_matrix.sorted.primary.dedup.counts'
-				# these operations trim the ends so we are left with '.sorted.primary.dedup.' (note the leading and trailing dots)
-				base = base.lstrip(project.parameters.get('raw_count_matrix_file_prefix'))
-				base = base.rstrip(project.parameters.get('feature_counts_file_extension'))
-
-				for contrast_pair in project.contrasts:
-					ctrl_condition = contrast_pair[0]
-					exp_condition = contrast_pair[1]
-
-					# construct the full path to the output deseq file and heatmap file
-					contrast_prefix = exp_condition + component_params.get('deseq_contrast_flag') + ctrl_condition
-					contrast_base =  contrast_prefix + base
-					output_deseq_file = os.path.join(component_params.get('deseq_output_dir'), contrast_base + component_params.get('deseq_output_tag'))
-					output_deseq_heatmap = os.path.join(component_params.get('deseq_output_dir'), contrast_base + component_params.get('heatmap_file_tag'))
-
-					args = [count_matrix_filepath, 
-							project.parameters.get('sample_annotation_file'), 
-							ctrl_condition, 
-							exp_condition, 
-							output_deseq_file, 
-							output_deseq_heatmap, 
-							component_params.get('number_of_genes_for_heatmap')]
-					arg_string = ' '.join(args)
-
-					call_script(component_params.get('deseq_script'), arg_string)
+				base, contrasts = get_contrasts(project, component_params, count_matrix_filepath)
+				for contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap in contrasts:
 					deseq_output_files[contrast_base[:-1]] = output_deseq_file # [:-1] removes the trailing dot '.'
 					heatmap_files[contrast_base[:-1]] = output_deseq_heatmap # [:-1] removes the trailing dot '.'
+
+				if component_params.get('deseq_mode') == BATCH_MODE:
+					# the sessions are shared out between the count matrices, so that all the workers have something to do
+					sessions = -(-executor.max_workers//len(project.raw_count_matrices)) if executor else 1
+					call_deseq_batch(project, component_params, result_cache, runner, executor, cache, count_matrix_filepath, base, contrasts, sessions)
+				elif component_params.get('deseq_mode') == NATIVE_MODE:
+					call_deseq_native(project, component_params, result_cache, executor, cache, count_matrix_filepath, contrasts, count_matrix, differential_expression)
+				else:
+					call_deseq_per_contrast(project, component_params, result_cache, runner, executor, cache, count_matrix_filepath, contrasts)
 			else:
 				logging.error('Error in finding the count matrices.  There is no file located at %s' % count_matrix_filepath)
 				raise MissingCountMatrixFileException('No file at %s' % count_matrix_filepath)
+		if executor:
+			executor.wait()
 		return (deseq_output_files, heatmap_files)
 	except AttributeError:
 		logging.error('The project does not have any count matrices that can be located.')
@@ -123,28 +242,226 @@ def call_deseq(project, component_params):
 
 
 
-def call_script(script, arg_string):
+def script_path(script):
 	"""
-	Receives the name of the script to call and the cmd line args to call the script with.
-	The command line args are expected to already be formatted-- e.g. properly spaced/separated, etc.
+	Returns the full path to a script of this component
+	"""
+	return os.path.join(os.path.dirname(os.path.realpath(__file__)), script)
+
+
+def source_path(module):
+	"""
+	Returns the path to the source of a module (whose __file__ may be the compiled copy)
+	"""
+	return os.path.splitext(os.path.realpath(module.__file__))[0] + '.py'
+
+
+def get_contrast_key(project, component_params, result_cache, implementation, count_matrix_filepath, contrast_pair, contrast_base):
+	"""
+	Returns the result cache key for the results of a contrast made by the given implementation (the full paths of the script or modules
+	which make them)
+	"""
+	key_parts = ['deseq', contrast_base, contrast_pair[0], contrast_pair[1]] + \
+			[result_cache.ContentOf(path) for path in implementation] + [result_cache.ContentOf(count_matrix_filepath)]
+	return key_parts + get_contrast_annotations(project.parameters.get('sample_annotation_file'), contrast_pair)
+
+
+def call_deseq_per_contrast(project, component_params, result_cache, runner, executor, cache, count_matrix_filepath, contrasts):
+	"""
+	Runs each of the contrasts of a count matrix (a list of (contrast pair, contrast base, output file, heatmap file) tuples) with its own
+	call of the DESeq script.  The heatmaps are not made by the script.
+	"""
+	for contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap in contrasts:
+		ctrl_condition = contrast_pair[0]
+		exp_condition = contrast_pair[1]
+		args = [count_matrix_filepath, 
+				project.parameters.get('sample_annotation_file'), 
+				ctrl_condition, 
+				exp_condition, 
+				output_deseq_file]
+		arg_string = ' '.join(args)
+
+		key_parts = []
+		if cache:
+			key_parts = get_contrast_key(project, component_params, result_cache, [script_path(component_params.get('deseq_script'))], count_matrix_filepath, contrast_pair, contrast_base)
+		dispatch(executor, contrast_base[:-1], result_cache.cached_call, cache, key_parts, [output_deseq_file], call_script, runner, component_params.get('deseq_script'), arg_string, 'deseq.' + contrast_base[:-1])
+
+
+def split_contrasts(contrasts, sessions):
+	"""
+	Splits the contrasts into (at most) the given number of lists, of similar lengths.  Contrasts of the same conditions (e.g. A vs B and
+	B vs A) stay together.
+	"""
+	if sessions <= 1:
+		return [list(contrasts)]
+	groups = {}
+	for contrast in contrasts:
+		groups.setdefault(frozenset(contrast[0]), []).append(contrast)
+	ordered_groups = sorted(groups.values(), key = lambda g: contrasts.index(g[0]))
+	splits = [[] for i in range(min(sessions, len(ordered_groups)))]
+	for group in ordered_groups:
+		min(splits, key = len).extend(group)
+	return [split for split in splits if split]
+
+
+def call_deseq_batch(project, component_params, result_cache, runner, executor, cache, count_matrix_filepath, base, contrasts, sessions = 1):
+	"""
+	Runs the contrasts of a count matrix (a list of (contrast pair, contrast base, output file, heatmap file) tuples) with calls of the batch
+	script, each of which runs its share of the contrasts in one R session.  Contrasts whose results are in the result cache are restored
+	from it and left out of the calls.
+	"""
+	script = component_params.get('deseq_batch_script')
+	splits = split_contrasts(contrasts, sessions)
+	for n, split in enumerate(splits):
+		# with several sessions, each gets a number: e.g. '.primary.' becomes '.primary.2.'
+		session_base = base + ('%d.' % (n + 1) if len(splits) > 1 else '')
+		entries = []
+		for contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap in split:
+			key_parts = []
+			if cache:
+				key_parts = get_contrast_key(project, component_params, result_cache, [script_path(script)], count_matrix_filepath, contrast_pair, contrast_base)
+			entries.append((key_parts, [output_deseq_file]))
+		dispatch(executor, 'deseq' + session_base[:-1], result_cache.cached_batch_call, cache, entries, run_batch_session, project, component_params, runner, script, count_matrix_filepath, session_base, split)
+
+
+def run_batch_session(pending, project, component_params, runner, script, count_matrix_filepath, session_base, contrasts):
+	"""
+	Calls the batch script for the pending contrasts (indexes into contrasts).  If it fails, the contrasts without results are reported.
+	"""
+	# the batch script reads the contrasts to run from a file, with a line for each
+	contrasts_filepath = os.path.join(component_params.get('deseq_output_dir'), component_params.get('deseq_contrasts_file_prefix') + session_base + 'tsv')
+	with open(contrasts_filepath, 'w') as contrasts_file:
+		for i in pending:
+			contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap = contrasts[i]
+			contrasts_file.write('\t'.join([contrast_pair[0], contrast_pair[1], output_deseq_file]) + '\n')
+	logging.info('Running %d contrasts of %s in one R session' % (len(pending), count_matrix_filepath))
+	arg_string = ' '.join([count_matrix_filepath, project.parameters.get('sample_annotation_file'), contrasts_filepath])
+	try:
+		call_script(runner, script, arg_string, 'deseq' + session_base[:-1])
+	except Exception:
+		# the script carries on past a failing contrast, so the others have their results
+		failed = [contrasts[i][1][:-1] for i in pending if not os.path.isfile(contrasts[i][2])]
+		logging.error('These contrasts failed: %s' % ', '.join(failed))
+		raise DeseqContrastException('Failed contrasts: %s' % ', '.join(failed))
+
+
+def call_deseq_native(project, component_params, result_cache, executor, cache, count_matrix_filepath, contrasts, count_matrix, differential_expression):
+	"""
+	Runs each of the contrasts of a count matrix (a list of (contrast pair, contrast base, output file, heatmap file) tuples) in python,
+	with the same analysis as the DESeq script.  The count matrix and sample annotations are read once for all the contrasts.
 	"""
+	matrix = count_matrix.get_count_matrix(project, count_matrix_filepath)
+	annotations = read_sample_annotations(project.parameters.get('sample_annotation_file'))
+	implementation = [source_path(differential_expression)]
+	for contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap in contrasts:
+		key_parts = []
+		if cache:
+			key_parts = get_contrast_key(project, component_params, result_cache, implementation, count_matrix_filepath, contrast_pair, contrast_base)
+		dispatch(executor, contrast_base[:-1], result_cache.cached_call, cache, key_parts, [output_deseq_file], run_native_contrast,
+			differential_expression, matrix, annotations, contrast_pair, output_deseq_file)
+
+
+def run_native_contrast(differential_expression, matrix, annotations, contrast_pair, output_deseq_file):
+	"""
+	Tests the experimental condition of the contrast against the control, and writes the results
+	"""
+	logging.info('Testing %s versus %s' % (contrast_pair[1], contrast_pair[0]))
+	result = differential_expression.test_contrast(matrix, annotations, contrast_pair[0], contrast_pair[1])
+	result.write(output_deseq_file)
 
-	# full path to the script
-	script = os.path.join(os.path.dirname(os.path.realpath(__file__)), script)
 
-	command = 'Rscript ' + script + ' ' + arg_string
+def get_heatmap_worker_count(component_params):
+	"""
+	Returns the number of processes drawing heatmaps: heatmap_max_workers if that is set, otherwise the number of cores
+	"""
+	max_workers = int(component_params.get('heatmap_max_workers'))
+	return max_workers if max_workers > 0 else multiprocessing.cpu_count()
+
 
-	logging.info('Calling DESeq script: ')
-	logging.info(command)
-	process = subprocess.Popen(command, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-	stdout, stderr = process.communicate()
+def create_heatmaps(project, component_params, result_cache, runner, executor, count_matrix, differential_expression, heatmap_files):
+	"""
+	Draws the heatmap of each contrast (its most significant genes), and for each count matrix, a heatmap of the distances between all
+	the samples (which is added to heatmap_files).  They are drawn from the variance-stabilized counts of the count matrix, which are
+	computed once for all its heatmaps: by the deseq_vst_script, unless the contrasts were run natively (without R).  Heatmaps whose
+	inputs match an earlier run are restored from the result cache.  The others are drawn by processes which the executor runs.
+	"""
+	cache = result_cache.create_result_cache(project.parameters)
+	annotation_filepath = project.parameters.get('sample_annotation_file')
+	annotations = read_sample_annotations(annotation_filepath)
+	gene_count = int(component_params.get('number_of_genes_for_heatmap'))
+
+	# the variance-stabilized counts depend on all the samples' annotations, not only those of a contrast
+	implementation = [result_cache.ContentOf(source_path(module)) for module in [differential_expression, deseq_heatmaps]]
+	if component_params.get('deseq_mode') != NATIVE_MODE:
+		implementation.append(result_cache.ContentOf(script_path(component_params.get('deseq_vst_script'))))
+	entries = []
+	tasks = []
+	for count_matrix_filepath in project.raw_count_matrices:
+		base, contrasts = get_contrasts(project, component_params, count_matrix_filepath)
+		matrix_key = implementation + [result_cache.ContentOf(count_matrix_filepath), result_cache.ContentOf(annotation_filepath)]
+
+		label = component_params.get('sample_heatmap_file_prefix') + base[:-1]
+		sample_heatmap = os.path.join(component_params.get('deseq_output_dir'), component_params.get('sample_heatmap_file_prefix') + base + component_params.get('heatmap_file_tag'))
+		heatmap_files[label] = sample_heatmap
+		entries.append((['deseq_sample_heatmap'] + matrix_key, [sample_heatmap]))
+		tasks.append((count_matrix_filepath, label, deseq_heatmaps.plot_sample_heatmap, [sample_heatmap]))
+
+		for contrast_pair, contrast_base, output_deseq_file, output_deseq_heatmap in contrasts:
+			samples, conditions = differential_expression.contrast_samples(annotations, contrast_pair[0], contrast_pair[1])
+			entries.append((['deseq_heatmap', str(gene_count), result_cache.ContentOf(output_deseq_file)] + samples + matrix_key, [output_deseq_heatmap]))
+			tasks.append((count_matrix_filepath, contrast_base[:-1], deseq_heatmaps.plot_contrast_heatmap, [output_deseq_file, samples, gene_count, output_deseq_heatmap]))
+	result_cache.cached_batch_call(cache, entries, draw_heatmaps, project, component_params, runner, executor, count_matrix, differential_expression, annotations, tasks)
+
+
+def get_r_variance_stabilized(project, component_params, runner, count_matrix, differential_expression, count_matrix_filepath, annotations):
+	"""
+	Returns the variance-stabilized counts of the count matrix file computed by the deseq_vst_script.  They are kept next to the count matrix
+	in the same form as the native ones (see differential_expression.py), so the R script only runs again if the count matrix or the annotations change.
+	"""
+	vst = differential_expression.read_variance_stabilized(count_matrix_filepath, annotations, differential_expression.R_VST)
+	if vst is None:
+		logging.info('Computing the variance-stabilized counts of %s' % count_matrix_filepath)
+		vst_table = count_matrix_filepath + '.vst.tsv'
+		arg_string = ' '.join([count_matrix_filepath, project.parameters.get('sample_annotation_file'), vst_table])
+		call_script(runner, component_params.get('deseq_vst_script'), arg_string, 'vst.' + os.path.basename(count_matrix_filepath))
+		vst = count_matrix.read_count_matrix(vst_table, float)
+		os.remove(vst_table)
+		differential_expression.write_variance_stabilized(vst, count_matrix_filepath, annotations, differential_expression.R_VST)
+	return vst
+
+
+def draw_heatmaps(pending, project, component_params, runner, executor, count_matrix, differential_expression, annotations, tasks):
+	"""
+	Draws the pending heatmaps (indexes into tasks, which are (count matrix file, label, plot method, args) tuples).  The variance-stabilized
+	counts of each count matrix are made (or read from where they are kept) before the heatmaps are drawn, by processes which each read the
+	rows they need from the file.  They come from R, as the results do, unless the contrasts were run natively.
+	"""
+	vst_args = {}
+	render_tasks = []
+	for i in pending:
+		count_matrix_filepath, label, method, args = tasks[i]
+		if count_matrix_filepath not in vst_args:
+			if component_params.get('deseq_mode') == NATIVE_MODE:
+				vst = differential_expression.get_variance_stabilized(project, count_matrix_filepath, annotations)
+			else:
+				vst = get_r_variance_stabilized(project, component_params, runner, count_matrix, differential_expression, count_matrix_filepath, annotations)
+			vst_args[count_matrix_filepath] = [count_matrix_filepath + differential_expression.VST_SUFFIX, vst.genes, vst.samples]
+		render_tasks.append((label, method, vst_args[count_matrix_filepath] + args))
+	logging.info('Drawing %d heatmaps with up to %d processes' % (len(render_tasks), executor.max_workers))
+	failed = deseq_heatmaps.render_heatmaps(render_tasks, executor, runner)
+	if failed:
+		logging.error('These heatmaps failed:\n%s' % '\n'.join(['%s: %s' % f for f in failed]))
+		raise DeseqHeatmapException('Failed heatmaps: %s' % ', '.join([label for label, error in failed]))
+
+
+def call_script(runner, script, arg_string, label):
+	"""
+	Receives the name of the script to call and the cmd line args to call the script with.
+	The command line args are expected to already be formatted-- e.g. properly spaced/separated, etc.
+	"""
 
-	logging.info('STDOUT from DESeq script: ')
-	logging.info(stdout)
-	logging.info('STDERR from DESeq script: ')
-	logging.info(stderr)
-		
-	if process.returncode != 0:			
+	result = runner.run_r_script(label, script_path(script), arg_string.split())
+	if result.returncode != 0:			
 		logging.error('There was an error while calling the R script for DESeq.  Check the logs.')
 		raise Exception('Error during normalization module.')
 
@@ -2,13 +2,15 @@ import logging
 import sys
 import os
 import imp
-import subprocess
 import re
 
 # to import from the parent directory, append to sys.path
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
 import component_utils
 
+# the normalization_method (in normalize.cfg) which computes the size factors in python rather than calling the R script
+NATIVE_NORMALIZATION = 'native'
+
 class NoCountMatricesException(Exception):
 	pass
 
@@ -35,8 +37,28 @@ def run(name, project):
 	# create the final output directory, if possible
 	util_methods.create_directory(output_dir, overwrite = True)
 
+	# normalized matrices whose inputs match an earlier run are restored from the result cache
+	result_cache = component_utils.load_remote_module('result_cache', utils_dir)
+
+	# the output of R goes to a log file for each count matrix:
+	process_runner = component_utils.load_remote_module('process_runner', utils_dir)
+	runner = process_runner.create_runner(project.parameters, name)
+
+	# the native normalization reads the raw count matrices (and keeps the normalized ones) through the count_matrix module
+	count_matrix = component_utils.load_remote_module('count_matrix', utils_dir)
+	normalization = component_utils.load_remote_module('normalization', utils_dir)
+
+	# the normalizations (e.g. CPM) made alongside the DESeq one.  The gene lengths for TPM are read from the GTF file once, if needed.
+	further_methods = [m for m in util_methods.as_list(component_params.get('further_normalizations')) if m]
+	normalization.check_further_normalizations(further_methods)
+	gene_lengths = normalization.GeneLengths(project.parameters.get('gtf'), component_params.get('gene_length_feature'), component_params.get('gene_length_attribute'))
+
 	# perform the actual normalization:
-	output_files = normalize(project, component_params)
+	output_files = normalize(project, component_params, result_cache, runner, count_matrix, normalization, further_methods, gene_lengths)
+
+	# parse each normalized matrix once and write its binary copy-- the downstream components (e.g. GSEA) read it from memory or from that copy
+	for normalized_filepath in project.normalized_count_matrices:
+		count_matrix.get_count_matrix(project, normalized_filepath, float)
 
 	logging.info('Done with normalize.  Output files: %s' % output_files)
 	# change permissions on those output files:
@@ -49,13 +71,16 @@ def run(name, project):
 
 
 
-def normalize(project, component_params):
+def normalize(project, component_params, result_cache, runner, count_matrix = None, normalization = None, further_methods = [], gene_lengths = None):
 	"""
-	Creates the calls and executes the system calls for running the normalization
+	Normalizes each raw count matrix: in python if the normalization_method is native (which needs the count_matrix and normalization
+	modules), otherwise by calling the R script.  The further_methods (e.g. CPM) are always done in python, and each gets a matrix named
+	after the DESeq one, with the method in place of the extension (e.g. normalized_count_matrix.sort.primary.cpm).
 	"""
 	output_files = {}
 	normalized_count_files = []
 	try:
+		cache = result_cache.create_result_cache(project.parameters)
 		for count_matrix_filepath in project.raw_count_matrices:
 			if os.path.isfile(count_matrix_filepath):
 				logging.info('Located raw count matrix at %s ' % count_matrix_filepath)
@@ -63,12 +88,57 @@ def normalize(project, component_params):
 				normalized_filename = re.sub(project.parameters.get('raw_count_matrix_file_prefix'), 
 							component_params.get('normalized_counts_file_prefix'), base)
 				normalized_filepath = os.path.join(component_params.get('normalized_counts_output_dir'), normalized_filename)
-				call_script(component_params.get('normalization_script'), 
-					count_matrix_filepath, 
-					normalized_filepath, 
-					project.parameters.get('sample_annotation_file'))
+				if component_params.get('normalization_method') == NATIVE_NORMALIZATION:
+					key_parts = []
+					if cache:
+						key_parts = ['native normalization', normalized_filename,
+								result_cache.ContentOf(os.path.splitext(normalization.__file__)[0] + '.py'),
+								result_cache.ContentOf(count_matrix_filepath)]
+					result_cache.cached_call(cache, key_parts, [normalized_filepath],
+						normalize_natively,
+						project,
+						count_matrix,
+						normalization,
+						count_matrix_filepath,
+						normalized_filepath)
+				else:
+					key_parts = []
+					if cache:
+						key_parts = ['normalization', normalized_filename,
+								result_cache.ContentOf(os.path.join(os.path.dirname(os.path.realpath(__file__)), component_params.get('normalization_script'))),
+								result_cache.ContentOf(count_matrix_filepath),
+								result_cache.ContentOf(project.parameters.get('sample_annotation_file'))]
+					result_cache.cached_call(cache, key_parts, [normalized_filepath], 
+						call_script, 
+						runner, 
+						component_params.get('normalization_script'), 
+						count_matrix_filepath, 
+						normalized_filepath, 
+						project.parameters.get('sample_annotation_file'))
 				output_files[normalized_filename] = normalized_filepath
 				normalized_count_files.append(normalized_filepath)
+
+				if further_methods:
+					further_filepaths = [os.path.join(component_params.get('normalized_counts_output_dir'), os.path.splitext(normalized_filename)[0] + '.' + m) for m in further_methods]
+					key_parts = []
+					if cache:
+						key_parts = ['further normalization', normalized_filename] + further_methods + [
+								result_cache.ContentOf(os.path.splitext(normalization.__file__)[0] + '.py'),
+								result_cache.ContentOf(count_matrix_filepath)]
+						if normalization.TPM in further_methods:
+							key_parts += [gene_lengths.feature, gene_lengths.attribute, result_cache.ContentOf(gene_lengths.gtf)]
+					result_cache.cached_call(cache, key_parts, further_filepaths,
+						normalize_further,
+						project,
+						count_matrix,
+						normalization,
+						further_methods,
+						gene_lengths,
+						count_matrix_filepath,
+						further_filepaths)
+					for further_filepath in further_filepaths:
+						output_files[os.path.basename(further_filepath)] = further_filepath
+						normalized_count_files.append(further_filepath)
 			else:
 				logging.error('Error in finding the count matrices.  There is no file located at %s' % count_matrix_filepath)
 				raise MissingCountMatrixFileException('No file at %s' % count_matrix_filepath)
@@ -79,23 +149,35 @@ def normalize(project, component_params):
 		raise NoCountMatricesException()	
 
 
-def call_script(script, inputfile, outputfile, annotation_file):
+def normalize_natively(project, count_matrix, normalization, inputfile, outputfile):
+	"""
+	Normalizes the raw count matrix in inputfile as normalize.R does, and writes it to outputfile in the same format.  The normalized
+	matrix is kept in memory for the downstream components.
+	"""
+	logging.info('Normalizing %s' % inputfile)
+	normalized = normalization.normalize_count_matrix(count_matrix.get_count_matrix(project, inputfile))
+	normalized.write(outputfile, normalization.format_as_r)
+	project.count_matrices[outputfile] = normalized
+
+
+def normalize_further(project, count_matrix, normalization, methods, gene_lengths, inputfile, outputfiles):
+	"""
+	Makes the further normalizations of the raw count matrix in inputfile (all from one read of it), writing each to the corresponding
+	file in outputfiles
+	"""
+	logging.info('Making %s matrices from %s' % (', '.join(methods), inputfile))
+	raw = count_matrix.get_count_matrix(project, inputfile)
+	for (method, normalized), outputfile in zip(normalization.normalize_count_matrix_further(raw, methods, gene_lengths), outputfiles):
+		normalized.write(outputfile, normalization.format_as_r)
+		project.count_matrices[outputfile] = normalized
+
+
+def call_script(runner, script, inputfile, outputfile, annotation_file):
 
 	# full path to the script
 	script = os.path.join(os.path.dirname(os.path.realpath(__file__)), script)
-	command = 'Rscript ' + script + ' ' + inputfile + ' ' + outputfile + ' ' + annotation_file
-
-	logging.info('Calling normalization script: ')
-	logging.info(command)
-	process = subprocess.Popen(command, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-	stdout, stderr = process.communicate()
-
-	logging.info('STDOUT from normalization script: ')
-	logging.info(stdout)
-	logging.info('STDERR from normalization script: ')
-	logging.info(stderr)
-		
-	if process.returncode != 0:			
+	result = runner.run_r_script('normalization.' + os.path.basename(outputfile), script, [inputfile, outputfile, annotation_file])
+	if result.returncode != 0:			
 		logging.error('There was an error while calling the R script for normalization.  Check the logs.')
 		raise Exception('Error during normalization module.')
 
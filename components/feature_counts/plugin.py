@@ -2,7 +2,7 @@ import logging
 import sys
 import os
 import imp
-import subprocess
+import re
 
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
 
@@ -14,6 +14,15 @@ class CountfileQuantityException(Exception):
 class MissingBamFileException(Exception):
 	pass
 
+# the counting_mode (in feature_counts.cfg) which counts the BAM files of all the samples together
+COHORT_COUNTING = 'cohort'
+
+# the name (before the BAM file's level and the count file extension) of the count files written by cohort counting
+COHORT_COUNTFILE_PREFIX = 'cohort'
+
+# featureCounts reports the fraction of reads it could assign to genes with a line like '|| Successfully assigned alignments : 4512001 (85.2%) ||'
+ASSIGNED_READS_PATTERN = re.compile('Successfully assigned (?:alignments|reads|fragments)\s*:\s*(\d+)\s*\(([\d.]+%)\)')
+
 def run(name, project):
 	logging.info('Beginning featureCounts component of pipeline.')
 
@@ -35,11 +44,25 @@ def run(name, project):
 	# create the final output directory, if possible
 	util_methods.create_directory(output_dir, overwrite = True)
 
-	# start the counting:
-	execute_counting(project, component_params, util_methods)
+	# count files whose inputs match an earlier run are restored from the result cache instead of being recounted
+	result_cache = component_utils.load_remote_module('result_cache', utils_dir)
+
+	# the count matrices are assembled (and kept in memory for the downstream components) by the count_matrix module
+	count_matrix = component_utils.load_remote_module('count_matrix', utils_dir)
 
-	# create the final, unnormalized count matrices for each set of BAM files
-	merged_count_files = create_count_matrices(project, component_params, util_methods)
+	# featureCounts' output goes to a log file for each BAM file:
+	process_runner = component_utils.load_remote_module('process_runner', utils_dir)
+	runner = process_runner.create_runner(project.parameters, name)
+
+	if component_params.get('counting_mode') == COHORT_COUNTING:
+		# a single featureCounts process for each set of BAM files, whose output becomes the count matrix
+		merged_count_files = execute_cohort_counting(name, project, component_params, util_methods, result_cache, runner, count_matrix)
+	else:
+		# start the counting:
+		execute_counting(name, project, component_params, util_methods, result_cache, runner)
+
+		# create the final, unnormalized count matrices for each set of BAM files
+		merged_count_files = create_count_matrices(project, component_params, count_matrix)
 	
 	# add these common files to the project object (so that other components have access to them):
 	project.raw_count_matrices = merged_count_files
@@ -54,53 +77,33 @@ def run(name, project):
 	return [component_utils.ComponentOutput(cf_dict, component_params.get('tab_title'), component_params.get('header_msg'), component_params.get('display_format')),]
 
 
-def create_count_matrices(project, component_params, util_methods):
+def create_count_matrices(project, component_params, count_matrix):
 	"""
 	In general, there are a set of countfiles for each sample, corresponding to each bamfile.  This method takes the countfile of each 'type' across all samples
 	and creates a count matrix such that the genes are in rows and the samples are in columns.  In the end, each 'type' of bamfile (e.g. primary, deduped) will have
 	a full count matrix.
 
-	This method iterates through each set of countfiles and writes the countfiles to the appropriate location.  It then returns a list of the paths for all
-	of the count matrices
+	The counts of each countfile are matched to the genes by name (see count_matrix.py).  The matrices are written to files and also kept in
+	project.count_matrices, so the downstream components do not have to parse them again.  Returns a list of the paths for all of the count matrices
 	"""
 	merged_count_files = []
-	sample_names = sorted([s.sample_name for s in project.samples])
-	header_line = ['Gene'] + sample_names
+	sample_names = [s.sample_name for s in project.samples]
 
 	file_groups = get_countfile_groupings(project, component_params)
 	
 	for file_group in file_groups:
-		files = sorted(file_group)
-		group_suffix = os.path.basename(files[0]).lstrip(sample_names[0])
-		matrix = []
-		for f in files:
-			read(matrix,f)	
+		# the countfiles of a group are in the same order as the samples-- put both in order of the sample names:
+		names, files = zip(*sorted(zip(sample_names, file_group)))
+		group_suffix = os.path.basename(files[0])[len(names[0]):]
+		matrix = count_matrix.assemble_count_matrix(files, names)
 
-		matrix.insert(0, header_line)
 		outfilepath = os.path.join(os.path.dirname(files[0]), component_params.get('raw_count_matrix_file_prefix') + group_suffix)
+		matrix.write(outfilepath)
+		project.count_matrices[outfilepath] = matrix
 		merged_count_files.append(outfilepath)
-		with open(outfilepath, 'w') as outfile:
-			for row in matrix:
-				outfile.write('\t'.join(row) + '\n')
 	return merged_count_files
 
 
-def read(matrix, filepath):
-	"""
-	This is a helper method for create_count_matrices(...) that assembles the count matrix by sequentially appending columns as new samples are read/parsed.
-	Adds (in-place) to the existing matrix passed as the first argument.    
-	"""
-	was_empty = True if len(matrix) == 0 else False
-	with open(filepath) as f:
-		for i, line in enumerate(f):
-			if i > 1:
-				contents = line.strip().split()
-				if was_empty:
-					matrix.append([contents[0], contents[6]])
-				else:
-					matrix[i-2].append(contents[6]) # the (i-2) corrects for the offset due to the two header lines
-
-
 
 def get_countfile_groupings(project, component_params):
 	"""
@@ -135,20 +138,18 @@ def get_countfile_groupings(project, component_params):
 
 
 
-def execute_counting(project, component_params, util_methods):
+def execute_counting(component_name, project, component_params, util_methods, result_cache, runner):
 	"""
 	Creates the calls and executes the system calls for running featureCounts
 	"""
 	logging.info('Begin counting reads in the BAM files.')
-	
-	# default options, as a list of tuples:
-	default_options = [('-a', project.parameters.get('gtf')),('-t', 'exon'),('-g', 'gene_name')]
-	base_command = component_params.get('feature_counts') + ' ' + ' '.join(map(lambda x: ' '.join(x), default_options))
+	base_command = get_base_command(project, component_params)
+	cache = result_cache.create_result_cache(project.parameters)
 
-	# if a paired experiment, count the fragments, not the single reads
-	if project.parameters.get('paired_alignment'):
-		base_command += ' -p'
+	# when restarting, only the samples whose BAM files (or the parameters) changed are counted again
+	samples_to_count = util_methods.get_samples_to_run(project, component_name)
 
+	executor = util_methods.create_sample_executor(project.parameters)
 	for sample in project.samples:
 		countfiles = []
 		for bamfile in sample.bamfiles:
@@ -156,21 +157,16 @@ def execute_counting(project, component_params, util_methods):
 				output_name = util_methods.case_insensitive_rstrip(os.path.basename(bamfile), 'bam') + component_params.get('feature_counts_file_extension')
 				output_path = os.path.join(component_params.get('feature_counts_output_dir'), output_name)
 				command = base_command + ' -o ' + output_path + ' ' + bamfile
-
-				logging.info('Calling featureCounts with: ')
-				logging.info(command)
-				process = subprocess.Popen(command, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-				stdout, stderr = process.communicate()
-				logging.info('STDOUT from featureCounts script: ')
-				logging.info(stdout)
-				logging.info('STDERR from featureCounts script: ')
-				logging.info(stderr)
-				if process.returncode != 0:			
-					logging.error('There was an error encountered during execution of featureCounts for sample %s ' % sample.sample_name)
-					raise Exception('Error during featureCounts module.')
-				else:
-					countfiles.append(output_path)
-
+				key_parts = []
+				if cache:
+					key_parts = ['featureCounts', base_command, output_name,
+							result_cache.IdentityOf(component_params.get('feature_counts')),
+							result_cache.ContentOf(project.parameters.get('gtf')),
+							result_cache.ContentOf(bamfile)]
+				output_paths = [output_path, output_path + '.summary']
+				if sample in samples_to_count:
+					executor.submit(bamfile, result_cache.cached_call, cache, key_parts, output_paths, count_bamfile, runner, command, sample.sample_name, 'featureCounts.' + output_name)
+				countfiles.append(output_path)
 			else:
 				logging.error('The bamfile (%s) is not actually a file.' % bamfile)
 				raise MissingBamFileException('Missing BAM file: %s' % bamfile)
@@ -178,5 +174,135 @@ def execute_counting(project, component_params, util_methods):
 		# keep track of the count files in the sample object:
 		sample.countfiles = countfiles
 
+	# run the featureCounts processes.  If any fail, this raises an exception listing all the failures
+	executor.wait()
+
+
+def get_base_command(project, component_params):
+	"""
+	Returns the featureCounts command, without the output file and the BAM files
+	"""
+	# default options, as a list of tuples:
+	default_options = [('-a', project.parameters.get('gtf')),('-t', 'exon'),('-g', 'gene_name')]
+	base_command = component_params.get('feature_counts') + ' ' + ' '.join(map(lambda x: ' '.join(x), default_options))
+
+	# if a paired experiment, count the fragments, not the single reads
+	if project.parameters.get('paired_alignment'):
+		base_command += ' -p'
+	return base_command
+
+
+def get_bamfile_groupings(samples):
+	"""
+	Groups the BAM files of the samples by their 'type' (e.g. primary alignments, deduplicated, etc), which is the part of the file name
+	after the sample name.  Returns a list of (type, BAM files) tuples, with the BAM files in the same order as the samples.
+	"""
+	extensions = [os.path.basename(bamfile)[len(samples[0].sample_name):] for bamfile in samples[0].bamfiles]
+	bamfile_groups = []
+	for extension in extensions:
+		grouping = []
+		for sample in samples:
+			matches = [bamfile for bamfile in sample.bamfiles if os.path.basename(bamfile) == sample.sample_name + extension]
+			if len(matches) != 1:
+				logging.error('Sample %s does not have a %s BAM file (it has %s), so its BAM files cannot be counted with the others.' % (sample.sample_name, extension, sample.bamfiles))
+				raise MissingBamFileException('Missing %s BAM file for sample %s' % (extension, sample.sample_name))
+			grouping.append(matches[0])
+		bamfile_groups.append((extension, grouping))
+	return bamfile_groups
+
+
+def execute_cohort_counting(component_name, project, component_params, util_methods, result_cache, runner, count_matrix):
+	"""
+	Counts each 'type' of BAM file (e.g. the primary alignments) of all the samples with a single, multi-threaded featureCounts process,
+	so the GTF is parsed once per type instead of once per BAM file.  featureCounts writes a column of counts for each BAM file,
+	which is turned into the raw count matrix directly (and kept in project.count_matrices).  Returns the paths to the count matrices.
+	"""
+	logging.info('Begin counting reads in the BAM files, all samples at once.')
+	threads = int(component_params.get('feature_counts_threads'))
+	base_command = get_base_command(project, component_params)
+	output_dir = component_params.get('feature_counts_output_dir')
+	extension = component_params.get('feature_counts_file_extension')
+
+	cache = result_cache.create_result_cache(project.parameters)
+
+	# when restarting, the BAM files are only counted again if the BAM files (or the parameters) of some sample changed
+	samples_to_count = util_methods.get_samples_to_run(project, component_name)
+
+	samples = sorted(project.samples, key = lambda s: s.sample_name)
+	sample_names = [s.sample_name for s in samples]
+	# each featureCounts process takes 'threads' of the cores the sample tasks share
+	executor = util_methods.create_sample_executor(project.parameters, task_cpus = threads)
+	counted = []
+	for bam_type, bamfiles in get_bamfile_groupings(samples):
+		for bamfile in bamfiles:
+			if not os.path.isfile(bamfile):
+				logging.error('The bamfile (%s) is not actually a file.' % bamfile)
+				raise MissingBamFileException('Missing BAM file: %s' % bamfile)
+		count_type = util_methods.case_insensitive_rstrip(bam_type, 'bam') + extension
+		output_path = os.path.join(output_dir, COHORT_COUNTFILE_PREFIX + count_type)
+		matrix_path = os.path.join(output_dir, component_params.get('raw_count_matrix_file_prefix') + count_type)
+		command = base_command + ' -T %d -o %s %s' % (threads, output_path, ' '.join(bamfiles))
+		key_parts = []
+		if cache:
+			# the thread count does not change the counts, so it is not part of the key
+			key_parts = ['featureCounts', base_command, COHORT_COUNTFILE_PREFIX + count_type, result_cache.IdentityOf(component_params.get('feature_counts')),
+					result_cache.ContentOf(project.parameters.get('gtf'))] + sample_names + [result_cache.ContentOf(bamfile) for bamfile in bamfiles]
+		output_paths = [output_path, output_path + '.summary']
+		if samples_to_count or not os.path.isfile(output_path):
+			executor.submit(COHORT_COUNTFILE_PREFIX + count_type, result_cache.cached_call, cache, key_parts, output_paths, count_cohort, runner, command, 'featureCounts.' + COHORT_COUNTFILE_PREFIX + count_type, threads)
+		counted.append((output_path, matrix_path))
+
+	# run the featureCounts processes.  If any fail, this raises an exception listing all the failures
+	executor.wait()
+
+	# every sample's counts are in the cohort's count files, so those are the count files of each sample (which a restart checks for changes)
+	for sample in samples:
+		sample.countfiles = [output_path for output_path, matrix_path in counted]
+
+	for output_path, matrix_path in counted:
+		project.count_matrices[matrix_path] = write_cohort_count_matrix(count_matrix, output_path, matrix_path, sample_names)
+	return [matrix_path for output_path, matrix_path in counted]
+
+
+def count_cohort(runner, command, label, threads):
+	"""
+	Runs a featureCounts process on the BAM files of all the samples
+	"""
+	result = runner.run(label, command, progress_parsers = [parse_assigned_reads], cpus = threads)
+	if result.returncode != 0:
+		logging.error('There was an error encountered during execution of featureCounts (%s)' % label)
+		raise Exception('Error during featureCounts module.')
+
+
+def write_cohort_count_matrix(count_matrix, countfile, matrix_path, sample_names):
+	"""
+	Writes the count matrix (genes in rows, samples in columns) from featureCounts' output for the BAM files of all the samples, which has
+	a column of counts for each BAM file, in the order of sample_names.  Returns the matrix.
+	"""
+	genes, counts = count_matrix.read_feature_counts(countfile)
+	if counts.shape[1] != len(sample_names):
+		logging.error('The featureCounts output in %s has %d count columns, but there are %d samples.' % (countfile, counts.shape[1], len(sample_names)))
+		raise CountfileQuantityException('The number of count columns did not match the number of samples.  Check log.')
+	count_matrix.check_unique(genes, countfile)
+	matrix = count_matrix.CountMatrix(genes, sample_names, counts)
+	matrix.write(matrix_path)
+	return matrix
+
+
+def parse_assigned_reads(line):
+	match = ASSIGNED_READS_PATTERN.search(line)
+	if match:
+		return 'featureCounts assigned %s reads (%s)' % match.groups()
+
+
+def count_bamfile(runner, command, sample_name, label):
+	"""
+	Runs a single featureCounts process
+	"""
+	result = runner.run(label, command, progress_parsers = [parse_assigned_reads])
+	if result.returncode != 0:			
+		logging.error('There was an error encountered during execution of featureCounts for sample %s ' % sample_name)
+		raise Exception('Error during featureCounts module.')
+
 
 
@@ -3,8 +3,6 @@ import sys
 import os
 import imp
 import glob
-import subprocess
-import pandas as pd
 from collections import defaultdict
 
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
@@ -46,11 +44,13 @@ def run(name, project):
 
 		# create the cls and gct files for input to GSEA:
 		logging.info('About to create the CLS and GCT files')
-		create_input_files(project, component_params)
+		count_matrix = component_utils.load_remote_module('count_matrix', utils_dir)
+		create_input_files(project, component_params, count_matrix)
 
-		# run it:
+		# run it.  GSEA's output goes to a log file for each contrast:
 		logging.info('Actually run GSEA')
-		output = run_gsea(project, component_params, util_methods)
+		process_runner = component_utils.load_remote_module('process_runner', utils_dir)
+		output = run_gsea(project, component_params, util_methods, process_runner.create_runner(project.parameters, name))
 
 		return [component_utils.ComponentOutput(output, component_params.get('tab_title'), component_params.get('header_msg'), component_params.get('display_format')),]
 	else:
@@ -58,7 +58,7 @@ def run(name, project):
 		return [None,]
 
 
-def create_input_files(project, component_params):
+def create_input_files(project, component_params, count_matrix):
 	'''
 	Create the .cls and .gct files necessary for input to GSEA
 	'''
@@ -87,46 +87,42 @@ def create_input_files(project, component_params):
 	logging.info('Done writing CLS file')
 	
 	# read in the normalized expression matrix
-	exp_mtx = [p for p in project.normalized_count_matrices if p.endswith(component_params.get('normalized_count_target'))]
+	# unless configured otherwise, use the counts from the BAM level selected for the analysis
+	target = component_params.get('normalized_count_target')
+	if not target:
+		target = project.parameters.get('bam_filter_level') + '.' + project.parameters.get('feature_counts_file_extension')
+	exp_mtx = [p for p in project.normalized_count_matrices if p.endswith(target)]
 	logging.info('All normalized count matrices: %s ' % project.normalized_count_matrices)
 	logging.info('Use this file for GSEA analysis: %s ' % exp_mtx)
 	if len(exp_mtx) == 1:
 
-		expression_data = pd.read_table(exp_mtx[0], sep = '\t')
+		# the normalized matrix was kept in memory (or in binary form) by the normalization component
+		expression_data = count_matrix.get_count_matrix(project, exp_mtx[0], float)
 
-		# do not want to assume if the first column (the gene symbols) has any particular naming convention.  Simply rename it here
-		gene_col_name = 'gene'
-		expression_data.rename(columns = {expression_data.columns[0]:gene_col_name}, inplace = True)
-
-		# add the Description column for the gct format:
-		desc_col = 'Description'
-		expression_data[desc_col] = 'NA'
-		
-		# order the columns of the matrix to match the cls file and add the new first column at the beginning:
-		ordered_cols = reduce(lambda x,y: x+y, [condition_to_sample_map[c] for c in conditions])
-		ordered_cols.insert(0, gene_col_name)
-		ordered_cols.insert(1, desc_col)
-
-		logging.info('New column order: %s ' % ordered_cols)
-		
-		# now use this list to re-order the columns of the exp matrix:
-		expression_data = expression_data[ordered_cols]
+		# order the columns of the matrix to match the cls file:
+		ordered_samples = reduce(lambda x,y: x+y, [condition_to_sample_map[c] for c in conditions])
+		logging.info('New column order: %s ' % ordered_samples)
+		columns = [expression_data.samples.index(s) for s in ordered_samples]
 
 		# Create the gct file and update gct_file to be the absolute path
 		gct_filepath = os.path.join(component_params.get('gsea_output_dir'), component_params.get('gct_file'))
 		component_params['gct_file'] = gct_filepath	
 		logging.info('GCT location: %s ' % gct_filepath)
 		with open(gct_filepath, 'w') as gct_out:
-			intro_lines = '#1.2\n'
-			intro_lines += str(expression_data.shape[0]) + '\t' + str(expression_data.shape[1]-2) + '\n'
-			gct_out.write(intro_lines)
-			expression_data.to_csv(gct_out, sep='\t', index = False)
+			gct_out.write('#1.2\n')
+			gct_out.write(str(len(expression_data.genes)) + '\t' + str(len(ordered_samples)) + '\n')
+			# the gct format has a Description column after the gene names:
+			gct_out.write('\t'.join(['gene', 'Description'] + ordered_samples) + '\n')
+			for start in range(0, len(expression_data.genes), count_matrix.WRITE_BLOCK_ROWS):
+				block = expression_data.counts[start:start + count_matrix.WRITE_BLOCK_ROWS][:, columns]
+				genes = expression_data.genes[start:start + count_matrix.WRITE_BLOCK_ROWS]
+				gct_out.write(''.join(['\t'.join([gene, 'NA'] + [repr(v) for v in row]) + '\n' for gene, row in zip(genes, block.tolist())]))
 			logging.info('Done writing')
 	else:
 		raise NormalizedCountFileNotFoundException('Could not find the normalized count file to use, or found more than 1, so ambiguous')
 
 
-def run_gsea(project, component_params, util_methods):
+def run_gsea(project, component_params, util_methods, runner):
 	
 	output_reports = {}
 
@@ -170,18 +166,9 @@ def run_gsea(project, component_params, util_methods):
 		cmd += ' -cls ' + component_params.get('cls_file') + '#' + contrast_string
 		cmd += ' -rpt_label ' + report_label
 		
-		logging.info('Calling GSEA with: ')
-		logging.info(cmd)
-		process = subprocess.Popen(cmd, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-
-		stdout, stderr = process.communicate()
-		logging.info('STDOUT from GSEA: ')
-		logging.info(stdout)
-		logging.info('STDERR from GSEA: ')
-		logging.info(stderr)
-	
-		if process.returncode != 0:			
-			logging.error('There was an error encountered during execution of rna-SeQC for sample %s ' % sample.sample_name)
+		result = runner.run('gsea.' + report_label, cmd)
+		if result.returncode != 0:			
+			logging.error('There was an error encountered during execution of GSEA for contrast %s ' % contrast_string)
 			raise Exception('Error during GSEA module.')
 		else:
 			report_path_pattern = os.path.join(component_params.get('gsea_output_dir'), report_label + '*', component_params.get('gsea_default_html'))
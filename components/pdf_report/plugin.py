@@ -3,9 +3,7 @@ import sys
 import os
 import glob
 import imp
-import subprocess
 import numpy as np
-import StringIO 
 import jinja2
 import shutil
 
@@ -33,6 +31,10 @@ def run(name, project):
 	# load the util_methods module:
 	util_methods = component_utils.load_remote_module('util_methods', utils_dir)
 
+	# the output of the external tools (bedtools, samtools, latex) goes to a log file for each call:
+	process_runner = component_utils.load_remote_module('process_runner', utils_dir)
+	runner = process_runner.create_runner(project.parameters, name)
+
 	# parse this module's config file
 	this_dir = os.path.dirname(os.path.realpath(__file__))
 	project.parameters.add(component_utils.parse_config_file(project, this_dir))
@@ -54,7 +56,7 @@ def run(name, project):
 	# read template
 	env = jinja2.Environment(loader=jinja2.FileSystemLoader(this_dir))
 	template = env.get_template(component_params.get('report_template'))
-	output_file = create_report(template, project, component_params, extra_params)
+	output_file = create_report(template, project, component_params, runner, extra_params)
 
 	# change permissions:
 	os.chmod(output_file, 0775)
@@ -68,19 +70,19 @@ def run(name, project):
 	return [ c1 ]
 
 
-def create_report(template, project, component_params, extra_params = {} ):
+def create_report(template, project, component_params, runner, extra_params = {} ):
 	# returns a dict of file name mapping (e.g. what is displayed as the href element) to the file path
 
-	generate_figures(project, component_params, extra_params)
+	generate_figures(project, component_params, runner, extra_params)
 
 	fill_template(template, project, component_params)
 
-	report_filepath = compile_report(project, component_params)
+	report_filepath = compile_report(project, component_params, runner)
 
 	return report_filepath
 
 
-def generate_figures(project, component_params, extra_params = {}):
+def generate_figures(project, component_params, runner, extra_params = {}):
 
 	if project.parameters.get('aligner') == 'star' and not project.parameters.get('skip_align'):
 		logging.info('Calling star specific methods for figure generation')
@@ -102,19 +104,26 @@ def generate_figures(project, component_params, extra_params = {}):
 	# other plots that do not require aligner-specific methods:
 
 	# the read counts in the various bam files
-	bam_count_data = get_bam_counts(project, component_params)
+	bam_count_data = get_bam_counts(project, component_params, runner)
 	bam_count_plot_path = os.path.join(component_params.get('report_output_dir'), component_params.get('bamfile_reads_fig'))
 	general_plots.plot_bam_counts(bam_count_data, bam_count_plot_path)
 
 	# the coverage plots for the 'usual' chromosomes
-	calculate_coverage_data(project, component_params)
+	calculate_coverage_data(project, component_params, runner)
 	general_plots.plot_coverage(project, component_params)
 
 
 
-def calculate_coverage_data(project, component_params):
+def calculate_coverage_data(project, component_params, runner):
 	target_bam_suffix = project.parameters.get('bam_filter_level')
 
+	util_methods = component_utils.load_remote_module('util_methods', project.parameters.get('utils_dir'))
+	bam_levels = component_utils.load_remote_module('bam_levels', project.parameters.get('utils_dir'))
+
+	# the BAM files at this level may not have been created yet (e.g. if the level was changed when continuing a run)
+	bam_levels.ensure_level(project, target_bam_suffix)
+
+	executor = util_methods.create_sample_executor(project.parameters)
 	for sample in project.samples:
 
 		target_bamfile = [s for s in sample.bamfiles if s.lower().endswith(target_bam_suffix.lower() + '.bam')]
@@ -123,16 +132,22 @@ def calculate_coverage_data(project, component_params):
 			bam = target_bamfile[0]
 			cvg_filepath = os.path.join( component_params.get('report_output_dir'), sample.sample_name + '.' + target_bam_suffix + '.' + component_params.get('coverage_file_suffix'))
 			bedtools_args = [ component_params.get('bedtools_path'), component_params.get('bedtools_cmd'), '-ibam', bam, '-bga']
+			executor.submit(sample.sample_name, calculate_sample_coverage, runner, bedtools_args, cvg_filepath)
+		else:
+			logging.error('Could not find a BAM file ending with %s for sample %s.  Not exiting, but this is likely indicative of a problem')
 
-			with open(cvg_filepath, 'w') as cvg_filehandle:
-				p = subprocess.Popen(bedtools_args, stderr=subprocess.STDOUT, stdout=cvg_filehandle)
-			stdout, stderr = p.communicate()
+	# run the bedtools processes.  If any fail, this raises an exception listing all the failures
+	executor.wait()
 
-			logging.info('STDERR from bedtools genomecov call: ')
-			logging.info(stderr)
 
-		else:
-			logging.error('Could not find a BAM file ending with %s for sample %s.  Not exiting, but this is likely indicative of a problem')
+def calculate_sample_coverage(runner, bedtools_args, cvg_filepath):
+	"""
+	Runs bedtools for a single BAM file, writing the coverage to cvg_filepath
+	"""
+	result = runner.run('bedtools.' + os.path.basename(cvg_filepath), bedtools_args, stdout_path = cvg_filepath)
+	if result.returncode != 0:
+		logging.error('There was an error calculating coverage with: %s' % ' '.join(bedtools_args))
+		raise Exception('Error during bedtools genomecov call.')
 
 
 
@@ -186,7 +201,7 @@ def get_diff_exp_gene_summary(project):
 	return [line.strip().split('\t') for line in open(project.diff_exp_summary_filepath)]
 
 
-def compile_report(project, component_params):
+def compile_report(project, component_params, runner):
 	"""
 	Run the compilation for the latex .tex file that was created
 	"""
@@ -195,13 +210,8 @@ def compile_report(project, component_params):
 	compile_script = os.path.join(this_dir, component_params.get('compile_script'))
 	output_dir = component_params.get('report_output_dir')
 	args = [compile_script, output_dir, project_id]
-	p = subprocess.Popen(args, stdout = subprocess.PIPE, stderr=subprocess.PIPE)
-	stdout, stderr = p.communicate()
-	logging.info('STDOUT from latex compile script: ')
-	logging.info(stdout)
-	logging.info('STDERR from latex compile script: ')
-	logging.info(stderr)
-	if p.returncode != 0:
+	result = runner.run('latex.' + project_id, args)
+	if result.returncode != 0:
 		logging.error('Error running the compile script for the latex report.')
 		raise Exception('Error running the compile script for the latex report.')
 	# the compiled report is simply the project name with the '.pdf' suffix
@@ -210,7 +220,7 @@ def compile_report(project, component_params):
 	return pdf_report_path
 
 
-def get_bam_counts(project, component_params):
+def get_bam_counts(project, component_params, runner):
 	"""
 	Return a dict of dicts-- first level is the 'types' of the bamfiles.  Those each point at dicts which contain samples-to-counts info
 	"""
@@ -246,15 +256,13 @@ def get_bam_counts(project, component_params):
 			expected_index_path = bam_path + '.bai'
 			if os.path.isfile(expected_index_path):
 				call_args = [component_params.get('samtools'), component_params.get('samtools_call'), bam_path]
-				p = subprocess.Popen( call_args, stdout = subprocess.PIPE)
-				stdout, stderr = p.communicate()
-				if p.returncode != 0:
+				idxstats_path = os.path.join(component_params.get('report_output_dir'), s + '.' + t + '.idxstats')
+				result = runner.run('samtools.' + s + '.' + t, call_args, stdout_path = idxstats_path)
+				if result.returncode != 0:
 					logging.error('There was an error when calling out to samtools.  The call was: %s' % ' '.join(call_args))
-					logging.error('stdout: %s' % stdout)
-					logging.error('stderr: %s' % stderr)
 					raise Exception('Exception when calling samtools for counting reads in the bam files')
 				else:
-					total_reads = np.sum(np.loadtxt(StringIO.StringIO(stdout), usecols=(2,)))
+					total_reads = np.sum(np.loadtxt(idxstats_path, usecols=(2,)))
 					read_count_dict[t][s] = total_reads
 			else:
 				logging.error('Problem with finding a bam index file.  The expected BAM path was: %s' % bam_path)
@@ -2,7 +2,6 @@ import logging
 import sys
 import os
 import imp
-import subprocess
 
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
 
@@ -34,19 +33,27 @@ def run(name, project):
 	# create the final output directory, if possible
 	util_methods.create_directory(output_dir, overwrite = True)
 
+	# rnaSeQC's output goes to a log file for each sample:
+	process_runner = component_utils.load_remote_module('process_runner', utils_dir)
+	runner = process_runner.create_runner(project.parameters, name)
+
 	# run the QC processes:
-	reports = run_qc(project, component_params, util_methods)
+	reports = run_qc(name, project, component_params, util_methods, runner)
 
 	return [component_utils.ComponentOutput(reports, component_params.get('tab_title'), component_params.get('header_msg'), component_params.get('display_format')),]
 
 
-def run_qc(project, component_params, util_methods):
+def run_qc(component_name, project, component_params, util_methods, runner):
 
 	base_command = 'java -jar ' + component_params.get('rnaseqc_jar') 
 	base_command +=' -r ' + project.parameters.get('genome_fasta')
 	base_command +=' -t ' + component_params.get('rnaseqc_gtf')
 
+	# when restarting, only the samples whose BAM files (or the parameters) changed are checked again
+	samples_to_check = util_methods.get_samples_to_run(project, component_name)
+
 	all_reports = {}
+	executor = util_methods.create_sample_executor(project.parameters)
 	for sample in project.samples:
 		# only use the most 'raw' bamfile at this point.
 		bamfile = get_earliest_version_of_file(sample.bamfiles)
@@ -60,29 +67,31 @@ def run_qc(project, component_params, util_methods):
 			arg = '"' + sample.sample_name + '|' + bamfile + '|-"'
 
 			command = base_command + ' -o ' + output_dir + ' -s ' + arg
+			if sample in samples_to_check:
+				executor.submit(sample.sample_name, run_sample_qc, runner, command, sample.sample_name)
 
-			logging.info('Calling rnaSeQC with: ')
-			logging.info(command)
-			process = subprocess.Popen(command, shell = True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-
-			stdout, stderr = process.communicate()
-			logging.info('STDOUT from rna-SeQC: ')
-			logging.info(stdout)
-			logging.info('STDERR from rna-SeQC: ')
-			logging.info(stderr)
-	
-			if process.returncode != 0:			
-				logging.error('There was an error encountered during execution of rna-SeQC for sample %s ' % sample.sample_name)
-				raise Exception('Error during rna-SeQC module.')
 			report_path = os.path.join(output_dir, component_params.get('rnaseqc_report_name'))
 			sample.rnaseqc_report = report_path
 			all_reports[name] = report_path
 		else:
 			logging.error('The bamfile (%s) is not actually a file.' % bamfile)
 			raise MissingBamFileException('Missing BAM file: %s' % bamfile)
+
+	# run the QC processes.  If any fail, this raises an exception listing all the failures
+	executor.wait()
 	return all_reports
 
 
+def run_sample_qc(runner, command, sample_name):
+	"""
+	Runs rnaSeQC for a single sample
+	"""
+	result = runner.run('rnaSeQC.' + sample_name, command)
+	if result.returncode != 0:			
+		logging.error('There was an error encountered during execution of rna-SeQC for sample %s ' % sample_name)
+		raise Exception('Error during rna-SeQC module.')
+
+
 
 def get_earliest_version_of_file(file_list):
 	"""
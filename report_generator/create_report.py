@@ -3,7 +3,10 @@ import jinja2
 import shutil
 import os
 import sys
-import imp
+
+# the modules of the utils directory are loaded as the components load them (see component_utils.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'components'))
+import component_utils
 
 class EmptySectionException(Exception):
 	pass
@@ -27,6 +30,13 @@ class Panel(object):
 		self.has_iframe = has_iframe
 
 
+class Table(object):
+	def __init__(self, title, columns, rows):
+		self.title = title
+		self.columns = columns
+		self.rows = rows
+
+
 class Section(object):
 	def __init__(self, href, header_message, contents):
 		self.href = href
@@ -37,26 +47,14 @@ class Section(object):
 				self.panel_section = True
 			elif type(contents[0]) is Link:
 				self.link_section = True
+			elif type(contents[0]) is Table:
+				self.table_section = True
 			else:
 				raise InvalidDisplayException('Display type has not been implemented.')
 		else:
 			raise EmptySectionException('Attempting to populate an empty section.')
 
 
-def load_remote_module(module_name, location):
-	"""
-	Loads and returns the module given by 'module_name' that resides in the given location
-	"""
-	sys.path.append(location)
-	try:
-		fileobj, filename, description = imp.find_module(module_name, [location])
-		module = imp.load_module(module_name, fileobj, filename, description)
-		return module
-	except ImportError as ex:
-		logging.error('Could not import module %s at location %s' % (module_name, location))
-		raise ex
-
-
 def add_fastq(project, transformer):
 	tab_header = Link("fastq_files","FastQ Files")
 	file_links = []
@@ -94,6 +92,45 @@ def add_fastQC_reports(project, transformer):
 		return None, None
 
 
+def format_value(value, scale = 1.0, template = '%.1f'):
+	if value is None:
+		return '-'
+	return template % (value/scale)
+
+
+def add_run_profile(profile):
+	"""
+	Summarizes the run profile (see utils/run_profile.py): a row for each component (its own time plus the totals of the external
+	tools it ran), and a row for each external tool
+	"""
+	if not profile:
+		return None, None
+	tab_header = Link("run_profile", "Run Profile")
+	mb = 1024.0**2
+
+	component_rows = []
+	for c in profile['components']:
+		component_rows.append([c['name'], format_value(c['wall_time']), format_value(c['user_time']), format_value(c['system_time']), 
+					str(c['task_count']), format_value(c['task_wall_time']), format_value(c['task_user_time']), format_value(c['task_system_time']), 
+					format_value(c['task_max_rss'], template = '%.0f'), format_value(c['task_bytes_read'], mb, '%.0f'), format_value(c['task_bytes_written'], mb, '%.0f')])
+	component_table = Table('Components (the run took %s s, starting %s)' % (format_value(profile['wall_time']), profile['started']),
+				['Component', 'Wall time (s)', 'User CPU (s)', 'System CPU (s)', 'Tools run', 'Tool wall time (s)', 'Tool user CPU (s)', 
+				'Tool system CPU (s)', 'Tool peak memory (MB)', 'Tool reads (MB)', 'Tool writes (MB)'], 
+				component_rows)
+
+	task_rows = []
+	for t in profile['tasks']:
+		task_rows.append([t.get('component') or '-', t['label'], str(t['returncode']), format_value(t['wall_time']), format_value(t['user_time']), 
+					format_value(t['system_time']), format_value(t['max_rss'], template = '%.0f'), 
+					format_value(t['bytes_read'], mb, '%.0f'), format_value(t['bytes_written'], mb, '%.0f')])
+	task_table = Table('External tools', 
+				['Component', 'Task', 'Exit status', 'Wall time (s)', 'User CPU (s)', 'System CPU (s)', 'Peak memory (MB)', 'Reads (MB)', 'Writes (MB)'], 
+				task_rows)
+
+	section = Section("run_profile", "Time and resources used by this run:", [component_table, task_table])
+	return tab_header, section
+
+
 def add_to_context(context, tab, section):
 	if tab and section:
 		context['section_list'].append(tab)
@@ -112,8 +149,8 @@ def write_report(pipeline):
 		utils_dir = parameters.get('utils_dir')
 
 		# load the parser and the util_methods modules:
-		config_parser = load_remote_module('config_parser', utils_dir)
-		util_methods = load_remote_module('util_methods', utils_dir)
+		config_parser = component_utils.load_remote_module('config_parser', utils_dir)
+		util_methods = component_utils.load_remote_module('util_methods', utils_dir)
 
 		# read the config file for this report generator:
 		this_directory = os.path.dirname(os.path.realpath(__file__))
@@ -160,6 +197,10 @@ def write_report(pipeline):
 					section = Section(section_href, output.header_msg, contents)
 					add_to_context(context, tab_header, section)
 
+		logging.info('Adding the run profile to output report.')
+		run_profile = component_utils.load_remote_module('run_profile', utils_dir)
+		add_to_context(context, *add_run_profile(run_profile.load_run_profile(parameters.get('output_location'))))
+
 		logging.info('Rendering report.')
 		completed_report_path = os.path.join(report_directory, report_parameters.get('completed_html_report'))
 		with open(completed_report_path, 'w') as outfile:
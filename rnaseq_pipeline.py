@@ -9,6 +9,8 @@ import datetime
 import report_generator.create_report as report_writer
 from utils.component import Component
 import utils.continue_analysis
+import utils.work_queue
+import utils.diff_exp_store
 from utils.pipeline_builder import PipelineBuilder
 from utils.pipeline import Pipeline # allows unpickling the pipeline object
 
@@ -36,6 +38,16 @@ if __name__ == "__main__":
 		# Parse the commandline args:
 		cmd_line_params = cl_parser.read()
 
+		# a worker only runs the tasks another pipeline run (the coordinator) puts in its work queue:
+		if cmd_line_params.get('worker_output_location', None):
+			utils.work_queue.run_worker(pipeline_home, cmd_line_params)
+			sys.exit(0)
+
+		# a query only reads the differential expression results of an earlier run:
+		if cmd_line_params.get('query_store', None):
+			utils.diff_exp_store.run_query(cmd_line_params)
+			sys.exit(0)
+
 		# set the Pipeline object to None by default-- we will only pickle a configured pipeline if analyses have been completed.  
 		# If the pipeline raises an exception prior to starting actual analyses, it is quick to make the necessary fix and restart
 		# without involving any pickling.  
@@ -53,7 +65,7 @@ if __name__ == "__main__":
 			create_logger(configured_pipeline.project.parameters.get('output_location'))
 
 			# alter the pipeline for the pending analysis:
-			utils.continue_analysis.configure_for_restart(configured_pipeline, cmd_line_params.get('annotation_file', None), cmd_line_params.get('contrast_file', None))
+			utils.continue_analysis.configure_for_restart(configured_pipeline, cmd_line_params.get('annotation_file', None), cmd_line_params.get('contrast_file', None), cmd_line_params.get('bam_filter_level', None))
 		else:
 			# build the pipeline:
 			builder = PipelineBuilder(pipeline_home)
@@ -71,6 +83,9 @@ if __name__ == "__main__":
 			latex_report_component.run()
 			configured_pipeline.components.append(latex_report_component) # have to add to configured pipeline so that the report writer finds it.
 
+		# write the run profile again, now including the report component:
+		configured_pipeline.write_run_profile()
+
 		report_writer.write_report(configured_pipeline)
 
 		# if we reach this far, everything was good- if it was a full analysis run, then simply finish.  Otherwise, save the current state for a potential restart
@@ -0,0 +1,145 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import os
+import shutil
+import tempfile
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+import utils.bam_levels as bam_levels
+from utils.project import Project
+from utils.sample import Sample
+from utils.component import Component
+from utils.util_classes import Params
+from utils.custom_exceptions import *
+import utils.continue_analysis as continue_analysis
+
+
+def create_params(bam_filter_level, extra_bam_levels = ()):
+	p = Params()
+	p.add(bam_filter_level = bam_filter_level, extra_bam_levels = extra_bam_levels, samtools = 'SAMTOOLS', picard = 'PICARD', max_sample_workers = '2')
+	return p
+
+
+class TestBamLevels(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.original_create_runner = bam_levels.process_runner.create_runner
+
+
+	def tearDown(self):
+		bam_levels.process_runner.create_runner = self.original_create_runner
+		shutil.rmtree(self.tmp_dir)
+
+
+	def touch(self, filename):
+		filepath = os.path.join(self.tmp_dir, filename)
+		open(filepath, 'w').close()
+		return filepath
+
+
+	def mock_subprocess(self, returncode = 0):
+		"""
+		Mocks the external tools.  Any output file (after '>' or OUTPUT=) is created, as the real tools would.
+		"""
+		commands = []
+		def run(label, command, **kwargs):
+			commands.append(command)
+			for token in command.split():
+				if token.startswith('OUTPUT='):
+					open(token[len('OUTPUT='):], 'w').close()
+			if '>' in command:
+				open(command.split('>')[1].strip(), 'w').close()
+			return mock.Mock(returncode = returncode)
+		runner = mock.Mock()
+		runner.run.side_effect = run
+		bam_levels.process_runner.create_runner = mock.Mock(return_value = runner)
+		return commands
+
+
+	def test_required_levels_include_the_levels_they_are_made_from(self):
+		self.assertEqual(bam_levels.get_required_levels(create_params('sort')), ['sort'])
+		self.assertEqual(bam_levels.get_required_levels(create_params('sort.primary')), ['sort', 'sort.primary'])
+		self.assertEqual(bam_levels.get_required_levels(create_params('sort', 'sort.primary.dedup')), ['sort', 'sort.primary', 'sort.primary.dedup'])
+
+
+	def test_unknown_level_raises_exception(self):
+		with self.assertRaises(BamLevelException):
+			bam_levels.get_required_levels(create_params('sort', 'foo'))
+
+
+	def test_existing_level_is_not_recreated(self):
+		commands = self.mock_subprocess()
+		project = Project()
+		project.parameters = create_params('sort.primary')
+		project.samples = [Sample('A', 'X', bamfiles = [self.touch('A.sort.bam'), self.touch('A.sort.primary.bam')])]
+		self.assertFalse(bam_levels.ensure_level(project, 'sort.primary'))
+		self.assertEqual(commands, [])
+
+
+	def test_missing_levels_are_created_from_the_previous_level(self):
+		commands = self.mock_subprocess()
+		project = Project()
+		project.parameters = create_params('sort.primary.dedup')
+		samples = [Sample(name, 'X', bamfiles = [self.touch(name + '.sort.bam')]) for name in ['A', 'B']]
+		project.samples = samples
+		self.assertTrue(bam_levels.ensure_level(project, 'sort.primary.dedup'))
+		for s in samples:
+			self.assertEqual(s.bamfiles, [os.path.join(self.tmp_dir, s.sample_name + '.' + l + '.bam') for l in bam_levels.BAM_LEVELS])
+		self.assertEqual(len([c for c in commands if 'MarkDuplicates' in c]), 2)
+		self.assertEqual(len([c for c in commands if '-F 0x0100' in c]), 2)
+
+
+	def test_failed_level_creation_raises_exception(self):
+		self.mock_subprocess(returncode = 1)
+		project = Project()
+		project.parameters = create_params('sort.primary')
+		project.samples = [Sample('A', 'X', bamfiles = [self.touch('A.sort.bam')])]
+		with self.assertRaises(SampleTaskException):
+			bam_levels.ensure_level(project, 'sort.primary')
+
+
+	def test_samples_without_any_level_are_skipped(self):
+		commands = self.mock_subprocess()
+		project = Project()
+		project.parameters = create_params('sort.primary')
+		project.samples = [Sample('A', 'X', bamfiles = [self.touch('A.custom.bam')])]
+		self.assertFalse(bam_levels.ensure_level(project, 'sort.primary'))
+		self.assertEqual(commands, [])
+
+
+	def test_continue_with_new_level_reruns_downstream_components(self):
+		commands = self.mock_subprocess()
+		project = Project()
+		project.parameters = create_params('sort.primary')
+		project.parameters.add(skip_analysis = True)
+		project.samples = [Sample('A', 'X', bamfiles = [self.touch('A.sort.bam'), self.touch('A.sort.primary.bam')])]
+		project.contrasts = [('X', 'Y')]
+
+		components = [Component('star', 'star_dir', produces = ['bam_files']),
+				Component('deseq', 'deseq_dir', 'ANALYSIS', consumes = ['raw_count_matrices'], produces = ['deseq_tables']),
+				Component('feature_counts', 'fc_dir', consumes = ['bam_files'], produces = ['raw_count_matrices']),
+				Component('rna_seqc', 'qc_dir', consumes = ['bam_files'], produces = ['qc_reports']),
+				Component('other', 'other_dir', consumes = ['something_else'])]
+		for c in components:
+			c.records = {'*': {}, 'A': {}}
+		pipeline = mock.Mock()
+		pipeline.project = project
+		pipeline.components = components
+
+		continue_analysis.configure_for_restart(pipeline, bam_filter_level = 'sort.primary.dedup')
+
+		self.assertEqual(project.parameters.get('bam_filter_level'), 'sort.primary.dedup')
+		self.assertTrue(os.path.join(self.tmp_dir, 'A.sort.primary.dedup.bam') in project.samples[0].bamfiles)
+		self.assertEqual([c.name for c in components if '*' not in c.records], ['deseq', 'feature_counts', 'rna_seqc'])
+		self.assertTrue(all(['A' in c.records for c in components]))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,175 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import mock
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.process_runner import ProcessRunner
+from utils.batch_scheduler import BatchTask, BatchScheduler, SCHEDULERS, create_scheduler
+import utils.batch_scheduler as batch_scheduler
+from utils.task_executor import get_worker_count
+from utils.util_classes import Params
+from utils.custom_exceptions import *
+
+
+# stand-ins for qsub/qstat/qdel, which run the jobs on this machine.  qsub records each submission and runs the tasks of the
+# job in the background; qstat knows about the job until all of its tasks have finished.
+FAKE_QSUB = """#!/bin/bash
+STATE=%(state)s
+SCRIPT="${@: -1}"
+COUNT=$(echo "$*" | sed -n 's/.*-t 1-\\([0-9]*\\).*/\\1/p')
+echo "$*" >> $STATE/submissions
+ID=$(wc -l < $STATE/submissions)
+( if [ -z "$COUNT" ]; then SGE_TASK_ID=undefined bash "$SCRIPT"; else for i in $(seq 1 $COUNT); do SGE_TASK_ID=$i bash "$SCRIPT" & done; wait; fi; touch $STATE/$ID.done ) > /dev/null 2>&1 &
+echo "$ID"
+"""
+
+FAKE_QSTAT = """#!/bin/bash
+if [ -f %(state)s/$2.done ]; then echo "Following jobs do not exist: $2"; exit 1; fi
+echo "job_number: $2"
+"""
+
+
+class TestBatchScheduler(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.state_dir = os.path.join(self.tmp_dir, 'scheduler')
+		os.makedirs(self.state_dir)
+		self.settings = dict(SCHEDULERS['sge'])
+		for name, template in [('qsub', FAKE_QSUB), ('qstat', FAKE_QSTAT)]:
+			script = os.path.join(self.state_dir, name)
+			with open(script, 'w') as f:
+				f.write(template % {'state': self.state_dir})
+			os.chmod(script, 0775)
+		self.settings.update({'submit': os.path.join(self.state_dir, 'qsub'), 'status': os.path.join(self.state_dir, 'qstat') + ' -j', 'cancel': 'true'})
+		self.log_dir = os.path.join(self.tmp_dir, 'task_logs')
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def create_runner(self, settings = None):
+		scheduler = BatchScheduler(settings or self.settings, os.path.join(self.log_dir, 'jobs'), poll_interval = 0.05, gather_window = 0.3)
+		return ProcessRunner(self.log_dir, scheduler = scheduler)
+
+
+	def submissions(self):
+		return open(os.path.join(self.state_dir, 'submissions')).read().splitlines()
+
+
+	def test_tasks_run_together_are_submitted_as_one_array_job(self):
+		runner = self.create_runner()
+		results = {}
+		def run(i):
+			results[i] = runner.run('sample_%d' % i, 'echo aligning sample %d; exit %d' % (i, 3 if i == 2 else 0))
+		threads = [threading.Thread(target = run, args = (i,)) for i in range(3)]
+		[t.start() for t in threads]
+		[t.join() for t in threads]
+
+		submissions = self.submissions()
+		self.assertEqual(len(submissions), 1)
+		self.assertTrue('-t 1-3' in submissions[0])
+		self.assertEqual([results[i].returncode for i in range(3)], [0, 0, 3])
+		self.assertEqual(results[1].tail, ['aligning sample 1'])
+		self.assertEqual(open(results[1].log_path).read().splitlines()[1:], ['aligning sample 1'])
+		self.assertTrue(results[0].wall_time >= 0)
+		self.assertEqual(results[0].max_rss, None)
+
+
+	def test_single_task_with_stdout_and_resources(self):
+		runner = self.create_runner()
+		output_path = os.path.join(self.tmp_dir, 'coverage.txt')
+		result = runner.run('coverage', ['sh', '-c', 'echo chr1 0 10 5; echo warning 1>&2'], stdout_path = output_path, memory = 40, cpus = 4)
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(open(output_path).read(), 'chr1 0 10 5\n')
+		self.assertEqual(result.tail, ['warning'])
+		submission = self.submissions()[0]
+		self.assertFalse('-t 1-' in submission)
+		# SGE takes the memory per slot
+		self.assertTrue('-pe smp 4 -l h_vmem=10G' in submission)
+
+
+	def test_slurm_takes_the_memory_of_the_whole_task(self):
+		settings = dict(SCHEDULERS['slurm'])
+		settings.update({'submit': os.path.join(self.state_dir, 'qsub'), 'status': os.path.join(self.state_dir, 'qstat') + ' -j', 'cancel': 'true'})
+		scheduler = BatchScheduler(settings, os.path.join(self.log_dir, 'jobs'))
+		with mock.patch('subprocess.Popen') as popen:
+			popen.return_value.communicate.return_value = ('17\n', None)
+			popen.return_value.returncode = 0
+			scheduler.submit([BatchTask('sample', 'true', os.path.join(self.tmp_dir, 'sample.log'), memory = 40, cpus = 4)])
+		self.assertTrue('--cpus-per-task=4 --mem=40G' in popen.call_args[0][0])
+
+
+	def test_unknown_job_is_told_apart_from_a_failed_status_command(self):
+		scheduler = BatchScheduler(self.settings, os.path.join(self.log_dir, 'jobs'))
+		for returncode, output, active in [(0, 'job_number: 7\n', True), (1, 'Following jobs do not exist: 7\n', False),
+				(1, 'error: commlib error: got select error (Connection refused)\n', None)]:
+			with mock.patch('subprocess.Popen') as popen:
+				popen.return_value.communicate.return_value = (output, None)
+				popen.return_value.returncode = returncode
+				self.assertEqual(scheduler.is_active('7'), active)
+
+
+	def test_failing_status_command_does_not_fail_a_running_job(self):
+		# qstat fails while the job runs (for longer than the exit status files are waited for), then works again
+		with open(os.path.join(self.state_dir, 'qstat'), 'w') as f:
+			f.write('#!/bin/bash\nif [ ! -f %(state)s/$2.done ]; then echo "error: failed receiving gdi request"; exit 1; fi\n' % {'state': self.state_dir}
+				+ FAKE_QSTAT.split('\n', 1)[1] % {'state': self.state_dir})
+		with mock.patch.object(batch_scheduler, 'EXIT_FILE_TIMEOUT', 0), mock.patch.object(batch_scheduler, 'MAX_STATUS_FAILURES', 1000):
+			result = self.create_runner().run('sample', 'sleep 0.5; echo aligned')
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(result.tail, ['aligned'])
+
+
+	def test_job_is_given_up_on_if_its_status_cannot_be_checked(self):
+		settings = dict(self.settings)
+		settings['status'] = 'false'
+		with mock.patch.object(batch_scheduler, 'EXIT_FILE_TIMEOUT', 0), mock.patch.object(batch_scheduler, 'MAX_STATUS_FAILURES', 3):
+			result = self.create_runner(settings).run('sample', 'sleep 5')
+		self.assertEqual(result.returncode, 1)
+
+
+	def test_failed_submission_fails_the_task(self):
+		settings = dict(self.settings)
+		settings['submit'] = 'false'
+		result = self.create_runner(settings).run('sample', 'echo never runs')
+		self.assertEqual(result.returncode, 1)
+
+
+	def test_scheduler_created_from_parameters(self):
+		p = Params()
+		p.add(job_backend = 'local')
+		self.assertEqual(create_scheduler(p, self.log_dir), None)
+
+		p.reset_param('job_backend', 'slurm')
+		p.add(batch_submit_command = '/opt/slurm/bin/sbatch --parsable', batch_status_command = '', batch_cancel_command = '',
+			batch_submit_options = '--partition=short', batch_poll_interval = '10', batch_gather_window = '1')
+		scheduler = create_scheduler(p, self.log_dir)
+		self.assertEqual((scheduler.settings['submit'], scheduler.settings['status']), ('/opt/slurm/bin/sbatch --parsable', 'squeue -h -j'))
+		self.assertEqual((scheduler.submit_options, scheduler.poll_interval, scheduler.job_dir), ('--partition=short', 10.0, os.path.join(self.log_dir, 'jobs')))
+
+		p.reset_param('job_backend', 'pbs')
+		with self.assertRaises(BatchJobException):
+			create_scheduler(p, self.log_dir)
+
+
+	def test_batch_backend_sizes_sample_workers_by_job_limit(self):
+		p = Params()
+		p.add(max_sample_workers = '2', job_backend = 'sge', batch_max_jobs = '300')
+		self.assertEqual(get_worker_count(p), 300)
+		p.reset_param('job_backend', 'local')
+		self.assertEqual(get_worker_count(p), 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
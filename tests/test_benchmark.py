@@ -0,0 +1,106 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import gzip
+import shutil
+import tempfile
+import subprocess
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from benchmarks import synthetic_project
+from benchmarks import run_benchmark
+import utils.util_methods as util_methods
+import utils.count_matrix as count_matrix
+import components.feature_counts.plugin as feature_counts
+
+
+class TestSyntheticProject(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def test_project_layout(self):
+		project = synthetic_project.create_project(self.tmp_dir, 4, reads_per_sample = 10, paired = True, prealigned = True, gene_count = 20)
+		self.assertEqual(project['samples'], ['S0001', 'S0002', 'S0003', 'S0004'])
+		annotations = util_methods.parse_annotation_file(project['sample_annotation_file'])
+		self.assertEqual(sorted(annotations), [('S0001', 'Condition1'), ('S0002', 'Condition2'), ('S0003', 'Condition1'), ('S0004', 'Condition2')])
+
+		sample_dir = os.path.join(self.tmp_dir, 'Sample_S0001')
+		fastq = os.path.join(sample_dir, 'S0001_R2_.final.fastq.gz')
+		self.assertEqual(len(gzip.open(fastq).read().splitlines()), 40)
+		self.assertTrue(os.path.isfile(os.path.join(sample_dir, 'star_align', 'S0001.sort.primary.bam.bai')))
+		self.assertTrue(os.path.isdir(project['star_genome_index']))
+
+
+	def test_count_files_can_be_merged(self):
+		count_files = []
+		totals = []
+		for name in ['A', 'B']:
+			count_files.append(os.path.join(self.tmp_dir, name + '.counts'))
+			totals.append(synthetic_project.write_count_file(count_files[-1], name + '.bam', 20, name))
+		matrix = count_matrix.assemble_count_matrix(count_files, ['A', 'B'])
+		self.assertEqual(matrix.counts.sum(axis = 0).tolist(), totals)
+		self.assertEqual(matrix.counts.shape, (20, 2))
+
+		# counting both BAM files at once gives the same counts:
+		cohort_file = os.path.join(self.tmp_dir, 'cohort.counts')
+		synthetic_project.write_count_table(cohort_file, ['A.bam', 'B.bam'], 20, ['A', 'B'])
+		self.assertEqual(count_matrix.read_feature_counts(cohort_file)[1].tolist(), matrix.counts.tolist())
+
+
+class TestStubTools(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.bin_dir = os.path.join(self.tmp_dir, 'bin')
+		run_benchmark.create_stubs(self.bin_dir)
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def test_stubs_write_expected_outputs(self):
+		fastq = os.path.join(self.tmp_dir, 'A_R1_.final.fastq.gz')
+		synthetic_project.write_fastq(fastq, 'A', 25)
+		prefix = os.path.join(self.tmp_dir, 'A.')
+		subprocess.check_call([os.path.join(self.bin_dir, 'STAR'), '--readFilesIn', fastq, '--outSAMtype', 'BAM', 'SortedByCoordinate', '--outFileNamePrefix', prefix])
+		self.assertTrue(os.path.isfile(prefix + 'Aligned.sortedByCoord.out.bam'))
+		star_log = dict([[x.strip() for x in line.split('|')] for line in open(prefix + 'Log.final.out') if '|' in line])
+		self.assertEqual(star_log['Number of input reads'], '25')
+
+		output = subprocess.check_output([os.path.join(self.bin_dir, 'featureCounts'), '-a', 'genes.gtf', '-o', prefix + 'counts', prefix + 'Aligned.sortedByCoord.out.bam'])
+		self.assertTrue(feature_counts.parse_assigned_reads(output))
+
+		self.assertNotEqual(subprocess.call([os.path.join(self.bin_dir, 'samtools'), 'sort', 'x.bam'], stderr = open(os.devnull, 'w')), 0)
+
+
+class TestBenchmarkSummary(unittest.TestCase):
+
+	def test_busy_time_counts_overlapping_tasks_once(self):
+		tasks = [{'start': 10.0, 'wall_time': 5.0}, {'start': 12.0, 'wall_time': 5.0}, {'start': 20.0, 'wall_time': 1.0}]
+		self.assertEqual(run_benchmark.busy_time(tasks), 8.0)
+		self.assertEqual(run_benchmark.busy_time([]), 0.0)
+
+
+	def test_summary(self):
+		profile = {'pipeline_max_rss': 100.0,
+			'components': [{'name': 'star', 'start': 102.0, 'wall_time': 10.0, 'task_count': 2, 'task_wall_time': 12.0}],
+			'tasks': [{'component': 'star', 'start': 103.0, 'wall_time': 6.0}, {'component': 'star', 'start': 104.0, 'wall_time': 6.0}]}
+		summary = run_benchmark.summarize(profile, 100.0, 20.0)
+		self.assertEqual((summary['startup_time'], summary['tool_busy_time'], summary['overhead']), (2.0, 7.0, 13.0))
+		self.assertEqual((summary['stages'][0]['tool_busy_time'], summary['stages'][0]['overhead']), (7.0, 3.0))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,55 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+import components.component_utils as component_utils
+
+
+class TestLoadRemoteModule(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		with open(os.path.join(self.tmp_dir, 'shared_test_module.py'), 'w') as f:
+			f.write('class SharedException(Exception):\n\tpass\n')
+
+
+	def tearDown(self):
+		sys.modules.pop('shared_test_module', None)
+		shutil.rmtree(self.tmp_dir)
+
+
+	def test_loaded_module_is_reused(self):
+		first = component_utils.load_remote_module('shared_test_module', self.tmp_dir)
+		error = first.SharedException()
+		second = component_utils.load_remote_module('shared_test_module', self.tmp_dir)
+		self.assertIs(first, second)
+		self.assertIsInstance(error, second.SharedException)
+		self.assertEqual(sys.path.count(self.tmp_dir), 1)
+
+
+	def test_module_of_another_location_is_loaded(self):
+		first = component_utils.load_remote_module('shared_test_module', self.tmp_dir)
+		other_dir = tempfile.mkdtemp()
+		try:
+			shutil.copy(os.path.join(self.tmp_dir, 'shared_test_module.py'), other_dir)
+			second = component_utils.load_remote_module('shared_test_module', other_dir)
+			self.assertEqual(os.path.dirname(second.__file__), other_dir)
+		finally:
+			shutil.rmtree(other_dir)
+
+
+	def test_missing_module(self):
+		with self.assertRaises(ImportError):
+			component_utils.load_remote_module('missing_test_module', self.tmp_dir)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,122 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import shutil
+import pickle
+import tempfile
+import numpy as np
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.count_matrix import CountMatrix, assemble_count_matrix, read_count_matrix, read_feature_counts, get_count_matrix, read_binary, BINARY_SUFFIX, INDEX_SUFFIX
+from utils.custom_exceptions import CountMatrixException
+from utils.project import Project
+
+
+class TestCountMatrix(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def write_countfile(self, name, rows):
+		path = os.path.join(self.tmp_dir, name)
+		with open(path, 'w') as f:
+			f.write('# Program:featureCounts\nGeneid\tChr\tStart\tEnd\tStrand\tLength\t%s.bam\n' % name)
+			for gene, count in rows:
+				f.write('%s\tchr1\t1\t100\t+\t100\t%d\n' % (gene, count))
+		return path
+
+
+	def test_counts_are_matched_to_genes_by_name(self):
+		a = self.write_countfile('A', [('g1', 1), ('g2', 2), ('g3', 3)])
+		b = self.write_countfile('B', [('g3', 30), ('g1', 10), ('g2', 20)])
+		matrix = assemble_count_matrix([a, b], ['A', 'B'])
+		self.assertEqual(matrix.genes, ['g1', 'g2', 'g3'])
+		self.assertEqual(matrix.samples, ['A', 'B'])
+		self.assertEqual(matrix.counts.dtype, np.int64)
+		self.assertEqual(matrix.counts.tolist(), [[1, 10], [2, 20], [3, 30]])
+
+
+	def test_inconsistent_genes_raise_exception(self):
+		a = self.write_countfile('A', [('g1', 1), ('g2', 2)])
+		for rows in [[('g1', 1)], [('g1', 1), ('g9', 2)], [('g1', 1), ('g2', 2), ('g3', 3)], [('g2', 1), ('g1', 2), ('g1', 3)]]:
+			b = self.write_countfile('B', rows)
+			with self.assertRaises(CountMatrixException):
+				assemble_count_matrix([a, b], ['A', 'B'])
+
+		duplicated = self.write_countfile('C', [('g1', 1), ('g1', 2)])
+		with self.assertRaises(CountMatrixException):
+			assemble_count_matrix([duplicated], ['C'])
+
+
+	def test_matrix_written_and_read_back(self):
+		matrix = CountMatrix(['g1', 'g2'], ['A', 'B', 'C'], np.array([[0, 1, 2], [30, 40, 50]], dtype = np.int64))
+		path = os.path.join(self.tmp_dir, 'raw_count_matrix.counts')
+		matrix.write(path)
+		self.assertEqual(open(path).read(), 'Gene\tA\tB\tC\ng1\t0\t1\t2\ng2\t30\t40\t50\n')
+		copy = read_count_matrix(path)
+		self.assertEqual((copy.genes, copy.samples, copy.counts.tolist()), (matrix.genes, matrix.samples, matrix.counts.tolist()))
+
+		with self.assertRaises(CountMatrixException):
+			CountMatrix(['g1'], ['A', 'B'], np.zeros((2, 2)))
+
+
+	def test_multicolumn_feature_counts_file(self):
+		path = os.path.join(self.tmp_dir, 'cohort.counts')
+		with open(path, 'w') as f:
+			f.write('# Program:featureCounts\nGeneid\tChr\tStart\tEnd\tStrand\tLength\tA.bam\tB.bam\ng1\tchr1\t1\t100\t+\t100\t5\t6\n')
+		genes, counts = read_feature_counts(path)
+		self.assertEqual((genes, counts.tolist()), (['g1'], [[5, 6]]))
+
+
+	def test_matrices_kept_in_memory_but_not_pickled(self):
+		path = os.path.join(self.tmp_dir, 'raw_count_matrix.counts')
+		matrix = CountMatrix(['g1'], ['A'], np.array([[7]], dtype = np.int64))
+		matrix.write(path)
+		project = Project()
+		project.count_matrices[path] = matrix
+		self.assertTrue(get_count_matrix(project, path) is matrix)
+
+		restored = pickle.loads(pickle.dumps(project))
+		self.assertEqual(restored.count_matrices, {})
+		self.assertEqual(get_count_matrix(restored, path).counts.tolist(), [[7]])
+		self.assertTrue(path in restored.count_matrices)
+
+
+	def test_binary_copy_is_memory_mapped(self):
+		path = os.path.join(self.tmp_dir, 'raw_count_matrix.counts')
+		CountMatrix(['g1', 'g2'], ['A', 'B'], np.array([[1, 2], [3, 4]], dtype = np.int64)).write(path)
+		self.assertTrue(os.path.isfile(path + BINARY_SUFFIX) and os.path.isfile(path + INDEX_SUFFIX))
+		matrix = read_binary(path)
+		self.assertTrue(isinstance(matrix.counts, np.memmap))
+		self.assertEqual((matrix.genes, matrix.samples, matrix.counts.tolist()), (['g1', 'g2'], ['A', 'B'], [[1, 2], [3, 4]]))
+
+		# once the text file is replaced, the binary copy is out of date:
+		with open(path, 'w') as f:
+			f.write('Gene\tA\tB\ng1\t5\t6\n')
+		self.assertEqual(read_binary(path), None)
+		self.assertEqual(get_count_matrix(Project(), path).counts.tolist(), [[5, 6]])
+		self.assertEqual(read_binary(path).counts.tolist(), [[5, 6]])
+
+
+	def test_text_matrix_is_parsed_once(self):
+		# e.g. a normalized matrix written by R
+		path = os.path.join(self.tmp_dir, 'normalized_count_matrix.counts')
+		with open(path, 'w') as f:
+			f.write('Gene\tA\tB\ng1\t1.5\t2.25\n')
+		matrix = get_count_matrix(Project(), path, float)
+		self.assertEqual(matrix.counts.tolist(), [[1.5, 2.25]])
+		self.assertEqual(read_binary(path).counts.dtype, np.float64)
+
+
+if __name__ == "__main__":
+	unittest.main()
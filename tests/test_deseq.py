@@ -5,15 +5,24 @@ import unittest
 import mock
 import sys
 import os
+import shutil
+import tempfile
+import numpy as np
 
 from os import path
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
 import utils.util_methods as util_methods
+import utils.result_cache as result_cache
+import utils.task_executor as task_executor
+import utils.count_matrix as count_matrix
+import utils.differential_expression as differential_expression
 
 from utils.project import Project
+from utils.process_runner import ProcessRunner
 from utils.sample import Sample
 from utils.util_classes import Params
+from utils.custom_exceptions import SampleTaskException
 
 from component_tester import ComponentTester
 
@@ -28,7 +37,7 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		project = Project()
 		cp = Params()
 		with self.assertRaises(self.module.NoCountMatricesException):
-			self.module.call_deseq(project, cp)
+			self.module.call_deseq(project, cp, result_cache, mock.Mock())
 
 
 	def test_correct_calls_are_made(self):
@@ -37,6 +46,7 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		Mostly tests the path renaming, etc.
 		"""
 		self.module.call_script = mock.Mock()
+		runner = mock.Mock()
 		project = Project()
 		project.raw_count_matrices = ['/path/to/raw_counts/raw_count_matrix.primary.counts',
 					'/path/to/raw_counts/raw_count_matrix.primary.dedup.counts']
@@ -46,6 +56,7 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		project_params.add(feature_counts_file_extension = 'counts')
 		component_params.add(deseq_output_dir = '/path/to/final/deseq_dir')
 		component_params.add(deseq_script = 'deseq_original.R')
+		component_params.add(deseq_mode = 'per_contrast')
 		project_params.add(sample_annotation_file = '/path/to/samples.txt')
 		component_params.add( deseq_output_tag ='deseq')
 		component_params.add(deseq_contrast_flag = '_vs_')
@@ -56,16 +67,20 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		project.contrasts = [('X', 'Y'),('X', 'Z')]
 
 		# construct the expected call strings:
-		call_1 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/Y_vs_X.primary.deseq /path/to/final/deseq_dir/Y_vs_X.primary.heatmap.png 30'
-		call_2 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Z /path/to/final/deseq_dir/Z_vs_X.primary.deseq /path/to/final/deseq_dir/Z_vs_X.primary.heatmap.png 30'
-		call_3 ='/path/to/raw_counts/raw_count_matrix.primary.dedup.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/Y_vs_X.primary.dedup.deseq /path/to/final/deseq_dir/Y_vs_X.primary.dedup.heatmap.png 30'
-		call_4 ='/path/to/raw_counts/raw_count_matrix.primary.dedup.counts /path/to/samples.txt X Z /path/to/final/deseq_dir/Z_vs_X.primary.dedup.deseq /path/to/final/deseq_dir/Z_vs_X.primary.dedup.heatmap.png 30'
+		call_1 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/Y_vs_X.primary.deseq'
+		label_1 = 'deseq.Y_vs_X.primary'
+		call_2 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Z /path/to/final/deseq_dir/Z_vs_X.primary.deseq'
+		label_2 = 'deseq.Z_vs_X.primary'
+		call_3 ='/path/to/raw_counts/raw_count_matrix.primary.dedup.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/Y_vs_X.primary.dedup.deseq'
+		label_3 = 'deseq.Y_vs_X.primary.dedup'
+		call_4 ='/path/to/raw_counts/raw_count_matrix.primary.dedup.counts /path/to/samples.txt X Z /path/to/final/deseq_dir/Z_vs_X.primary.dedup.deseq'
+		label_4 = 'deseq.Z_vs_X.primary.dedup'
 
 		m = mock.MagicMock(side_effect = [True, True])
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
-			self.module.call_deseq(project, component_params)
-			calls = [mock.call('deseq_original.R', call_1), mock.call('deseq_original.R', call_2), mock.call('deseq_original.R', call_3), mock.call('deseq_original.R', call_4)]
+			self.module.call_deseq(project, component_params, result_cache, runner)
+			calls = [mock.call(runner, 'deseq_original.R', call_1, label_1), mock.call(runner, 'deseq_original.R', call_2, label_2), mock.call(runner, 'deseq_original.R', call_3, label_3), mock.call(runner, 'deseq_original.R', call_4, label_4)]
 			self.module.call_script.assert_has_calls(calls)
 
 
@@ -75,6 +90,7 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		and that the one successful call was indeed made correctly.
 		"""
 		self.module.call_script = mock.Mock()
+		runner = mock.Mock()
 		project = Project()
 		project.raw_count_matrices = ['/path/to/raw_counts/raw_count_matrix.primary.counts',
 					'/path/to/raw_counts/raw_count_matrix.primary.dedup.counts']
@@ -85,6 +101,7 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		project_params.add(feature_counts_file_extension = 'counts')
 		component_params.add(deseq_output_dir = '/path/to/final/deseq_dir')
 		component_params.add(deseq_script = 'deseq_original.R')
+		component_params.add(deseq_mode = 'per_contrast')
 		project_params.add(sample_annotation_file = '/path/to/samples.txt')
 		component_params.add( deseq_output_tag ='deseq')
 		component_params.add(deseq_contrast_flag = '_vs_')
@@ -95,33 +112,279 @@ class TestDeseqComponent(unittest.TestCase, ComponentTester):
 		project.contrasts = [('X', 'Y'),('X', 'Z')]
 
 		# construct the expected call strings:
-		call_1 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/Y_vs_X.primary.deseq /path/to/final/deseq_dir/Y_vs_X.primary.heatmap.png 30'
-		call_2 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Z /path/to/final/deseq_dir/Z_vs_X.primary.deseq /path/to/final/deseq_dir/Z_vs_X.primary.heatmap.png 30'
+		call_1 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/Y_vs_X.primary.deseq'
+		label_1 = 'deseq.Y_vs_X.primary'
+		call_2 ='/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Z /path/to/final/deseq_dir/Z_vs_X.primary.deseq'
+		label_2 = 'deseq.Z_vs_X.primary'
 
 		m = mock.MagicMock(side_effect = [True, False])
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
 			with self.assertRaises(self.module.MissingCountMatrixFileException):
-				self.module.call_deseq(project, component_params)
-			calls = [mock.call('deseq_original.R', call_1), mock.call('deseq_original.R', call_2)]
+				self.module.call_deseq(project, component_params, result_cache, runner)
+			calls = [mock.call(runner, 'deseq_original.R', call_1, label_1), mock.call(runner, 'deseq_original.R', call_2, label_2)]
 			self.module.call_script.assert_has_calls(calls)
 
 
 	def test_system_call_to_Rscript(self):
-		self.module.subprocess = mock.Mock()
-		mock_process = mock.Mock()
-		mock_process.communicate.return_value = (('abc', 'def'))
-		mock_process.returncode = 0
-		self.module.subprocess.Popen.return_value = mock_process
-		self.module.subprocess.STDOUT = 'abc'
-		self.module.subprocess.STDERR = 'def'
-		self.module.call_script('deseq_original.R', '/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/X_vs_Y.primary.deseq /path/to/final/deseq_dir/X_vs_Y.primary.heatmap.png 30')
+		runner = mock.Mock()
+		runner.run_r_script.return_value = mock.Mock(returncode = 0)
+		self.module.call_script(runner, 'deseq_original.R', '/path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/X_vs_Y.primary.deseq', 'deseq.X_vs_Y.primary')
 		full_script_path = os.path.join(os.path.dirname(os.path.abspath(self.module.__file__)), 'deseq_original.R')
-		expected_call = 'Rscript ' + full_script_path + ' /path/to/raw_counts/raw_count_matrix.primary.counts /path/to/samples.txt X Y /path/to/final/deseq_dir/X_vs_Y.primary.deseq /path/to/final/deseq_dir/X_vs_Y.primary.heatmap.png 30'
-		self.module.subprocess.Popen.assert_called_once_with(expected_call, shell = True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)
+		expected_args = ['/path/to/raw_counts/raw_count_matrix.primary.counts', '/path/to/samples.txt', 'X', 'Y', '/path/to/final/deseq_dir/X_vs_Y.primary.deseq']
+		runner.run_r_script.assert_called_once_with('deseq.X_vs_Y.primary', full_script_path, expected_args)
 
 
-		
+	def test_batch_mode_runs_contrasts_in_one_session(self):
+		"""
+		Tests that each count matrix gets a single call of the batch script, which is given the contrasts in a file, and that
+		contrasts restored from the result cache are left out of it.
+		"""
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			matrix_paths = [os.path.join(tmp_dir, 'raw_count_matrix.primary.counts'), os.path.join(tmp_dir, 'raw_count_matrix.primary.dedup.counts')]
+			for matrix_path in matrix_paths:
+				with open(matrix_path, 'w') as f:
+					f.write('Gene\tS1\tS2\tS3\n')
+			annotation_path = os.path.join(tmp_dir, 'samples.txt')
+			with open(annotation_path, 'w') as f:
+				f.write('S1\tX\nS2\tY\nS3\tZ\n')
+			output_dir = os.path.join(tmp_dir, 'deseq')
+			os.mkdir(output_dir)
+
+			project = Project()
+			project.raw_count_matrices = matrix_paths
+			project_params = Params()
+			project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix', feature_counts_file_extension = 'counts', sample_annotation_file = annotation_path)
+			project_params.add(result_cache_dir = os.path.join(tmp_dir, 'cache'))
+			project.add_parameters(project_params)
+			project.contrasts = [('X', 'Y'), ('X', 'Z')]
+			component_params = Params()
+			component_params.add(deseq_output_dir = output_dir, deseq_mode = 'batch', deseq_batch_script = 'deseq_batch.R', deseq_script = 'deseq_original.R',
+				deseq_contrasts_file_prefix = 'contrasts', deseq_output_tag = 'deseq', deseq_contrast_flag = '_vs_', number_of_genes_for_heatmap = '30', heatmap_file_tag = 'heatmap.png')
+
+			contrast_files = []
+			def run_batch(runner, script, arg_string, label):
+				contrasts_path = arg_string.split()[2]
+				contrast_files.append((label, open(contrasts_path).read()))
+				for line in open(contrasts_path):
+					for output_path in line.split()[2:]:
+						open(output_path, 'w').close()
+			self.module.call_script = mock.Mock(side_effect = run_batch)
+			deseq_files, heatmap_files = self.module.call_deseq(project, component_params, result_cache, mock.Mock())
+
+			self.assertEqual(self.module.call_script.call_count, 2)
+			args = self.module.call_script.call_args_list[0][0]
+			self.assertEqual((args[1], args[2]), ('deseq_batch.R', '%s %s %s' % (matrix_paths[0], annotation_path, os.path.join(output_dir, 'contrasts.primary.tsv'))))
+			self.assertEqual(contrast_files[0], ('deseq.primary', 'X\tY\t%s\nX\tZ\t%s\n' % (deseq_files['Y_vs_X.primary'], deseq_files['Z_vs_X.primary'])))
+			self.assertEqual(contrast_files[1][0], 'deseq.primary.dedup')
+
+			# a rerun with a new contrast only runs that one:
+			project.contrasts = [('X', 'Y'), ('X', 'Z'), ('Y', 'Z')]
+			self.module.call_deseq(project, component_params, result_cache, mock.Mock())
+			self.assertEqual(self.module.call_script.call_count, 4)
+			self.assertEqual([len(text.splitlines()) for label, text in contrast_files[2:]], [1, 1])
+			self.assertTrue(contrast_files[2][1].startswith('Y\tZ\t'))
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_native_mode_runs_contrasts_without_r(self):
+		"""
+		Tests that the native mode makes the results of each contrast, and that the heatmaps (of each contrast and of the samples) are then
+		drawn from the variance-stabilized counts of the count matrix, which are kept next to it.  A rerun restores the heatmaps from the
+		result cache without transforming the counts again.
+		"""
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			matrix_path = os.path.join(tmp_dir, 'raw_count_matrix.primary.counts')
+			rng = np.random.RandomState(0)
+			means = np.exp(rng.uniform(1, 8, 300))
+			counts = np.column_stack([rng.negative_binomial(10, 10/(10 + means*f)) for f in [1, 1.2, 0.9, 1.1, 1, 0.8]])
+			count_matrix.CountMatrix(['g%d' % i for i in range(300)], ['S1', 'S2', 'S3', 'S4', 'S5', 'S6'], counts).write(matrix_path)
+			annotation_path = os.path.join(tmp_dir, 'samples.txt')
+			with open(annotation_path, 'w') as f:
+				f.write('S1\tX\nS2\tX\nS3\tX\nS4\tY\nS5\tY\nS6\tZ\n')
+			output_dir = os.path.join(tmp_dir, 'deseq')
+			os.mkdir(output_dir)
+
+			project = Project()
+			project.raw_count_matrices = [matrix_path]
+			project_params = Params()
+			project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix', feature_counts_file_extension = 'counts', sample_annotation_file = annotation_path)
+			project_params.add(result_cache_dir = os.path.join(tmp_dir, 'cache'))
+			project.add_parameters(project_params)
+			project.contrasts = [('X', 'Y'), ('X', 'Z')]
+			component_params = Params()
+			component_params.add(deseq_output_dir = output_dir, deseq_mode = 'native', deseq_output_tag = 'deseq', deseq_contrast_flag = '_vs_',
+				number_of_genes_for_heatmap = '30', heatmap_file_tag = 'heatmap.png', sample_heatmap_file_prefix = 'sample_clustering', heatmap_max_workers = '2')
+
+			self.module.call_script = mock.Mock()
+			deseq_files, heatmap_files = self.module.call_deseq(project, component_params, result_cache, mock.Mock(), task_executor.SampleTaskExecutor(2),
+				count_matrix, differential_expression)
+			self.assertFalse(self.module.call_script.called)
+			self.assertEqual(sorted(deseq_files.keys()), ['Y_vs_X.primary', 'Z_vs_X.primary'])
+			for contrast, condition in [('Y_vs_X.primary', 'Y'), ('Z_vs_X.primary', 'Z')]:
+				lines = open(deseq_files[contrast]).read().splitlines()
+				self.assertEqual(lines[0], 'id,baseMean,X,%s,foldChange,log2FoldChange,pval,padj' % condition)
+				self.assertEqual(len(lines), 301)
+				self.assertFalse(os.path.exists(heatmap_files[contrast]))
+
+			runner = ProcessRunner(os.path.join(tmp_dir, 'task_logs'))
+			self.module.create_heatmaps(project, component_params, result_cache, runner, task_executor.SampleTaskExecutor(2), count_matrix, differential_expression, heatmap_files)
+			self.assertFalse(self.module.call_script.called)
+			self.assertEqual(sorted(heatmap_files.keys()), ['Y_vs_X.primary', 'Z_vs_X.primary', 'sample_clustering.primary'])
+			self.assertEqual(heatmap_files['sample_clustering.primary'], os.path.join(output_dir, 'sample_clustering.primary.heatmap.png'))
+			for heatmap_file in heatmap_files.values():
+				self.assertTrue(open(heatmap_file, 'rb').read().startswith('\x89PNG'))
+			self.assertTrue(os.path.isfile(matrix_path + differential_expression.VST_SUFFIX))
+
+			for heatmap_file in heatmap_files.values():
+				os.remove(heatmap_file)
+			with mock.patch.object(differential_expression, 'get_variance_stabilized') as get_variance_stabilized:
+				self.module.create_heatmaps(project, component_params, result_cache, runner, task_executor.SampleTaskExecutor(2), count_matrix, differential_expression, heatmap_files)
+				self.assertFalse(get_variance_stabilized.called)
+			for heatmap_file in heatmap_files.values():
+				self.assertTrue(os.path.isfile(heatmap_file))
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_r_modes_draw_heatmaps_from_the_variance_stabilized_counts_of_r(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			matrix_path = os.path.join(tmp_dir, 'raw_count_matrix.primary.counts')
+			rng = np.random.RandomState(1)
+			counts = rng.negative_binomial(5, 0.05, size = (100, 4))
+			count_matrix.CountMatrix(['g%d' % i for i in range(100)], ['S1', 'S2', 'S3', 'S4'], counts).write(matrix_path)
+			annotation_path = os.path.join(tmp_dir, 'samples.txt')
+			with open(annotation_path, 'w') as f:
+				f.write('S2\tX\nS1\tX\nS3\tY\nS4\tY\n')
+			output_dir = os.path.join(tmp_dir, 'deseq')
+			os.mkdir(output_dir)
+			results_path = os.path.join(output_dir, 'Y_vs_X.primary.deseq')
+			with open(results_path, 'w') as f:
+				f.write('id,baseMean,X,Y,foldChange,log2FoldChange,pval,padj\n')
+				f.write(''.join(['g%d,1,1,1,1,0,%s,%s\n' % (i, 0.5/(i + 1), 0.5/(i + 1)) for i in range(100)]))
+
+			project = Project()
+			project.raw_count_matrices = [matrix_path]
+			project_params = Params()
+			project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix', feature_counts_file_extension = 'counts', sample_annotation_file = annotation_path)
+			project_params.add(result_cache_dir = os.path.join(tmp_dir, 'cache'))
+			project.add_parameters(project_params)
+			project.contrasts = [('X', 'Y')]
+			component_params = Params()
+			component_params.add(deseq_output_dir = output_dir, deseq_mode = 'batch', deseq_output_tag = 'deseq', deseq_contrast_flag = '_vs_',
+				deseq_vst_script = 'deseq_vst.R', number_of_genes_for_heatmap = '10', heatmap_file_tag = 'heatmap.png', sample_heatmap_file_prefix = 'sample_clustering',
+				heatmap_max_workers = '1')
+
+			# the R script writes the variance-stabilized counts of the annotated samples, in annotation order:
+			def vst_script(runner, script, arg_string, label):
+				self.assertEqual(script, 'deseq_vst.R')
+				matrix_arg, annotation_arg, table_path = arg_string.split()
+				self.assertEqual((matrix_arg, annotation_arg), (matrix_path, annotation_path))
+				count_matrix.CountMatrix(['g%d' % i for i in range(100)], ['S2', 'S1', 'S3', 'S4'], np.log2(counts[:, [1, 0, 2, 3]] + 1.0)).write(table_path)
+			self.module.call_script = mock.Mock(side_effect = vst_script)
+			heatmap_files = {'Y_vs_X.primary': os.path.join(output_dir, 'Y_vs_X.primary.heatmap.png')}
+			with mock.patch.object(differential_expression, 'get_variance_stabilized') as get_variance_stabilized:
+				self.module.create_heatmaps(project, component_params, result_cache, ProcessRunner(os.path.join(tmp_dir, 'task_logs')), task_executor.SampleTaskExecutor(1),
+					count_matrix, differential_expression, heatmap_files)
+				self.assertFalse(get_variance_stabilized.called)
+			self.assertEqual(self.module.call_script.call_count, 1)
+			for heatmap_file in heatmap_files.values():
+				self.assertTrue(open(heatmap_file, 'rb').read().startswith('\x89PNG'))
+			self.assertFalse(os.path.exists(matrix_path + '.vst.tsv'))
+
+			# the counts from R are kept, and not taken for native ones (or the other way round):
+			annotations = self.module.read_sample_annotations(annotation_path)
+			vst = differential_expression.read_variance_stabilized(matrix_path, annotations, differential_expression.R_VST)
+			self.assertEqual(vst.samples, ['S2', 'S1', 'S3', 'S4'])
+			np.testing.assert_allclose(vst.counts, np.log2(counts[:, [1, 0, 2, 3]] + 1.0))
+			self.assertEqual(differential_expression.read_variance_stabilized(matrix_path, annotations), None)
+			self.module.get_r_variance_stabilized(project, component_params, mock.Mock(), count_matrix, differential_expression, matrix_path, annotations)
+			self.assertEqual(self.module.call_script.call_count, 1)
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_heatmaps_are_drawn_by_new_processes_and_failures_reported(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			vst_path = os.path.join(tmp_dir, 'raw_count_matrix.primary.counts.vst.npy')
+			np.save(vst_path, np.random.RandomState(2).normal(8, 2, size = (50, 4)))
+			samples = ['S1', 'S2', 'S3', 'S4']
+			heatmaps = [os.path.join(tmp_dir, name) for name in ['sample_clustering.primary.heatmap.png', 'broken.heatmap.png']]
+			deseq_heatmaps = self.module.deseq_heatmaps
+			tasks = [('sample_clustering.primary', deseq_heatmaps.plot_sample_heatmap, [vst_path, ['g%d' % i for i in range(50)], samples, heatmaps[0]]),
+				('broken', deseq_heatmaps.plot_sample_heatmap, [os.path.join(tmp_dir, 'missing.npy'), [], samples, heatmaps[1]])]
+			runner = ProcessRunner(os.path.join(tmp_dir, 'task_logs'))
+			failed = deseq_heatmaps.render_heatmaps(tasks, task_executor.SampleTaskExecutor(2), runner)
+			self.assertEqual([label for label, error in failed], ['broken'])
+			self.assertTrue(open(heatmaps[0], 'rb').read().startswith('\x89PNG'))
+			self.assertFalse(os.path.exists(heatmaps[1]))
+			self.assertTrue('Heatmap broken failed' in open(os.path.join(tmp_dir, 'task_logs', 'heatmap.broken.log')).read())
+			self.assertEqual([f for f in os.listdir(tmp_dir) if f.endswith(deseq_heatmaps.TASK_FILE_SUFFIX)], [])
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_contrasts_run_in_parallel_and_failures_are_reported_per_contrast(self):
+		project = Project()
+		project.raw_count_matrices = ['/path/to/raw_counts/raw_count_matrix.primary.counts', '/path/to/raw_counts/raw_count_matrix.primary.dedup.counts']
+		project_params = Params()
+		project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix', feature_counts_file_extension = 'counts', sample_annotation_file = '/path/to/samples.txt')
+		project.add_parameters(project_params)
+		project.contrasts = [('X', 'Y'), ('X', 'Z'), ('Y', 'Z')]
+		component_params = Params()
+		component_params.add(deseq_output_dir = '/path/to/final/deseq_dir', deseq_mode = 'per_contrast', deseq_script = 'deseq_original.R',
+			deseq_output_tag = 'deseq', deseq_contrast_flag = '_vs_', number_of_genes_for_heatmap = '30', heatmap_file_tag = 'heatmap.png')
+
+		def run_contrast(runner, script, arg_string, label):
+			if label == 'deseq.Z_vs_X.primary.dedup':
+				raise Exception('R failed')
+		self.module.call_script = mock.Mock(side_effect = run_contrast)
+		with mock.patch.object(self.module.os.path, 'isfile', mock.Mock(return_value = True)):
+			with self.assertRaises(SampleTaskException) as context:
+				self.module.call_deseq(project, component_params, result_cache, mock.Mock(), task_executor.SampleTaskExecutor(4))
+		self.assertEqual(self.module.call_script.call_count, 6)
+		self.assertEqual([label for label, ex in context.exception.failures], ['Z_vs_X.primary.dedup'])
+
+
+	def test_contrasts_of_the_same_conditions_stay_in_one_session(self):
+		contrasts = [(('A', 'B'), 'B_vs_A.'), (('A', 'C'), 'C_vs_A.'), (('B', 'A'), 'A_vs_B.'), (('B', 'C'), 'C_vs_B.')]
+		self.assertEqual(self.module.split_contrasts(contrasts, 2), [[contrasts[0], contrasts[2]], [contrasts[1], contrasts[3]]])
+		self.assertEqual(self.module.split_contrasts(contrasts, 10), [[contrasts[0], contrasts[2]], [contrasts[1]], [contrasts[3]]])
+		self.assertEqual(self.module.split_contrasts(contrasts, 1), [contrasts])
+
+
+	def test_worker_count_follows_cores_and_memory(self):
+		component_params = Params()
+		component_params.add(deseq_max_workers = '0', deseq_memory = '4', deseq_mode = 'batch')
+		resource_manager = mock.Mock()
+		resource_manager.get_available_memory.return_value = 10.0
+		runner = mock.Mock(scheduler = None, r_workers = None)
+		with mock.patch.object(self.module.multiprocessing, 'cpu_count', mock.Mock(return_value = 8)):
+			self.assertEqual(self.module.get_worker_count(Params(), component_params, runner, task_executor, resource_manager), 2)
+			resource_manager.get_available_memory.return_value = 100.0
+			self.assertEqual(self.module.get_worker_count(Params(), component_params, runner, task_executor, resource_manager), 8)
+		component_params.add(deseq_max_workers = '3')
+		self.assertEqual(self.module.get_worker_count(Params(), component_params, runner, task_executor, resource_manager), 3)
+
+
+	def test_worker_count_is_capped_by_the_r_worker_pool(self):
+		component_params = Params()
+		component_params.add(deseq_max_workers = '6', deseq_memory = '4', deseq_mode = 'per_contrast')
+		runner = mock.Mock(scheduler = None, r_workers = mock.Mock(size = 4))
+		self.assertEqual(self.module.get_worker_count(Params(), component_params, runner, task_executor, mock.Mock()), 4)
+		runner.r_workers.size = 8
+		self.assertEqual(self.module.get_worker_count(Params(), component_params, runner, task_executor, mock.Mock()), 6)
+
+		# the native mode does not use R:
+		runner.r_workers.size = 2
+		component_params.add(deseq_mode = 'native')
+		self.assertEqual(self.module.get_worker_count(Params(), component_params, runner, task_executor, mock.Mock()), 6)
+
 
 if __name__ == "__main__":
 	unittest.main()
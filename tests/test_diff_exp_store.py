@@ -0,0 +1,129 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import StringIO
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+import utils.diff_exp_store as diff_exp_store
+from utils.custom_exceptions import DiffExpStoreException
+
+
+def write_results(directory, name, control, experimental, rows):
+	results_path = os.path.join(directory, name)
+	with open(results_path, 'w') as f:
+		f.write('id,baseMean,%s,%s,foldChange,log2FoldChange,pval,padj\n' % (control, experimental))
+		for row in rows:
+			f.write(','.join(row) + '\n')
+	return results_path
+
+
+class TestDiffExpStore(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.store_path = os.path.join(self.tmp_dir, diff_exp_store.DEFAULT_STORE_NAME)
+		self.b_vs_a = write_results(self.tmp_dir, 'B_vs_A.deseq', 'A', 'B', [
+			['g1', '10', '5', '15', '3', '1.58', '0.001', '0.002'],
+			['g2', '10', '15', '5', '0.33', '-1.58', '0.01', '0.03'],
+			['g3', '1', '1', '1', '1', '0', '0.9', '0.9'],
+			['g4', '0', '0', '0', 'NaN', 'NaN', 'NA', 'NA'],
+			['g5', '2', '0', '4', 'Inf', 'Inf', '1e-20', '4e-20']])
+		self.c_vs_a = write_results(self.tmp_dir, 'C_vs_A.deseq', 'A', 'C', [
+			['g1', '10', '5', '6', '1.2', '0.26', '0.04', '0.04'],
+			['g2', '10', '15', '5', '0.33', '-1.58', '0.5', '0.5']])
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def test_gene_results_across_contrasts(self):
+		store = diff_exp_store.create_store(self.store_path)
+		store.add_results('B_vs_A', 'sort.primary', 'A', 'B', self.b_vs_a)
+		store.add_results('C_vs_A', 'sort.primary', 'A', 'C', self.c_vs_a)
+		store.add_results('B_vs_A', 'sort', 'A', 'B', self.b_vs_a)
+		self.assertEqual([(r[1], r[2], r[9]) for r in store.gene_results('g1')], [('B_vs_A', 'sort', 1.58), ('B_vs_A', 'sort.primary', 1.58), ('C_vs_A', 'sort.primary', 0.26)])
+		self.assertEqual(len(store.gene_results('g1', 'sort.primary')), 2)
+		self.assertEqual(store.gene_results('missing'), [])
+
+		# NA and NaN are missing; Inf is kept:
+		g4 = store.gene_results('g4')[0]
+		self.assertEqual(g4[8:], (None, None, None, None))
+		self.assertEqual(store.gene_results('g5')[0][8], float('inf'))
+		store.close()
+
+
+	def test_adding_again_replaces_the_results(self):
+		store = diff_exp_store.create_store(self.store_path)
+		store.add_results('B_vs_A', 'sort.primary', 'A', 'B', self.b_vs_a)
+		store.add_results('B_vs_A', 'sort.primary', 'A', 'B', self.c_vs_a)
+		self.assertEqual(len(store.gene_results('g1')), 1)
+		self.assertEqual(store.gene_results('g3'), [])
+		store.close()
+
+		# a new store starts empty:
+		store = diff_exp_store.create_store(self.store_path)
+		self.assertEqual(store.summarize(), [])
+		store.close()
+
+
+	def test_summarize_counts_genes_past_the_thresholds(self):
+		store = diff_exp_store.create_store(self.store_path)
+		store.add_results('B_vs_A', 'sort.primary', 'A', 'B', self.b_vs_a)
+		store.add_results('C_vs_A', 'sort.primary', 'A', 'C', self.c_vs_a)
+		store.add_results('C_vs_A', 'sort', 'A', 'C', self.c_vs_a)
+		self.assertEqual(store.summarize(), [('B_vs_A', 'sort.primary', 'A', 'B', 2, 1), ('C_vs_A', 'sort.primary', 'A', 'C', 1, 0),
+			('C_vs_A', 'sort', 'A', 'C', 1, 0)])
+		self.assertEqual(store.summarize(0.01, 0.5, 'sort.primary'), [('B_vs_A', 'sort.primary', 'A', 'B', 2, 0), ('C_vs_A', 'sort.primary', 'A', 'C', 0, 0)])
+		store.close()
+
+
+	def test_unexpected_file_is_rejected(self):
+		bad_path = os.path.join(self.tmp_dir, 'bad.deseq')
+		with open(bad_path, 'w') as f:
+			f.write('gene,count\ng1,4\n')
+		store = diff_exp_store.create_store(self.store_path)
+		with self.assertRaises(DiffExpStoreException):
+			store.add_results('B_vs_A', 'sort.primary', 'A', 'B', bad_path)
+
+		# the columns of DESeq2 are found by name:
+		deseq2_path = os.path.join(self.tmp_dir, 'deseq2.deseq')
+		with open(deseq2_path, 'w') as f:
+			f.write(',baseMean,log2FoldChange,lfcSE,stat,pvalue,padj\ng1,10,-2,0.1,3,0.001,0.01\n')
+		store.add_results('B_vs_A', 'sort.primary', 'A', 'B', deseq2_path)
+		self.assertEqual(store.gene_results('g1')[0][5:], (10.0, None, None, None, -2.0, 0.001, 0.01))
+		self.assertEqual(store.summarize(), [('B_vs_A', 'sort.primary', 'A', 'B', 0, 1)])
+		store.close()
+		with self.assertRaises(DiffExpStoreException):
+			diff_exp_store.open_store(os.path.join(self.tmp_dir, 'missing.sqlite'))
+
+
+	def test_query(self):
+		store = diff_exp_store.create_store(self.store_path)
+		store.add_results('B_vs_A', 'sort.primary', 'A', 'B', self.b_vs_a)
+		store.add_results('C_vs_A', 'sort.primary', 'A', 'C', self.c_vs_a)
+		store.close()
+
+		stream = StringIO.StringIO()
+		diff_exp_store.run_query({'query_store': self.store_path, 'query_genes': ['g2', 'g4'], 'query_bam_level': None}, stream)
+		lines = stream.getvalue().splitlines()
+		self.assertEqual(lines[0].split('\t'), diff_exp_store.GENE_RESULT_FIELDS)
+		self.assertEqual([l.split('\t')[:2] for l in lines[1:]], [['g2', 'B_vs_A'], ['g2', 'C_vs_A'], ['g4', 'B_vs_A']])
+		self.assertEqual(lines[3].split('\t')[-1], 'NA')
+
+		stream = StringIO.StringIO()
+		diff_exp_store.run_query({'query_store': self.store_path, 'query_genes': None, 'query_bam_level': None, 'query_padj': 0.05,
+			'query_min_log2_fold_change': 0.0}, stream)
+		self.assertEqual(stream.getvalue(), 'contrast\tbam_level\tcontrol\texperimental\tup\tdown\n'
+			'B_vs_A\tsort.primary\tA\tB\t2\t1\nC_vs_A\tsort.primary\tA\tC\t1\t0\n')
+
+
+if __name__ == "__main__":
+	unittest.main()
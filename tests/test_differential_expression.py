@@ -0,0 +1,264 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import mock
+import numpy as np
+from scipy.stats import nbinom
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+import utils.differential_expression as de
+from utils.count_matrix import CountMatrix, read_count_matrix
+from utils.custom_exceptions import DifferentialExpressionException
+
+# count matrices with the outputs of the R analysis (deseq_original.R) for them, written by make_expected.R in that directory
+FIXTURE_DIR = os.path.join(path.dirname(path.abspath(__file__)), 'fixtures', 'deseq')
+FIXTURE_DESIGNS = ['one_vs_one', 'two_vs_two', 'three_vs_three']
+
+# how close (relative) the native engine has to come to the R outputs: the size factors are computed the same way, and the parametric fit
+# solves the same regression, but the local fit (of the one_vs_one design) only approximates locfit
+SIZE_FACTOR_TOLERANCE = 1e-6
+DISPERSION_TOLERANCE = {de.PARAMETRIC_FIT: 1e-3, de.LOCAL_FIT: 0.1}
+PVALUE_TOLERANCE = {de.PARAMETRIC_FIT: 1e-2, de.LOCAL_FIT: 0.25}
+
+
+def simulate_counts(rng, genes, size_factors, fold_changes, de_genes):
+	"""
+	Returns negative binomial counts (dispersion 0.05 + 1/mean) for the samples, with the first de_genes genes changed by the fold change
+	of each sample
+	"""
+	means = np.exp(rng.uniform(0, 8, genes))
+	dispersions = 0.05 + 1/means
+	counts = np.empty((genes, len(size_factors)), dtype = np.int64)
+	for j, (size_factor, fold_change) in enumerate(zip(size_factors, fold_changes)):
+		sample_means = means*size_factor
+		sample_means[:de_genes] *= fold_change
+		counts[:, j] = rng.negative_binomial(1/dispersions, 1/(1 + dispersions*sample_means))
+	return counts
+
+
+def read_column(csv_path, column):
+	"""
+	Returns the first column and the given column (as floats, with NA as NaN) of a CSV file written by R
+	"""
+	with open(csv_path) as f:
+		header = f.readline().strip().split(',')
+		rows = [line.strip().split(',') for line in f if line.strip()]
+	index = header.index(column)
+	return [r[0] for r in rows], np.array([np.nan if r[index] == 'NA' else float(r[index]) for r in rows])
+
+
+class TestDifferentialExpression(unittest.TestCase):
+
+	def test_exact_test_sums_the_splits_of_each_total(self):
+		rng = np.random.RandomState(1)
+		counts_a = rng.negative_binomial(2, 0.02, size = (100, 2))
+		counts_b = rng.negative_binomial(2, 0.01, size = (100, 3))
+		counts_a[0] = counts_b[0] = 0
+		size_factors_a = np.array([0.9, 1.1])
+		size_factors_b = np.array([1.0, 0.8, 1.3])
+		dispersions = rng.uniform(0.01, 0.5, 100)
+		pvalues = de.exact_test(counts_a, counts_b, size_factors_a, size_factors_b, dispersions)
+		self.assertTrue(np.isnan(pvalues[0]))
+
+		# as nbinomTestForMatrices, one gene at a time:
+		for i in range(1, 100):
+			k_a, k_b = counts_a[i].sum(), counts_b[i].sum()
+			mu = np.mean(np.r_[counts_a[i]/size_factors_a, counts_b[i]/size_factors_b])
+			distributions = []
+			for s in [size_factors_a, size_factors_b]:
+				size = 1/(dispersions[i]*np.sum(s**2)/s.sum()**2)
+				distributions.append(nbinom(size, size/(size + mu*s.sum())))
+			ks = np.arange(k_a + k_b + 1)
+			ps = distributions[0].pmf(ks)*distributions[1].pmf(k_a + k_b - ks)
+			tail = ps[:k_a + 1] if k_a*size_factors_b.sum() < k_b*size_factors_a.sum() else ps[k_a:]
+			self.assertAlmostEqual(pvalues[i]/min(1, 2*tail.sum()/ps.sum()), 1, places = 9)
+
+
+	def test_pvalues_adjusted_as_p_adjust(self):
+		# p.adjust(c(0.01, 0.04, 0.03, NA, 0.2), method = 'BH')
+		adjusted = de.adjust_pvalues(np.array([0.01, 0.04, 0.03, np.nan, 0.2]))
+		self.assertTrue(np.isnan(adjusted[3]))
+		np.testing.assert_allclose(adjusted[[0, 1, 2, 4]], [0.04, 0.16/3, 0.16/3, 0.2])
+
+
+	def test_parametric_fit_recovers_the_curve(self):
+		means = np.exp(np.linspace(0, 10, 200))
+		fit = de.ParametricFit(means, 0.1 + 2/means)
+		self.assertAlmostEqual(fit.asymptotic_dispersion, 0.1)
+		self.assertAlmostEqual(fit.extra_poisson, 2)
+		np.testing.assert_allclose(fit(np.array([1.0, 10.0])), [2.1, 0.3])
+
+
+	def test_dispersion_settings_follow_the_r_script(self):
+		self.assertEqual(de.dispersion_settings(1, 1), (de.BLIND, de.FIT_ONLY, de.LOCAL_FIT))
+		self.assertEqual(de.dispersion_settings(2, 2), (de.BLIND, de.FIT_ONLY, de.PARAMETRIC_FIT))
+		self.assertEqual(de.dispersion_settings(3, 1), (de.POOLED, de.MAXIMUM, de.PARAMETRIC_FIT))
+		self.assertEqual(de.heatmap_fit_type(2, 1), de.LOCAL_FIT)
+		self.assertEqual(de.heatmap_fit_type(3, 3), de.PARAMETRIC_FIT)
+		self.assertEqual(de.heatmap_fit_type(2, 1, 2), de.LOCAL_FIT)
+		self.assertEqual(de.heatmap_fit_type(1, 1, 3), de.PARAMETRIC_FIT)
+
+
+	def test_bias_correction_inverts_the_estimates_of_gamma_samples(self):
+		# as DESeq's table of corrections, from the squared coefficients of variation estimated from simulated gamma samples:
+		rng = np.random.RandomState(3)
+		for n in [2, 3, 6]:
+			for scv in [0.05, 0.3, 1.0]:
+				samples = rng.gamma(1/scv, scv, size = (200000, n))
+				estimate = np.mean(samples.var(axis = 1, ddof = 1)/samples.mean(axis = 1)**2)
+				self.assertAlmostEqual(de.adjust_for_bias(np.array([estimate]), n)[0]/scv, 1, delta = 0.02)
+
+		# small (and missing) estimates are left as they are, and those near the largest possible one are capped:
+		adjusted = de.adjust_for_bias(np.array([-0.5, 0.01, np.nan, 2.0, 5.0]), 2)
+		np.testing.assert_allclose(adjusted[:2], [-0.5, 0.01])
+		self.assertTrue(np.isnan(adjusted[2]))
+		np.testing.assert_allclose(adjusted[3:], [2*1.98/0.02, 2*1.98/0.02])
+
+
+	def test_only_the_fit_is_corrected_for_bias(self):
+		means = np.exp(np.linspace(0, 8, 200))
+		size_factors = np.array([0.8, 1.0, 1.25])
+		xim = np.mean(1/size_factors)
+		dispersions = 0.1 + 2/means
+		variances = dispersions*means**2 + xim*means
+		gene_dispersions, fit = de.fit_dispersions(means, variances, size_factors, de.PARAMETRIC_FIT)
+		# the genes' own estimates, as DESeq's dispsAll:
+		np.testing.assert_allclose(gene_dispersions, dispersions)
+		# the fit, to the corrected estimates:
+		expected = de.ParametricFit(means, de.adjust_for_bias(dispersions, 3))
+		np.testing.assert_allclose([fit.asymptotic_dispersion, fit.extra_poisson], [expected.asymptotic_dispersion, expected.extra_poisson])
+		self.assertTrue(fit.extra_poisson > 2.5)
+
+
+	def test_pooled_variance_uses_replicated_conditions(self):
+		normalized = np.array([[1.0, 3.0, 10.0, 4.0, 6.0]])
+		means, variances = de.base_means_and_variances(normalized, ['A', 'A', 'B', 'C', 'C'], de.POOLED)
+		self.assertEqual(means.tolist(), [4.8])
+		# (2 + 2)/(1 + 1):
+		self.assertEqual(variances.tolist(), [2.0])
+		with self.assertRaises(DifferentialExpressionException):
+			de.base_means_and_variances(normalized[:, :3], ['A', 'B', 'C'], de.POOLED)
+
+
+	def test_changed_genes_are_found(self):
+		rng = np.random.RandomState(0)
+		counts = simulate_counts(rng, 2000, [0.8, 1.2, 1.0, 0.9, 1.1, 1.3], [1, 1, 1, 4, 4, 4], 200)
+		matrix = CountMatrix(['g%d' % i for i in range(2000)], ['S%d' % j for j in range(6)], counts)
+		annotations = [('S0', 'A'), ('S1', 'A'), ('S2', 'A'), ('S3', 'B'), ('S4', 'B'), ('S5', 'B')]
+		for samples in [['S0', 'S1', 'S2', 'S3', 'S4', 'S5'], ['S0', 'S1', 'S3', 'S4'], ['S0', 'S3']]:
+			result = de.test_contrast(matrix, [a for a in annotations if a[0] in samples], 'A', 'B')
+			self.assertEqual(result.samples, samples)
+			significant = np.where(np.isnan(result.adjusted_pvalues), 1, result.adjusted_pvalues) <= 0.05
+			self.assertTrue(np.sum(significant[200:]) <= 5)
+			if len(samples) > 2:
+				self.assertTrue(np.sum(significant[:200]) > 100)
+				self.assertTrue(np.all(result.log2_fold_changes[:200][significant[:200]] > 0))
+			vst = de.variance_stabilize(result)
+			self.assertEqual(vst.shape, (2000, len(samples)))
+			self.assertTrue(np.all(np.isfinite(vst)))
+
+		with self.assertRaises(DifferentialExpressionException):
+			de.test_contrast(matrix, annotations + [('S9', 'B')], 'A', 'B')
+
+
+	def test_variance_stabilized_counts_are_kept_next_to_the_count_matrix(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			rng = np.random.RandomState(2)
+			counts = simulate_counts(rng, 500, [0.8, 1.2, 1.0, 0.9, 1.1], [1, 1, 1, 4, 4], 50)
+			matrix_path = os.path.join(tmp_dir, 'raw_count_matrix.primary.counts')
+			CountMatrix(['g%d' % i for i in range(500)], ['S%d' % j for j in range(5)], counts).write(matrix_path)
+			# S1 is not annotated, so it is left out:
+			annotations = [('S4', 'B'), ('S0', 'A'), ('S2', 'A'), ('S3', 'B')]
+
+			project = mock.Mock(count_matrices = {})
+			vst = de.get_variance_stabilized(project, matrix_path, annotations)
+			self.assertEqual(vst.samples, ['S4', 'S0', 'S2', 'S3'])
+			self.assertEqual(vst.counts.shape, (500, 4))
+			self.assertTrue(np.all(np.isfinite(vst.counts)))
+			self.assertTrue(np.mean(vst.counts[:50, [0, 3]]) > np.mean(vst.counts[:50, [1, 2]]))
+
+			# the next time, they are read from the file:
+			with mock.patch.object(de, 'variance_stabilize_matrix') as variance_stabilize_matrix:
+				kept = de.get_variance_stabilized(project, matrix_path, annotations)
+				self.assertFalse(variance_stabilize_matrix.called)
+			self.assertTrue(isinstance(kept.counts, np.memmap))
+			np.testing.assert_allclose(kept.counts, vst.counts)
+
+			# but not once the annotations change:
+			self.assertEqual(de.read_variance_stabilized(matrix_path, annotations[:3]), None)
+			with self.assertRaises(DifferentialExpressionException):
+				de.get_variance_stabilized(project, matrix_path, annotations[:1])
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_results_written_as_r_writes_them(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			result = de.ContrastResult(['g1', 'g2', 'g3'], 'A', 'B', np.array([1.5, 0.0, 2.0]), np.array([1.0, 0.0, 0.0]), np.array([2.0, 0.0, 4.0]),
+				np.array([0.001, np.nan, 1e-20]), ['S1', 'S2'], np.array(['A', 'B']), None, None)
+			result_path = os.path.join(tmp_dir, 'B_vs_A.deseq')
+			result.write(result_path)
+			self.assertEqual(open(result_path).read(), 'id,baseMean,A,B,foldChange,log2FoldChange,pval,padj\n'
+				'g1,1.5,1,2,2,1,0.001,0.001\ng2,0,0,0,NaN,NaN,NA,NA\ng3,2,0,4,Inf,Inf,1e-20,2e-20\n')
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+class TestAgainstR(unittest.TestCase):
+	"""
+	Compares the native engine with the outputs of deseq_original.R on the fixture count matrices (see make_expected.R there)
+	"""
+
+	def compare(self, design):
+		results_path = os.path.join(FIXTURE_DIR, design + '.deseq.csv')
+		if not os.path.isfile(results_path):
+			self.skipTest('The R outputs for %s are missing: run tests/fixtures/deseq/make_expected.R where DESeq is installed.' % design)
+		matrix = read_count_matrix(os.path.join(FIXTURE_DIR, 'counts.tsv'))
+		with open(os.path.join(FIXTURE_DIR, design + '.annotations.tsv')) as f:
+			annotations = [tuple(line.strip().split('\t')) for line in f if line.strip()]
+		result = de.test_contrast(matrix, annotations, 'A', 'B')
+		is_a = result.conditions == 'A'
+		method, sharing_mode, fit_type = de.dispersion_settings(is_a.sum(), (~is_a).sum())
+		dispersions = de.estimate_dispersions(result.normalized, result.size_factors, result.conditions, method, sharing_mode, fit_type)[0]
+
+		samples, size_factors = read_column(os.path.join(FIXTURE_DIR, design + '.size_factors.csv'), 'size_factor')
+		self.assertEqual(samples, result.samples)
+		np.testing.assert_allclose(result.size_factors, size_factors, rtol = SIZE_FACTOR_TOLERANCE)
+
+		genes, r_dispersions = read_column(os.path.join(FIXTURE_DIR, design + '.dispersions.csv'), 'dispersion')
+		self.assertEqual(genes, matrix.genes)
+		expressed = np.isfinite(r_dispersions) & (result.base_means > 0)
+		np.testing.assert_allclose(dispersions[expressed], r_dispersions[expressed], rtol = DISPERSION_TOLERANCE[fit_type])
+
+		for column, values in [('pval', result.pvalues), ('padj', result.adjusted_pvalues)]:
+			genes, r_values = read_column(results_path, column)
+			self.assertEqual(genes, matrix.genes)
+			np.testing.assert_array_equal(np.isnan(values), np.isnan(r_values))
+			# p-values too small for a double are compared as zero:
+			shown = ~np.isnan(r_values) & (r_values > 1e-300)
+			np.testing.assert_allclose(values[shown], r_values[shown], rtol = PVALUE_TOLERANCE[fit_type])
+
+
+	def test_one_sample_per_condition(self):
+		self.compare('one_vs_one')
+
+
+	def test_two_samples_per_condition(self):
+		self.compare('two_vs_two')
+
+
+	def test_three_samples_per_condition(self):
+		self.compare('three_vs_three')
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -6,13 +6,16 @@ import mock
 import sys
 import os
 import re
-import __builtin__
-from StringIO import StringIO
+import shutil
+import tempfile
 
 from os import path
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
 import utils.util_methods as util_methods
+import utils.result_cache as result_cache
+import utils.count_matrix as count_matrix
+from utils.custom_exceptions import CountMatrixException
 
 from utils.project import Project
 from utils.sample import Sample
@@ -21,14 +24,6 @@ from utils.util_classes import Params
 from component_tester import ComponentTester
 
 
-def create_mock_open(fileobj):
-
-	mock_obj = mock.MagicMock(spec = file)
-	mock_obj.__enter__.return_value = fileobj
-	mock_obj.return_value = mock_obj
-	return mock_obj
-
-
 class TestFeatureCounts(unittest.TestCase, ComponentTester):
 	
 	def setUp(self):		
@@ -37,17 +32,8 @@ class TestFeatureCounts(unittest.TestCase, ComponentTester):
 
 	def test_system_calls_paired_experiment(self):
 
-		mock_process = mock.Mock(name='mock_process')
-		mock_process.communicate.return_value = (('',''))
-		mock_process.returncode = 0
-
-		mock_popen = mock.Mock(name='mock_popen')
-		mock_popen.return_value = mock_process
-		
-		self.module.subprocess = mock.Mock()
-		self.module.subprocess.Popen = mock_popen
-		self.module.subprocess.STDOUT = ''
-		self.module.subprocess.PIPE = ''
+		runner = mock.Mock(name='mock_runner')
+		runner.run.return_value = mock.Mock(returncode = 0)
 
 		p = Params()
 		cp = Params()
@@ -67,12 +53,12 @@ class TestFeatureCounts(unittest.TestCase, ComponentTester):
 		m = mock.MagicMock(side_effect = [True, True, True])
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
-			self.module.execute_counting(project, cp, util_methods)
+			self.module.execute_counting('feature_counts', project, cp, util_methods, result_cache, runner)
 
-			calls = [mock.call('/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -p -o /path/to/final/featureCounts/A.counts /path/to/bamdir/A.bam', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE),
-				mock.call('/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -p -o /path/to/final/featureCounts/A.primary.counts /path/to/bamdir/A.primary.bam', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE),
-				mock.call('/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -p -o /path/to/final/featureCounts/A.primary.dedup.counts /path/to/bamdir/A.primary.dedup.bam', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)]
-			mock_popen.assert_has_calls(calls)
+			calls = [mock.call('featureCounts.A.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -p -o /path/to/final/featureCounts/A.counts /path/to/bamdir/A.bam', progress_parsers=[self.module.parse_assigned_reads]),
+				mock.call('featureCounts.A.primary.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -p -o /path/to/final/featureCounts/A.primary.counts /path/to/bamdir/A.primary.bam', progress_parsers=[self.module.parse_assigned_reads]),
+				mock.call('featureCounts.A.primary.dedup.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -p -o /path/to/final/featureCounts/A.primary.dedup.counts /path/to/bamdir/A.primary.dedup.bam', progress_parsers=[self.module.parse_assigned_reads])]
+			runner.run.assert_has_calls(calls, any_order = True)
 
 		# check that the sample contains paths to the new count files in the correct locations:
 		expected_files = [os.path.join('/path/to/final/featureCounts', re.sub('bam', 'counts', os.path.basename(f))) for f in s1.bamfiles]
@@ -81,17 +67,8 @@ class TestFeatureCounts(unittest.TestCase, ComponentTester):
 		
 
 	def test_system_calls_single_end_experiment(self):
-		mock_process = mock.Mock(name='mock_process')
-		mock_process.communicate.return_value = (('',''))
-		mock_process.returncode = 0
-
-		mock_popen = mock.Mock(name='mock_popen')
-		mock_popen.return_value = mock_process
-		
-		self.module.subprocess = mock.Mock()
-		self.module.subprocess.Popen = mock_popen
-		self.module.subprocess.STDOUT = ''
-		self.module.subprocess.PIPE = ''
+		runner = mock.Mock(name='mock_runner')
+		runner.run.return_value = mock.Mock(returncode = 0)
 		
 		p = Params()
 		cp = Params()
@@ -111,12 +88,12 @@ class TestFeatureCounts(unittest.TestCase, ComponentTester):
 		m = mock.MagicMock(side_effect = [True, True, True])
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
-			self.module.execute_counting(project, cp, util_methods)
+			self.module.execute_counting('feature_counts', project, cp, util_methods, result_cache, runner)
 
-			calls = [mock.call('/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -o /path/to/final/featureCounts/A.counts /path/to/bamdir/A.bam', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE),
-				mock.call('/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -o /path/to/final/featureCounts/A.primary.counts /path/to/bamdir/A.primary.bam', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE),
-				mock.call('/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -o /path/to/final/featureCounts/A.primary.dedup.counts /path/to/bamdir/A.primary.dedup.bam', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)]
-			self.module.subprocess.Popen.assert_has_calls(calls)
+			calls = [mock.call('featureCounts.A.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -o /path/to/final/featureCounts/A.counts /path/to/bamdir/A.bam', progress_parsers=[self.module.parse_assigned_reads]),
+				mock.call('featureCounts.A.primary.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -o /path/to/final/featureCounts/A.primary.counts /path/to/bamdir/A.primary.bam', progress_parsers=[self.module.parse_assigned_reads]),
+				mock.call('featureCounts.A.primary.dedup.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -o /path/to/final/featureCounts/A.primary.dedup.counts /path/to/bamdir/A.primary.dedup.bam', progress_parsers=[self.module.parse_assigned_reads])]
+			runner.run.assert_has_calls(calls, any_order = True)
 
 			# check that the sample contains paths to the new count files in the correct locations:
 			expected_files = [os.path.join('/path/to/final/featureCounts', re.sub('bam', 'counts', os.path.basename(f))) for f in s1.bamfiles]
@@ -187,95 +164,79 @@ class TestFeatureCounts(unittest.TestCase, ComponentTester):
 
 	def test_countfiles_merged_correctly(self):
 		"""
-		This tests that multiple 'files' are merged into a single data structure in the correct way
+		This tests that the countfiles of each 'type' are merged into a count matrix with a column per sample (in order of the sample names),
+		matching the counts to the genes by name, and that the matrices are kept in memory for the downstream components
 		"""
-		matrix = []
-		mock_data_1 = '#header1\nheader2\ngeneA\tx\tx\tx\tx\tx\t0\ngeneB\tx\tx\tx\tx\tx\t1\ngeneC\tx\tx\tx\tx\tx\t2'
-		mock_data_2 = '#header1\nheader2\ngeneA\tx\tx\tx\tx\tx\t100\ngeneB\tx\tx\tx\tx\tx\t101\ngeneC\tx\tx\tx\tx\tx\t102'
-		mock_data_3 = '#header1\nheader2\ngeneA\tx\tx\tx\tx\tx\t200\ngeneB\tx\tx\tx\tx\tx\t201\ngeneC\tx\tx\tx\tx\tx\t202'
-		expected_result = [['geneA', '0','100','200'],['geneB', '1','101','201'],['geneC', '2','102','202']]
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			def write_countfile(name, rows):
+				path = os.path.join(tmp_dir, name)
+				with open(path, 'w') as f:
+					f.write('#header1\nheader2\n')
+					for gene, count in rows:
+						f.write('%s\tx\tx\tx\tx\tx\t%d\n' % (gene, count))
+				return path
+
+			samples = []
+			for name, offset in [('A', 0), ('C', 200), ('B', 100)]:
+				s = Sample(name, 'X')
+				rows = [('geneA', offset), ('geneB', offset + 1), ('geneC', offset + 2)]
+				# sample B lists its genes in a different order:
+				if name == 'B':
+					rows.reverse()
+				s.countfiles = [write_countfile(name + '.counts', rows), write_countfile(name + '.primary.counts', [(g, c*2) for g, c in rows])]
+				samples.append(s)
+
+			project = Project()
+			project.add_parameters(Params())
+			project.add_samples(samples)
+			cp = Params()
+			cp.add(raw_count_matrix_file_prefix = 'merged_counts')
+
+			result = self.module.create_count_matrices(project, cp, count_matrix)
+
+			expected_files = [os.path.join(tmp_dir, 'merged_counts.counts'), os.path.join(tmp_dir, 'merged_counts.primary.counts')]
+			self.assertEqual(result, expected_files)
+			self.assertEqual(open(expected_files[0]).read(), 'Gene\tA\tB\tC\ngeneA\t0\t100\t200\ngeneB\t1\t101\t201\ngeneC\t2\t102\t202\n')
+			self.assertEqual(open(expected_files[1]).read(), 'Gene\tA\tB\tC\ngeneA\t0\t200\t400\ngeneB\t2\t202\t402\ngeneC\t4\t204\t404\n')
+			matrix = project.count_matrices[expected_files[0]]
+			self.assertEqual((matrix.genes, matrix.samples, matrix.counts.tolist()), (['geneA', 'geneB', 'geneC'], ['A', 'B', 'C'], [[0, 100, 200], [1, 101, 201], [2, 102, 202]]))
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_countfiles_with_different_genes_are_not_merged(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			samples = []
+			for name, genes in [('A', ['geneA', 'geneB']), ('B', ['geneA', 'geneX'])]:
+				path = os.path.join(tmp_dir, name + '.counts')
+				with open(path, 'w') as f:
+					f.write('#header1\nheader2\n' + ''.join(['%s\tx\tx\tx\tx\tx\t1\n' % g for g in genes]))
+				s = Sample(name, 'X')
+				s.countfiles = [path]
+				samples.append(s)
+			project = Project()
+			project.add_parameters(Params())
+			project.add_samples(samples)
+			cp = Params()
+			cp.add(raw_count_matrix_file_prefix = 'merged_counts')
+			with self.assertRaises(CountMatrixException):
+				self.module.create_count_matrices(project, cp, count_matrix)
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+
+	def test_assigned_reads_are_picked_out_of_output(self):
+		self.assertEqual(self.module.parse_assigned_reads('|| Successfully assigned alignments : 4512001 (85.2%) ||\n'), 'featureCounts assigned 4512001 reads (85.2%)')
+		self.assertIsNone(self.module.parse_assigned_reads('|| Total alignments : 5296000 ||\n'))
 
-		mock_data_1 = StringIO(mock_data_1)
-		mock_open_1 = create_mock_open(mock_data_1)
-		with mock.patch.object(__builtin__, 'open', mock_open_1) as mo:
-			self.module.read(matrix, '/path/to/dummy')
 
-		mock_data_2 = StringIO(mock_data_2)
-		mock_open_2 = create_mock_open(mock_data_2)
-		with mock.patch.object(__builtin__, 'open', mock_open_2) as mo:
-			self.module.read(matrix, '/path/to/dummy')
-
-		mock_data_3 = StringIO(mock_data_3)
-		mock_open_3 = create_mock_open(mock_data_3)
-		with mock.patch.object(__builtin__, 'open', mock_open_3) as mo:
-			self.module.read(matrix, '/path/to/dummy')
-
-		self.assertEqual(matrix, expected_result)
-
-
-
-	def test_countfile_merging(self):
-		"""
-		This tests that the correct files are used to merge.  The result (a data structure) of the merging is mocked out.
-		Tests that the expected data is written to the file and tests that the file ends up in the correct location
-		"""
-
-		# a dummy method to mock the reading/concatenating of the data in the individual files
-		def mock_read(matrix, f):
-			dummy = [['geneA', '0','100','200'],['geneB', '1','101','201'],['geneC', '2','102','202']]
-			if len(matrix) == 0:
-				for k in range(len(dummy)):
-					matrix.append([])
-	
-			for i,l in enumerate(dummy):
-				matrix[i] = l
-
-
-		# mock out the actual implementations
-		self.module.get_countfile_groupings = mock.Mock()
-
-		self.module.get_countfile_groupings.return_value = [ ['/path/to/final/featureCounts/A.counts', '/path/to/final/featureCounts/C.counts', '/path/to/final/featureCounts/B.counts'],
-									['/path/to/final/featureCounts/A.primary.counts', '/path/to/final/featureCounts/C.primary.counts'],
-									['/path/to/final/featureCounts/A.primary.dedup.counts', '/path/to/final/featureCounts/B.primary.dedup.counts', '/path/to/final/featureCounts/C.primary.dedup.counts']] 
-	
-
-		self.module.read = mock_read
-
-		p = Params()
-		p.add(raw_count_matrix_file_prefix = 'merged_counts')
-		cp = Params()
-		cp.add(raw_count_matrix_file_prefix = 'merged_counts')
-
-		s1 = Sample('A', 'X')
-		s1.countfiles = ['/path/to/final/featureCounts/A.primary.counts', '/path/to/final/featureCounts/A.counts', '/path/to/final/featureCounts/A.primary.dedup.counts']
-		s2 = Sample('B', 'Y')
-		s2.countfiles = ['/path/to/final/featureCounts/B.counts', '/path/to/final/featureCounts/B.primary.dedup.counts', '/path/to/final/featureCounts/B.primary.counts']
-		s3 = Sample('C', 'Z')
-		s3.countfiles = ['/path/to/final/featureCounts/C.counts', '/path/to/final/featureCounts/C.primary.counts', '/path/to/final/featureCounts/C.primary.dedup.counts']
-
-		project = Project()
-		project.add_parameters(p)
-		project.add_samples([s1, s3, s2])
-		
-		m = mock.mock_open()
-		with mock.patch.object(__builtin__, 'open', m):
-			self.module.create_count_matrices(project, cp, mock.Mock())
-			m.assert_any_call('/path/to/final/featureCounts/merged_counts.counts', 'w')
-			m.assert_any_call('/path/to/final/featureCounts/merged_counts.primary.counts', 'w')
-			m.assert_any_call('/path/to/final/featureCounts/merged_counts.primary.dedup.counts', 'w')
-			handle = m()
-			calls = [mock.call('Gene\tA\tB\tC\n'), mock.call('geneA\t0\t100\t200\n'), mock.call('geneB\t1\t101\t201\n'), mock.call('geneC\t2\t102\t202\n')] * 3
-			handle.write.assert_has_calls(calls)
-			
-
-	
 	def test_bad_bamfile_path_raises_exception(self):
 
-		self.module.subprocess = mock.Mock()
-		mock_process = mock.Mock()
-		mock_process.communicate.return_value = (('abc', 'def'))
-		mock_process.returncode = 0
-		self.module.subprocess.Popen.return_value = mock_process
+		runner = mock.Mock(name='mock_runner')
+		runner.run.return_value = mock.Mock(returncode = 0)
 
 		p = Params()
 		cp = Params()
@@ -298,7 +259,73 @@ class TestFeatureCounts(unittest.TestCase, ComponentTester):
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
 			with self.assertRaises(self.module.MissingBamFileException):
-				self.module.execute_counting(project, cp, util_methods)
+				self.module.execute_counting('feature_counts', project, cp, util_methods, result_cache, runner)
+
+
+	def test_cohort_counting_runs_one_process_per_bam_type(self):
+		runner = mock.Mock(name='mock_runner')
+		runner.run.return_value = mock.Mock(returncode = 0)
+
+		p = Params()
+		p.add(gtf = '/path/to/GTF/mock.gtf')
+		p.add(paired_alignment = False)
+		cp = {'feature_counts': '/path/to/bin/featureCounts', 'feature_counts_file_extension': 'counts', 'feature_counts_output_dir': '/path/to/final/featureCounts',
+			'raw_count_matrix_file_prefix': 'raw_count_matrix', 'feature_counts_threads': '4'}
+
+		s1 = Sample('B', 'X')
+		s1.bamfiles = ['/path/to/bamdir/B.sort.bam', '/path/to/bamdir/B.sort.primary.bam']
+		s2 = Sample('A', 'Y')
+		s2.bamfiles = ['/path/to/bamdir/A.sort.primary.bam', '/path/to/bamdir/A.sort.bam']
+
+		project = Project()
+		project.add_parameters(p)
+		project.add_samples([s1, s2])
+
+		self.module.write_cohort_count_matrix = mock.Mock()
+		with mock.patch.object(self.module.os.path, 'isfile', mock.Mock(return_value = True)):
+			with mock.patch.object(util_methods, 'create_sample_executor', wraps = util_methods.create_sample_executor) as create_executor:
+				matrices = self.module.execute_cohort_counting('feature_counts', project, cp, util_methods, result_cache, runner, count_matrix)
+
+		# each featureCounts process takes the cores of its threads:
+		create_executor.assert_called_once_with(p, task_cpus = 4)
+
+		calls = [mock.call('featureCounts.cohort.sort.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -T 4 -o /path/to/final/featureCounts/cohort.sort.counts /path/to/bamdir/A.sort.bam /path/to/bamdir/B.sort.bam', progress_parsers=[self.module.parse_assigned_reads], cpus = 4),
+			mock.call('featureCounts.cohort.sort.primary.counts', '/path/to/bin/featureCounts -a /path/to/GTF/mock.gtf -t exon -g gene_name -T 4 -o /path/to/final/featureCounts/cohort.sort.primary.counts /path/to/bamdir/A.sort.primary.bam /path/to/bamdir/B.sort.primary.bam', progress_parsers=[self.module.parse_assigned_reads], cpus = 4)]
+		runner.run.assert_has_calls(calls, any_order = True)
+		self.assertEqual(runner.run.call_count, 2)
+		self.assertEqual(sorted(matrices), ['/path/to/final/featureCounts/raw_count_matrix.sort.counts', '/path/to/final/featureCounts/raw_count_matrix.sort.primary.counts'])
+		self.module.write_cohort_count_matrix.assert_any_call(count_matrix, '/path/to/final/featureCounts/cohort.sort.counts', '/path/to/final/featureCounts/raw_count_matrix.sort.counts', ['A', 'B'])
+		for sample in [s1, s2]:
+			self.assertEqual(sorted(sample.countfiles), ['/path/to/final/featureCounts/cohort.sort.counts', '/path/to/final/featureCounts/cohort.sort.primary.counts'])
+
+
+	def test_cohort_counting_requires_every_bam_type_for_every_sample(self):
+		s1 = Sample('A', 'X')
+		s1.bamfiles = ['/path/to/bamdir/A.sort.bam', '/path/to/bamdir/A.sort.primary.bam']
+		s2 = Sample('B', 'Y')
+		s2.bamfiles = ['/path/to/bamdir/B.sort.bam']
+		with self.assertRaises(self.module.MissingBamFileException):
+			self.module.get_bamfile_groupings([s1, s2])
+
+
+	def test_cohort_countfile_becomes_count_matrix(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			countfile = os.path.join(tmp_dir, 'cohort.sort.counts')
+			with open(countfile, 'w') as f:
+				f.write('# Program:featureCounts v1.4.4\n')
+				f.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\t/bams/A.sort.bam\t/bams/B.sort.bam\n')
+				f.write('geneA\tchr1\t1\t100\t+\t100\t0\t100\n')
+				f.write('geneB\tchr1;chr1\t200;300\t250;400\t+;+\t151\t1\t101\n')
+			matrix = os.path.join(tmp_dir, 'raw_count_matrix.sort.counts')
+			result = self.module.write_cohort_count_matrix(count_matrix, countfile, matrix, ['A', 'B'])
+			self.assertEqual(result.counts.tolist(), [[0, 100], [1, 101]])
+			self.assertEqual(open(matrix).read(), 'Gene\tA\tB\ngeneA\t0\t100\ngeneB\t1\t101\n')
+
+			with self.assertRaises(self.module.CountfileQuantityException):
+				self.module.write_cohort_count_matrix(count_matrix, countfile, matrix, ['A', 'B', 'C'])
+		finally:
+			shutil.rmtree(tmp_dir)
 
 
 
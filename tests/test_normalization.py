@@ -5,15 +5,22 @@ import unittest
 import mock
 import sys
 import os
+import shutil
+import tempfile
+import numpy as np
 
 from os import path
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
 import utils.util_methods as util_methods
+import utils.result_cache as result_cache
+import utils.count_matrix as count_matrix
+import utils.normalization as normalization
 
 from utils.project import Project
 from utils.sample import Sample
 from utils.util_classes import Params
+from utils.custom_exceptions import NormalizationException
 
 from component_tester import ComponentTester
 
@@ -28,7 +35,7 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		project = Project()
 		component_params = Params()
 		with self.assertRaises(self.module.NoCountMatricesException):
-			self.module.normalize(project, component_params)
+			self.module.normalize(project, component_params, result_cache, mock.Mock())
 
 
 	def test_correct_calls_are_made(self):
@@ -37,6 +44,7 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		Mostly tests the path renaming, etc.
 		"""
 		self.module.call_script = mock.Mock()
+		runner = mock.Mock()
 		project = Project()
 		project.raw_count_matrices = ['/path/to/raw_counts/raw_count_matrix.primary.counts',
 					'/path/to/raw_counts/raw_count_matrix.primary.dedup.counts']
@@ -45,6 +53,7 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix')
 		component_params.add(normalized_counts_file_prefix = 'normalized_count_matrix')
 		component_params.add(normalized_counts_output_dir = '/path/to/final/norm_counts_dir')
+		component_params.add(normalization_method = 'R')
 		component_params.add(normalization_script = 'normalize.R')
 		project_params.add(sample_annotation_file = '/path/to/samples.txt')
 		project.add_parameters(project_params)
@@ -52,10 +61,10 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		m = mock.MagicMock(side_effect = [True, True])
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
-			self.module.normalize(project, component_params)
-			calls = [mock.call('normalize.R', '/path/to/raw_counts/raw_count_matrix.primary.counts', 
+			self.module.normalize(project, component_params, result_cache, runner)
+			calls = [mock.call(runner, 'normalize.R', '/path/to/raw_counts/raw_count_matrix.primary.counts', 
 					'/path/to/final/norm_counts_dir/normalized_count_matrix.primary.counts', '/path/to/samples.txt' ), 
-				mock.call('normalize.R', '/path/to/raw_counts/raw_count_matrix.primary.dedup.counts', 
+				mock.call(runner, 'normalize.R', '/path/to/raw_counts/raw_count_matrix.primary.dedup.counts', 
 					'/path/to/final/norm_counts_dir/normalized_count_matrix.primary.dedup.counts', '/path/to/samples.txt' )]
 			self.module.call_script.assert_has_calls(calls)
 
@@ -65,6 +74,7 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		and that the one successful call was indeed made correctly.
 		"""
 		self.module.call_script = mock.Mock()
+		runner = mock.Mock()
 		project = Project()
 		project.raw_count_matrices = ['/path/to/raw_counts/raw_count_matrix.primary.counts',
 					'/path/to/raw_counts/raw_count_matrix.primary.dedup.counts']
@@ -73,6 +83,7 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix')
 		component_params.add(normalized_counts_file_prefix = 'normalized_count_matrix')
 		component_params.add(normalized_counts_output_dir = '/path/to/final/norm_counts_dir')
+		component_params.add(normalization_method = 'R')
 		component_params.add(normalization_script = 'normalize.R')
 		project_params.add(sample_annotation_file = '/path/to/samples.txt')
 		project.add_parameters(project_params)
@@ -81,27 +92,133 @@ class TestNormalizationComponent(unittest.TestCase, ComponentTester):
 		path = self.module.os.path
 		with mock.patch.object(path, 'isfile', m):
 			with self.assertRaises(self.module.MissingCountMatrixFileException):
-				self.module.normalize(project, component_params)
-			calls = [mock.call('normalize.R', '/path/to/raw_counts/raw_count_matrix.primary.counts', 
+				self.module.normalize(project, component_params, result_cache, runner)
+			calls = [mock.call(runner, 'normalize.R', '/path/to/raw_counts/raw_count_matrix.primary.counts', 
 					'/path/to/final/norm_counts_dir/normalized_count_matrix.primary.counts', '/path/to/samples.txt' )]
 			self.module.call_script.assert_has_calls(calls)
 
 
 	def test_system_call_to_Rscript(self):
-		self.module.subprocess = mock.Mock()
-		mock_process = mock.Mock()
-		mock_process.communicate.return_value = (('abc', 'def'))
-		mock_process.returncode = 0
-		self.module.subprocess.Popen.return_value = mock_process
-		self.module.subprocess.STDOUT = 'abc'
-		self.module.subprocess.STDERR = 'def'
-		self.module.call_script('normalize.R', '/path/to/input/raw.counts', '/path/to/output/norm.counts', '/path/to/samples.txt')
+		runner = mock.Mock()
+		runner.run_r_script.return_value = mock.Mock(returncode = 0)
+		self.module.call_script(runner, 'normalize.R', '/path/to/input/raw.counts', '/path/to/output/norm.counts', '/path/to/samples.txt')
 		full_script_path = os.path.join(os.path.dirname(os.path.abspath(self.module.__file__)), 'normalize.R')
-		expected_call = 'Rscript ' + full_script_path + ' /path/to/input/raw.counts /path/to/output/norm.counts /path/to/samples.txt'
-		self.module.subprocess.Popen.assert_called_once_with(expected_call, shell = True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)
+		runner.run_r_script.assert_called_once_with('normalization.norm.counts', full_script_path, ['/path/to/input/raw.counts', '/path/to/output/norm.counts', '/path/to/samples.txt'])
+
+
+	def test_native_normalization_writes_normalized_matrix(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			raw_path = os.path.join(tmp_dir, 'raw_count_matrix.primary.counts')
+			with open(raw_path, 'w') as f:
+				f.write('Gene\tA\tB\ng1\t10\t20\ng2\t0\t5\ng3\t30\t30\ng4\t4\t16\n')
+			project = Project()
+			project.raw_count_matrices = [raw_path]
+			project_params = Params()
+			project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix')
+			project.add_parameters(project_params)
+			component_params = Params()
+			component_params.add(normalization_method = 'native', normalized_counts_file_prefix = 'normalized_count_matrix', normalized_counts_output_dir = tmp_dir)
+
+			runner = mock.Mock()
+			output_files = self.module.normalize(project, component_params, result_cache, runner, count_matrix, normalization)
+			normalized_path = os.path.join(tmp_dir, 'normalized_count_matrix.primary.counts')
+			self.assertEqual(output_files, {'normalized_count_matrix.primary.counts': normalized_path})
+			self.assertFalse(runner.run_r_script.called)
+
+			# the size factors are sqrt(0.5) and sqrt(2); g2 has a zero count so does not take part
+			normalized = count_matrix.read_count_matrix(normalized_path, float)
+			self.assertEqual((normalized.genes, normalized.samples), (['g1', 'g2', 'g3', 'g4'], ['A', 'B']))
+			expected = np.array([[10, 20], [0, 5], [30, 30], [4, 16]])/np.array([np.sqrt(0.5), np.sqrt(2)])
+			self.assertTrue(np.allclose(normalized.counts, expected, rtol = 1e-14))
+			self.assertTrue(normalized_path in project.count_matrices)
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_further_normalizations_are_registered(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			raw_path = os.path.join(tmp_dir, 'raw_count_matrix.primary.counts')
+			with open(raw_path, 'w') as f:
+				f.write('Gene\tA\tB\ng1\t10\t20\ng2\t30\t180\n')
+			project = Project()
+			project.raw_count_matrices = [raw_path]
+			project_params = Params()
+			project_params.add(raw_count_matrix_file_prefix = 'raw_count_matrix')
+			project.add_parameters(project_params)
+			component_params = Params()
+			component_params.add(normalization_method = 'native', normalized_counts_file_prefix = 'normalized_count_matrix', normalized_counts_output_dir = tmp_dir)
+
+			self.module.normalize(project, component_params, result_cache, mock.Mock(), count_matrix, normalization, ['cpm', 'tmm'])
+			self.assertEqual(project.normalized_count_matrices, [os.path.join(tmp_dir, f) for f in
+				['normalized_count_matrix.primary.counts', 'normalized_count_matrix.primary.cpm', 'normalized_count_matrix.primary.tmm']])
+			cpm = count_matrix.read_count_matrix(project.normalized_count_matrices[1], float)
+			self.assertEqual(cpm.counts.tolist(), [[250000, 100000], [750000, 900000]])
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+class TestMedianOfRatios(unittest.TestCase):
+
+	def test_genes_with_a_zero_count_are_left_out(self):
+		counts = np.array([[10, 20, 40], [0, 1000, 1000], [5, 10, 20], [100, 100, 100]])
+		self.assertTrue(np.allclose(normalization.median_of_ratios_size_factors(counts), [0.5, 1, 2]))
+
+		with self.assertRaises(NormalizationException):
+			normalization.median_of_ratios_size_factors(np.array([[0, 1], [1, 0]]))
+
+
+	def test_numbers_formatted_as_r(self):
+		values = [[317.0, 1033.33333333333, 0.5, 100000.0, 123456.0, 1200000.0], [0.0001, 0.00012, 1.5e-05, 0.0, 1e+15, 14.142135623730949]]
+		self.assertEqual(normalization.format_as_r(np.array(values)),
+			[['317', '1033.33333333333', '0.5', '1e+05', '123456', '1200000'], ['1e-04', '0.00012', '1.5e-05', '0', '1e+15', '14.1421356237309']])
+
+
+class TestFurtherNormalizations(unittest.TestCase):
+
+	def test_tpm_uses_gene_lengths_from_gtf(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			gtf = os.path.join(tmp_dir, 'genes.gtf')
+			with open(gtf, 'w') as f:
+				# g1's exons overlap, so it covers 150 bases.  Other types of features do not count.
+				f.write('chr1\tsrc\texon\t1\t100\t.\t+\t.\tgene_id "G1"; gene_name "g1";\n')
+				f.write('chr1\tsrc\texon\t51\t150\t.\t+\t.\tgene_id "G1"; gene_name "g1";\n')
+				f.write('chr1\tsrc\tCDS\t1\t1000\t.\t+\t.\tgene_id "G1"; gene_name "g1";\n')
+				f.write('chr2\tsrc\texon\t1\t50\t.\t+\t.\tgene_id "G2"; gene_name "g2";\n')
+			gene_lengths = normalization.GeneLengths(gtf, 'exon', 'gene_name')
+			self.assertEqual(gene_lengths.get(['g2', 'g1']).tolist(), [50, 150])
+
+			matrix = count_matrix.CountMatrix(['g1', 'g2'], ['A', 'B'], np.array([[150, 300], [50, 100]]))
+			[(method, tpm)] = normalization.normalize_count_matrix_further(matrix, ['tpm'], gene_lengths)
+			self.assertEqual((method, tpm.counts.tolist()), ('tpm', [[500000, 500000], [500000, 500000]]))
+
+			with self.assertRaises(NormalizationException):
+				gene_lengths.get(['g3'])
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_tmm_corrects_for_composition(self):
+		# one gene takes up most of sample B's library, so CPM makes B's other genes look lower
+		matrix = count_matrix.CountMatrix(['g%d' % i for i in range(10)], ['A', 'B'], np.array([[10, 10]]*9 + [[10, 1000]]))
+		(_, cpm), (_, tmm) = normalization.normalize_count_matrix_further(matrix, ['cpm', 'tmm'])
+		self.assertTrue(cpm.counts[0, 0] > 10*cpm.counts[0, 1])
+		self.assertTrue(np.allclose(tmm.counts[:9, 0], tmm.counts[:9, 1]))
+
+		# without differences, the factors are all one
+		self.assertEqual(normalization.tmm_factors(np.array([[1.0, 2], [3, 6], [5, 10]]), np.array([9.0, 18])).tolist(), [1, 1])
+
+
+	def test_ties_get_average_ranks(self):
+		self.assertEqual(normalization.average_ranks(np.array([3.0, 1, 3, 2, 3])).tolist(), [4, 1, 4, 2, 4])
+
+
+	def test_unknown_normalization_raises_exception(self):
+		with self.assertRaises(NormalizationException):
+			normalization.check_further_normalizations(['cpm', 'rpkm'])
 
 
-		
-
 if __name__ == "__main__":
 	unittest.main()
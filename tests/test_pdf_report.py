@@ -22,6 +22,7 @@ import utils.config_parser as cp
 from utils.project import Project
 from utils.sample import Sample
 from utils.util_classes import Params
+from utils.process_runner import ProcessRunner
 
 from component_tester import ComponentTester
 
@@ -92,7 +93,7 @@ class TestPdfReportGenerator(unittest.TestCase, ComponentTester):
 		self.module.get_bam_counts.return_value = mock_bam_counts(mock_log_data.keys())
 		self.module.calculate_coverage_data = mock.Mock()
 		self.module.calculate_coverage_data.return_value = None
-		self.module.generate_figures(project, component_params, extra_params)
+		self.module.generate_figures(project, component_params, mock.Mock(), extra_params)
 
 
 	def test_fill_template(self):
@@ -133,7 +134,7 @@ class TestPdfReportGenerator(unittest.TestCase, ComponentTester):
 		template = env.get_template(component_params.get('report_template'))
 
 		self.module.fill_template(template, project, component_params)
-		self.module.compile_report(project, component_params)
+		self.module.compile_report(project, component_params, ProcessRunner(os.path.join(component_params['report_output_dir'], 'task_logs')))
 
 
 	def test_system_call_to_bedtools(self):
@@ -143,7 +144,8 @@ class TestPdfReportGenerator(unittest.TestCase, ComponentTester):
 				'genome': 'hg19', 
 				'genome_source_link':'ftp://ftp.ensembl.org/pub/release-75/fasta/homo_sapiens/dna/', 
 				'skip_align':False, 
-				'skip_analysis':False}
+				'skip_analysis':False,
+				'utils_dir': os.path.join(root, 'utils')}
 
 		project.parameters = parameters
 
@@ -161,28 +163,18 @@ class TestPdfReportGenerator(unittest.TestCase, ComponentTester):
 
 		component_params = cp.read_config(os.path.join(root, 'components', 'pdf_report', 'report.cfg'), 'COMPONENT_SPECIFIC')	
 
-		self.module.subprocess.Popen = mock.Mock()
-		
-		mock_process = mock.Mock()
-		mock_process.communicate.return_value = (('abc', 'def'))
-		mock_process.returncode = 0
-		self.module.subprocess.Popen.return_value = mock_process
-		self.module.subprocess.STDOUT = 'abc'
-		self.module.subprocess.STDERR = 'def'
-		
+		runner = mock.Mock()
+		runner.run.return_value = mock.Mock(returncode = 0)
+		self.module.calculate_coverage_data(project, component_params, runner)
 
-		m = mock.mock_open()
-		with mock.patch.object(__builtin__, 'open', m) as x:
-			expected_calls = [
-				mock.call([ component_params.get('bedtools_path'), component_params.get('bedtools_cmd'), '-ibam', '/abc/def/AAA.sort.primary.bam', '-bga'],  stderr='abc', stdout=m()),
-				mock.call().communicate(),
-				mock.call([ component_params.get('bedtools_path'), component_params.get('bedtools_cmd'), '-ibam', '/abc/def/BBB.sort.primary.bam', '-bga'], stderr='abc', stdout=m()),
-				mock.call().communicate(),
-				mock.call([ component_params.get('bedtools_path'), component_params.get('bedtools_cmd'), '-ibam', '/abc/def/CCC.sort.primary.bam', '-bga'], stderr='abc', stdout=m()),
-				mock.call().communicate()]
-			self.module.calculate_coverage_data(project, component_params)
-
-		self.module.subprocess.Popen.assert_has_calls(expected_calls) 
+		# the samples are processed concurrently, so the order of the calls is not fixed
+		expected_calls = []
+		for sn in mock_sample_names:
+			cvg_filepath = os.path.join(component_params.get('report_output_dir'), sn + '.sort.primary.' + component_params.get('coverage_file_suffix'))
+			bedtools_args = [component_params.get('bedtools_path'), component_params.get('bedtools_cmd'), '-ibam', '/abc/def/%s.sort.primary.bam' % sn, '-bga']
+			expected_calls.append(mock.call('bedtools.' + os.path.basename(cvg_filepath), bedtools_args, stdout_path = cvg_filepath))
+		runner.run.assert_has_calls(expected_calls, any_order = True)
+		self.assertEqual(runner.run.call_count, 3)
 		
 
 
@@ -7,12 +7,17 @@ import mock
 import sys
 import os
 import __builtin__
+import threading
 
 # for finding modules in the sibling directories
 from os import path
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
 from utils.pipeline import Pipeline
+from utils.component import Component
+from utils.project import Project
+from utils.sample import Sample
+from utils.util_classes import Params
 from utils.custom_exceptions import *
 import utils.config_parser
 from utils.util_methods import *
@@ -22,11 +27,132 @@ def dummy_join(a,b):
 	return os.path.join(a,b)
 
 
+def create_pipeline(components, max_concurrent = 4, skip_analysis = False):
+	p = Params()
+	p.add(max_concurrent_components = str(max_concurrent))
+	p.add(skip_analysis = skip_analysis)
+	project = Project()
+	project.add_parameters(p)
+	project.add_samples([Sample('A', 'X')])
+	pipeline = Pipeline()
+	pipeline.register_components(components)
+	pipeline.add_project(project)
+	return pipeline
+
+
+def create_component(name, consumes = [], produces = [], run_method = None, component_type = 'STANDARD'):
+	component = Component(name, '/path/to/' + name, component_type, consumes = consumes, produces = produces)
+	component.run = mock.Mock(side_effect = run_method)
+	return component
+
+
 class TestPipeline(unittest.TestCase):
 	"""
 	Tests the Pipeline object
 	"""
-	pass
+
+	def test_components_run_after_their_inputs_are_produced(self):
+		"""
+		feature_counts -> normalization is a chain, so the order of those matters.  Checks that a consumer never starts before its producer has finished
+		"""
+		finished = []
+		def recorder(name):
+			def f():
+				finished.append(name)
+			return f
+
+		aligner = create_component('star', produces = ['bam_files'], run_method = recorder('star'))
+		fc = create_component('feature_counts', consumes = ['bam_files'], produces = ['raw_count_matrices'], run_method = recorder('feature_counts'))
+		norm = create_component('normalization', consumes = ['raw_count_matrices'], produces = ['normalized_count_matrices'], run_method = recorder('normalization'))
+
+		# register them out of order to show that the configured order is not what determines execution
+		pipeline = create_pipeline([norm, fc, aligner])
+		pipeline.run()
+		self.assertEqual(finished, ['star', 'feature_counts', 'normalization'])
+		self.assertTrue(all([len(c.records) > 0 for c in [aligner, fc, norm]]))
+
+
+	def test_independent_components_run_concurrently(self):
+		"""
+		rna_seqc and feature_counts only need the BAM files, so both should be running at the same time.  Each one waits for the other to start, 
+		which would deadlock (and hit the timeout) if they were run one after the other.
+		"""
+		barrier = [threading.Event(), threading.Event()]
+		def make_method(mine, other):
+			def f():
+				mine.set()
+				if not other.wait(5):
+					raise Exception('The other component was never started.')
+			return f
+
+		qc = create_component('rna_seqc', consumes = ['bam_files'], produces = ['qc_reports'], run_method = make_method(barrier[0], barrier[1]))
+		fc = create_component('feature_counts', consumes = ['bam_files'], produces = ['raw_count_matrices'], run_method = make_method(barrier[1], barrier[0]))
+		pipeline = create_pipeline([fc, qc])
+		pipeline.run()
+		self.assertTrue(len(qc.records) > 0)
+		self.assertTrue(len(fc.records) > 0)
+
+
+	def test_failed_component_stops_downstream_components(self):
+		def fail():
+			raise Exception('failed!')
+
+		fc = create_component('feature_counts', consumes = ['bam_files'], produces = ['raw_count_matrices'], run_method = fail)
+		norm = create_component('normalization', consumes = ['raw_count_matrices'], produces = ['normalized_count_matrices'])
+		pipeline = create_pipeline([fc, norm])
+		with self.assertRaises(Exception):
+			pipeline.run()
+		self.assertEqual(fc.records, {})
+		self.assertEqual(norm.records, {})
+		self.assertEqual(norm.run.call_count, 0)
+
+
+	def test_up_to_date_components_are_not_rerun(self):
+		fc = create_component('feature_counts', consumes = ['bam_files'], produces = ['raw_count_matrices'])
+		norm = create_component('normalization', consumes = ['raw_count_matrices'], produces = ['normalized_count_matrices'])
+		pipeline = create_pipeline([fc, norm])
+		pipeline.run()
+		pipeline.run()
+		self.assertEqual(fc.run.call_count, 1)
+		self.assertEqual(norm.run.call_count, 1)
+
+
+	def test_analysis_components_skipped(self):
+		fc = create_component('feature_counts', consumes = ['bam_files'], produces = ['raw_count_matrices'])
+		deseq = create_component('deseq', consumes = ['raw_count_matrices'], produces = ['deseq_tables'], component_type = 'ANALYSIS')
+		pipeline = create_pipeline([fc, deseq], skip_analysis = True)
+		pipeline.run()
+		self.assertEqual(fc.run.call_count, 1)
+		self.assertEqual(deseq.run.call_count, 0)
+
+
+	def test_cyclic_dependencies_raise_exception(self):
+		a = create_component('a', consumes = ['y'], produces = ['x'])
+		b = create_component('b', consumes = ['x'], produces = ['y'])
+		pipeline = create_pipeline([a, b])
+		with self.assertRaises(ComponentDependencyException):
+			pipeline.run()
+
+
+	def test_max_concurrent_components_respected(self):
+		"""
+		With a limit of one, independent components have to run one at a time
+		"""
+		lock = threading.Lock()
+		state = {'running':0, 'max':0}
+		def f():
+			with lock:
+				state['running'] += 1
+				state['max'] = max(state['max'], state['running'])
+			threading.Event().wait(0.05)
+			with lock:
+				state['running'] -= 1
+
+		components = [create_component(name, consumes = ['bam_files'], produces = [name], run_method = f) for name in ['a', 'b', 'c']]
+		pipeline = create_pipeline(components, max_concurrent = 1)
+		pipeline.run()
+		self.assertEqual(state['max'], 1)
+		self.assertTrue(all([len(c.records) > 0 for c in components]))
 
 
 if __name__ == "__main__":
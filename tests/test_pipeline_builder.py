@@ -85,6 +85,8 @@ class TestPipelineBuilder(unittest.TestCase):
 					default_aligner = default_aligner,
 					aligner=None,
 					aligners_dir = '/path/to/dir',
+					aligner_inputs = 'fastq_files',
+					aligner_outputs = 'bam_files',
 					genome = 'hg19')
 		p.builder_params = mock_pipeline_params
 		p.all_components = []
@@ -94,6 +96,8 @@ class TestPipelineBuilder(unittest.TestCase):
 		
 		p._PipelineBuilder__check_aligner_valid()
 		self.assertEqual(p.builder_params.get('aligner'), default_aligner)
+		self.assertEqual(p.all_components[0].consumes, ['fastq_files'])
+		self.assertEqual(p.all_components[0].produces, ['bam_files'])
 
 
 
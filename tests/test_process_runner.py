@@ -0,0 +1,91 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import os
+import shutil
+import tempfile
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.process_runner import ProcessRunner, RotatingLogWriter, create_runner
+from utils.util_classes import Params
+
+
+class TestProcessRunner(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.log_dir = os.path.join(self.tmp_dir, 'task_logs')
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def test_output_goes_to_task_log(self):
+		runner = ProcessRunner(self.log_dir)
+		result = runner.run('sample A', 'echo first; echo second 1>&2')
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(result.log_path, os.path.join(self.log_dir, 'sample_A.log'))
+		lines = open(result.log_path).read().splitlines()
+		self.assertEqual(lines[1:], ['first', 'second'])
+		self.assertEqual(result.tail, ['first', 'second'])
+		self.assertTrue(result.wall_time >= 0)
+		self.assertTrue(result.max_rss > 0)
+
+
+	def test_exit_status_is_reported(self):
+		runner = ProcessRunner(self.log_dir)
+		self.assertEqual(runner.run('fails', 'echo oops; exit 3').returncode, 3)
+		self.assertEqual(runner.run('killed', 'kill -9 $$').returncode, -9)
+
+
+	def test_stdout_written_to_file(self):
+		runner = ProcessRunner(self.log_dir)
+		output_path = os.path.join(self.tmp_dir, 'coverage.txt')
+		result = runner.run('coverage', ['sh', '-c', 'echo chr1 0 10 5; echo warning 1>&2'], stdout_path = output_path)
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(open(output_path).read(), 'chr1 0 10 5\n')
+		self.assertEqual(result.tail, ['warning'])
+
+
+	def test_progress_parsers_see_each_line(self):
+		runner = ProcessRunner(self.log_dir)
+		seen = []
+		def parser(line):
+			seen.append(line.strip())
+			if line.startswith('progress'):
+				return line.strip()
+		def broken_parser(line):
+			raise ValueError('cannot parse')
+		result = runner.run('parsed', 'echo progress 50%; echo done', progress_parsers = [parser, broken_parser])
+		self.assertEqual(result.returncode, 0)
+		self.assertEqual(seen, ['progress 50%', 'done'])
+
+
+	def test_log_is_rotated_at_size_cap(self):
+		log_path = os.path.join(self.tmp_dir, 'task.log')
+		writer = RotatingLogWriter(log_path, 100, 2)
+		for i in range(12):
+			writer.write('%02d' % i + 'x'*47 + '\n')
+		writer.close()
+		self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['task.log', 'task.log.1', 'task.log.2'])
+		self.assertTrue(open(log_path).read().startswith('10'))
+		self.assertTrue(all([os.path.getsize(os.path.join(self.tmp_dir, f)) <= 100 for f in os.listdir(self.tmp_dir)]))
+
+
+	def test_runner_created_from_parameters(self):
+		p = Params()
+		p.add(output_location = self.tmp_dir, task_log_dir = 'logs', task_log_max_size = '1', task_log_backups = '0')
+		runner = create_runner(p)
+		self.assertEqual(runner.log_dir, os.path.join(self.tmp_dir, 'logs'))
+		self.assertEqual(runner.max_log_size, 1024**2)
+		self.assertEqual(runner.log_backups, 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,173 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import os
+import shutil
+import tempfile
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils import r_worker_pool
+from utils.r_worker_pool import RWorkerPool, get_pool
+from utils.process_runner import ProcessRunner
+from utils.custom_exceptions import RWorkerException
+from utils.util_classes import Params
+
+# A stand-in for r_worker.R which speaks its protocol.  The 'scripts' it runs are python files, except that crash.R kills the worker and
+# hang.R never finishes, and once the file named by the HANG environment variable exists, the worker stops answering pings.
+FAKE_WORKER = """
+import os, sys, time
+print('loading packages: ' + ' '.join(sys.argv[1:]))
+print('R_WORKER READY')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+	fields = line.rstrip('\\n').split('\\t')
+	if fields[0] == 'PING':
+		if os.path.exists(os.environ['HANG']):
+			time.sleep(60)
+		print('R_WORKER PONG')
+	elif fields[0] == 'RUN':
+		if os.path.basename(fields[2]) == 'crash.R':
+			os._exit(3)
+		if os.path.basename(fields[2]) == 'hang.R':
+			time.sleep(60)
+		with open(fields[1], 'w') as output:
+			output.write('pid %d args %s\\n' % (os.getpid(), ' '.join(fields[3:])))
+		print('R_WORKER DONE %d 0.5 0.25' % int(open(fields[2]).read()))
+	sys.stdout.flush()
+"""
+
+
+class TestRWorkerPool(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		worker = os.path.join(self.tmp_dir, 'fake_worker.py')
+		with open(worker, 'w') as f:
+			f.write(FAKE_WORKER)
+		self.hang_path = os.path.join(self.tmp_dir, 'hang')
+		os.environ['HANG'] = self.hang_path
+		self.patcher = mock.patch.object(r_worker_pool, 'WORKER_COMMAND', [sys.executable, worker])
+		self.patcher.start()
+		self.pool = RWorkerPool(1, ['DESeq'], os.path.join(self.tmp_dir, 'logs'), startup_timeout = 10, health_check_interval = 0, ping_timeout = 0.5)
+
+
+	def tearDown(self):
+		self.pool.shutdown()
+		self.patcher.stop()
+		del os.environ['HANG']
+		shutil.rmtree(self.tmp_dir)
+
+
+	def write_script(self, name, status):
+		script = os.path.join(self.tmp_dir, name)
+		with open(script, 'w') as f:
+			f.write(str(status))
+		return script
+
+
+	def worker_pid(self, output_path):
+		return open(output_path).read().split()[1]
+
+
+	def test_worker_is_reused(self):
+		script = self.write_script('ok.R', 0)
+		output = os.path.join(self.tmp_dir, 'out')
+		self.assertEqual(self.pool.run(script, ['a', 'b'], output), (0, 0.5, 0.25))
+		first_pid = self.worker_pid(output)
+		self.assertEqual(open(output).read().split()[3:], ['a', 'b'])
+		self.assertEqual(self.pool.run(self.write_script('fails.R', 2), [], output)[0], 2)
+		self.assertEqual(self.worker_pid(output), first_pid)
+		self.assertEqual(len(self.pool.workers), 1)
+
+
+	def test_crashed_worker_is_restarted(self):
+		script = self.write_script('ok.R', 0)
+		output = os.path.join(self.tmp_dir, 'out')
+		self.pool.run(script, [], output)
+		first_pid = self.worker_pid(output)
+		self.assertEqual(self.pool.run(self.write_script('crash.R', 0), [], output), (3, None, None))
+		self.assertEqual(self.pool.run(script, [], output)[0], 0)
+		self.assertNotEqual(self.worker_pid(output), first_pid)
+
+
+	def test_unresponsive_worker_is_restarted(self):
+		script = self.write_script('ok.R', 0)
+		output = os.path.join(self.tmp_dir, 'out')
+		self.pool.run(script, [], output)
+		first_pid = self.worker_pid(output)
+		open(self.hang_path, 'w').close()
+		self.pool.run(script, [], output)
+		self.assertNotEqual(self.worker_pid(output), first_pid)
+
+
+	def test_script_which_runs_too_long_fails_and_its_worker_is_restarted(self):
+		script = self.write_script('ok.R', 0)
+		output = os.path.join(self.tmp_dir, 'out')
+		self.pool.run(script, [], output)
+		first_pid = self.worker_pid(output)
+		self.pool.job_timeout = 0.5
+		status, user_time, system_time = self.pool.run(self.write_script('hang.R', 0), [], output)
+		self.assertNotEqual(status, 0)
+		self.assertEqual((user_time, system_time), (None, None))
+		self.assertEqual(self.pool.run(script, [], output)[0], 0)
+		self.assertNotEqual(self.worker_pid(output), first_pid)
+
+
+	def test_worker_which_does_not_start_raises_exception(self):
+		with mock.patch.object(r_worker_pool, 'WORKER_COMMAND', [sys.executable, '-c', 'pass']):
+			pool = RWorkerPool(1, [], os.path.join(self.tmp_dir, 'logs'), startup_timeout = 10)
+			with self.assertRaises(RWorkerException):
+				pool.run(self.write_script('ok.R', 0), [], os.path.join(self.tmp_dir, 'out'))
+			pool.shutdown()
+
+
+	def test_runner_gives_r_scripts_to_the_pool(self):
+		runner = ProcessRunner(os.path.join(self.tmp_dir, 'task_logs'), r_workers = self.pool)
+		result = runner.run_r_script('deseq.A_vs_B', self.write_script('ok.R', 0), ['x', 1])
+		self.assertEqual((result.returncode, result.max_rss, result.user_time), (0, None, 0.5))
+		self.assertEqual(result.command, 'Rscript %s x 1' % os.path.join(self.tmp_dir, 'ok.R'))
+		log = open(result.log_path).read()
+		self.assertTrue('args x 1' in log)
+		self.assertFalse(os.path.exists(result.log_path[:-len('.log')] + '.r.out'))
+
+		# with a scheduler, the script is run as a command:
+		runner = ProcessRunner(os.path.join(self.tmp_dir, 'task_logs'), scheduler = mock.Mock(), r_workers = self.pool)
+		runner.run = mock.Mock()
+		runner.run_r_script('deseq.A_vs_B', '/path/to/deseq.R', ['x'])
+		runner.run.assert_called_once_with('deseq.A_vs_B', 'Rscript /path/to/deseq.R x')
+
+
+	def test_pool_only_created_if_configured(self):
+		p = Params()
+		p.add(r_worker_pool_size = '0')
+		self.assertEqual(get_pool(p, self.tmp_dir), None)
+		p = Params()
+		p.add(r_worker_pool_size = '3', r_worker_packages = ('DESeq', 'gplots'), r_worker_job_timeout = '3600')
+		with mock.patch.object(r_worker_pool, 'POOL', None):
+			with mock.patch('atexit.register'):
+				pool = get_pool(p, self.tmp_dir)
+				self.assertEqual((pool.size, pool.packages, pool.health_check_interval, pool.job_timeout), (3, ['DESeq', 'gplots'], r_worker_pool.DEFAULT_HEALTH_CHECK_INTERVAL, 3600.0))
+				self.assertTrue(get_pool(p, self.tmp_dir) is pool)
+
+
+	def test_auto_pool_size_follows_cores_and_memory(self):
+		p = Params()
+		p.add(r_worker_pool_size = 'auto', r_worker_memory = '4')
+		with mock.patch.object(r_worker_pool.multiprocessing, 'cpu_count', mock.Mock(return_value = 8)):
+			with mock.patch.object(r_worker_pool.resource_manager, 'get_available_memory', mock.Mock(return_value = 10.0)):
+				self.assertEqual(r_worker_pool.get_pool_size(p), 2)
+			with mock.patch.object(r_worker_pool.resource_manager, 'get_available_memory', mock.Mock(return_value = 100.0)):
+				self.assertEqual(r_worker_pool.get_pool_size(p), 8)
+			with mock.patch.object(r_worker_pool.resource_manager, 'get_available_memory', mock.Mock(return_value = 1.0)):
+				self.assertEqual(r_worker_pool.get_pool_size(p), 1)
+		p.add(r_worker_pool_size = '3')
+		self.assertEqual(r_worker_pool.get_pool_size(p), 3)
+
+
+if __name__ == "__main__":
+	unittest.main()
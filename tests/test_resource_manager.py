@@ -0,0 +1,84 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import threading
+import __builtin__
+from StringIO import StringIO
+
+# for finding modules in the sibling directories
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.resource_manager import ResourceManager, get_available_memory
+from utils.custom_exceptions import *
+
+
+def create_mock_open(fileobj):
+
+	mock_obj = mock.MagicMock(spec = file)
+	mock_obj.__enter__.return_value = fileobj
+	mock_obj.return_value = mock_obj
+	return mock_obj
+
+
+class TestResourceManager(unittest.TestCase):
+
+	def test_reservations_within_limits_do_not_block(self):
+		rm = ResourceManager(100, 8)
+		rm.reserve(40, 4)
+		rm.reserve(40, 4)
+		self.assertEqual(rm.reserved_memory, 80)
+		self.assertEqual(rm.reserved_cpus, 8)
+		self.assertFalse(rm.fits(10, 1))
+
+
+	def test_waiting_reservation_admitted_on_release(self):
+		rm = ResourceManager(100, 8)
+		rm.reserve(60, 2)
+		admitted = threading.Event()
+		def waiter():
+			rm.reserve(60, 2)
+			admitted.set()
+		t = threading.Thread(target = waiter)
+		t.start()
+
+		# cannot fit while the first reservation is held:
+		self.assertFalse(admitted.wait(0.1))
+		rm.release(60, 2)
+		self.assertTrue(admitted.wait(5))
+		t.join()
+		self.assertEqual(rm.reserved_memory, 60)
+
+
+	def test_reservation_larger_than_the_totals_runs_alone(self):
+		rm = ResourceManager(30, 8)
+		rm.reserve(40, 16)
+		self.assertEqual((rm.reserved_memory, rm.reserved_cpus), (30, 8))
+		self.assertFalse(rm.try_reserve(1, 1))
+		rm.release(40, 16)
+		self.assertEqual((rm.reserved_memory, rm.reserved_cpus), (0, 0))
+
+		# it waits for the other reservations to finish:
+		rm.reserve(10, 1)
+		self.assertFalse(rm.try_reserve(40, 1))
+		rm.release(10, 1)
+		self.assertTrue(rm.try_reserve(40, 1))
+
+
+	def test_available_memory_parsed(self):
+		meminfo = 'MemTotal:       528000000 kB\nMemFree:         1048576 kB\nMemAvailable:   209715200 kB\nCached:         1048576 kB\n'
+		with mock.patch.object(__builtin__, 'open', create_mock_open(StringIO(meminfo))):
+			self.assertEqual(get_available_memory(), 200.0)
+
+
+	def test_available_memory_on_old_kernels(self):
+		meminfo = 'MemTotal:       528000000 kB\nMemFree:         1048576 kB\nCached:         2097152 kB\n'
+		with mock.patch.object(__builtin__, 'open', create_mock_open(StringIO(meminfo))):
+			self.assertEqual(get_available_memory(), 3.0)
+
+
+if __name__ == "__main__":
+	unittest.main()
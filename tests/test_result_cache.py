@@ -0,0 +1,158 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import os
+import shutil
+import tempfile
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.result_cache import ResultCache, ContentOf, IdentityOf, cached_call, cached_batch_call, create_result_cache, MANIFEST
+from utils.util_classes import Params
+
+
+class TestResultCache(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+		self.work_dir = os.path.join(self.tmp_dir, 'work')
+		os.makedirs(self.work_dir)
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def write(self, filename, contents):
+		filepath = os.path.join(self.work_dir, filename)
+		with open(filepath, 'w') as f:
+			f.write(contents)
+		return filepath
+
+
+	def test_cache_disabled_without_directory(self):
+		p = Params()
+		p.add(result_cache_dir = ())
+		self.assertIsNone(create_result_cache(p))
+		p.reset_param('result_cache_dir', self.cache_dir)
+		self.assertIsNotNone(create_result_cache(p))
+
+
+	def test_fingerprint_follows_file_content(self):
+		cache = ResultCache(self.cache_dir, 1)
+		input_file = self.write('reads.fastq', 'ACGT')
+		key = cache.fingerprint(['star', ContentOf(input_file)])
+		self.assertEqual(key, cache.fingerprint(['star', ContentOf(input_file)]))
+		self.assertNotEqual(key, cache.fingerprint(['featureCounts', ContentOf(input_file)]))
+
+		# same content in a different file gives the same key:
+		copied_file = self.write('copy.fastq', 'ACGT')
+		self.assertEqual(key, cache.fingerprint(['star', ContentOf(copied_file)]))
+
+		self.write('reads.fastq', 'ACGTACGT')
+		self.assertNotEqual(key, cache.fingerprint(['star', ContentOf(input_file)]))
+
+
+	def test_fingerprint_follows_identity_of_directories(self):
+		cache = ResultCache(self.cache_dir, 1)
+		index_dir = os.path.join(self.work_dir, 'index')
+		os.makedirs(index_dir)
+		with open(os.path.join(index_dir, 'SA'), 'w') as f:
+			f.write('abc')
+		key = cache.fingerprint([IdentityOf(index_dir)])
+		with open(os.path.join(index_dir, 'Genome'), 'w') as f:
+			f.write('abc')
+		self.assertNotEqual(key, cache.fingerprint([IdentityOf(index_dir)]))
+
+
+	def test_second_call_is_restored_from_cache(self):
+		cache = ResultCache(self.cache_dir, 1)
+		input_file = self.write('sample.bam', 'some reads')
+		output_file = os.path.join(self.work_dir, 'out', 'sample.counts')
+		os.makedirs(os.path.dirname(output_file))
+
+		def count():
+			with open(output_file, 'w') as f:
+				f.write('counts')
+		method = mock.Mock(side_effect = count)
+
+		self.assertFalse(cached_call(cache, ['count', ContentOf(input_file)], [output_file], method))
+		shutil.rmtree(os.path.dirname(output_file))
+		self.assertTrue(cached_call(cache, ['count', ContentOf(input_file)], [output_file], method))
+		self.assertEqual(method.call_count, 1)
+		self.assertEqual(open(output_file).read(), 'counts')
+
+
+	def test_rerun_does_not_overwrite_cached_copy(self):
+		cache = ResultCache(self.cache_dir, 1)
+		input_file = self.write('sample.bam', 'some reads')
+		output_file = os.path.join(self.work_dir, 'sample.counts')
+		def write_output(contents):
+			with open(output_file, 'w') as f:
+				f.write(contents)
+
+		cached_call(cache, ['count', ContentOf(input_file)], [output_file], write_output, 'first')
+		cached_call(cache, ['count', ContentOf(input_file)], [output_file], write_output, 'never called')
+
+		# different inputs, same output path-- the restored hardlink must not be written through
+		cached_call(cache, ['count', 'other options', ContentOf(input_file)], [output_file], write_output, 'second')
+		self.assertEqual(open(output_file).read(), 'second')
+		os.remove(output_file)
+		cached_call(cache, ['count', ContentOf(input_file)], [output_file], write_output, 'never called')
+		self.assertEqual(open(output_file).read(), 'first')
+
+
+	def test_batch_call_only_makes_missing_outputs(self):
+		cache = ResultCache(self.cache_dir, 1)
+		input_file = self.write('matrix.counts', 'counts')
+		entries = [(['contrast', name, ContentOf(input_file)], [os.path.join(self.work_dir, name + '.csv')]) for name in ['A_vs_B', 'A_vs_C']]
+		def run(pending, contents):
+			for i in pending:
+				with open(entries[i][1][0], 'w') as f:
+					f.write(contents)
+		method = mock.Mock(side_effect = run)
+
+		self.assertEqual(cached_batch_call(cache, entries[:1], method, 'first'), 0)
+		self.assertEqual(cached_batch_call(cache, entries, method, 'second'), 1)
+		self.assertEqual(method.call_args_list, [mock.call([0], 'first'), mock.call([1], 'second')])
+		self.assertEqual([open(paths[0]).read() for key_parts, paths in entries], ['first', 'second'])
+
+		self.assertEqual(cached_batch_call(cache, entries, method, 'never called'), 2)
+		self.assertEqual(method.call_count, 2)
+
+
+	def test_restore_into_directory(self):
+		cache = ResultCache(self.cache_dir, 1)
+		outputs = [self.write('A.sort.bam', 'bam'), self.write('A.Log.final.out', 'log')]
+		cache.store('abcdef', outputs)
+		restore_dir = os.path.join(self.tmp_dir, 'restored')
+		os.makedirs(restore_dir)
+		self.assertTrue(cache.fetch('abcdef', output_dir = restore_dir))
+		self.assertEqual(sorted(os.listdir(restore_dir)), ['A.Log.final.out', 'A.sort.bam'])
+		self.assertFalse(cache.fetch('123456', output_dir = restore_dir))
+
+
+	def test_least_recently_used_entries_are_evicted(self):
+		# room for two of the three 400-byte entries:
+		cache = ResultCache(self.cache_dir, 1000.0/1024**3)
+		for i, key in enumerate(['aaaa', 'bbbb']):
+			cache.store(key, [self.write('%s.txt' % key, 'x'*400)])
+			manifest = os.path.join(cache.entry_dir(key), MANIFEST)
+			os.utime(manifest, (1000 + i, 1000 + i))
+
+		# use the older entry, so the other one becomes the least recently used:
+		self.assertTrue(cache.fetch('aaaa', [os.path.join(self.work_dir, 'aaaa.txt')]))
+		cache.store('cccc', [self.write('cccc.txt', 'x'*400)])
+
+		self.assertTrue(os.path.isdir(cache.entry_dir('aaaa')))
+		self.assertFalse(os.path.isdir(cache.entry_dir('bbbb')))
+		self.assertTrue(os.path.isdir(cache.entry_dir('cccc')))
+
+
+if __name__ == "__main__":
+	unittest.main()
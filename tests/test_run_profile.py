@@ -0,0 +1,117 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.component import Component
+from utils.project import Project
+from utils.sample import Sample
+from utils.pipeline import Pipeline
+from utils.util_classes import Params
+from utils.process_runner import ProcessRunner, TASK_RECORDS
+import utils.run_profile as run_profile
+import report_generator.create_report as create_report
+
+
+PLUGIN = """
+import process_runner
+
+def run(name, project):
+	runner = process_runner.create_runner(project.parameters, name)
+	runner.run(name + '.tool', 'echo working; head -c 100000 /dev/zero > %s' % project.parameters.get('tool_output'))
+	return []
+"""
+
+
+class TestRunProfile(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.component_dir = os.path.join(self.tmp_dir, 'counter')
+		os.makedirs(self.component_dir)
+		with open(os.path.join(self.component_dir, 'plugin.py'), 'w') as f:
+			f.write(PLUGIN)
+		self.utils_dir = os.path.join(path.dirname(path.dirname(path.abspath(__file__))), 'utils')
+		sys.path.append(self.utils_dir)
+
+
+	def tearDown(self):
+		sys.path.remove(self.utils_dir)
+		shutil.rmtree(self.tmp_dir)
+
+
+	def create_pipeline(self):
+		p = Params()
+		p.add(output_location = self.tmp_dir, entry_module = 'plugin', entry_method = 'run', skip_analysis = False,
+			tool_output = os.path.join(self.tmp_dir, 'zeros'), task_log_dir = 'task_logs', task_log_max_size = '1', task_log_backups = '0', job_backend = 'local', r_worker_pool_size = '0')
+		project = Project()
+		project.add_parameters(p)
+		project.add_samples([Sample('A', 'X')])
+		project.contrasts = []
+		pipeline = Pipeline()
+		pipeline.register_components([Component('counter', self.component_dir)])
+		pipeline.add_project(project)
+		return pipeline
+
+
+	def test_run_profile_written_for_components_and_tools(self):
+		pipeline = self.create_pipeline()
+		pipeline.run()
+
+		profile = run_profile.load_run_profile(self.tmp_dir)
+		self.assertEqual([c['name'] for c in profile['components']], ['counter'])
+		component = profile['components'][0]
+		self.assertEqual(component['task_count'], 1)
+		self.assertTrue(component['wall_time'] >= component['task_wall_time'])
+
+		task = profile['tasks'][0]
+		self.assertEqual((task['component'], task['label'], task['returncode']), ('counter', 'counter.tool', 0))
+		self.assertTrue(task['max_rss'] > 0)
+		if task['bytes_written'] is not None:
+			self.assertTrue(task['bytes_written'] >= 100000)
+
+
+	def test_tasks_from_earlier_runs_are_left_out(self):
+		runner = ProcessRunner(self.tmp_dir, component_name = 'counter')
+		runner.run('earlier', 'true')
+		started = time.time()
+		runner.run('later', 'true')
+		records = run_profile.read_task_records(os.path.join(self.tmp_dir, TASK_RECORDS), started)
+		self.assertEqual([r['label'] for r in records], ['later'])
+
+
+	def test_components_which_did_not_run_are_left_out(self):
+		ran = Component('ran', 'ran_dir')
+		ran.profile = {'start': 200, 'wall_time': 5.0, 'user_time': 1.0, 'system_time': 0.5, 'bytes_read': None, 'bytes_written': None}
+		skipped = Component('skipped', 'skipped_dir')
+		skipped.profile = {'start': 50, 'wall_time': 5.0, 'user_time': 1.0, 'system_time': 0.5, 'bytes_read': None, 'bytes_written': None}
+		tasks = [{'component': 'ran', 'label': 'a', 'start': 210, 'wall_time': 2.0, 'user_time': 1.5, 'system_time': 0.1, 'max_rss': 100.0, 'bytes_read': 10, 'bytes_written': None},
+			{'component': 'ran', 'label': 'b', 'start': 220, 'wall_time': 3.0, 'user_time': 2.5, 'system_time': 0.2, 'max_rss': 300.0, 'bytes_read': 20, 'bytes_written': None}]
+		profile = run_profile.create_run_profile([ran, skipped, Component('never_run', 'dir')], tasks, 100)
+		self.assertEqual(len(profile['components']), 1)
+		entry = profile['components'][0]
+		self.assertEqual((entry['task_count'], entry['task_wall_time'], entry['task_max_rss'], entry['task_bytes_read'], entry['task_bytes_written']), (2, 5.0, 300.0, 30, None))
+
+
+	def test_report_table(self):
+		pipeline = self.create_pipeline()
+		pipeline.run()
+		tab, section = create_report.add_run_profile(run_profile.load_run_profile(self.tmp_dir))
+		self.assertTrue(section.table_section)
+		components, tasks = section.contents
+		self.assertEqual(components.rows[0][0], 'counter')
+		self.assertEqual(tasks.rows[0][:3], ['counter', 'counter.tool', '0'])
+		self.assertEqual(create_report.add_run_profile(None), (None, None))
+
+
+if __name__ == "__main__":
+	unittest.main()
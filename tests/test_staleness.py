@@ -0,0 +1,204 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import os
+import shutil
+import tempfile
+import pickle
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.pipeline import Pipeline
+from utils.component import Component
+from utils.project import Project
+from utils.sample import Sample
+from utils.util_classes import Params
+from utils.staleness import StalenessChecker, COHORT
+import utils.util_methods as util_methods
+
+
+SAMPLE_RESOURCES = {'fastq_files': 'read_1_fastq', 'bam_files': 'bamfiles', 'raw_count_matrices': 'countfiles'}
+
+
+class TestIncrementalPipeline(unittest.TestCase):
+	"""
+	Runs a small pipeline (aligner -> counts -> normalization) whose components write real files, then changes things and checks what is re-run
+	"""
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.runs = {}
+
+		p = Params()
+		p.add(max_concurrent_components = '2', skip_analysis = False)
+		p.add(sample_resources = SAMPLE_RESOURCES, signature_params = 'genome', genome = 'hg19')
+		self.project = Project()
+		self.project.add_parameters(p)
+		self.project.add_samples([Sample(name, 'X', read_1_fastq = self.write(name + '.fastq', 'ACGT'), bamfiles = []) for name in ['A', 'B']])
+		self.project.contrasts = []
+
+		aligner = self.create_component('star', ['fastq_files'], ['bam_files'], self.align)
+		counts = self.create_component('feature_counts', ['bam_files'], ['raw_count_matrices'], self.count)
+		norm = self.create_component('normalization', ['raw_count_matrices'], ['normalized_count_matrices'], self.normalize)
+		self.pipeline = Pipeline()
+		self.pipeline.register_components([aligner, counts, norm])
+		self.pipeline.add_project(self.project)
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def write(self, filename, contents):
+		filepath = os.path.join(self.tmp_dir, filename)
+		with open(filepath, 'w') as f:
+			f.write(contents)
+		return filepath
+
+
+	def create_component(self, name, consumes, produces, method):
+		component = Component(name, os.path.join(self.tmp_dir, name), consumes = consumes, produces = produces)
+		def run():
+			samples = util_methods.get_samples_to_run(self.project, name)
+			self.runs.setdefault(name, []).append(sorted([s.sample_name for s in samples]))
+			method(samples)
+		component.run = run
+		return component
+
+
+	def align(self, samples):
+		for s in samples:
+			s.bamfiles = [self.write(s.sample_name + '.sort.bam', open(s.read_1_fastq).read())]
+
+
+	def count(self, samples):
+		for s in samples:
+			s.countfiles = [self.write(s.sample_name + '.counts', open(s.bamfiles[0]).read())]
+		self.project.raw_count_matrices = [self.write('raw_count_matrix.counts', ''.join([open(s.countfiles[0]).read() for s in self.project.samples]))]
+
+
+	def normalize(self, samples):
+		self.project.normalized_count_matrices = [self.write('normalized_count_matrix.counts', open(self.project.raw_count_matrices[0]).read())]
+
+
+	def test_first_run_runs_everything(self):
+		self.pipeline.run()
+		self.assertEqual(self.runs, {'star': [['A', 'B']], 'feature_counts': [['A', 'B']], 'normalization': [['A', 'B']]})
+
+
+	def test_nothing_reruns_when_nothing_changed(self):
+		self.pipeline.run()
+		self.pipeline.run()
+		self.assertEqual(self.runs, {'star': [['A', 'B']], 'feature_counts': [['A', 'B']], 'normalization': [['A', 'B']]})
+
+
+	def test_replaced_fastq_only_reruns_that_sample(self):
+		self.pipeline.run()
+		self.write('A.fastq', 'ACGTACGT')
+		self.pipeline.run()
+		self.assertEqual(self.runs['star'], [['A', 'B'], ['A']])
+		self.assertEqual(self.runs['feature_counts'], [['A', 'B'], ['A']])
+		self.assertEqual(len(self.runs['normalization']), 2)
+		self.assertEqual(open(self.project.normalized_count_matrices[0]).read(), 'ACGTACGTACGT')
+
+
+	def test_deleted_output_is_recreated(self):
+		self.pipeline.run()
+		os.remove(os.path.join(self.tmp_dir, 'B.counts'))
+		self.pipeline.run()
+		self.assertEqual(self.runs['star'], [['A', 'B']])
+		self.assertEqual(self.runs['feature_counts'], [['A', 'B'], ['B']])
+		self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'B.counts')))
+
+
+	def test_changed_parameter_reruns_everything(self):
+		self.pipeline.run()
+		self.project.parameters.reset_param('genome', 'mm10')
+		self.pipeline.run()
+		self.assertEqual(self.runs['star'], [['A', 'B'], ['A', 'B']])
+
+
+	def test_changed_conditions_only_rerun_cohort_steps(self):
+		self.pipeline.run()
+		self.project.samples[1].condition = 'Y'
+		self.pipeline.run()
+		self.assertEqual(self.runs['star'], [['A', 'B'], []])
+		self.assertEqual(self.runs['feature_counts'], [['A', 'B'], []])
+		self.assertEqual(len(self.runs['normalization']), 2)
+
+
+class TestStalenessChecker(unittest.TestCase):
+
+	def test_component_without_records_is_stale(self):
+		project = Project()
+		project.add_samples([Sample('A', 'X', bamfiles = [])])
+		project.contrasts = []
+		project.parameters = Params()
+		component = Component('feature_counts', '/path/to/fc', consumes = ['bam_files'], produces = ['raw_count_matrices'])
+		checker = StalenessChecker({'bam_files': ['bamfiles'], 'raw_count_matrices': ['countfiles']}, [])
+		self.assertEqual(sorted(checker.stale_cells(component, project)), [COHORT, 'A'])
+		checker.record(component, project)
+		self.assertEqual(checker.stale_cells(component, project), [])
+
+
+class TestOldPickles(unittest.TestCase):
+	"""
+	Pipelines pickled before the components had records and resources (and the project had stale samples) can still be restarted
+	"""
+
+	def old_pipeline(self):
+		project = Project()
+		project.add_parameters(Params())
+		project.add_samples([Sample('A', 'X', bamfiles = []), Sample('B', 'Y', bamfiles = [])])
+		project.contrasts = []
+		del project.stale_samples
+		del project.count_matrices
+		components = [Component(name, '/path/to/' + name) for name in ['star', 'feature_counts', 'deseq']]
+		for component in components:
+			for attribute in ['records', 'profile', 'consumes', 'produces']:
+				delattr(component, attribute)
+			component.completed = component.name != 'deseq'
+		pipeline = Pipeline()
+		pipeline.register_components(components)
+		pipeline.add_project(project)
+		del pipeline.run_started
+		return pickle.loads(pickle.dumps(pipeline))
+
+
+	def test_missing_attributes_are_filled(self):
+		pipeline = self.old_pipeline()
+		self.assertEqual(pipeline.project.stale_samples, {})
+		self.assertEqual(pipeline.project.count_matrices, {})
+		self.assertIsNone(pipeline.run_started)
+		self.assertEqual([s.sample_name for s in util_methods.get_samples_to_run(pipeline.project, 'deseq')], ['A', 'B'])
+		checker = StalenessChecker({'bam_files': ['bamfiles']}, [])
+		for component in pipeline.components:
+			self.assertEqual(component.records, {})
+			self.assertEqual(checker.stale_cells(component, pipeline.project), [COHORT])
+
+
+	def test_completed_components_are_not_run_again(self):
+		pipeline = self.old_pipeline()
+		checker = StalenessChecker({'bam_files': ['bamfiles']}, [])
+		star, feature_counts, deseq = pipeline.components
+		self.assertEqual(pipeline.get_stale_samples(star, checker), None)
+		self.assertEqual(pipeline.get_stale_samples(feature_counts, checker), None)
+		self.assertEqual(pipeline.get_stale_samples(deseq, checker), ['A', 'B'])
+		self.assertTrue(COHORT in star.records)
+
+
+	def test_components_run_in_their_old_order(self):
+		star, feature_counts, deseq = self.old_pipeline().components
+		pipeline = Pipeline()
+		self.assertTrue(pipeline.dependencies_met(star, [star, feature_counts, deseq]))
+		self.assertFalse(pipeline.dependencies_met(feature_counts, [star, feature_counts, deseq]))
+		self.assertFalse(pipeline.dependencies_met(deseq, [feature_counts, deseq]))
+		self.assertTrue(pipeline.dependencies_met(deseq, [deseq]))
+
+
+if __name__ == "__main__":
+	unittest.main()
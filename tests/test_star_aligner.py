@@ -12,6 +12,11 @@ sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 from utils.project import Project
 from utils.sample import Sample
 from utils.util_classes import Params
+from utils.resource_manager import ResourceManager
+import utils.resource_manager as resource_manager
+import threading
+import tempfile
+import shutil
 
 from component_tester import ComponentTester
 
@@ -43,9 +48,12 @@ class TestStarAligner(unittest.TestCase, ComponentTester):
 
 
 	def test_general_portion_of_template_injected_correctly(self):
-		template = 'STAR=%STAR%\nSAMTOOLS=%SAMTOOLS%\nPICARD_DIR=%PICARD_DIR%\nGTF=%GTF%\nGENOME_INDEX=%GENOME_INDEX%'
-		expected_result = 'STAR=STARPATH\nSAMTOOLS=SAM\nPICARD_DIR=PIC\nGTF=my.gtf\nGENOME_INDEX=GI'
+		template = 'STAR=%STAR%\nSAMTOOLS=%SAMTOOLS%\nPICARD_DIR=%PICARD_DIR%\nGTF=%GTF%\nGENOME_INDEX=%GENOME_INDEX%\nNUM_THREADS=%NUM_THREADS%\nGENOME_LOAD=%GENOME_LOAD%\nSORTED_BAM_MODE=%SORTED_BAM_MODE%\nSORT_THREADS=%SORT_THREADS%\nSORT_MEMORY=%SORT_MEMORY%\nBAM_COMPRESSION=%BAM_COMPRESSION%'
+		expected_result = 'STAR=STARPATH\nSAMTOOLS=SAM\nPICARD_DIR=PIC\nGTF=my.gtf\nGENOME_INDEX=GI\nNUM_THREADS=4\nGENOME_LOAD=NoSharedMemory\nSORTED_BAM_MODE=streamed\nSORT_THREADS=8\nSORT_MEMORY=10737418240\nBAM_COMPRESSION=6'
 		p = Params()
+		p.add(star_threads = '4')
+		p.add(genome_load_mode = 'NoSharedMemory')
+		p.add(sorted_bam_mode = 'streamed', sort_threads = '8', sort_memory = '10', bam_compression = '6')
 		p.add(star_align = 'STARPATH')
 		p.add(samtools = 'SAM')
 		p.add(gtf = 'my.gtf')
@@ -58,6 +66,133 @@ class TestStarAligner(unittest.TestCase, ComponentTester):
 		self.assertEqual( result, expected_result)
 
 
+	def test_shared_genome_mode_attaches_to_loaded_genome(self):
+		p = Params()
+		p.add(star_align = 'STARPATH', samtools = 'SAM', gtf = 'my.gtf', star_genome_index= 'GI', picard = 'PIC', star_threads = '4')
+		p.add(genome_load_mode = 'shared')
+		p.add(sorted_bam_mode = 'picard', sort_threads = '8', sort_memory = '10', bam_compression = '6')
+		myproject = Project()
+		myproject.parameters = p
+		template = 'STAR=%STAR%\nSAMTOOLS=%SAMTOOLS%\nPICARD_DIR=%PICARD_DIR%\nGTF=%GTF%\nGENOME_INDEX=%GENOME_INDEX%\nNUM_THREADS=%NUM_THREADS%\nGENOME_LOAD=%GENOME_LOAD%\nSORTED_BAM_MODE=%SORTED_BAM_MODE%\nSORT_THREADS=%SORT_THREADS%\nSORT_MEMORY=%SORT_MEMORY%\nBAM_COMPRESSION=%BAM_COMPRESSION%'
+		result = self.module.fill_out_general_template_portion(myproject, template)
+		self.assertTrue('GENOME_LOAD=LoadAndKeep' in result)
+
+
+	def test_job_memory_reservation(self):
+		"""
+		The memory reserved per alignment depends on whether the genome is shared and whether STAR sorts the BAM itself
+		"""
+		p = Params()
+		p.add(min_memory = '40', shared_genome_job_memory = '8', sort_memory = '10')
+		p.add(genome_load_mode = 'NoSharedMemory', sorted_bam_mode = 'picard')
+		self.assertEqual(self.module.get_job_memory(p), 40.0)
+		p.reset_param('sorted_bam_mode', 'streamed')
+		self.assertEqual(self.module.get_job_memory(p), 50.0)
+		p.reset_param('genome_load_mode', 'shared')
+		self.assertEqual(self.module.get_job_memory(p), 18.0)
+
+
+	def shared_genome_params(self):
+		p = Params()
+		p.add(output_location = '/path/to/output')
+		p.add(star_align = '/path/to/STAR')
+		p.add(star_genome_index = '/path/to/index')
+		p.add(shared_genome_dir = 'star_shared_genome')
+		p.add(shared_genome_marker = 'star_shared_genome.loaded')
+		return p
+
+
+	def test_only_required_bam_levels_are_registered(self):
+		p = Params()
+		myproject = Project()
+		myproject.parameters = p
+		s = Sample('A', 'X')
+		s.alignment_dir = '/path/to/A/star_align'
+		myproject.samples = [s]
+		glob_method = mock.Mock(side_effect = lambda pattern: [pattern])
+		self.module.register_bam_files(myproject, ['sort', 'sort.primary'], glob_method)
+		self.assertEqual(s.bamfiles, ['/path/to/A/star_align/A.sort.bam', '/path/to/A/star_align/A.sort.primary.bam'])
+
+
+	def test_missing_bam_level_raises_exception(self):
+		p = Params()
+		myproject = Project()
+		myproject.parameters = p
+		s = Sample('A', 'X')
+		s.alignment_dir = '/path/to/A/star_align'
+		myproject.samples = [s]
+		glob_method = mock.Mock(side_effect = lambda pattern: [] if pattern.endswith('primary.bam') else [pattern])
+		with self.assertRaises(self.module.BAMFileNotFoundException):
+			self.module.register_bam_files(myproject, ['sort', 'sort.primary'], glob_method)
+
+
+	def test_shared_genome_loaded_and_removed(self):
+		self.module.call_star_genome_load = mock.Mock(return_value = 0)
+		self.module.get_genome_memory = mock.Mock(return_value = 30.0)
+		resources = ResourceManager(100, 8)
+		m = mock.mock_open()
+		isfile = mock.Mock(side_effect = [False, True])
+		remove = mock.Mock()
+		with mock.patch.object(self.module.os.path, 'isfile', isfile):
+			with mock.patch.object(self.module.os, 'remove', remove):
+				with mock.patch('__builtin__.open', m):
+					with self.module.shared_genome(self.shared_genome_params(), resources):
+						# the single shared copy is reserved while the alignments run
+						self.assertEqual(resources.reserved_memory, 30.0)
+		calls = [mock.call(mock.ANY, 'LoadAndExit'), mock.call(mock.ANY, 'Remove')]
+		self.module.call_star_genome_load.assert_has_calls(calls)
+		m.assert_called_once_with('/path/to/output/star_shared_genome.loaded', 'w')
+		remove.assert_called_once_with('/path/to/output/star_shared_genome.loaded')
+		self.assertEqual(resources.reserved_memory, 0)
+
+
+	def test_shared_genome_removed_when_alignments_fail(self):
+		self.module.call_star_genome_load = mock.Mock(return_value = 0)
+		self.module.get_genome_memory = mock.Mock(return_value = 30.0)
+		resources = ResourceManager(100, 8)
+		m = mock.mock_open()
+		isfile = mock.Mock(side_effect = [False, True])
+		with mock.patch.object(self.module.os.path, 'isfile', isfile):
+			with mock.patch.object(self.module.os, 'remove', mock.Mock()):
+				with mock.patch('__builtin__.open', m):
+					with self.assertRaises(self.module.AlignmentScriptErrorException):
+						with self.module.shared_genome(self.shared_genome_params(), resources):
+							raise self.module.AlignmentScriptErrorException()
+		self.module.call_star_genome_load.assert_called_with(mock.ANY, 'Remove')
+		self.assertEqual(resources.reserved_memory, 0)
+
+
+	def test_stale_shared_genome_removed_on_restart(self):
+		"""
+		The marker file exists when starting, so a previous run must have died with the genome still loaded.  That copy is removed first.
+		"""
+		self.module.call_star_genome_load = mock.Mock(return_value = 0)
+		self.module.get_genome_memory = mock.Mock(return_value = 30.0)
+		isfile = mock.Mock(side_effect = [True, True])
+		with mock.patch.object(self.module.os.path, 'isfile', isfile):
+			with mock.patch.object(self.module.os, 'remove', mock.Mock()):
+				with mock.patch('__builtin__.open', mock.mock_open()):
+					with self.module.shared_genome(self.shared_genome_params(), ResourceManager(100, 8)):
+						pass
+		calls = [mock.call(mock.ANY, 'Remove'), mock.call(mock.ANY, 'LoadAndExit'), mock.call(mock.ANY, 'Remove')]
+		self.assertEqual(self.module.call_star_genome_load.call_args_list, calls)
+
+
+	def test_stale_shared_genome_which_cannot_be_removed_is_kept(self):
+		self.module.call_star_genome_load = mock.Mock(return_value = 1)
+		self.module.get_genome_memory = mock.Mock(return_value = 30.0)
+		remove = mock.Mock()
+		resources = ResourceManager(100, 8)
+		with mock.patch.object(self.module.os.path, 'isfile', mock.Mock(return_value = True)):
+			with mock.patch.object(self.module.os, 'remove', remove):
+				with self.assertRaises(self.module.SharedGenomeException):
+					with self.module.shared_genome(self.shared_genome_params(), resources):
+						self.fail('The alignments started.')
+		self.assertEqual(self.module.call_star_genome_load.call_args_list, [mock.call(mock.ANY, 'Remove')])
+		self.assertFalse(remove.called)
+		self.assertEqual(resources.reserved_memory, 0)
+
+
 	def test_sample_specific_template_injected_correctly_for_single_end_alignment(self):
 		sample_template = 'FASTQFILEA=%FASTQFILEA%\nFASTQFILEB=%FASTQFILEB%\nSAMPLE_NAME=%SAMPLE_NAME%\nPAIRED=%PAIRED%\nOUTDIR=%OUTDIR%\nFCID=%FCID%\nLANE=%LANE%\nINDEX=%INDEX%\n'
 		expected_result = 'FASTQFILEA=/path/to/ABC_r1_001.fastq.gz\nFASTQFILEB=\nSAMPLE_NAME=ABC\nPAIRED=0\nOUTDIR=/path/to/aln\nFCID=DEFAULT\nLANE=0\nINDEX=DEFAULT_INDEX\n'
@@ -82,123 +217,181 @@ class TestStarAligner(unittest.TestCase, ComponentTester):
 		self.assertEqual(result, expected_result)
 
 
-	def test_alignment_calls(self):
-
-		mock_process = mock.Mock(name='mock_process')
-		mock_process.communicate.return_value = (('',''))
-		mock_process.returncode = 0
+	def mock_runner(self, returncode = 0, run = None):
+		runner = mock.Mock(name='mock_runner')
+		runner.run.return_value = mock.Mock(returncode = returncode)
+		if run:
+			runner.run.side_effect = run
+		self.module.os.chmod = mock.Mock()
+		return runner
 
-		mock_popen = mock.Mock(name='mock_popen')
-		mock_popen.return_value = mock_process
-		
-		self.module.subprocess = mock.Mock()
-		self.module.subprocess.Popen = mock_popen
-		self.module.subprocess.STDOUT = ''
-		self.module.subprocess.PIPE = ''
 
-		self.module.os.chmod = mock.Mock()
-		self.module.assert_memory_reasonable = mock.Mock()
-		self.module.assert_memory_reasonable.return_value = True
+	def test_alignment_calls(self):
+		runner = self.mock_runner()
 		p = Params()
-		p.add(wait_length = '10')
-		p.add(wait_cycles = '50')
 		p.add(min_memory = '40')
-		paths = ['/path/to/a.sh', '/path/to/b.sh']
-		self.module.execute_alignments(paths, p)
+		p.add(star_threads = '4')
+		paths = ['/path/to/a.star_align.sh', '/path/to/b.star_align.sh']
+		self.module.execute_alignments(paths, p, ResourceManager(200, 32), runner)
 
-		calls = [mock.call('/path/to/a.sh', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE),
-			mock.call('/path/to/b.sh', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)]
-		self.module.subprocess.Popen.assert_has_calls(calls)
+		calls = [mock.call('a.star_align', '/path/to/a.star_align.sh', progress_parsers = [self.module.parse_star_progress], memory = 40.0, cpus = 4),
+			mock.call('b.star_align', '/path/to/b.star_align.sh', progress_parsers = [self.module.parse_star_progress], memory = 40.0, cpus = 4)]
+		runner.run.assert_has_calls(calls, any_order = True)
 
 
 	def test_alignment_call_raises_exception(self):
-		import subprocess
-
-		mock_process = mock.Mock(name='mock_process')
-		mock_process.communicate.return_value = (('',''))
-		mock_process.returncode = 1
-
-		mock_popen = mock.Mock(name='mock_popen')
-		mock_popen.return_value = mock_process
-		
-		self.module.subprocess = mock.Mock()
-		self.module.subprocess.Popen = mock_popen
-		self.module.subprocess.STDOUT = ''
-		self.module.subprocess.PIPE = ''
-
-		self.module.os.chmod = mock.Mock()
-		self.module.assert_memory_reasonable = mock.Mock()
-		self.module.assert_memory_reasonable.return_value = True
+		"""
+		Only enough memory for one alignment at a time, so the failure of the first one should stop the second from starting
+		"""
+		runner = self.mock_runner(returncode = 1)
 		p = Params()
-		p.add(wait_length = '10')
-		p.add(wait_cycles = '50')
 		p.add(min_memory = '40')
+		p.add(star_threads = '4')
 		paths = ['/path/to/a.sh', '/path/to/b.sh']
+		resources = ResourceManager(40, 32)
 		with self.assertRaises(self.module.AlignmentScriptErrorException):
-			self.module.execute_alignments(paths, p)
+			self.module.execute_alignments(paths, p, resources, runner)
 
 		# assert that the second script was not called due to the first one failing.
-		calls = [mock.call('/path/to/a.sh', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)]
-		self.module.subprocess.Popen.assert_has_calls(calls)
+		runner.run.assert_called_once_with('a', '/path/to/a.sh', progress_parsers = [self.module.parse_star_progress], memory = 40.0, cpus = 4)
 
+		# and everything was released:
+		self.assertEqual(resources.reserved_memory, 0)
+		self.assertEqual(resources.reserved_cpus, 0)
 
-	def test_alignment_call_waits_properly(self):
-		import subprocess
 
-		mock_process = mock.Mock(name='mock_process')
-		mock_process.communicate.return_value = (('',''))
-		mock_process.returncode = 0
+	def test_failed_journal_check_counts_as_failed_alignment(self):
+		runner = self.mock_runner()
+		p = Params()
+		p.add(min_memory = '40')
+		p.add(star_threads = '4')
+		journaled = []
+		def on_success(script_path):
+			if script_path == '/path/to/b.sh':
+				raise Exception('Missing BAM file')
+			journaled.append(script_path)
+		with self.assertRaises(self.module.AlignmentScriptErrorException):
+			self.module.execute_alignments(['/path/to/a.sh', '/path/to/b.sh'], p, ResourceManager(200, 32), runner, on_success = on_success)
+		self.assertEqual(journaled, ['/path/to/a.sh'])
+
+
+	def create_aligned_sample(self, tmp_dir, levels):
+		s = Sample('A', 'X', read_1_fastq = os.path.join(tmp_dir, 'A_R1.fastq.gz'))
+		s.alignment_dir = tmp_dir
+		files = [s.read_1_fastq, os.path.join(tmp_dir, 'A.Log.final.out')]
+		for level in levels:
+			files += [os.path.join(tmp_dir, 'A.%s.bam' % level), os.path.join(tmp_dir, 'A.%s.bam.bai' % level)]
+		for f in files:
+			with open(f, 'w') as fout:
+				fout.write('                          Uniquely mapped reads % |	85.12%\n')
+		return s
+
+
+	def test_journal_records_finished_alignment(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			p = Params()
+			p.add(journal_suffix = 'align.done')
+			s = self.create_aligned_sample(tmp_dir, ['sort', 'sort.primary'])
+			self.assertFalse(self.module.journal_entry_valid(s, p, ['sort', 'sort.primary']))
+			self.module.write_journal_entry(s, p, ['sort', 'sort.primary'])
+			self.assertTrue(self.module.journal_entry_valid(s, p, ['sort', 'sort.primary']))
+
+			# if the reads are replaced, the sample has to be aligned again:
+			with open(s.read_1_fastq, 'w') as f:
+				f.write('new reads')
+			self.assertFalse(self.module.journal_entry_valid(s, p, ['sort', 'sort.primary']))
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_journal_not_written_for_incomplete_alignment(self):
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			p = Params()
+			p.add(journal_suffix = 'align.done')
+			s = self.create_aligned_sample(tmp_dir, ['sort'])
+			with self.assertRaises(self.module.BAMFileNotFoundException):
+				self.module.write_journal_entry(s, p, ['sort', 'sort.primary'])
+			self.assertFalse(os.path.isfile(os.path.join(tmp_dir, 'A.align.done')))
+		finally:
+			shutil.rmtree(tmp_dir)
+
+
+	def test_concurrent_alignments_limited_by_memory(self):
+		"""
+		With 100GB and 40GB per alignment, at most two alignments should be running at any time
+		"""
+		lock = threading.Lock()
+		state = {'running':0, 'max':0}
+		def run(label, command, **kwargs):
+			with lock:
+				state['running'] += 1
+				state['max'] = max(state['max'], state['running'])
+			threading.Event().wait(0.05)
+			with lock:
+				state['running'] -= 1
+			return mock.Mock(returncode = 0)
+
+		runner = self.mock_runner(run = run)
+		p = Params()
+		p.add(min_memory = '40')
+		p.add(star_threads = '4')
+		paths = ['/path/to/%s.sh' % x for x in 'abcdef']
+		self.module.execute_alignments(paths, p, ResourceManager(100, 32), runner)
+		self.assertEqual(runner.run.call_count, 6)
+		self.assertEqual(state['max'], 2)
+
+
+	def test_concurrent_alignments_limited_by_cpus(self):
+		lock = threading.Lock()
+		state = {'running':0, 'max':0}
+		def run(label, command, **kwargs):
+			with lock:
+				state['running'] += 1
+				state['max'] = max(state['max'], state['running'])
+			threading.Event().wait(0.05)
+			with lock:
+				state['running'] -= 1
+			return mock.Mock(returncode = 0)
+
+		runner = self.mock_runner(run = run)
+		p = Params()
+		p.add(min_memory = '40')
+		p.add(star_threads = '8')
+		paths = ['/path/to/%s.sh' % x for x in 'abcdef']
+		self.module.execute_alignments(paths, p, ResourceManager(1000, 24), runner)
+		self.assertEqual(state['max'], 3)
 
-		mock_popen = mock.Mock(name='mock_popen')
-		mock_popen.return_value = mock_process
-		
-		self.module.subprocess = mock.Mock()
-		self.module.subprocess.Popen = mock_popen
-		self.module.subprocess.STDOUT = ''
-		self.module.subprocess.PIPE = ''
 
-		self.module.os.chmod = mock.Mock()
-		self.module.assert_memory_reasonable = mock.Mock()
-		self.module.sleep = mock.Mock()
-		self.module.assert_memory_reasonable.side_effect = [False, False, True, True]
+	def test_batch_alignments_are_all_admitted_at_once(self):
+		runner = self.mock_runner()
+		runner.scheduler = mock.Mock()
 		p = Params()
-		p.add(wait_length = '10')
-		p.add(wait_cycles = '50')
-		p.add(min_memory = '40')
-		paths = ['/path/to/a.sh', '/path/to/b.sh']
-			
-		self.module.execute_alignments(paths, p)
+		p.add(star_threads = '4', genome_load_mode = 'NoSharedMemory')
+		resources = self.module.create_alignment_resources(p, resource_manager, runner, 100, 40.0)
+		self.assertEqual((resources.total_memory, resources.total_cpus), (4000.0, 400))
 
-		# assert that the script was eventually called.
-		calls = [mock.call('/path/to/a.sh', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE),
-			mock.call('/path/to/b.sh', shell=True, stderr=self.module.subprocess.STDOUT, stdout=self.module.subprocess.PIPE)]
-		self.module.subprocess.Popen.assert_has_calls(calls)
+		p.reset_param('genome_load_mode', 'shared')
+		with self.assertRaises(self.module.SharedGenomeException):
+			self.module.create_alignment_resources(p, resource_manager, runner, 100, 40.0)
 
-		# assert that it had to wait twice (via calling sleep() twice)
-		calls = [mock.call(600), mock.call(600)]
-		self.module.sleep.assert_has_calls(calls)
-	
 
-	def test_alignment_call_timesout_properly(self):
-		import subprocess
-		self.module.subprocess = mock.Mock()
-		self.module.os.chmod = mock.Mock()
-		self.module.assert_memory_reasonable = mock.Mock()
-		self.module.sleep = mock.Mock()
-		self.module.assert_memory_reasonable.side_effect = [False, False, False, False]
-		p = Params()
-		p.add(wait_length = '10')
-		p.add(wait_cycles = '3')
-		p.add(min_memory = '40')
-		paths = ['/path/to/a.sh']
-			
-		with self.assertRaises(self.module.AlignmentTimeoutException):
-			self.module.execute_alignments(paths, p)
+	def test_star_progress_is_picked_out_of_script_output(self):
+		self.assertEqual(self.module.parse_star_progress('Oct 17 10:15:02 ..... started mapping\n'), 'STAR started mapping')
+		self.assertIsNone(self.module.parse_star_progress('Sorting the BAM file\n'))
 
 
-		# assert that it had to wait the proper amount of times (via calling sleep())
-		calls = [mock.call(600), mock.call(600), mock.call(600)]
-		self.module.sleep.assert_has_calls(calls)
+	def test_alignment_too_large_for_node_runs_alone(self):
+		runner = self.mock_runner()
+		p = Params()
+		p.add(min_memory = '40')
+		p.add(star_threads = '4')
+		paths = ['/path/to/a.sh', '/path/to/b.sh']
+		resources = ResourceManager(30, 2)
+		self.module.execute_alignments(paths, p, resources, runner)
+		self.assertEqual(runner.run.call_count, 2)
+		self.assertEqual((resources.reserved_memory, resources.reserved_cpus), (0, 0))
 	
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import mock
+import sys
+import threading
+
+# for finding modules in the sibling directories
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils import task_executor
+from utils.task_executor import SampleTaskExecutor, get_worker_count, get_cpu_slots
+from utils.resource_manager import ResourceManager
+from utils.util_classes import Params
+from utils.custom_exceptions import *
+
+
+class TestSampleTaskExecutor(unittest.TestCase):
+
+	def test_results_are_mapped_to_labels(self):
+		executor = SampleTaskExecutor(2)
+		for i in range(5):
+			executor.submit('sample_%d' % i, lambda x: x*x, i)
+		results = executor.wait()
+		self.assertEqual(results, {'sample_%d' % i: i*i for i in range(5)})
+
+
+	def test_number_of_workers_is_bounded(self):
+		lock = threading.Lock()
+		state = {'running':0, 'max':0}
+		def f():
+			with lock:
+				state['running'] += 1
+				state['max'] = max(state['max'], state['running'])
+			threading.Event().wait(0.02)
+			with lock:
+				state['running'] -= 1
+
+		executor = SampleTaskExecutor(3)
+		for i in range(10):
+			executor.submit(i, f)
+		executor.wait()
+		self.assertTrue(state['max'] <= 3)
+		self.assertTrue(state['max'] > 1)
+
+
+	def test_all_failures_are_reported_together(self):
+		"""
+		Two of the four tasks fail-- the other tasks should still run and both failures should be in the exception
+		"""
+		def f(x):
+			if x % 2 == 1:
+				raise Exception('failed on %d' % x)
+			completed.append(x)
+
+		completed = []
+		executor = SampleTaskExecutor(2)
+		for i in range(4):
+			executor.submit('sample_%d' % i, f, i)
+		with self.assertRaises(SampleTaskException) as cm:
+			executor.wait()
+		self.assertEqual(sorted(completed), [0, 2])
+		self.assertEqual([label for label, ex in cm.exception.failures], ['sample_1', 'sample_3'])
+		self.assertTrue('sample_1' in cm.exception.message and 'sample_3' in cm.exception.message)
+
+
+	@mock.patch('utils.task_executor.multiprocessing')
+	def test_worker_count_defaults_to_available_cores(self, mock_mp):
+		mock_mp.cpu_count.return_value = 32
+		p = Params()
+		self.assertEqual(get_worker_count(p), 32)
+		p.add(max_sample_workers = '0')
+		self.assertEqual(get_worker_count(p), 32)
+		p.reset_param('max_sample_workers', '8')
+		self.assertEqual(get_worker_count(p), 8)
+
+
+	def test_executors_share_the_cpu_slots(self):
+		lock = threading.Lock()
+		state = {'cpus':0, 'max':0}
+		def f(cpus):
+			with lock:
+				state['cpus'] += cpus
+				state['max'] = max(state['max'], state['cpus'])
+			threading.Event().wait(0.02)
+			with lock:
+				state['cpus'] -= cpus
+
+		# each executor could run 4 tasks, but together they only have 4 cores; the tasks needing 8 cores are given all 4:
+		cpu_slots = ResourceManager(0, 4)
+		executors = [SampleTaskExecutor(4, cpu_slots), SampleTaskExecutor(4, cpu_slots), SampleTaskExecutor(4, cpu_slots, 8)]
+		for executor, cpus in zip(executors, [1, 1, 4]):
+			for i in range(6):
+				executor.submit(i, f, cpus)
+		threads = [threading.Thread(target = executor.wait) for executor in executors]
+		[t.start() for t in threads]
+		[t.join() for t in threads]
+		self.assertEqual(state['max'], 4)
+		self.assertEqual(cpu_slots.reserved_cpus, 0)
+
+
+	def test_cpu_slots_are_shared_by_the_local_executors(self):
+		p = Params()
+		p.add(job_backend = 'local', sample_task_cpus = '6')
+		with mock.patch.object(task_executor, 'CPU_SLOTS', None):
+			cpu_slots = get_cpu_slots(p)
+			self.assertEqual(cpu_slots.total_cpus, 6)
+			self.assertTrue(get_cpu_slots(p) is cpu_slots)
+		p.reset_param('job_backend', 'sge')
+		self.assertEqual(get_cpu_slots(p), None)
+
+
+	def test_failures_are_not_shared_between_exceptions(self):
+		first = SampleTaskException('first')
+		first.failures.append(('sample_1', Exception()))
+		self.assertEqual(SampleTaskException('second').failures, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
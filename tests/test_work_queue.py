@@ -0,0 +1,178 @@
+import logging
+logging.disable(logging.CRITICAL)
+
+import unittest
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import threading
+
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+
+from utils.process_runner import ProcessRunner
+from utils.batch_scheduler import create_scheduler
+from utils.work_queue import WorkQueue, QueueWorker, requeue_expired, create_queue_dirs, PENDING, CLAIMED, DONE
+from utils.resource_manager import ResourceManager
+from utils.util_classes import Params
+import utils.cmd_line_parser as cl_parser
+
+
+class TestWorkQueue(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.queue_dir = os.path.join(self.tmp_dir, 'work_queue')
+		self.log_dir = os.path.join(self.tmp_dir, 'task_logs')
+		self.queue = WorkQueue(self.queue_dir, os.path.join(self.log_dir, 'jobs'), poll_interval = 0.05, lease_timeout = 60)
+
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+
+	def start_worker(self, memory = 8, cpus = 4, **kwargs):
+		settings = {'poll_interval': 0.05, 'heartbeat_interval': 0.05, 'lease_timeout': 60, 'idle_timeout': 0.5}
+		settings.update(kwargs)
+		worker = QueueWorker(self.queue_dir, ResourceManager(memory, cpus), **settings)
+		thread = threading.Thread(target = worker.serve)
+		thread.start()
+		return worker, thread
+
+
+	def run_tasks(self, runner, tasks):
+		results = {}
+		def run(i, args, kwargs):
+			results[i] = runner.run(*args, **kwargs)
+		threads = [threading.Thread(target = run, args = (i, args, kwargs)) for i, (args, kwargs) in enumerate(tasks)]
+		[t.start() for t in threads]
+		[t.join() for t in threads]
+		return results
+
+
+	def test_workers_run_queued_tasks(self):
+		runner = ProcessRunner(self.log_dir, scheduler = self.queue)
+		workers = [self.start_worker(), self.start_worker()]
+		output_path = os.path.join(self.tmp_dir, 'coverage.txt')
+		results = self.run_tasks(runner, [(('sample_%d' % i, 'echo counting sample %d; exit %d' % (i, 3 if i == 2 else 0)), {}) for i in range(3)]
+			+ [(('coverage', ['sh', '-c', 'echo chr1 0 10 5; echo warning 1>&2']), {'stdout_path': output_path})])
+		[t.join() for w, t in workers]
+
+		self.assertEqual([results[i].returncode for i in range(4)], [0, 0, 3, 0])
+		self.assertEqual(results[1].tail, ['counting sample 1'])
+		self.assertEqual(open(results[1].log_path).read().splitlines()[1:], ['counting sample 1'])
+		self.assertTrue(results[0].max_rss > 0)
+		self.assertEqual(open(output_path).read(), 'chr1 0 10 5\n')
+		self.assertEqual(results[3].tail, ['warning'])
+		for state in [PENDING, CLAIMED, DONE]:
+			self.assertEqual([f for f in os.listdir(os.path.join(self.queue_dir, state)) if f.endswith('.json')], [])
+
+
+	def test_worker_only_claims_tasks_which_fit(self):
+		runner = ProcessRunner(self.log_dir, scheduler = self.queue)
+		worker, thread = self.start_worker(memory = 8, cpus = 4)
+		timing_path = os.path.join(self.tmp_dir, 'timing')
+		command = 'echo "start $(date +%%s.%%N)" >> %s; sleep 0.3; echo "end $(date +%%s.%%N)" >> %s' % (timing_path, timing_path)
+		results = self.run_tasks(runner, [(('align_%d' % i, command), {'memory': 5, 'cpus': 2}) for i in range(2)])
+		thread.join()
+
+		self.assertEqual([r.returncode for r in results.values()], [0, 0])
+		# the memory only fits one alignment at a time, so the first one ends before the second starts:
+		events = [line.split()[0] for line in open(timing_path).read().splitlines()]
+		self.assertEqual(events, ['start', 'end', 'start', 'end'])
+
+
+	def test_lost_task_is_requeued_then_failed(self):
+		create_queue_dirs(self.queue_dir)
+		name = '0000000000.000000.1.align_S1.json'
+		claimed_path = os.path.join(self.queue_dir, CLAIMED, name)
+		with open(claimed_path, 'w') as f:
+			json.dump({'label': 'align_S1', 'command': 'true', 'attempts': 0, 'worker': 'node1.123'}, f)
+
+		# the lease is still fresh:
+		self.assertEqual(requeue_expired(self.queue_dir, 60, 2), 0)
+
+		os.utime(claimed_path, (time.time() - 120, time.time() - 120))
+		self.assertEqual(requeue_expired(self.queue_dir, 60, 2), 1)
+		self.assertFalse(os.path.exists(claimed_path))
+		record = json.load(open(os.path.join(self.queue_dir, PENDING, name)))
+		self.assertEqual((record['attempts'], 'worker' in record), (1, False))
+
+		os.rename(os.path.join(self.queue_dir, PENDING, name), claimed_path)
+		os.utime(claimed_path, (time.time() - 120, time.time() - 120))
+		requeue_expired(self.queue_dir, 60, 2)
+		self.assertFalse(os.path.exists(os.path.join(self.queue_dir, PENDING, name)))
+		self.assertEqual(json.load(open(os.path.join(self.queue_dir, DONE, name)))['returncode'], 1)
+
+
+	def test_late_result_does_not_replace_a_newer_attempt(self):
+		create_queue_dirs(self.queue_dir)
+		name = '0000000000.000000.1.align_S1.json'
+		claimed_path = os.path.join(self.queue_dir, CLAIMED, name)
+		done_path = os.path.join(self.queue_dir, DONE, name)
+		worker = QueueWorker(self.queue_dir, ResourceManager(8, 4))
+		record = {'label': 'align_S1', 'command': 'true', 'attempts': 1, 'worker': 'node2.456'}
+		result = {'returncode': 0, 'start': 1.0, 'end': 2.0, 'worker': worker.name}
+
+		# the task was taken for lost while this worker ran it, and another worker has claimed it since:
+		with open(claimed_path, 'w') as f:
+			json.dump(record, f)
+		worker.leave_result(name, record, result)
+		self.assertEqual(json.load(open(claimed_path))['worker'], 'node2.456')
+		self.assertFalse(os.path.exists(done_path))
+
+		# the task has been requeued, but nobody has claimed it again yet:
+		os.rename(claimed_path, os.path.join(self.queue_dir, PENDING, name))
+		worker.leave_result(name, record, result)
+		self.assertEqual(json.load(open(done_path))['returncode'], 0)
+		self.assertEqual(os.listdir(os.path.join(self.queue_dir, PENDING)), [])
+
+		# the pipeline has picked up the result already:
+		os.remove(done_path)
+		worker.leave_result(name, record, result)
+		self.assertFalse(os.path.exists(done_path))
+
+		# this worker's own claim:
+		record['worker'] = worker.name
+		with open(claimed_path, 'w') as f:
+			json.dump(record, f)
+		worker.leave_result(name, record, result)
+		self.assertFalse(os.path.exists(claimed_path))
+		self.assertEqual(json.load(open(done_path))['worker'], worker.name)
+
+
+	def test_task_of_dead_worker_is_run_again(self):
+		runner = ProcessRunner(self.log_dir, scheduler = WorkQueue(self.queue_dir, os.path.join(self.log_dir, 'jobs'), poll_interval = 0.05, lease_timeout = 0.5))
+		results = {}
+		coordinator = threading.Thread(target = lambda: results.update(sample_1 = runner.run('sample_1', 'echo counted')))
+		coordinator.start()
+		while not os.path.isdir(os.path.join(self.queue_dir, PENDING)) or not os.listdir(os.path.join(self.queue_dir, PENDING)):
+			time.sleep(0.01)
+
+		# a worker which claims the task and then dies (so never runs it, or renews its lease):
+		dead_worker = QueueWorker(self.queue_dir, ResourceManager(8, 4))
+		dead_worker.execute = lambda *args: None
+		dead_worker.claim_tasks()
+		self.assertEqual(len(os.listdir(os.path.join(self.queue_dir, CLAIMED))), 1)
+
+		worker, thread = self.start_worker(lease_timeout = 0.5, idle_timeout = 1.5)
+		coordinator.join()
+		thread.join()
+		self.assertEqual((results['sample_1'].returncode, results['sample_1'].tail), (0, ['counted']))
+
+
+	def test_queue_backend_and_worker_command(self):
+		p = Params()
+		p.add(job_backend = 'queue', output_location = self.tmp_dir, work_queue_dir = 'shared_queue', work_queue_poll_interval = '2')
+		queue = create_scheduler(p, self.log_dir)
+		self.assertEqual((queue.queue_dir, queue.job_dir, queue.poll_interval), (os.path.join(self.tmp_dir, 'shared_queue'), os.path.join(self.log_dir, 'jobs'), 2.0))
+
+		args = vars(cl_parser.setup_args().parse_args(['worker', '-o', self.tmp_dir, '-cpus', '8', '-idle', '600']))
+		self.assertEqual((args['worker_output_location'], args['worker_cpus'], args['worker_memory'], args['worker_idle_timeout']), (os.path.realpath(self.tmp_dir), 8, 0, 600))
+
+
+if __name__ == "__main__":
+	unittest.main()
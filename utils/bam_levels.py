@@ -0,0 +1,115 @@
+import logging
+import os
+import util_methods
+import process_runner
+from custom_exceptions import BamLevelException, ParameterNotFoundException
+
+
+# the filtering 'levels' of the BAM files, in order.  Each level is created from the one before it: the sorted BAM comes out
+# of the alignment, the primary-filtered BAM is made from the sorted BAM, and the deduplicated BAM from the primary-filtered BAM.
+BAM_LEVELS = ['sort', 'sort.primary', 'sort.primary.dedup']
+
+
+def get_required_levels(params):
+	"""
+	Returns the BAM levels that need to exist for this run: the level selected for downstream analysis (bam_filter_level), any
+	levels listed in extra_bam_levels, and the levels these are made from.  Since each level is made from the previous one, this
+	is always a leading portion of BAM_LEVELS.
+	"""
+	levels = [params.get('bam_filter_level')]
+	try:
+		levels.extend(util_methods.as_list(params.get('extra_bam_levels')))
+	except ParameterNotFoundException:
+		pass
+	unknown_levels = [l for l in levels if l not in BAM_LEVELS]
+	if unknown_levels:
+		logging.error('Unknown BAM levels: %s.  Choose from %s' % (unknown_levels, BAM_LEVELS))
+		raise BamLevelException('Unknown BAM level requested.  See log.')
+	deepest = max([BAM_LEVELS.index(l) for l in levels])
+	return BAM_LEVELS[:deepest + 1]
+
+
+def get_bam_path(alignment_dir, sample_name, level):
+	return os.path.join(alignment_dir, sample_name + '.' + level + '.bam')
+
+
+def find_bam(sample, level):
+	"""
+	Returns the path to the sample's BAM file at the given level, or None if the sample does not have one
+	"""
+	suffix = '.' + level.lower() + '.bam'
+	matches = [b for b in sample.bamfiles if b.lower().endswith(suffix) and os.path.isfile(b)]
+	if len(matches) > 0:
+		return matches[0]
+	return None
+
+
+def get_level_commands(params, source_bam, target_bam, level):
+	"""
+	Returns the shell commands which create target_bam (at the given level) from source_bam (at the level before it)
+	"""
+	samtools = params.get('samtools')
+	if level == 'sort.primary':
+		commands = ['%s view -b -F 0x0100 %s > %s' % (samtools, source_bam, target_bam)]
+	elif level == 'sort.primary.dedup':
+		picard_args = ['INPUT=' + source_bam,
+				'OUTPUT=' + target_bam,
+				'ASSUME_SORTED=TRUE',
+				'TMP_DIR=' + os.path.join(os.path.dirname(target_bam), 'tmp'),
+				'REMOVE_DUPLICATES=TRUE',
+				'METRICS_FILE=' + target_bam + '.metrics.out',
+				'VALIDATION_STRINGENCY=LENIENT']
+		commands = ['java -Xmx8g -jar %s %s' % (os.path.join(params.get('picard'), 'MarkDuplicates.jar'), ' '.join(picard_args))]
+	else:
+		logging.error('The %s BAM file is created by the aligner, and cannot be created from another BAM file.' % level)
+		raise BamLevelException('Cannot create BAM files at level %s.' % level)
+	commands.append('%s index %s' % (samtools, target_bam))
+	return commands
+
+
+def create_level(params, runner, sample, level):
+	"""
+	Creates the sample's BAM file at the given level (and any missing levels it is made from).  Returns the path to the new BAM file.
+	"""
+	previous_level = BAM_LEVELS[BAM_LEVELS.index(level) - 1]
+	source_bam = find_bam(sample, previous_level)
+	if not source_bam:
+		source_bam = create_level(params, runner, sample, previous_level)
+
+	target_bam = get_bam_path(os.path.dirname(source_bam), sample.sample_name, level)
+	for i, command in enumerate(get_level_commands(params, source_bam, target_bam, level)):
+		logging.info('Creating %s BAM for sample %s' % (level, sample.sample_name))
+		result = runner.run('%s.%s.%d' % (sample.sample_name, level, i), command)
+		if result.returncode != 0:
+			logging.error('Failed while creating the %s BAM file for sample %s' % (level, sample.sample_name))
+			raise BamLevelException('Could not create the %s BAM file for sample %s.  See log.' % (level, sample.sample_name))
+	sample.bamfiles = sample.bamfiles + [target_bam]
+	return target_bam
+
+
+def ensure_level(project, level):
+	"""
+	Makes sure every sample has a BAM file at the given level, creating any that are missing from the BAM files the sample already has.
+	Samples with no BAM file at any level (e.g. BAM files supplied with a custom naming scheme) are left alone.
+	Returns True if any BAM files were created.
+	"""
+	if level not in BAM_LEVELS:
+		logging.error('Unknown BAM level: %s.  Choose from %s' % (level, BAM_LEVELS))
+		raise BamLevelException('Unknown BAM level requested: %s' % level)
+
+	executor = util_methods.create_sample_executor(project.parameters)
+	runner = None
+	created = False
+	for sample in project.samples:
+		if find_bam(sample, level):
+			continue
+		if not any([find_bam(sample, l) for l in BAM_LEVELS[:BAM_LEVELS.index(level)]]):
+			logging.warning('Sample %s has no BAM file that a %s BAM file can be made from.' % (sample.sample_name, level))
+			continue
+		logging.info('Sample %s does not have a %s BAM file yet.  Creating it.' % (sample.sample_name, level))
+		if runner is None:
+			runner = process_runner.create_runner(project.parameters)
+		executor.submit(sample.sample_name, create_level, project.parameters, runner, sample, level)
+		created = True
+	executor.wait()
+	return created
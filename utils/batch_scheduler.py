@@ -0,0 +1,345 @@
+import logging
+import os
+import math
+import re
+import time
+import pipes
+import threading
+import subprocess
+from custom_exceptions import BatchJobException, ParameterNotFoundException
+import work_queue
+
+# the job backends (the 'job_backend' parameter) which submit the tools to a cluster scheduler, and how to talk to each scheduler.
+# 'submit' is the command which submits a job script and prints the job id; 'status' (followed by the job id) succeeds and prints
+# something while the job is queued or running, and fails with a message matching 'unknown_job' once the scheduler has forgotten the job
+# (any other failure of the status command says nothing about the job); 'cancel' (followed by the job id) removes the job.  The other
+# entries are the submit options for the job name, the array size, the file for the scheduler's own output, and the resources each task
+# needs.  'memory_per_cpu' is set if the scheduler takes the memory per slot (SGE's h_vmem), rather than for the whole task.
+SCHEDULERS = {
+	'sge': {'submit': 'qsub -terse -cwd -V -S /bin/bash',
+		'status': 'qstat -j',
+		'unknown_job': 'do not exist',
+		'cancel': 'qdel',
+		'name_option': '-N %s',
+		'array_option': '-t 1-%d',
+		'output_option': '-j y -o %s',
+		'resource_option': '-pe smp %(cpus)d -l h_vmem=%(memory)dG',
+		'memory_per_cpu': True,
+		'index_variable': 'SGE_TASK_ID'},
+	'slurm': {'submit': 'sbatch --parsable --export=ALL',
+		'status': 'squeue -h -j',
+		'unknown_job': 'Invalid job id',
+		'cancel': 'scancel',
+		'name_option': '--job-name=%s',
+		'array_option': '--array=1-%d',
+		'output_option': '--output=%s',
+		'resource_option': '--cpus-per-task=%(cpus)d --mem=%(memory)dG',
+		'memory_per_cpu': False,
+		'index_variable': 'SLURM_ARRAY_TASK_ID'}
+}
+
+LOCAL_BACKEND = 'local'
+
+# defaults, if the configuration does not set them:
+DEFAULT_POLL_INTERVAL = 30 # seconds
+DEFAULT_GATHER_WINDOW = 2 # seconds
+
+# the directory (in the task log directory) for the job scripts, the output of the tasks, and their exit status files
+JOB_DIR = 'jobs'
+
+# how long (in seconds) to wait for a finished job's exit status files to show up (a shared filesystem may be slow to show them)
+EXIT_FILE_TIMEOUT = 60
+
+# how many checks in a row the status command may fail (e.g. while the scheduler's master is busy) before the job is given up on
+MAX_STATUS_FAILURES = 10
+
+# the scheduler printed the job id first (e.g. '4242', '4242.1-10:1', or '4242;cluster')
+JOB_ID_PATTERN = re.compile('^\s*(\d+)')
+
+# runs one task of the job: the command, with its output (and stdout, if that goes to a file) redirected, then its exit status and
+# start/end times are written to the exit status file
+TASK_SCRIPT = """#!/bin/bash
+# %(label)s
+cd %(cwd)s
+START=$(date +%%s.%%N)
+( %(command)s ) %(redirection)s
+STATUS=$?
+echo "$STATUS $START $(date +%%s.%%N)" > %(exit_path)s.tmp
+mv %(exit_path)s.tmp %(exit_path)s
+"""
+
+# the job script: picks the task script by the scheduler's array index (which SGE sets to 'undefined' for jobs which are not arrays)
+JOB_SCRIPT = """#!/bin/bash
+TASK_ID=$%(index_variable)s
+case "$TASK_ID" in ''|undefined) TASK_ID=1 ;; esac
+TASKS=(%(task_scripts)s)
+exec /bin/bash ${TASKS[$((TASK_ID-1))]}
+"""
+
+
+class BatchTask(object):
+	"""
+	A command to run as (a task of) a batch job.  output_path gets the command's output (only stderr if stdout_path is given).
+	Once the job has finished, returncode, start, and end are filled in and 'finished' is set.  max_rss (MB), user_time, and system_time
+	are only filled in by backends which can measure them (see work_queue.py).
+	"""
+	def __init__(self, label, command, output_path, stdout_path = None, memory = None, cpus = None):
+		self.label = label
+		self.command = command
+		self.output_path = output_path
+		self.stdout_path = stdout_path
+		self.memory = memory
+		self.cpus = cpus
+		self.returncode = None
+		self.start = None
+		self.end = None
+		self.max_rss = None
+		self.user_time = None
+		self.system_time = None
+		self.finished = threading.Event()
+
+
+def get_optional_param(params, name, default):
+	try:
+		value = params.get(name)
+	except ParameterNotFoundException:
+		value = None
+	if value is None or value == () or value == '':
+		return default
+	return value
+
+
+def create_scheduler(params, log_dir):
+	"""
+	Returns a BatchScheduler for the 'job_backend' parameter, or None if the tools run locally.  The scheduler's commands can be
+	replaced with 'batch_submit_command', 'batch_status_command', and 'batch_cancel_command' (e.g. the full paths to qsub, etc.)
+	The 'queue' backend returns a WorkQueue instead, which runs the tools on the pipeline's own worker processes.
+	"""
+	backend = get_optional_param(params, 'job_backend', LOCAL_BACKEND)
+	if backend == LOCAL_BACKEND:
+		return None
+	if backend == work_queue.QUEUE_BACKEND:
+		return work_queue.create_work_queue(params, os.path.join(log_dir, JOB_DIR))
+	if backend not in SCHEDULERS:
+		logging.error('Unknown job_backend %s.  Choose from: %s' % (backend, ', '.join([LOCAL_BACKEND, work_queue.QUEUE_BACKEND] + sorted(SCHEDULERS.keys()))))
+		raise BatchJobException('Unknown job backend: %s' % backend)
+	settings = dict(SCHEDULERS[backend])
+	for command in ['submit', 'status', 'cancel']:
+		settings[command] = get_optional_param(params, 'batch_%s_command' % command, settings[command])
+	submit_options = get_optional_param(params, 'batch_submit_options', '')
+	if isinstance(submit_options, tuple):
+		submit_options = ','.join(submit_options)
+	return BatchScheduler(settings, os.path.join(log_dir, JOB_DIR),
+			submit_options = submit_options,
+			poll_interval = float(get_optional_param(params, 'batch_poll_interval', DEFAULT_POLL_INTERVAL)),
+			gather_window = float(get_optional_param(params, 'batch_gather_window', DEFAULT_GATHER_WINDOW)))
+
+
+class BatchScheduler(object):
+	"""
+	Runs commands as jobs on a cluster scheduler (SGE, SLURM, ...): writes a job script, submits it, polls the scheduler until the job
+	is gone, and collects the exit status and output the job left in the job directory (which must be on a filesystem the cluster nodes share).
+
+	run(...) blocks until the command has finished, like running it locally.  Commands which are run within gather_window seconds of
+	each other (e.g. by the threads of a SampleTaskExecutor, one per sample) and need the same resources are submitted together as an
+	array job, so a cohort is a single submission which the scheduler spreads over the cluster.
+	"""
+
+	def __init__(self, settings, job_dir, submit_options = '', poll_interval = DEFAULT_POLL_INTERVAL, gather_window = DEFAULT_GATHER_WINDOW):
+		self.settings = settings
+		self.job_dir = job_dir
+		self.submit_options = submit_options
+		self.poll_interval = poll_interval
+		self.gather_window = gather_window
+		self.condition = threading.Condition()
+		self.pending = []
+		self.last_added = 0
+		self.dispatching = False
+		self.job_count = 0
+
+
+	def run(self, task):
+		"""
+		Runs the BatchTask as (part of) a batch job and blocks until it has finished.  Returns the task.
+		"""
+		with self.condition:
+			self.pending.append(task)
+			self.last_added = time.time()
+			if not self.dispatching:
+				self.dispatching = True
+				dispatcher = threading.Thread(target = self.dispatch)
+				dispatcher.daemon = True
+				dispatcher.start()
+		task.finished.wait()
+		return task
+
+
+	def dispatch(self):
+		"""
+		Waits until no task has been added for gather_window seconds, then submits the pending tasks (as one array job for each set of resources)
+		"""
+		while True:
+			with self.condition:
+				remaining = self.last_added + self.gather_window - time.time()
+				if remaining <= 0:
+					tasks = self.pending
+					self.pending = []
+					self.dispatching = False
+					break
+			time.sleep(remaining)
+
+		groups = {}
+		for task in tasks:
+			groups.setdefault((task.memory, task.cpus), []).append(task)
+		for group in groups.values():
+			waiter = threading.Thread(target = self.run_job, args = (group,))
+			waiter.daemon = True
+			waiter.start()
+
+
+	def run_job(self, tasks):
+		"""
+		Submits the tasks as one job, waits for it, and collects the results.  If anything goes wrong, the tasks are marked as failed.
+		"""
+		try:
+			job_id = self.submit(tasks)
+			self.wait(job_id, tasks)
+			self.collect(tasks)
+		except Exception as ex:
+			logging.error('Batch job for %s failed: %s' % (', '.join([t.label for t in tasks]), ex))
+		finally:
+			for task in tasks:
+				if task.returncode is None:
+					task.returncode = 1
+				task.finished.set()
+
+
+	def job_name(self, tasks):
+		with self.condition:
+			self.job_count += 1
+			count = self.job_count
+		label = re.sub('[^\w.-]+', '_', tasks[0].label)
+		return '%s.%d' % (label, count) if len(tasks) == 1 else '%s.and_%d_more.%d' % (label, len(tasks) - 1, count)
+
+
+	def write_scripts(self, name, tasks):
+		"""
+		Writes a script for each task and the job script which runs them.  Returns the path to the job script.
+		"""
+		if not os.path.isdir(self.job_dir):
+			os.makedirs(self.job_dir)
+		task_scripts = []
+		for i, task in enumerate(tasks):
+			task_script = os.path.join(self.job_dir, '%s.%d.sh' % (name, i + 1))
+			if task.stdout_path:
+				redirection = '> %s 2> %s' % (pipes.quote(task.stdout_path), pipes.quote(task.output_path))
+			else:
+				redirection = '> %s 2>&1' % pipes.quote(task.output_path)
+			with open(task_script, 'w') as f:
+				f.write(TASK_SCRIPT % {'label': task.label,
+							'cwd': pipes.quote(os.getcwd()),
+							'command': task.command,
+							'redirection': redirection,
+							'exit_path': pipes.quote(self.exit_path(task))})
+			task_scripts.append(pipes.quote(task_script))
+		job_script = os.path.join(self.job_dir, name + '.sh')
+		with open(job_script, 'w') as f:
+			f.write(JOB_SCRIPT % {'index_variable': self.settings['index_variable'], 'task_scripts': ' '.join(task_scripts)})
+		os.chmod(job_script, 0775)
+		return job_script
+
+
+	def exit_path(self, task):
+		return task.output_path + '.exit'
+
+
+	def submit(self, tasks):
+		"""
+		Submits the tasks as a single job (an array job, if there is more than one task) and returns the job id
+		"""
+		name = self.job_name(tasks)
+		job_script = self.write_scripts(name, tasks)
+		for task in tasks:
+			if os.path.isfile(self.exit_path(task)):
+				os.remove(self.exit_path(task))
+
+		options = [self.settings['name_option'] % name, self.settings['output_option'] % pipes.quote(os.path.join(self.job_dir, name + '.scheduler.log'))]
+		if len(tasks) > 1:
+			options.append(self.settings['array_option'] % len(tasks))
+		if tasks[0].memory or tasks[0].cpus:
+			cpus = int(tasks[0].cpus or 1)
+			memory = float(tasks[0].memory or 1)
+			if self.settings.get('memory_per_cpu'):
+				memory /= cpus
+			options.append(self.settings['resource_option'] % {'memory': max(1, int(math.ceil(memory))), 'cpus': cpus})
+		command = ' '.join([self.settings['submit']] + options + [self.submit_options, pipes.quote(job_script)])
+		logging.info('Submitting %d task(s) as batch job %s: %s' % (len(tasks), name, command))
+		process = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		output = process.communicate()[0]
+		match = JOB_ID_PATTERN.search(output)
+		if process.returncode != 0 or not match:
+			logging.error('Could not submit batch job %s (exit status %d): %s' % (name, process.returncode, output))
+			raise BatchJobException('Could not submit batch job %s' % name)
+		logging.info('Batch job %s has id %s' % (name, match.group(1)))
+		return match.group(1)
+
+
+	def is_active(self, job_id):
+		"""
+		Returns True while the scheduler still knows about the job (i.e. it is queued or running), False once it does not, and None if
+		the status command failed for another reason
+		"""
+		process = subprocess.Popen('%s %s' % (self.settings['status'], job_id), shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		output = process.communicate()[0]
+		if process.returncode == 0:
+			return output.strip() != ''
+		if self.settings.get('unknown_job') and re.search(self.settings['unknown_job'], output):
+			return False
+		logging.warning('Could not check on batch job %s (exit status %d): %s' % (job_id, process.returncode, output.strip()))
+		return None
+
+
+	def wait(self, job_id, tasks):
+		"""
+		Polls the scheduler until the job is finished.  While the status command fails, the job counts as finished only once all of
+		its tasks have written their exit status files; after MAX_STATUS_FAILURES failures in a row, it is cancelled.  If waiting is interrupted
+		(e.g. the pipeline is stopped), the job is cancelled.
+		"""
+		try:
+			failures = 0
+			while True:
+				active = self.is_active(job_id)
+				if active is None:
+					failures += 1
+					if all([os.path.isfile(self.exit_path(task)) for task in tasks]):
+						break
+					if failures >= MAX_STATUS_FAILURES:
+						logging.error('Could not check on batch job %s %d times in a row-- giving up on it and cancelling it.' % (job_id, failures))
+						subprocess.call('%s %s' % (self.settings['cancel'], job_id), shell = True)
+						break
+				elif active:
+					failures = 0
+				else:
+					break
+				time.sleep(self.poll_interval)
+		except BaseException:
+			logging.error('Stopped waiting for batch job %s-- cancelling it.' % job_id)
+			subprocess.call('%s %s' % (self.settings['cancel'], job_id), shell = True)
+			raise
+
+
+	def collect(self, tasks):
+		"""
+		Reads the exit status and the start/end times of the tasks from their exit status files.  A task without one (e.g. if the
+		scheduler killed the job) counts as failed.
+		"""
+		deadline = time.time() + EXIT_FILE_TIMEOUT
+		for task in tasks:
+			while not os.path.isfile(self.exit_path(task)) and time.time() < deadline:
+				time.sleep(min(self.poll_interval, 1))
+			try:
+				with open(self.exit_path(task)) as f:
+					status, start, end = f.read().split()
+				task.returncode, task.start, task.end = int(status), float(start), float(end)
+			except (IOError, ValueError):
+				logging.error('Task %s of a batch job did not record an exit status (was it killed by the scheduler?)' % task.label)
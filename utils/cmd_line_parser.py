@@ -18,6 +18,8 @@ def setup_args():
 	run_subparser = subparsers.add_parser('run')
 	restart_subparser = subparsers.add_parser('restart')
 	continue_subparser = subparsers.add_parser('continue')
+	worker_subparser = subparsers.add_parser('worker')
+	query_subparser = subparsers.add_parser('query')
 
 	restart_subparser.add_argument("-pickle",
 				required=True,
@@ -45,6 +47,74 @@ def setup_args():
 				action=MakeAbsolutePathAction,
 				dest="annotation_file")
 
+	continue_subparser.add_argument("-level", "--bam-level",
+				required=False,
+				default=None,
+				choices=['sort','sort.primary','sort.primary.dedup'],
+				help="Change the filtering level of BAM file to use for downstream analysis.  Missing BAM files are created from the existing ones.",
+				dest="bam_filter_level")
+
+
+	worker_subparser.add_argument("-o", "--output",
+				required=True,
+				help="Full path to the output directory of the pipeline run (with job_backend = queue) whose tasks to run.",
+				action=MakeAbsolutePathAction,
+				dest="worker_output_location")
+
+	worker_subparser.add_argument("-cpus",
+				required=False,
+				default=0,
+				type=int,
+				help="The number of cpus the worker's tasks may use (default: all the cores of this machine).",
+				dest="worker_cpus")
+
+	worker_subparser.add_argument("-memory",
+				required=False,
+				default=0,
+				type=float,
+				help="The memory (in GB) the worker's tasks may use (default: the memory currently available on this machine).",
+				dest="worker_memory")
+
+	worker_subparser.add_argument("-idle",
+				required=False,
+				default=0,
+				type=float,
+				help="Stop after this many seconds without any tasks to run (default: keep running).",
+				dest="worker_idle_timeout")
+
+	query_subparser.add_argument("-db", "--database",
+				required=True,
+				help="Full path to the differential expression results of a run (by default, diff_exp_results.sqlite in its deseq output directory).",
+				action=MakeAbsolutePathAction,
+				dest="query_store")
+
+	query_subparser.add_argument("-gene",
+				required=False,
+				nargs="+",
+				default=None,
+				help="Show the results of these genes across all the contrasts.  Without it, the number of up- and down-regulated genes of each contrast is shown.",
+				dest="query_genes")
+
+	query_subparser.add_argument("-padj",
+				required=False,
+				default=0.05,
+				type=float,
+				help="For the numbers of up- and down-regulated genes: the largest adjusted p-value counted (default: 0.05).",
+				dest="query_padj")
+
+	query_subparser.add_argument("-lfc",
+				required=False,
+				default=0.0,
+				type=float,
+				help="For the numbers of up- and down-regulated genes: the log2 fold change a gene must exceed, either way (default: 0).",
+				dest="query_min_log2_fold_change")
+
+	query_subparser.add_argument("-level", "--bam-level",
+				required=False,
+				default=None,
+				choices=['sort','sort.primary','sort.primary.dedup'],
+				help="Only show the results for this BAM level.",
+				dest="query_bam_level")
 
 	run_subparser.add_argument("-d", "--dir", 
 				required=True, 
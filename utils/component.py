@@ -1,6 +1,7 @@
 import os
 import imp
 import logging
+from run_profile import Measurement
 
 class UnknownComponentTypeException(Exception):
 	pass
@@ -9,12 +10,15 @@ class Component(object):
 
 	COMPONENT_TYPES = ['STANDARD', 'ANALYSIS']
 
-	def __init__(self, name, directory, component_type = 'STANDARD'):
+	def __init__(self, name, directory, component_type = 'STANDARD', consumes = [], produces = []):
 		self.name = name
 		self.location = directory
 		self.project = None
-		self.completed = False # keeps track of whether the component has been executed successfully.
+		self.records = {} # what the component read, used and wrote for each sample (and the cohort) when it last ran successfully.  See staleness.py
 		self.outputs = [] 
+		self.consumes = list(consumes) # names of the resources (e.g. 'bam_files') this component needs before it can run
+		self.produces = list(produces) # names of the resources this component makes available to others
+		self.profile = None # the time, cpu, and I/O used by the last run.  See run_profile.py
 
 		if component_type in Component.COMPONENT_TYPES:
 			self.component_type = component_type
@@ -22,9 +26,25 @@ class Component(object):
 			raise UnknownComponentTypeException('Exception when setting the type of Component object.  The value %s was passed, and the acceptable values are %s.' % (t, COMPONENT_TYPES))
 
 
+	def __setstate__(self, state):
+		"""
+		Fills in the attributes that components pickled by older versions do not have.  Those only kept whether they had completed, which
+		stays set: the pipeline records a completed component as it finds it (see Pipeline.get_stale_samples), so it is not run again.  Their
+		resources are unknown (None) until Pipeline.__setstate__ orders the components as they were run then.
+		"""
+		self.__dict__.update(state)
+		self.__dict__.setdefault('records', {})
+		self.__dict__.setdefault('completed', False)
+		self.__dict__.setdefault('profile', None)
+		self.__dict__.setdefault('consumes', None)
+		self.__dict__.setdefault('produces', None)
+
+
 	def __str__(self):
 		s = 'Component name: ' + str(self.name) + '\n'
-		s += 'location: '+str(self.location)
+		s += 'location: '+str(self.location) + '\n'
+		s += 'consumes: '+str(self.consumes) + '\n'
+		s += 'produces: '+str(self.produces)
 		return s
 
 
@@ -50,13 +70,19 @@ class Component(object):
 		# import the method from module
 		try:
 			logging.info('Attempting to locate and load module for component: %s in %s ' % (self.name, self.location))
+			# every plugin script shares the same name, so load it under a name unique to this component.  Otherwise, components
+			# running at the same time would re-initialize each other's module
 			fileobj, filename, description = imp.find_module(module_name, [self.location])
-			module = imp.load_module(module_name, fileobj, filename, description)
+			module = imp.load_module(self.name + '_' + module_name, fileobj, filename, description)
 			
 			run_method = getattr(module, method_name)
 
 			# run the component and add the output objects to this object:
-			self.outputs.extend(run_method(self.name, self.project))
+			measurement = Measurement()
+			try:
+				self.outputs.extend(run_method(self.name, self.project))
+			finally:
+				self.profile = measurement.finish()
 
 		except ImportError as ex:
 			logging.error('ImportError: Could not load the module at %s ' % filename)
@@ -1,4 +1,6 @@
 import util_methods
+import bam_levels
+import staleness
 import logging
 import itertools
 
@@ -9,10 +11,41 @@ class MissingAnnotationException(Exception):
 	pass
 
 
-def configure_for_restart(configured_pipeline, annotation_filepath = None, contrast_filepath = None):
+def change_bam_level(configured_pipeline, bam_filter_level):
+	"""
+	Switches the downstream analysis to a different BAM level.  Any missing BAM files at that level are created from the existing BAM files.
+	Samples which gained a BAM file are re-run by the components reading the BAM files, since their inputs changed.  The project-wide work of those
+	components (and anything using their results) is marked to run again, since it depends on which level is selected.
+	"""
+	project = configured_pipeline.project
+	if bam_filter_level == project.parameters.get('bam_filter_level'):
+		return
+
+	logging.info('Changing the BAM level from %s to %s' % (project.parameters.get('bam_filter_level'), bam_filter_level))
+	project.parameters.reset_param('bam_filter_level', bam_filter_level)
+	bam_levels.ensure_level(project, bam_filter_level)
+
+	stale_resources = set(['bam_files'])
+	rerun_components = set()
+	changed = True
+	while changed:
+		changed = False
+		for component in configured_pipeline.components:
+			if component.name not in rerun_components and any([r in stale_resources for r in component.consumes]):
+				logging.info('Component %s will be run for the new BAM level.' % component.name)
+				component.records.pop(staleness.COHORT, None)
+				rerun_components.add(component.name)
+				stale_resources.update(component.produces)
+				changed = True
+
+
+def configure_for_restart(configured_pipeline, annotation_filepath = None, contrast_filepath = None, bam_filter_level = None):
                        
 	# !! Change the skip_analysis flag to False so the DGE components are run !!
 	configured_pipeline.project.parameters.reset_param('skip_analysis', False)
+
+	if bam_filter_level:
+		change_bam_level(configured_pipeline, bam_filter_level)
 	
 	if not configured_pipeline.project.contrasts:
 		if not annotation_filepath:
@@ -0,0 +1,175 @@
+import logging
+import os
+import json
+import numpy as np
+from custom_exceptions import CountMatrixException
+
+# the rows of a count matrix are formatted and written this many at a time
+WRITE_BLOCK_ROWS = 10000
+
+# the header of the gene column in a count matrix file
+GENE_HEADER = 'Gene'
+
+# the binary copy of a count matrix file is kept next to it: the matrix as a .npy file (which can be memory-mapped) and an index file with the
+# genes (rows) and samples (columns).  The text file is only kept as an export format.
+BINARY_SUFFIX = '.npy'
+INDEX_SUFFIX = '.index.json'
+
+# featureCounts' output has a comment line and a header, then a line per gene whose counts start in the 7th column
+FEATURE_COUNTS_HEADER_LINES = 2
+FEATURE_COUNTS_FIRST_COUNT = 6
+
+
+class CountMatrix(object):
+	"""
+	A count matrix: counts is a numpy array (integers for raw counts, floats for normalized ones) with a row for each gene and a column for each sample
+	"""
+
+	def __init__(self, genes, samples, counts):
+		self.genes = list(genes)
+		self.samples = list(samples)
+		self.counts = counts
+		if self.counts.shape != (len(self.genes), len(self.samples)):
+			raise CountMatrixException('A count matrix of shape %s cannot have %d genes and %d samples' % (self.counts.shape, len(self.genes), len(self.samples)))
+
+
+	def write(self, path, formatter = None):
+		"""
+		Writes the matrix as tab-separated text, with a header line ('Gene' and the sample names) and a line per gene.  If given, formatter
+		turns a block of rows of the counts into rows of strings (by default, numpy's str of each value is written).
+		"""
+		with open(path, 'w') as f:
+			f.write('\t'.join([GENE_HEADER] + self.samples) + '\n')
+			for start in range(0, len(self.genes), WRITE_BLOCK_ROWS):
+				block = self.counts[start:start + WRITE_BLOCK_ROWS]
+				block = formatter(block) if formatter else block.astype(str)
+				f.write(''.join(['\t'.join([gene] + list(row)) + '\n' for gene, row in zip(self.genes[start:start + WRITE_BLOCK_ROWS], block)]))
+		write_binary(self, path)
+
+
+def write_binary(matrix, path):
+	"""
+	Writes the binary copy of the count matrix file at path.  The index records the size and modification time of the text file, so a
+	binary copy which no longer matches it (e.g. the text file was replaced by a later run) is not used.
+	"""
+	np.save(path + BINARY_SUFFIX, np.ascontiguousarray(matrix.counts))
+	stat = os.stat(path)
+	with open(path + INDEX_SUFFIX + '.tmp', 'w') as f:
+		json.dump({'genes': matrix.genes, 'samples': matrix.samples, 'text_size': stat.st_size, 'text_mtime': stat.st_mtime}, f)
+	os.rename(path + INDEX_SUFFIX + '.tmp', path + INDEX_SUFFIX)
+
+
+def read_binary(path):
+	"""
+	Returns the count matrix from the binary copy of the count matrix file at path, or None if there is no up-to-date copy.  The counts
+	are memory-mapped (read-only), so only the parts that are used are read from disk.
+	"""
+	try:
+		with open(path + INDEX_SUFFIX) as f:
+			index = json.load(f)
+		stat = os.stat(path)
+		if (index['text_size'], index['text_mtime']) != (stat.st_size, stat.st_mtime):
+			return None
+		return CountMatrix(index['genes'], index['samples'], np.load(path + BINARY_SUFFIX, mmap_mode = 'r'))
+	except (IOError, OSError, ValueError, KeyError):
+		return None
+
+
+def read_feature_counts(path):
+	"""
+	Parses a featureCounts output file.  Returns the genes, in the order of the file, and an integer array of the counts with a
+	column for each BAM file that was counted.
+	"""
+	genes = []
+	values = []
+	with open(path) as f:
+		for i, line in enumerate(f):
+			if i >= FEATURE_COUNTS_HEADER_LINES:
+				fields = line.rstrip('\n').split('\t')
+				genes.append(fields[0])
+				values.append(fields[FEATURE_COUNTS_FIRST_COUNT:])
+	if not genes:
+		return genes, np.zeros((0, 0), dtype = np.int64)
+	return genes, np.array(values).astype(np.int64)
+
+
+def read_count_matrix(path, dtype = np.int64):
+	"""
+	Parses a count matrix text file (as written by CountMatrix.write(...) or the normalization script)
+	"""
+	with open(path) as f:
+		samples = f.readline().rstrip('\n').split('\t')[1:]
+		genes = []
+		values = []
+		for line in f:
+			fields = line.rstrip('\n').split('\t')
+			genes.append(fields[0])
+			values.append(fields[1:])
+	counts = np.array(values).astype(dtype) if values else np.zeros((0, len(samples)), dtype = dtype)
+	return CountMatrix(genes, samples, counts)
+
+
+def get_count_matrix(project, path, dtype = np.int64):
+	"""
+	Returns the count matrix in the file at path: from memory if a component of this run made it (see Project.count_matrices), otherwise
+	from its binary copy.  If there is no binary copy, the text file is parsed (as dtype) and the binary copy written, so it is only parsed once.
+	"""
+	matrices = getattr(project, 'count_matrices', {})
+	if path not in matrices:
+		matrix = read_binary(path)
+		if matrix is None:
+			logging.info('Parsing count matrix %s' % path)
+			matrix = read_count_matrix(path, dtype)
+			write_binary(matrix, path)
+		matrices[path] = matrix
+	return matrices[path]
+
+
+def check_unique(genes, path):
+	if len(set(genes)) != len(genes):
+		seen = set()
+		duplicates = set([g for g in genes if g in seen or seen.add(g)])
+		logging.error('The count file %s lists these genes more than once: %s' % (path, ', '.join(sorted(duplicates)[:10])))
+		raise CountMatrixException('Duplicate genes in %s' % path)
+
+
+def align_genes(reference_genes, reference_index, genes, path):
+	"""
+	Returns the row of each reference gene in a count file with the given genes, or None if they are already in the same order.
+	Raises an exception if the count file does not have exactly the reference genes.
+	"""
+	if genes == reference_genes:
+		return None
+	check_unique(genes, path)
+	if len(genes) != len(reference_genes) or not all([g in reference_index for g in genes]):
+		gene_set = set(genes)
+		missing = [g for g in reference_genes if g not in gene_set]
+		extra = [g for g in genes if g not in reference_index]
+		logging.error('The genes in %s do not match those of the other count files.  Missing: %s  Not in the others: %s' % (path, ', '.join(missing[:10]), ', '.join(extra[:10])))
+		raise CountMatrixException('The genes in %s do not match those of the other count files.  See log.' % path)
+	rows = np.empty(len(genes), dtype = np.int64)
+	rows[[reference_index[g] for g in genes]] = np.arange(len(genes))
+	return rows
+
+
+def assemble_count_matrix(countfiles, sample_names):
+	"""
+	Assembles the count matrix from a featureCounts file for each sample (in the same order as sample_names).  The genes are in the order
+	of the first file; those of the other files are matched to them by name, so the files do not need to list the genes in the same order,
+	but they must all have the same genes.
+	"""
+	if len(countfiles) != len(sample_names):
+		raise CountMatrixException('There are %d count files for %d samples' % (len(countfiles), len(sample_names)))
+	counts = None
+	for j, countfile in enumerate(countfiles):
+		genes, column = read_feature_counts(countfile)
+		if column.shape[1] != 1:
+			raise CountMatrixException('Expected a single column of counts in %s, but found %d' % (countfile, column.shape[1]))
+		if counts is None:
+			check_unique(genes, countfile)
+			reference_genes = genes
+			reference_index = {g: i for i, g in enumerate(genes)}
+			counts = np.empty((len(genes), len(countfiles)), dtype = np.int64)
+		rows = align_genes(reference_genes, reference_index, genes, countfile)
+		counts[:, j] = column[:, 0] if rows is None else column[rows, 0]
+	return CountMatrix(reference_genes, sample_names, counts)
@@ -43,3 +43,32 @@ class ContrastSpecificationException(Exception):
 
 class InconsistentPairingStatusException(Exception):
 	pass
+
+class ComponentDependencyException(Exception):
+	pass
+
+class SampleTaskException(Exception):
+	def __init__(self, message, failures = None):
+		Exception.__init__(self, message)
+		self.failures = failures if failures is not None else [] # a list of (label, exception) tuples
+
+class BamLevelException(Exception):
+	pass
+
+class BatchJobException(Exception):
+	pass
+
+class CountMatrixException(Exception):
+	pass
+
+class NormalizationException(Exception):
+	pass
+
+class RWorkerException(Exception):
+	pass
+
+class DifferentialExpressionException(Exception):
+	pass
+
+class DiffExpStoreException(Exception):
+	pass
@@ -0,0 +1,183 @@
+import logging
+import os
+import sys
+import csv
+import sqlite3
+from custom_exceptions import DiffExpStoreException
+
+# the default name of the store, which the DESeq component writes in its output directory
+DEFAULT_STORE_NAME = 'diff_exp_results.sqlite'
+
+# the columns stored from a DESeq results file (see deseq_original.R), in the order of the results table.  The first column of the file
+# holds the genes, and the control and experimental columns (the mean counts in each condition) are named after the conditions.  Only the
+# columns in REQUIRED_COLUMNS must be present; the others are stored as missing if they are not.
+RESULT_COLUMNS = ['baseMean', 'control', 'experimental', 'foldChange', 'log2FoldChange', 'pval', 'padj']
+REQUIRED_COLUMNS = ['log2FoldChange', 'padj']
+
+# other names DESeq versions give the columns
+COLUMN_ALIASES = {'pvalue': 'pval'}
+
+# the defaults for counting the differentially expressed genes of a contrast
+DEFAULT_PADJ_THRESHOLD = 0.05
+DEFAULT_MIN_LOG2_FOLD_CHANGE = 0.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contrasts (
+	id INTEGER PRIMARY KEY,
+	contrast TEXT NOT NULL,
+	bam_level TEXT NOT NULL,
+	control TEXT NOT NULL,
+	experimental TEXT NOT NULL,
+	results_file TEXT,
+	UNIQUE (contrast, bam_level)
+);
+CREATE TABLE IF NOT EXISTS results (
+	gene TEXT NOT NULL,
+	contrast_id INTEGER NOT NULL REFERENCES contrasts (id),
+	base_mean REAL,
+	control_mean REAL,
+	experimental_mean REAL,
+	fold_change REAL,
+	log2_fold_change REAL,
+	pval REAL,
+	padj REAL,
+	PRIMARY KEY (gene, contrast_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_by_contrast ON results (contrast_id, padj);
+"""
+
+# the columns of a gene's results, as returned by DiffExpStore.gene_results(...)
+GENE_RESULT_FIELDS = ['gene', 'contrast', 'bam_level', 'control', 'experimental', 'baseMean', 'control_mean', 'experimental_mean',
+	'foldChange', 'log2FoldChange', 'pval', 'padj']
+
+# the columns of a summary, as returned by DiffExpStore.summarize(...)
+SUMMARY_FIELDS = ['contrast', 'bam_level', 'control', 'experimental', 'up', 'down']
+
+
+def parse_value(text):
+	"""
+	Returns the number written by R (NA and NaN are None; Inf and -Inf are infinities)
+	"""
+	try:
+		value = float(text)
+	except ValueError:
+		return None
+	return None if value != value else value
+
+
+class DiffExpStore(object):
+	"""
+	The DESeq results of every contrast and BAM level of a run in one SQLite database, indexed by gene (for a gene's results across all the
+	contrasts) and by contrast (for counting a contrast's differentially expressed genes)
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.connection = sqlite3.connect(path)
+		self.connection.executescript(SCHEMA)
+
+
+	def close(self):
+		self.connection.close()
+
+
+	def add_results(self, contrast, bam_level, control, experimental, results_path):
+		"""
+		Loads a DESeq results file into the store, replacing any results already stored for the contrast and BAM level
+		"""
+		with open(results_path) as f:
+			reader = csv.reader(f)
+			header = next(reader, None) or []
+			names = [COLUMN_ALIASES.get(h, h) for h in header]
+			names = [{control: 'control', experimental: 'experimental'}.get(n, n) for n in names]
+			if not header or any([c not in names[1:] for c in REQUIRED_COLUMNS]):
+				logging.error('%s does not look like a DESeq results file.  Its header is %s' % (results_path, header))
+				raise DiffExpStoreException('Unexpected format of %s.  See log.' % results_path)
+			indexes = [names.index(c, 1) if c in names[1:] else None for c in RESULT_COLUMNS]
+			rows = [[row[0]] + [parse_value(row[i]) if i is not None else None for i in indexes] for row in reader]
+		with self.connection:
+			previous = self.connection.execute('SELECT id FROM contrasts WHERE contrast = ? AND bam_level = ?', (contrast, bam_level)).fetchone()
+			if previous:
+				self.connection.execute('DELETE FROM results WHERE contrast_id = ?', previous)
+				self.connection.execute('DELETE FROM contrasts WHERE id = ?', previous)
+			contrast_id = self.connection.execute('INSERT INTO contrasts (contrast, bam_level, control, experimental, results_file) VALUES (?, ?, ?, ?, ?)',
+				(contrast, bam_level, control, experimental, results_path)).lastrowid
+			self.connection.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [[row[0], contrast_id] + row[1:] for row in rows])
+		logging.info('Stored %d results of %s (%s) from %s' % (len(rows), contrast, bam_level, results_path))
+
+
+	def gene_results(self, gene, bam_level = None):
+		"""
+		Returns the results of a gene in every contrast (or only those of one BAM level), as tuples of GENE_RESULT_FIELDS
+		"""
+		query = 'SELECT r.gene, c.contrast, c.bam_level, c.control, c.experimental, r.base_mean, r.control_mean, r.experimental_mean, ' \
+			'r.fold_change, r.log2_fold_change, r.pval, r.padj FROM results r JOIN contrasts c ON r.contrast_id = c.id WHERE r.gene = ?'
+		parameters = [gene]
+		if bam_level:
+			query += ' AND c.bam_level = ?'
+			parameters.append(bam_level)
+		return self.connection.execute(query + ' ORDER BY c.bam_level, c.contrast', parameters).fetchall()
+
+
+	def summarize(self, padj_threshold = DEFAULT_PADJ_THRESHOLD, min_log2_fold_change = DEFAULT_MIN_LOG2_FOLD_CHANGE, bam_level = None):
+		"""
+		Returns the number of genes up- and down-regulated in each contrast (or those of one BAM level), as tuples of SUMMARY_FIELDS.  A gene
+		counts if its adjusted p-value is at most padj_threshold and its log2 fold change is beyond min_log2_fold_change (either way).
+		"""
+		query = 'SELECT c.contrast, c.bam_level, c.control, c.experimental, ' \
+			'COALESCE(SUM(r.padj <= ? AND r.log2_fold_change > ?), 0), COALESCE(SUM(r.padj <= ? AND r.log2_fold_change < ?), 0) ' \
+			'FROM contrasts c LEFT JOIN results r ON r.contrast_id = c.id'
+		parameters = [padj_threshold, min_log2_fold_change, padj_threshold, -min_log2_fold_change]
+		if bam_level:
+			query += ' WHERE c.bam_level = ?'
+			parameters.append(bam_level)
+		return self.connection.execute(query + ' GROUP BY c.id ORDER BY c.id', parameters).fetchall()
+
+
+def create_store(path):
+	"""
+	Returns a new, empty store at path (replacing any store already there, e.g. from an earlier run)
+	"""
+	if os.path.isfile(path):
+		os.remove(path)
+	return DiffExpStore(path)
+
+
+def open_store(path):
+	"""
+	Returns the existing store at path
+	"""
+	if not os.path.isfile(path):
+		raise DiffExpStoreException('There is no differential expression store at %s' % path)
+	return DiffExpStore(path)
+
+
+def format_value(value):
+	if value is None:
+		return 'NA'
+	if isinstance(value, float):
+		return '%.6g' % value
+	return str(value)
+
+
+def write_table(fields, rows, stream):
+	stream.write('\t'.join(fields) + '\n')
+	for row in rows:
+		stream.write('\t'.join([format_value(v) for v in row]) + '\n')
+
+
+def run_query(options, stream = sys.stdout):
+	"""
+	Answers the query subcommand: the results of the genes in options['query_genes'] across all the contrasts, or if no genes are given,
+	the number of differentially expressed genes in each contrast.  Either can be limited to one BAM level.  The answer is written as
+	tab-separated text.
+	"""
+	store = open_store(options['query_store'])
+	try:
+		if options.get('query_genes'):
+			write_table(GENE_RESULT_FIELDS, [row for gene in options['query_genes'] for row in store.gene_results(gene, options.get('query_bam_level'))], stream)
+		else:
+			write_table(SUMMARY_FIELDS, store.summarize(options.get('query_padj', DEFAULT_PADJ_THRESHOLD), options.get('query_min_log2_fold_change', DEFAULT_MIN_LOG2_FOLD_CHANGE),
+				options.get('query_bam_level')), stream)
+	finally:
+		store.close()
@@ -0,0 +1,499 @@
+import logging
+import os
+import json
+import numpy as np
+from scipy.special import gammaln
+from scipy.interpolate import CubicSpline
+from custom_exceptions import DifferentialExpressionException
+from normalization import median_of_ratios_size_factors, format_as_r
+from count_matrix import CountMatrix, get_count_matrix
+
+# how the dispersions are estimated (see DESeq's estimateDispersions): 'blind' ignores the conditions, 'pooled' uses the variance within
+# the replicated conditions
+BLIND = 'blind'
+POOLED = 'pooled'
+
+# the dispersion-mean relationship is fit with the curve disp = asymptDisp + extraPois/mean ('parametric') or a local regression ('local')
+PARAMETRIC_FIT = 'parametric'
+LOCAL_FIT = 'local'
+
+# each gene's dispersion is the fitted one ('fit-only') or the larger of its own estimate and the fitted one ('maximum')
+FIT_ONLY = 'fit-only'
+MAXIMUM = 'maximum'
+
+# the parametric fit only uses genes whose dispersion is within these multiples of the fitted value, and is repeated (at most
+# PARAMETRIC_MAX_ITERATIONS times) until the coefficients settle
+PARAMETRIC_RESIDUAL_RANGE = (1e-4, 15)
+PARAMETRIC_MAX_ITERATIONS = 10
+
+# the iterations of each gamma regression (as R's glm.control)
+GLM_EPSILON = 1e-8
+GLM_MAX_ITERATIONS = 25
+
+# the local fit (as locfit's defaults): a quadratic in log(mean) around each point, fit to the nearest LOCAL_FRACTION of the genes with
+# tricube weights.  It is evaluated at LOCAL_GRID_POINTS points and interpolated between them.
+LOCAL_FRACTION = 0.7
+LOCAL_DEGREE = 2
+LOCAL_GRID_POINTS = 100
+
+# the smallest dispersion the local fit gives
+MIN_DISPERSION = 1e-8
+
+# the dispersions estimated from a few samples are corrected for their bias (see adjust_for_bias(...)).  As DESeq, estimates up to
+# SCV_BIAS_THRESHOLD are left as they are, since their bias is negligible.  n samples cannot give an estimate above n, and estimates beyond
+# SCV_BIAS_MAX_FRACTION of that are taken as that fraction.
+SCV_BIAS_THRESHOLD = 0.02
+SCV_BIAS_MAX_FRACTION = 0.99
+
+# the number of grid points for the numerical variance-stabilizing transformation of a local fit
+VST_GRID_POINTS = 1000
+
+# the exact tests are computed for blocks of genes, with each block's probability table holding at most this many values
+EXACT_TEST_BLOCK_SIZE = 2000000
+
+# the columns of a results file, as written by deseq_original.R (the mean columns are named after the conditions)
+RESULT_COLUMNS = ['id', 'baseMean', None, None, 'foldChange', 'log2FoldChange', 'pval', 'padj']
+
+# the variance-stabilized counts of a count matrix file are kept next to it (as its binary copy, see count_matrix.py): the values as a .npy
+# file (which can be memory-mapped) and an index file with the genes, the samples and their conditions
+VST_SUFFIX = '.vst.npy'
+VST_INDEX_SUFFIX = '.vst.index.json'
+
+# where the variance-stabilized counts kept next to a count matrix came from: this module, or the R script of the DESeq component
+NATIVE_VST = 'native'
+R_VST = 'R'
+
+
+def dispersion_settings(control_count, experimental_count):
+	"""
+	Returns the (method, sharing mode, fit type) for the dispersions of a contrast with the given numbers of samples in each condition, as
+	chosen by deseq_original.R
+	"""
+	if control_count == 1 and experimental_count == 1:
+		return BLIND, FIT_ONLY, LOCAL_FIT
+	if control_count == 2 and experimental_count == 2:
+		return BLIND, FIT_ONLY, PARAMETRIC_FIT
+	return POOLED, MAXIMUM, PARAMETRIC_FIT
+
+
+def heatmap_fit_type(*sample_counts):
+	"""
+	Returns the fit type of the blind dispersions for a heatmap of conditions with the given numbers of samples: local unless one of them
+	has more than two samples, as deseq_original.R chose for the two conditions of a contrast
+	"""
+	return LOCAL_FIT if all([count <= 2 for count in sample_counts]) else PARAMETRIC_FIT
+
+
+def base_means_and_variances(normalized, conditions, method):
+	"""
+	Returns the mean of each gene's normalized counts and their variance: across all the samples ('blind'), or pooled within the
+	conditions which have more than one sample ('pooled')
+	"""
+	means = normalized.mean(axis = 1)
+	if method == BLIND:
+		return means, normalized.var(axis = 1, ddof = 1)
+	conditions = np.asarray(conditions)
+	replicated = [c for c in sorted(set(conditions)) if np.sum(conditions == c) > 1]
+	if not replicated:
+		raise DifferentialExpressionException('None of the conditions has replicates, so the dispersions cannot be pooled.')
+	squares = np.zeros(normalized.shape[0])
+	degrees_of_freedom = 0
+	for condition in replicated:
+		columns = normalized[:, conditions == condition]
+		squares += ((columns - columns.mean(axis = 1)[:, np.newaxis])**2).sum(axis = 1)
+		degrees_of_freedom += columns.shape[1] - 1
+	return means, squares/degrees_of_freedom
+
+
+def adjust_for_bias(dispersions, sample_count):
+	"""
+	Returns the dispersions corrected for the bias of their estimates from sample_count samples, as DESeq's adjustScvForBias.  The squared
+	coefficient of variation of n gamma-distributed values is estimated, on average, as n*c/(n + c) rather than c, so an estimate e is
+	taken to come from c = n*e/(n - e).  DESeq interpolates a table of simulated estimates for this, of which this is the exact form.
+	"""
+	n = float(sample_count)
+	with np.errstate(invalid = 'ignore'):
+		estimates = np.minimum(dispersions, SCV_BIAS_MAX_FRACTION*n)
+		return np.where(dispersions > SCV_BIAS_THRESHOLD, n*estimates/(n - estimates), dispersions)
+
+
+def gamma_identity_glm(x, y, start):
+	"""
+	Fits y = a + b*x by a gamma regression with the identity link (as R's glm(y ~ x, family = Gamma(link = 'identity'), start = start)).
+	Returns the coefficients (a, b).
+	"""
+	design = np.column_stack([np.ones(len(x)), x])
+	coefficients = np.asarray(start, dtype = np.float64)
+	deviance = None
+	for i in range(GLM_MAX_ITERATIONS):
+		mu = design.dot(coefficients)
+		if np.any(mu <= 0):
+			raise DifferentialExpressionException('The gamma regression of the dispersions gave non-positive means.')
+		# with the identity link, the working response is y itself and the weights are 1/mu^2:
+		weights = 1/mu**2
+		coefficients = np.linalg.solve(design.T.dot(design*weights[:, np.newaxis]), design.T.dot(weights*y))
+		mu = design.dot(coefficients)
+		if np.any(mu <= 0):
+			raise DifferentialExpressionException('The gamma regression of the dispersions gave non-positive means.')
+		previous, deviance = deviance, 2*np.sum(-np.log(y/mu) + (y - mu)/mu)
+		if previous is not None and abs(deviance - previous)/(abs(deviance) + 0.1) < GLM_EPSILON:
+			break
+	return coefficients
+
+
+class ParametricFit(object):
+	"""
+	The dispersion-mean relationship disp = asymptDisp + extraPois/mean, fit as DESeq's parametricDispersionFit does
+	"""
+
+	def __init__(self, means, dispersions):
+		coefficients = np.array([0.1, 1.0])
+		for iteration in range(PARAMETRIC_MAX_ITERATIONS + 1):
+			residuals = dispersions/(coefficients[0] + coefficients[1]/means)
+			good = (residuals > PARAMETRIC_RESIDUAL_RANGE[0]) & (residuals < PARAMETRIC_RESIDUAL_RANGE[1])
+			previous = coefficients
+			coefficients = gamma_identity_glm(1/means[good], dispersions[good], previous)
+			if not np.all(coefficients > 0):
+				raise DifferentialExpressionException('The parametric dispersion fit failed.')
+			if np.sum(np.log(coefficients/previous)**2) < 1e-6:
+				break
+		else:
+			logging.warning('The parametric dispersion fit did not converge.')
+		self.asymptotic_dispersion, self.extra_poisson = coefficients
+
+
+	def __call__(self, means):
+		with np.errstate(divide = 'ignore'):
+			return self.asymptotic_dispersion + self.extra_poisson/means
+
+
+	def transform(self, normalized, size_factors):
+		"""
+		Returns the variance-stabilized normalized counts: the closed form of the transformation for this curve
+		"""
+		a, b = self.asymptotic_dispersion, self.extra_poisson
+		return np.log((1 + b + 2*a*normalized + 2*np.sqrt(a*normalized*(1 + b + a*normalized)))/(4*a))/np.log(2)
+
+
+class LocalFit(object):
+	"""
+	The dispersion-mean relationship from a local regression of the variances on log(mean), as DESeq's local fit (which uses locfit with the
+	gamma family): each local fit is a gamma regression with the log link, weighted by distance.  The mean's share of the variance (xim
+	times the mean) is taken out of the fitted variance to give the dispersion, which is then corrected for the bias of its estimate from
+	sample_count samples.
+	"""
+
+	def __init__(self, means, variances, xim, sample_count):
+		self.xim = xim
+		self.sample_count = sample_count
+		x = np.log(means)
+		self.grid = np.linspace(x.min(), x.max(), LOCAL_GRID_POINTS) if x.max() > x.min() else np.array([x.min()])
+		neighbours = min(len(x), int(np.ceil(LOCAL_FRACTION*len(x))))
+		self.log_variances = np.array([self.fit_at(point, x, variances, neighbours) for point in self.grid])
+
+
+	def fit_at(self, point, x, y, neighbours):
+		"""
+		Returns the log of the variance fit locally at the point
+		"""
+		distances = np.abs(x - point)
+		bandwidth = np.partition(distances, neighbours - 1)[neighbours - 1]
+		if bandwidth <= 0:
+			bandwidth = distances.max() or 1.0
+		kernel = np.clip(1 - (distances/bandwidth)**3, 0, None)**3
+		used = kernel > 0
+		design = np.vander(x[used] - point, LOCAL_DEGREE + 1, increasing = True)
+		kernel, y = kernel[used], y[used]
+		# the local polynomial is started from the log of the weighted mean variance, then refit to the working response of the log link
+		# (with the gamma family, its weights are the kernel weights alone):
+		eta = np.full(len(y), np.log(max(np.sum(kernel*y)/np.sum(kernel), MIN_DISPERSION)))
+		coefficients = None
+		for i in range(GLM_MAX_ITERATIONS):
+			mu = np.exp(eta)
+			working = eta + (y - mu)/mu
+			weighted = design*kernel[:, np.newaxis]
+			previous = coefficients
+			coefficients = np.linalg.lstsq(weighted.T.dot(design), weighted.T.dot(working), rcond = None)[0]
+			eta = design.dot(coefficients)
+			if previous is not None and np.max(np.abs(coefficients - previous)) < GLM_EPSILON*(np.max(np.abs(coefficients)) + 0.1):
+				break
+		return coefficients[0]
+
+
+	def __call__(self, means):
+		means = np.asarray(means, dtype = np.float64)
+		dispersions = np.full(means.shape, np.nan)
+		positive = means > 0
+		variances = np.exp(np.interp(np.log(means[positive]), self.grid, self.log_variances))
+		dispersions[positive] = np.maximum((variances - self.xim*means[positive])/means[positive]**2, MIN_DISPERSION)
+		return adjust_for_bias(dispersions, self.sample_count)
+
+
+	def transform(self, normalized, size_factors):
+		"""
+		Returns the variance-stabilized normalized counts: the integral of 1/sqrt(variance), computed numerically as DESeq does and
+		scaled to be close to log2 for the highly expressed genes
+		"""
+		grid = np.sinh(np.linspace(0, np.arcsinh(normalized.max()), VST_GRID_POINTS))[1:]
+		integrand = 1/np.sqrt(self(grid)*grid**2 + np.mean(1/size_factors)*grid)
+		integral = CubicSpline(np.arcsinh((grid[1:] + grid[:-1])/2), np.cumsum((grid[1:] - grid[:-1])*(integrand[1:] + integrand[:-1])/2))
+		row_means = normalized.mean(axis = 1)
+		h1, h2 = np.percentile(row_means, 95), np.percentile(row_means, 99.9)
+		eta = (np.log2(h2) - np.log2(h1))/(integral(np.arcsinh(h2)) - integral(np.arcsinh(h1)))
+		xi = np.log2(h1) - eta*integral(np.arcsinh(h1))
+		return eta*integral(np.arcsinh(normalized)) + xi
+
+
+def fit_dispersions(means, variances, size_factors, fit_type):
+	"""
+	Returns each gene's own dispersion estimate and the fit of the dispersion-mean relationship (a ParametricFit or a LocalFit).  As in
+	DESeq, only the fit is corrected for the bias of estimates from this number of samples: the parametric fit is made to the corrected
+	estimates, and the local fit (made to the variances) corrects the dispersions it gives, while the genes' own estimates (which the
+	'maximum' sharing mode compares with the fit) are returned as they are.  A parametric fit which fails falls back to a local one.
+	"""
+	xim = np.mean(1/size_factors)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		dispersions = (variances - xim*means)/means**2
+	expressed = means > 0
+	if not expressed.any():
+		raise DifferentialExpressionException('Every gene has zero counts, so the dispersions cannot be estimated.')
+	if fit_type == PARAMETRIC_FIT:
+		try:
+			return dispersions, ParametricFit(means[expressed], adjust_for_bias(dispersions[expressed], len(size_factors)))
+		except (DifferentialExpressionException, np.linalg.LinAlgError) as ex:
+			logging.warning('%s  Using a local fit instead.' % ex)
+	return dispersions, LocalFit(means[expressed], variances[expressed], xim, len(size_factors))
+
+
+def estimate_dispersions(normalized, size_factors, conditions, method, sharing_mode, fit_type):
+	"""
+	Returns the dispersion of each gene (as DESeq's estimateDispersions) and the fit they came from
+	"""
+	means, variances = base_means_and_variances(normalized, conditions, method)
+	gene_dispersions, fit = fit_dispersions(means, variances, size_factors, fit_type)
+	fitted = fit(means)
+	if sharing_mode == MAXIMUM:
+		# as pmax(..., na.rm = TRUE)
+		return np.fmax(gene_dispersions, fitted), fit
+	return fitted, fit
+
+
+def exact_test(counts_a, counts_b, size_factors_a, size_factors_b, dispersions):
+	"""
+	Returns the p-value of each gene from DESeq's exact test (nbinomTestForMatrices): the probability, given the total count of both
+	conditions, of a split between them at least as extreme as the one observed.  Genes with no counts have no p-value (NaN).
+	"""
+	k_a = np.rint(counts_a.sum(axis = 1)).astype(np.int64)
+	k_b = np.rint(counts_b.sum(axis = 1)).astype(np.int64)
+	s_a = size_factors_a.sum()
+	s_b = size_factors_b.sum()
+	mus = np.column_stack([counts_a/size_factors_a, counts_b/size_factors_b]).mean(axis = 1)
+
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		sizes = []
+		for s, squares in [(s_a, np.sum(size_factors_a**2)), (s_b, np.sum(size_factors_b**2))]:
+			full_variances = np.maximum(mus*s + dispersions*mus**2*squares, mus*s*(1 + 1e-8))
+			sizes.append((mus*s)**2/(full_variances - mus*s))
+	size_a, size_b = sizes
+
+	totals = k_a + k_b
+	pvalues = np.full(len(totals), np.nan)
+	tested = np.nonzero(totals > 0)[0]
+	tested = tested[np.argsort(totals[tested], kind = 'mergesort')]
+	start = 0
+	while start < len(tested):
+		# the genes are taken in order of their total counts, as many at a time as fit in a block:
+		end = start + 1
+		while end < len(tested) and (end + 1 - start)*(totals[tested[end]] + 1) <= EXACT_TEST_BLOCK_SIZE:
+			end += 1
+		genes = tested[start:end]
+		n = totals[genes][:, np.newaxis]
+		ks = np.arange(n.max() + 1)[np.newaxis, :]
+		possible = ks <= n
+		rest = np.where(possible, n - ks, 0)
+		# the log of the probability of each split (k, n - k), leaving out the terms which are the same for all the splits of a gene:
+		log_factorials = gammaln(ks[0] + 1.0)
+		a, b = size_a[genes][:, np.newaxis], size_b[genes][:, np.newaxis]
+		mu_a, mu_b = (mus[genes]*s_a)[:, np.newaxis], (mus[genes]*s_b)[:, np.newaxis]
+		with np.errstate(invalid = 'ignore'):
+			log_ps = gammaln(ks + a) - log_factorials[np.newaxis, :] + ks*np.log(mu_a/(a + mu_a)) + \
+				gammaln(rest + b) - log_factorials[rest] + rest*np.log(mu_b/(b + mu_b))
+		log_ps[~possible] = -np.inf
+		ps = np.exp(log_ps - log_ps.max(axis = 1)[:, np.newaxis])
+		observed = k_a[genes][:, np.newaxis]
+		# the tail on the side of the observed split:
+		lower = (k_a[genes]*s_b < k_b[genes]*s_a)[:, np.newaxis]
+		tail = np.where(lower, ks <= observed, ks >= observed) & possible
+		pvalues[genes] = np.minimum(1, 2*np.sum(ps*tail, axis = 1)/np.sum(ps, axis = 1))
+		start = end
+	return pvalues
+
+
+def adjust_pvalues(pvalues):
+	"""
+	Returns the Benjamini-Hochberg adjusted p-values (as R's p.adjust(..., method = 'BH')).  Missing (NaN) p-values stay missing and are not counted.
+	"""
+	adjusted = np.full(len(pvalues), np.nan)
+	present = np.nonzero(~np.isnan(pvalues))[0]
+	n = len(present)
+	if n:
+		order = present[np.argsort(-pvalues[present], kind = 'mergesort')]
+		adjusted[order] = np.minimum(1, np.minimum.accumulate(pvalues[order]*n/np.arange(n, 0, -1)))
+	return adjusted
+
+
+class ContrastResult(object):
+	"""
+	The results of a contrast, as DESeq's nbinomTest gives them.  The contrast's samples, their conditions, normalized counts, and size
+	factors are kept for the heatmap.
+	"""
+
+	def __init__(self, genes, control, experimental, base_means, means_a, means_b, pvalues, samples, conditions, normalized, size_factors):
+		self.genes = genes
+		self.control = control
+		self.experimental = experimental
+		self.base_means = base_means
+		self.means_a = means_a
+		self.means_b = means_b
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			self.fold_changes = means_b/means_a
+			self.log2_fold_changes = np.log2(self.fold_changes)
+		self.pvalues = pvalues
+		self.adjusted_pvalues = adjust_pvalues(pvalues)
+		self.samples = samples
+		self.conditions = conditions
+		self.normalized = normalized
+		self.size_factors = size_factors
+
+
+	def write(self, path):
+		"""
+		Writes the results as deseq_original.R does: a CSV file with a line per gene.  Missing p-values are written as NA, and undefined
+		fold changes (no counts in either condition) as NaN.
+		"""
+		columns = [format_column(values, missing) for values, missing in [(self.base_means, 'NaN'), (self.means_a, 'NaN'), (self.means_b, 'NaN'),
+			(self.fold_changes, 'NaN'), (self.log2_fold_changes, 'NaN'), (self.pvalues, 'NA'), (self.adjusted_pvalues, 'NA')]]
+		header = RESULT_COLUMNS[:2] + [self.control, self.experimental] + RESULT_COLUMNS[4:]
+		with open(path, 'w') as f:
+			f.write(','.join(header) + '\n')
+			f.write(''.join([','.join(row) + '\n' for row in zip(self.genes, *columns)]))
+
+
+def format_column(values, missing):
+	"""
+	Formats a column of numbers as R writes them, with NaN written as 'missing', and infinities as Inf and -Inf
+	"""
+	finite = np.isfinite(values)
+	strings = format_as_r(np.where(finite, values, 0)[np.newaxis, :])[0] if len(values) else []
+	for i in np.nonzero(~finite)[0]:
+		strings[i] = missing if np.isnan(values[i]) else ('Inf' if values[i] > 0 else '-Inf')
+	return strings
+
+
+def contrast_samples(annotations, control, experimental):
+	"""
+	Returns the samples (in annotation order) of a contrast and the condition of each.  annotations are (sample, condition) pairs.
+	"""
+	selected = [(sample, condition) for sample, condition in annotations if condition in (control, experimental)]
+	return [s for s, c in selected], [c for s, c in selected]
+
+
+def test_contrast(matrix, annotations, control, experimental):
+	"""
+	Runs the analysis of deseq_original.R on a contrast of the count matrix: size factors, dispersions (the method, sharing mode, and fit
+	chosen by the numbers of samples), and the exact test of the experimental condition against the control.  Returns a ContrastResult.
+	"""
+	samples, conditions = contrast_samples(annotations, control, experimental)
+	column_index = dict([(s, j) for j, s in enumerate(matrix.samples)])
+	missing = [s for s in samples if s not in column_index]
+	if missing:
+		logging.error('These samples of the contrast %s vs %s are not in the count matrix: %s' % (experimental, control, ', '.join(missing)))
+		raise DifferentialExpressionException('Samples missing from the count matrix.  See log.')
+	conditions = np.array(conditions)
+	is_a = conditions == control
+	is_b = conditions == experimental
+	if not is_a.any() or not is_b.any():
+		raise DifferentialExpressionException('The contrast %s vs %s needs samples in both conditions.' % (experimental, control))
+
+	counts = np.asarray(matrix.counts)[:, [column_index[s] for s in samples]].astype(np.float64)
+	size_factors = median_of_ratios_size_factors(counts)
+	normalized = counts/size_factors
+	method, sharing_mode, fit_type = dispersion_settings(is_a.sum(), is_b.sum())
+	dispersions, fit = estimate_dispersions(normalized, size_factors, conditions, method, sharing_mode, fit_type)
+	pvalues = exact_test(counts[:, is_a], counts[:, is_b], size_factors[is_a], size_factors[is_b], dispersions)
+
+	return ContrastResult(matrix.genes, control, experimental, normalized.mean(axis = 1), normalized[:, is_a].mean(axis = 1), normalized[:, is_b].mean(axis = 1),
+		pvalues, samples, conditions, normalized, size_factors)
+
+
+def variance_stabilize(result):
+	"""
+	Returns the variance-stabilized counts of a contrast (a ContrastResult), from blind dispersions fit to its samples alone.  The heatmaps
+	use those of the whole count matrix instead (see variance_stabilize_matrix(...)).
+	"""
+	fit_type = heatmap_fit_type(np.sum(result.conditions == result.control), np.sum(result.conditions == result.experimental))
+	means, variances = base_means_and_variances(result.normalized, None, BLIND)
+	gene_dispersions, fit = fit_dispersions(means, variances, result.size_factors, fit_type)
+	return fit.transform(result.normalized, result.size_factors)
+
+
+def variance_stabilize_matrix(matrix, annotations):
+	"""
+	Returns the variance-stabilized counts (a CountMatrix) of the annotated samples of a count matrix, in annotation order, from blind
+	dispersions fit to all of them.  annotations are (sample, condition) pairs.
+	"""
+	column_index = dict([(s, j) for j, s in enumerate(matrix.samples)])
+	samples = [s for s, c in annotations if s in column_index]
+	conditions = [c for s, c in annotations if s in column_index]
+	if len(samples) < 2:
+		raise DifferentialExpressionException('The variance-stabilizing transformation needs at least two samples, but the count matrix has %d annotated ones.' % len(samples))
+	fit_type = heatmap_fit_type(*[conditions.count(c) for c in set(conditions)])
+	counts = np.asarray(matrix.counts)[:, [column_index[s] for s in samples]].astype(np.float64)
+	size_factors = median_of_ratios_size_factors(counts)
+	normalized = counts/size_factors
+	means, variances = base_means_and_variances(normalized, None, BLIND)
+	gene_dispersions, fit = fit_dispersions(means, variances, size_factors, fit_type)
+	return CountMatrix(matrix.genes, samples, fit.transform(normalized, size_factors))
+
+
+def write_variance_stabilized(vst, path, annotations, source = NATIVE_VST):
+	"""
+	Writes the variance-stabilized counts of the count matrix file at path next to it.  As for its binary copy, the index records the size
+	and modification time of the count matrix file, and also the annotations the counts were transformed with and what computed them.
+	"""
+	np.save(path + VST_SUFFIX, np.ascontiguousarray(vst.counts))
+	stat = os.stat(path)
+	with open(path + VST_INDEX_SUFFIX + '.tmp', 'w') as f:
+		json.dump({'genes': vst.genes, 'samples': vst.samples, 'annotations': [list(a) for a in annotations], 'source': source,
+			'text_size': stat.st_size, 'text_mtime': stat.st_mtime}, f)
+	os.rename(path + VST_INDEX_SUFFIX + '.tmp', path + VST_INDEX_SUFFIX)
+
+
+def read_variance_stabilized(path, annotations, source = NATIVE_VST):
+	"""
+	Returns the variance-stabilized counts kept next to the count matrix file at path (memory-mapped), or None if there are none which
+	match the file and the annotations, and were computed by the given source
+	"""
+	try:
+		with open(path + VST_INDEX_SUFFIX) as f:
+			index = json.load(f)
+		stat = os.stat(path)
+		if (index['text_size'], index['text_mtime']) != (stat.st_size, stat.st_mtime) or index['annotations'] != [list(a) for a in annotations] \
+				or index.get('source') != source:
+			return None
+		return CountMatrix(index['genes'], index['samples'], np.load(path + VST_SUFFIX, mmap_mode = 'r'))
+	except (IOError, OSError, ValueError, KeyError):
+		return None
+
+
+def get_variance_stabilized(project, path, annotations):
+	"""
+	Returns the variance-stabilized counts of the count matrix file at path, which are only computed once for all its heatmaps (and kept
+	for later runs)
+	"""
+	vst = read_variance_stabilized(path, annotations)
+	if vst is None:
+		logging.info('Computing the variance-stabilized counts of %s' % path)
+		vst = variance_stabilize_matrix(get_count_matrix(project, path), annotations)
+		write_variance_stabilized(vst, path, annotations)
+	return vst
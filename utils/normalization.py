@@ -0,0 +1,211 @@
+import logging
+import re
+import numpy as np
+from collections import defaultdict
+from custom_exceptions import NormalizationException
+from count_matrix import CountMatrix
+
+# R writes numbers with (up to) this many significant digits
+R_DIGITS = 15
+
+# '%.15g' picks fixed or scientific notation the same way R does, except for values in these ranges (e.g. R writes 1e+05 and 1e-04)
+R_FIXED_MAX = 1e5
+R_FIXED_MIN = 1e-3
+
+# the normalizations which can be made alongside the DESeq one (see normalize_count_matrix_further(...)).  Each is named after the
+# values it gives: counts per million, transcripts per million, and counts per million of the TMM-adjusted library sizes.
+CPM = 'cpm'
+TPM = 'tpm'
+TMM = 'tmm'
+FURTHER_NORMALIZATIONS = [CPM, TPM, TMM]
+
+# the fraction of genes trimmed from each end of the log-ratios and of the average expressions by TMM (as edgeR's defaults)
+TMM_LOGRATIO_TRIM = 0.3
+TMM_SUM_TRIM = 0.05
+
+
+def median_of_ratios_size_factors(counts):
+	"""
+	Returns the size factor of each sample (column of counts) as DESeq's estimateSizeFactors computes them: the median, over the genes,
+	of the ratio of the sample's count to the gene's geometric mean across the samples.  Genes with a zero count in any sample have no
+	finite geometric mean (on the log scale) and are left out.
+	"""
+	with np.errstate(divide = 'ignore'):
+		log_counts = np.log(counts.astype(np.float64))
+	# as R's rowMeans, the logs are summed in extended precision
+	log_geomeans = (log_counts.sum(axis = 1, dtype = np.longdouble)/counts.shape[1]).astype(np.float64)
+	used = np.isfinite(log_geomeans)
+	if not used.any():
+		logging.error('Every gene has a zero count in at least one sample, so size factors cannot be estimated.')
+		raise NormalizationException('No genes without zero counts for estimating the size factors.')
+	return np.exp(np.median(log_counts[used] - log_geomeans[used, np.newaxis], axis = 0))
+
+
+def normalize_count_matrix(matrix):
+	"""
+	Returns the count matrix normalized by the median-of-ratios size factors, as DESeq's counts(cds, normalized = TRUE)
+	"""
+	size_factors = median_of_ratios_size_factors(matrix.counts)
+	logging.info('Size factors: %s' % ', '.join(['%s: %.4f' % (s, f) for s, f in zip(matrix.samples, size_factors)]))
+	return CountMatrix(matrix.genes, matrix.samples, matrix.counts/size_factors)
+
+
+def check_further_normalizations(methods):
+	unknown = [m for m in methods if m not in FURTHER_NORMALIZATIONS]
+	if unknown:
+		logging.error('Unknown normalizations: %s.  Choose from %s' % (unknown, FURTHER_NORMALIZATIONS))
+		raise NormalizationException('Unknown normalization requested.  See log.')
+
+
+class GeneLengths(object):
+	"""
+	The length of each gene, as featureCounts computes it (the Length column of its output): the number of bases covered by the features
+	(e.g. exons) which have the gene's name in the given attribute, with overlapping features counted once.  The GTF file is only read the
+	first time the lengths are needed.
+	"""
+
+	def __init__(self, gtf, feature, attribute):
+		self.gtf = gtf
+		self.feature = feature
+		self.attribute = attribute
+		self.lengths = None
+
+
+	def read(self):
+		logging.info('Reading the lengths of the genes from %s' % self.gtf)
+		pattern = re.compile(r'%s "([^"]*)"' % re.escape(self.attribute))
+		intervals = defaultdict(list)
+		with open(self.gtf) as f:
+			for line in f:
+				fields = line.split('\t', 8)
+				if len(fields) == 9 and fields[2] == self.feature:
+					match = pattern.search(fields[8])
+					if match:
+						intervals[(match.group(1), fields[0])].append((int(fields[3]), int(fields[4])))
+		lengths = defaultdict(int)
+		for (gene, chromosome), spans in intervals.iteritems():
+			covered_to = 0
+			for start, end in sorted(spans):
+				if end > covered_to:
+					lengths[gene] += end - max(start, covered_to + 1) + 1
+					covered_to = end
+		return lengths
+
+
+	def get(self, genes):
+		"""
+		Returns an array of the lengths of the given genes
+		"""
+		if self.lengths is None:
+			self.lengths = self.read()
+		missing = [g for g in genes if g not in self.lengths]
+		if missing:
+			logging.error('These genes have no %s features in %s: %s' % (self.feature, self.gtf, ', '.join(missing[:10])))
+			raise NormalizationException('Missing gene lengths for TPM normalization.  See log.')
+		return np.array([self.lengths[g] for g in genes], dtype = np.float64)
+
+
+def average_ranks(values):
+	"""
+	Returns the rank (starting at 1) of each value, with tied values given the average of their ranks (as R's rank(...))
+	"""
+	order = np.argsort(values, kind = 'mergesort')
+	ordered = values[order]
+	run_starts = np.nonzero(np.r_[True, ordered[1:] != ordered[:-1]])[0]
+	run_ends = np.r_[run_starts[1:], len(values)]
+	ranks = np.empty(len(values))
+	ranks[order] = np.repeat((run_starts + run_ends + 1)/2.0, run_ends - run_starts)
+	return ranks
+
+
+def tmm_factor(sample, reference, sample_size, reference_size):
+	"""
+	The TMM factor of a sample against the reference sample, as edgeR's calcFactorTMM: the weighted mean of the log-ratios of the genes'
+	expression, after trimming the genes with the most extreme log-ratios and average expressions
+	"""
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		log_ratios = np.log2((sample/sample_size)/(reference/reference_size))
+		expressions = (np.log2(sample/sample_size) + np.log2(reference/reference_size))/2
+		variances = (sample_size - sample)/sample_size/sample + (reference_size - reference)/reference_size/reference
+	finite = np.isfinite(log_ratios) & np.isfinite(expressions)
+	log_ratios, expressions, variances = log_ratios[finite], expressions[finite], variances[finite]
+	if len(log_ratios) == 0 or np.abs(log_ratios).max() < 1e-6:
+		return 1.0
+
+	n = len(log_ratios)
+	ratio_low = np.floor(n*TMM_LOGRATIO_TRIM) + 1
+	expression_low = np.floor(n*TMM_SUM_TRIM) + 1
+	ratio_ranks = average_ranks(log_ratios)
+	expression_ranks = average_ranks(expressions)
+	keep = (ratio_ranks >= ratio_low) & (ratio_ranks <= n + 1 - ratio_low) & (expression_ranks >= expression_low) & (expression_ranks <= n + 1 - expression_low)
+	if not keep.any():
+		return 1.0
+	return 2**(np.sum(log_ratios[keep]/variances[keep])/np.sum(1/variances[keep]))
+
+
+def tmm_factors(counts, library_sizes):
+	"""
+	Returns the TMM normalization factor of each sample, as edgeR's calcNormFactors(method = 'TMM').  The reference sample is the one
+	whose upper quartile (of the counts relative to the library size) is closest to the mean upper quartile.
+	"""
+	counts = counts[(counts > 0).any(axis = 1)]
+	quartiles = np.percentile(counts/library_sizes, 75, axis = 0)
+	if np.median(quartiles) < 1e-20:
+		reference = np.argmax(np.sqrt(counts).sum(axis = 0))
+	else:
+		reference = np.argmin(np.abs(quartiles - quartiles.mean()))
+	factors = np.array([tmm_factor(counts[:, j], counts[:, reference], library_sizes[j], library_sizes[reference]) for j in range(counts.shape[1])])
+	# the factors are scaled so that they multiply to one:
+	return factors/np.exp(np.mean(np.log(factors)))
+
+
+def normalize_count_matrix_further(matrix, methods, gene_lengths = None):
+	"""
+	Returns a (method, normalized count matrix) pair for each of the methods (see FURTHER_NORMALIZATIONS), all made from a single copy of the
+	raw counts and their library sizes.  TPM needs a GeneLengths.
+	"""
+	check_further_normalizations(methods)
+	counts = matrix.counts.astype(np.float64)
+	library_sizes = counts.sum(axis = 0)
+	normalized = []
+	for method in methods:
+		if method == CPM:
+			values = counts/(library_sizes*1e-6)
+		elif method == TPM:
+			rates = counts/gene_lengths.get(matrix.genes)[:, np.newaxis]
+			values = rates/(rates.sum(axis = 0)*1e-6)
+		else:
+			factors = tmm_factors(counts, library_sizes)
+			logging.info('TMM factors: %s' % ', '.join(['%s: %.4f' % (s, f) for s, f in zip(matrix.samples, factors)]))
+			values = counts/(library_sizes*factors*1e-6)
+		normalized.append((method, CountMatrix(matrix.genes, matrix.samples, values)))
+	return normalized
+
+
+def format_real(value):
+	"""
+	Formats a number as R does when writing a table: the fewest significant digits (up to 15) which represent it, in fixed notation
+	unless scientific notation is shorter.
+	"""
+	if value == 0:
+		return '0'
+	mantissa, exponent = ('%.*e' % (R_DIGITS - 1, value)).split('e')
+	significant = len(mantissa.lstrip('-').replace('.', '').rstrip('0'))
+	power = int(exponent)
+	decimals = max(0, significant - power - 1)
+	fixed_width = max(power, 0) + 1 + (decimals + 1 if decimals else 0)
+	scientific_width = significant + (1 if significant > 1 else 0) + (4 if abs(power) < 100 else 5)
+	if fixed_width <= scientific_width:
+		return '%.*f' % (decimals, value)
+	return '%.*e' % (significant - 1, value)
+
+
+def format_as_r(block):
+	"""
+	Formats a block of rows of a normalized count matrix for CountMatrix.write(...), so the file matches the one written by the R script
+	"""
+	rows = [['%.15g' % v for v in row] for row in block.tolist()]
+	magnitudes = np.abs(block)
+	for i, j in zip(*np.nonzero((magnitudes >= R_FIXED_MAX) | ((magnitudes < R_FIXED_MIN) & (magnitudes > 0)))):
+		rows[i][j] = format_real(block[i, j])
+	return rows
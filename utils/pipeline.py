@@ -3,12 +3,40 @@ import util_methods
 import config_parser as cfg_parser
 from custom_exceptions import *
 import os
+import threading
+import Queue
+import time
+from staleness import StalenessChecker
+import run_profile
 
 class Pipeline(object):
 
+	# if the configuration does not say otherwise, how many components can run at the same time
+	DEFAULT_MAX_CONCURRENT_COMPONENTS = 4
+
+	# the resource each component of an old pickle produces (see __setstate__)
+	ORDER_RESOURCE_PREFIX = 'completed:'
+
 	def __init__(self):
 		self.components = None
 		self.project = None
+		self.run_started = None
+
+
+	def __setstate__(self, state):
+		"""
+		Pipelines pickled by older versions ran their components one after another, and the components did not say which resources they
+		consume and produce.  Each such component produces a resource of its own, and consumes those of the components before it, so they
+		still run in that order.
+		"""
+		self.__dict__.update(state)
+		self.__dict__.setdefault('run_started', None)
+		previous_resources = []
+		for component in self.components or []:
+			if component.consumes is None or component.produces is None:
+				component.consumes = list(previous_resources)
+				component.produces = [Pipeline.ORDER_RESOURCE_PREFIX + component.name]
+			previous_resources.extend(component.produces)
 
 
 	def register_components(self, components):
@@ -21,7 +49,7 @@ class Pipeline(object):
 
 	def print_summary(self):
 		logging.info('Configuration parameters:\n%s' % self.project.parameters)
-		logging.info('Pipeline components (in order to be executed):\n%s' % '\n'.join(str(c) for c in self.components))
+		logging.info('Pipeline components (run once the resources they consume are available):\n%s' % '\n'.join(str(c) for c in self.components))
 		logging.info('Samples:\n%s' % '\n'.join(str(s) for s in self.project.samples))
 		if not self.project.parameters.get('skip_analysis'):
 			logging.info('Contrasts:\n%s' % '\n'.join(map( lambda x: str(x[0])+ ' versus ' + str(x[1]) ,self.project.contrasts)))
@@ -38,24 +66,159 @@ class Pipeline(object):
 
 	def run(self):
 		"""
-		Sequentially runs the Component objects that have been added to this Pipeline object
+		Runs the Component objects that have been added to this Pipeline object.  Each component starts as soon as the resources
+		it consumes have been produced, so components which do not depend on each other run at the same time.
+		Components that ran before (e.g. when restarting) are only run for the samples whose inputs, parameters, or outputs changed since.
 		"""
 		if self.project and len(self.project.samples) > 0:
+			pending_components = []
 			for component in self.components:
 				if self.component_should_be_run(component):
-					if not component.completed:
-						component.add_project_data(self.project)
-						component.run()
-						component.completed = True
-					else:
-						logging.info('Component %s has been already completed successfully.  Moving onto next one...' % component.name)
+					pending_components.append(component)
 				else:
 					logging.info('Component %s has been skipped because of the commandline flag' % component.name)
+			self.run_started = time.time()
+			try:
+				self.schedule(pending_components)
+			finally:
+				self.write_run_profile()
 		else:
 			logging.error('Could not run the pipeline since no project was added, or there were zero samples detected.')
 			raise Exception('There was nothing to run.  Check the Samples were properly added to the project.')
 
 
+	def write_run_profile(self):
+		"""
+		Writes the time, cpu, memory, and I/O used by each component (and each external tool it ran) since the run started to the
+		output location.  A problem writing the profile is logged, but does not stop the pipeline.
+		"""
+		try:
+			self.project.parameters.get('output_location')
+		except ParameterNotFoundException:
+			logging.info('No output location, so no run profile is written.')
+			return
+		try:
+			run_profile.write_run_profile(self.project, self.components, self.run_started)
+		except Exception as ex:
+			logging.warning('Could not write the run profile: %s' % ex)
+
+
+	def get_max_concurrent_components(self):
+		try:
+			return max(1, int(self.project.parameters.get('max_concurrent_components')))
+		except ParameterNotFoundException:
+			return Pipeline.DEFAULT_MAX_CONCURRENT_COMPONENTS
+
+
+	def get_staleness_checker(self):
+		try:
+			sample_resources = {k:util_methods.as_list(v) for k,v in self.project.parameters.get('sample_resources').items()}
+		except ParameterNotFoundException:
+			sample_resources = {}
+		try:
+			signature_params = util_methods.as_list(self.project.parameters.get('signature_params'))
+		except ParameterNotFoundException:
+			signature_params = []
+		return StalenessChecker(sample_resources, signature_params)
+
+
+	def get_stale_samples(self, component, checker):
+		"""
+		Returns the names of the samples the component has to (re-)run for.  Returns None if the component is completely up to date.
+		If only the cohort cell is stale (e.g. a count matrix was deleted), this is an empty list-- the component runs, but none of its per-sample work.
+		Components without per-sample work (e.g. normalization) always run for all the samples.
+		A component which completed in a pipeline pickled before components kept records is taken as up to date: its records are made
+		from the files as they are now.
+		"""
+		if not component.records and getattr(component, 'completed', False):
+			logging.info('Component %s completed before this pipeline was saved.  Recording its current inputs and outputs.' % component.name)
+			checker.record(component, self.project)
+		stale_cells = checker.stale_cells(component, self.project)
+		if len(stale_cells) == 0:
+			return None
+		if not checker.is_per_sample(component):
+			return [s.sample_name for s in self.project.samples]
+		return [s.sample_name for s in self.project.samples if s.sample_name in stale_cells]
+
+
+	def dependencies_met(self, component, unfinished_components):
+		"""
+		A component can start once none of the other unfinished components produce a resource that it consumes.
+		Resources which no unfinished component produces (e.g. BAM files when alignment is skipped) are already available.
+		"""
+		blocking_resources = set()
+		for other in unfinished_components:
+			if other is not component:
+				blocking_resources.update(other.produces)
+		return not any([r in blocking_resources for r in component.consumes])
+
+
+	def schedule(self, pending_components):
+		"""
+		Starts each of the pending components in its own thread once its dependencies are met, and waits for all of them to finish.
+		If a component fails, no new components are started.  Once the running components finish, the first exception is re-raised.
+		"""
+		max_concurrent = self.get_max_concurrent_components()
+		checker = self.get_staleness_checker()
+		pending_components = list(pending_components)
+		running_components = []
+		finished_queue = Queue.Queue()
+		errors = []
+
+		while pending_components or running_components:
+			if not errors:
+				ready_components = [c for c in pending_components if self.dependencies_met(c, pending_components + running_components)]
+				while ready_components and len(running_components) < max_concurrent:
+					component = ready_components.pop(0)
+					pending_components.remove(component)
+
+					# staleness is decided once the inputs are final, i.e. after the components producing them have finished
+					stale_samples = self.get_stale_samples(component, checker)
+					if stale_samples is None:
+						logging.info('Component %s is up to date.  Moving onto next one...' % component.name)
+						ready_components = [c for c in pending_components if self.dependencies_met(c, pending_components + running_components)]
+						continue
+
+					running_components.append(component)
+					logging.info('Starting component %s (samples to run: %s)' % (component.name, stale_samples))
+					self.project.stale_samples[component.name] = stale_samples
+					component.add_project_data(self.project)
+					worker = threading.Thread(target = self.run_component, args = (component, finished_queue), name = component.name)
+					worker.start()
+
+			if len(running_components) == 0:
+				break
+
+			# block until one of the running components reports back:
+			component, ex = finished_queue.get()
+			running_components.remove(component)
+			if ex:
+				logging.error('Component %s failed.' % component.name)
+				errors.append(ex)
+			else:
+				logging.info('Component %s completed.' % component.name)
+				checker.record(component, self.project)
+				del self.project.stale_samples[component.name]
+
+		if errors:
+			raise errors[0]
+		elif pending_components:
+			logging.error('Could not start components %s.  Check the resources they consume and produce for cycles.' % [c.name for c in pending_components])
+			raise ComponentDependencyException('The component dependencies could not be satisfied.  See log.')
+
+
+	def run_component(self, component, finished_queue):
+		"""
+		Target for the component threads.  Reports the component and any exception it raised back to the scheduler.
+		"""
+		try:
+			component.run()
+			finished_queue.put((component, None))
+		except Exception as ex:
+			logging.exception('Exception raised while running component %s' % component.name)
+			finished_queue.put((component, ex))
+
+
 
 
 
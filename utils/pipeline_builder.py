@@ -40,6 +40,9 @@ class PipelineBuilder(object):
 		pipeline_elements_dict = self.__read_pipeline_config()
 		self.__verify_elements(pipeline_elements_dict)
 
+		# read the parameters that control how the pipeline schedules its work
+		self.builder_params.add(self.__read_execution_config())
+
 		# create an empty list that will hold Component objects
 		self.all_components = []
 
@@ -90,12 +93,12 @@ class PipelineBuilder(object):
 		# create the components that are always invoked:
 		for name in self.standard_components:
 			logging.info('Creating component: %s' % name)
-			self.all_components.append(Component(name, components_dict[name]))
+			self.all_components.append(Component(name, components_dict[name], consumes = self.component_inputs.get(name, []), produces = self.component_outputs.get(name, [])))
 
 		# add the analysis components, marking as appropriate
 		for name in self.analysis_components:
 			logging.info('Creating component: %s' % name)
-			self.all_components.append(Component(name, components_dict[name], 'ANALYSIS'))
+			self.all_components.append(Component(name, components_dict[name], 'ANALYSIS', consumes = self.component_inputs.get(name, []), produces = self.component_outputs.get(name, [])))
 
 
 
@@ -133,6 +136,15 @@ class PipelineBuilder(object):
 		logging.info('Standard components: %s', self.standard_components)
 		logging.info('Analysis components: %s', self.analysis_components)
 
+		# get the resources that each component consumes and produces-- these determine the order in which the components may run
+		self.component_inputs = {k:util_methods.as_list(v) for k,v in cfg_parser.read_config(config_filepath, 'plugin_inputs').items()}
+		self.component_outputs = {k:util_methods.as_list(v) for k,v in cfg_parser.read_config(config_filepath, 'plugin_outputs').items()}
+		logging.info('Component inputs: %s', self.component_inputs)
+
+		# the Sample attributes holding per-sample resources-- used to work out which samples need re-running on a restart
+		self.builder_params.add(sample_resources = cfg_parser.read_config(config_filepath, 'sample_resources'))
+		logging.info('Component outputs: %s', self.component_outputs)
+
 
 	def __check_and_create_samples(self):
 		"""
@@ -298,7 +310,7 @@ class PipelineBuilder(object):
 		util_methods.locate_config(aligner_specific_dir)
 
 		# create a component for the aligner:
-		self.all_components.append(Component(aligner, aligner_specific_dir))
+		self.all_components.append(Component(aligner, aligner_specific_dir, consumes = util_methods.as_list(self.builder_params.get('aligner_inputs')), produces = util_methods.as_list(self.builder_params.get('aligner_outputs'))))
 
 
 	def __get_aligner_info(self):
@@ -315,7 +327,14 @@ class PipelineBuilder(object):
 		# Read the pipeline-level config file
 		config_filepath = util_methods.locate_config(self.builder_params.get('pipeline_home'))
 		logging.info("Default pipeline configuration file is: %s", config_filepath)
-		return cfg_parser.read_config(config_filepath)
+		return cfg_parser.read_config(config_filepath, 'pipeline_params')
+
+
+	def __read_execution_config(self):
+
+		# Read the execution parameters (e.g. concurrency) from the pipeline-level config file
+		config_filepath = util_methods.locate_config(self.builder_params.get('pipeline_home'))
+		return cfg_parser.read_config(config_filepath, 'execution_params')
 		
 
 	def __check_project_config(self):
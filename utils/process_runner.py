@@ -0,0 +1,340 @@
+import logging
+import os
+import re
+import time
+import subprocess
+import threading
+import json
+import pipes
+from collections import deque
+from custom_exceptions import ParameterNotFoundException
+import batch_scheduler
+import r_worker_pool
+
+# defaults, if the configuration does not set them:
+DEFAULT_TASK_LOG_DIR = 'task_logs'
+DEFAULT_MAX_LOG_SIZE = 50 # MB
+DEFAULT_LOG_BACKUPS = 2
+
+# the number of final output lines kept in memory, so a failing task's error can be put in the main log
+TAIL_LINES = 20
+
+# the file (in the task log directory) to which a record of each task's resource usage is appended.  See run_profile.py
+TASK_RECORDS = 'task_profile.jsonl'
+
+# how often (in seconds) to check whether a tool which closed its output has exited
+EXIT_POLL_INTERVAL = 0.05
+
+
+class ProcessResult(object):
+	"""
+	The outcome of running a command: its exit status (negative if it was killed by a signal), start time, wall time (seconds), peak resident
+	memory (MB), cpu times (seconds), the bytes it read and wrote (None if /proc is not available), the path to its log, and its last few lines of output
+	"""
+	def __init__(self, label, command, returncode, start, wall_time, max_rss, user_time, system_time, io, log_path, tail):
+		self.label = label
+		self.command = command
+		self.returncode = returncode
+		self.start = start
+		self.wall_time = wall_time
+		self.max_rss = max_rss
+		self.user_time = user_time
+		self.system_time = system_time
+		self.bytes_read = io.get('rchar') if io else None
+		self.bytes_written = io.get('wchar') if io else None
+		self.log_path = log_path
+		self.tail = tail
+
+
+	def record(self):
+		"""
+		Returns the resource usage as a dictionary, as written to the task records
+		"""
+		return {'label': self.label, 'command': self.command, 'returncode': self.returncode, 'start': self.start, 'wall_time': self.wall_time,
+			'max_rss': self.max_rss, 'user_time': self.user_time, 'system_time': self.system_time,
+			'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written, 'log_path': self.log_path}
+
+
+class RotatingLogWriter(object):
+	"""
+	Writes lines to a log file.  Once the file grows past max_size bytes it is renamed to <path>.1 (older copies move to .2, .3, ...)
+	and a new file is started.  At most 'backups' old copies are kept, so a task never takes more than (backups + 1) * max_size of disk.
+	"""
+
+	def __init__(self, path, max_size, backups):
+		self.path = path
+		self.max_size = max_size
+		self.backups = backups
+		self.handle = open(path, 'w')
+		self.size = 0
+
+
+	def write(self, line):
+		if self.max_size > 0 and self.size + len(line) > self.max_size and self.size > 0:
+			self.rotate()
+		self.handle.write(line)
+		self.size += len(line)
+
+
+	def rotate(self):
+		self.handle.close()
+		if self.backups > 0:
+			for i in range(self.backups - 1, 0, -1):
+				older = '%s.%d' % (self.path, i)
+				if os.path.isfile(older):
+					os.rename(older, '%s.%d' % (self.path, i + 1))
+			os.rename(self.path, self.path + '.1')
+		self.handle = open(self.path, 'w')
+		self.size = 0
+
+
+	def close(self):
+		self.handle.close()
+
+
+def read_proc_io(pid):
+	"""
+	Returns the I/O counters (e.g. rchar, wchar) from /proc/<pid>/io as a dictionary, or None if they cannot be read
+	"""
+	try:
+		with open('/proc/%d/io' % pid) as f:
+			return {k.strip(): int(v) for k, v in [line.split(':') for line in f if ':' in line]}
+	except (IOError, ValueError):
+		return None
+
+
+def wait_for_exit(pid):
+	"""
+	Blocks until the process has exited, but without reaping it, so its /proc entry can still be read.  Returns False if /proc is not available.
+	"""
+	stat_path = '/proc/%d/stat' % pid
+	while True:
+		try:
+			with open(stat_path) as f:
+				# the state follows the command name, which is in parentheses (and may itself contain spaces):
+				state = f.read().rsplit(')', 1)[1].split()[0]
+		except (IOError, IndexError):
+			return False
+		if state in ('Z', 'X'):
+			return True
+		time.sleep(EXIT_POLL_INTERVAL)
+
+
+def get_optional_param(params, name, default):
+	try:
+		value = params.get(name)
+	except ParameterNotFoundException:
+		value = None
+	if value is None or value == () or value == '':
+		return default
+	return value
+
+
+def get_task_log_dir(params):
+	return os.path.join(params.get('output_location'), get_optional_param(params, 'task_log_dir', DEFAULT_TASK_LOG_DIR))
+
+
+def create_runner(params, component_name = None):
+	"""
+	Creates a ProcessRunner which writes the task logs to 'task_log_dir' (relative to the output location), capped and rotated
+	according to 'task_log_max_size' (in MB) and 'task_log_backups'.  The resource usage of the tasks is recorded under component_name.
+	The tools run on this machine, are submitted to a cluster scheduler, or are put in a work queue for worker processes, depending on
+	'job_backend' (see batch_scheduler.py and work_queue.py).  R scripts run on this machine are given to the run's pool of R workers,
+	if 'r_worker_pool_size' is set (see r_worker_pool.py).
+	"""
+	max_log_size = float(get_optional_param(params, 'task_log_max_size', DEFAULT_MAX_LOG_SIZE))
+	log_backups = int(get_optional_param(params, 'task_log_backups', DEFAULT_LOG_BACKUPS))
+	log_dir = get_task_log_dir(params)
+	return ProcessRunner(log_dir, max_log_size, log_backups, component_name, batch_scheduler.create_scheduler(params, log_dir), r_worker_pool.get_pool(params, log_dir))
+
+
+class ProcessRunner(object):
+	"""
+	Runs external tools (STAR, featureCounts, Rscript, etc.) without holding their output in memory.  The output is streamed, line by line,
+	to a log file for each task, while the main log gets a summary: the exit status, wall time, and peak memory of the tool, along with
+	anything reported by the progress parsers and, if the tool failed, its last few lines of output.
+	The resource usage of each task is also appended to the task records (TASK_RECORDS in the log directory), from which the run profile is made.
+	If given a BatchScheduler (or a WorkQueue), the tools are run as jobs on the cluster (or by the queue's workers) instead of on this machine.
+	If given an RWorkerPool, R scripts run on this machine (see run_r_script(...)) are run by its workers rather than a new Rscript process each.
+	"""
+
+	def __init__(self, log_dir, max_log_size = DEFAULT_MAX_LOG_SIZE, log_backups = DEFAULT_LOG_BACKUPS, component_name = None, scheduler = None, r_workers = None):
+		self.log_dir = log_dir
+		self.max_log_size = int(max_log_size*1024**2)
+		self.log_backups = log_backups
+		self.component_name = component_name
+		self.scheduler = scheduler
+		self.r_workers = r_workers
+		self.lock = threading.Lock()
+
+
+	def log_path(self, label):
+		with self.lock:
+			if not os.path.isdir(self.log_dir):
+				os.makedirs(self.log_dir)
+		return os.path.join(self.log_dir, re.sub('[^\w.-]+', '_', label) + '.log')
+
+
+	def run_r_script(self, label, script, args):
+		"""
+		Runs the R script (full path) with the given arguments, as 'Rscript script args' would, and returns a ProcessResult.  If there is a
+		pool of R workers (and no scheduler), one of its workers runs the script, so R is not started (nor the packages loaded) for every script.
+		"""
+		args = [str(a) for a in args]
+		command = 'Rscript ' + ' '.join([script] + args)
+		if self.scheduler or not self.r_workers:
+			return self.run(label, command)
+		return self.run(label, command, r_job = (script, args))
+
+
+	def run(self, label, command, progress_parsers = [], stdout_path = None, memory = None, cpus = None, r_job = None):
+		"""
+		Runs the command (a string is run through the shell, a list is not) and returns a ProcessResult.  The label names the task's log file.
+		progress_parsers are called with each line of output; any message they return is put in the main log.
+		If stdout_path is given, the command's stdout is written there (e.g. for tools which write their results to stdout) and only
+		stderr goes to the log.
+		memory (in GB) and cpus are what the command needs.  They are requested from the cluster scheduler, if there is one.
+		r_job is the (script, args) of an R script to give to an R worker instead of running the command (see run_r_script(...)).
+		"""
+		command_string = command if isinstance(command, basestring) else ' '.join(command)
+		log_path = self.log_path(label)
+		logging.info('Running task %s (output is in %s): %s' % (label, log_path, command_string))
+
+		writer = RotatingLogWriter(log_path, self.max_log_size, self.log_backups)
+		writer.write('# %s\n' % command_string)
+		output = TaskOutput(label, writer, progress_parsers)
+		try:
+			if r_job:
+				result = self.run_r_worker(label, r_job[0], r_job[1], command_string, output)
+			elif self.scheduler:
+				result = self.run_batch(label, command, command_string, output, stdout_path, memory, cpus)
+			else:
+				result = self.run_local(label, command, command_string, output, stdout_path)
+		finally:
+			writer.close()
+
+		if result.max_rss is not None:
+			memory_message = 'peak memory %.1f MB' % result.max_rss
+		else:
+			memory_message = 'ran in an R worker' if r_job else 'ran as a batch job'
+		logging.info('Task %s finished with exit status %d in %.1f s (%s)' % (label, result.returncode, result.wall_time, memory_message))
+		if result.returncode != 0:
+			logging.error('Task %s failed.  The last lines of its output (see %s for all of it) were:\n%s' % (label, log_path, '\n'.join(result.tail)))
+		self.record(result)
+		return result
+
+
+	def run_local(self, label, command, command_string, output, stdout_path):
+		"""
+		Runs the command as a child process of the pipeline
+		"""
+		stdout_handle = None
+		start = time.time()
+		try:
+			if stdout_path:
+				stdout_handle = open(stdout_path, 'w')
+				process = subprocess.Popen(command, shell = isinstance(command, basestring), stdout = stdout_handle, stderr = subprocess.PIPE)
+				stream = process.stderr
+			else:
+				process = subprocess.Popen(command, shell = isinstance(command, basestring), stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+				stream = process.stdout
+
+			try:
+				output.follow(stream)
+			except:
+				# do not leave the tool blocked on a full pipe:
+				process.kill()
+				raise
+			finally:
+				stream.close()
+				# the I/O counters are only available until the process is reaped.  They include the children it waited for.
+				io = read_proc_io(process.pid) if wait_for_exit(process.pid) else None
+				# wait4 (rather than wait) also gives the resource usage of the tool and the children it waited for:
+				pid, status, usage = os.wait4(process.pid, 0)
+				# Popen did not reap the process itself, so tell it the exit status:
+				process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+		finally:
+			if stdout_handle:
+				stdout_handle.close()
+
+		# ru_maxrss is in kilobytes on linux
+		return ProcessResult(label, command_string, process.returncode, start, time.time() - start, usage.ru_maxrss/1024.0, usage.ru_utime, usage.ru_stime, io, output.writer.path, output.tail_lines())
+
+
+	def run_r_worker(self, label, script, args, command_string, output):
+		"""
+		Runs the R script on a worker of the pool and copies its output (which the worker wrote to a file next to the task log) to the task log.
+		The worker's memory is shared by all the scripts it runs and its I/O is not known, so those are None.
+		"""
+		job_output = output.writer.path[:-len('.log')] + '.r.out'
+		start = time.time()
+		returncode, user_time, system_time = self.r_workers.run(script, args, job_output)
+		wall_time = time.time() - start
+		if os.path.isfile(job_output):
+			with open(job_output) as stream:
+				output.follow(stream)
+			os.remove(job_output)
+		return ProcessResult(label, command_string, returncode, start, wall_time, None, user_time, system_time, None, output.writer.path, output.tail_lines())
+
+
+	def run_batch(self, label, command, command_string, output, stdout_path, memory, cpus):
+		"""
+		Runs the command as a batch job and copies its output (which the job wrote to a file in the job directory) to the task log.
+		A cluster scheduler does not report the memory or cpu time of the job (a work queue worker does), and the I/O is never known, so those are None.
+		"""
+		if not isinstance(command, basestring):
+			command = ' '.join([pipes.quote(c) for c in command])
+		job_output = os.path.join(self.scheduler.job_dir, os.path.basename(output.writer.path)[:-len('.log')] + '.out')
+		task = self.scheduler.run(batch_scheduler.BatchTask(label, command, job_output, stdout_path, memory, cpus))
+		if os.path.isfile(job_output):
+			with open(job_output) as stream:
+				output.follow(stream)
+			os.remove(job_output)
+		start = task.start if task.start is not None else time.time()
+		wall_time = task.end - task.start if task.start is not None else 0.0
+		return ProcessResult(label, command_string, task.returncode, start, wall_time, task.max_rss, task.user_time, task.system_time, None, output.writer.path, output.tail_lines())
+
+
+	def record(self, result):
+		"""
+		Appends the task's resource usage to the task records.  Each record is a single line written with one call, so records
+		from tasks finishing at the same time do not interleave.
+		"""
+		record = result.record()
+		record['component'] = self.component_name
+		fd = os.open(os.path.join(self.log_dir, TASK_RECORDS), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0664)
+		try:
+			os.write(fd, json.dumps(record) + '\n')
+		finally:
+			os.close(fd)
+
+
+class TaskOutput(object):
+	"""
+	Passes each line of a task's output to its log, the progress parsers, and the tail (its last few lines)
+	"""
+
+	def __init__(self, label, writer, progress_parsers):
+		self.label = label
+		self.writer = writer
+		self.parsers = list(progress_parsers)
+		self.tail = deque(maxlen = TAIL_LINES)
+
+
+	def follow(self, stream):
+		for line in iter(stream.readline, ''):
+			self.writer.write(line)
+			self.tail.append(line.rstrip('\n'))
+			for parser in self.parsers[:]:
+				try:
+					message = parser(line)
+				except Exception as ex:
+					logging.warning('A progress parser for task %s failed (%s) and was removed.' % (self.label, ex))
+					self.parsers.remove(parser)
+					continue
+				if message:
+					logging.info('%s: %s' % (self.label, message))
+
+
+	def tail_lines(self):
+		return list(self.tail)
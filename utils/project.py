@@ -5,6 +5,23 @@ class Project(object):
 		self.parameters = None
 		self.samples = None
 		self.contrasts = None
+		self.stale_samples = {} # maps the names of the running components to the samples they need to (re-)run for
+		self.count_matrices = {} # maps the paths of the count matrix files made in this run to the matrices (see count_matrix.py)
+
+
+	def __getstate__(self):
+		# the count matrices are only kept in memory for the components of this run-- a restart reads them from their files again
+		state = dict(self.__dict__)
+		state['count_matrices'] = {}
+		return state
+
+
+	def __setstate__(self, state):
+		# projects pickled by older versions have neither: every component then runs for all the samples
+		self.__dict__.update(state)
+		self.__dict__.setdefault('stale_samples', {})
+		self.__dict__.setdefault('count_matrices', {})
+
 
 	def add_parameters(self, params):
 		if self.parameters:
@@ -0,0 +1,276 @@
+import logging
+import os
+import time
+import errno
+import select
+import atexit
+import threading
+import subprocess
+import multiprocessing
+import Queue
+import resource_manager
+from custom_exceptions import RWorkerException, ParameterNotFoundException
+
+# the R side of a worker (see the protocol described there)
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'r_worker.R')
+WORKER_COMMAND = ['Rscript', WORKER_SCRIPT]
+REPLY_PREFIX = 'R_WORKER '
+
+# defaults, if the configuration does not set them:
+DEFAULT_PACKAGES = ['DESeq']
+DEFAULT_STARTUP_TIMEOUT = 300 # seconds
+DEFAULT_HEALTH_CHECK_INTERVAL = 60 # seconds
+DEFAULT_PING_TIMEOUT = 30 # seconds
+DEFAULT_WORKER_MEMORY = 2 # GB
+DEFAULT_JOB_TIMEOUT = 0 # seconds; no limit
+
+# the r_worker_pool_size which sizes the pool from the cores and memory of this machine (see get_pool_size(...))
+AUTO_POOL_SIZE = 'auto'
+
+# the pool shared by the components of this run (see get_pool(...))
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+def get_optional_param(params, name, default):
+	try:
+		value = params.get(name)
+	except ParameterNotFoundException:
+		value = None
+	if value is None or value == () or value == '':
+		return default
+	return value
+
+
+def get_pool_size(params):
+	"""
+	Returns the number of workers in the pool: r_worker_pool_size, or if that is 'auto', as many as there are cores for, and memory for
+	(r_worker_memory GB per worker)-- the same limit the DESeq component puts on the R scripts it runs at the same time
+	"""
+	size = get_optional_param(params, 'r_worker_pool_size', 0)
+	if str(size).strip().lower() != AUTO_POOL_SIZE:
+		return int(size)
+	memory_limit = int(resource_manager.get_available_memory()/float(get_optional_param(params, 'r_worker_memory', DEFAULT_WORKER_MEMORY)))
+	return max(1, min(multiprocessing.cpu_count(), memory_limit))
+
+
+def get_pool(params, log_dir):
+	"""
+	Returns the pool of R workers shared by the components of this run, which is created the first time.  Returns None if 'r_worker_pool_size'
+	is not set or is zero, in which case each R script is run by its own Rscript process.
+	"""
+	global POOL
+	size = get_pool_size(params)
+	if size <= 0:
+		return None
+	with POOL_LOCK:
+		if POOL is None:
+			packages = get_optional_param(params, 'r_worker_packages', DEFAULT_PACKAGES)
+			POOL = RWorkerPool(size, [packages] if isinstance(packages, basestring) else list(packages), log_dir,
+				float(get_optional_param(params, 'r_worker_startup_timeout', DEFAULT_STARTUP_TIMEOUT)),
+				float(get_optional_param(params, 'r_worker_health_check_interval', DEFAULT_HEALTH_CHECK_INTERVAL)),
+				float(get_optional_param(params, 'r_worker_ping_timeout', DEFAULT_PING_TIMEOUT)),
+				float(get_optional_param(params, 'r_worker_job_timeout', DEFAULT_JOB_TIMEOUT)))
+			atexit.register(POOL.shutdown)
+		return POOL
+
+
+class RWorker(object):
+	"""
+	A long-lived R process (running WORKER_SCRIPT) which is sent scripts to run over a pipe
+	"""
+
+	def __init__(self, name, packages, log_path, startup_timeout):
+		self.name = name
+		self.packages = packages
+		self.log_path = log_path
+		self.startup_timeout = startup_timeout
+		self.process = None
+		self.buffer = ''
+		self.last_used = None
+
+
+	def start(self):
+		"""
+		Starts the R process and waits until it has loaded the packages.  Raises an exception if it does not get that far.
+		"""
+		logging.info('Starting R worker %s (its own output is in %s)' % (self.name, self.log_path))
+		self.buffer = ''
+		with open(self.log_path, 'a') as log:
+			try:
+				self.process = subprocess.Popen(WORKER_COMMAND + self.packages, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = log, close_fds = True)
+			except OSError as ex:
+				logging.error('Could not start Rscript for R worker %s: %s' % (self.name, ex))
+				raise RWorkerException('Could not start an R worker.  See log.')
+		if self.read_reply(self.startup_timeout) != 'READY':
+			self.stop()
+			logging.error('R worker %s did not start within %s seconds.  See %s' % (self.name, self.startup_timeout, self.log_path))
+			raise RWorkerException('R worker %s did not start.  See log.' % self.name)
+		self.last_used = time.time()
+
+
+	def alive(self):
+		return self.process is not None and self.process.poll() is None
+
+
+	def send(self, fields):
+		"""
+		Sends a request.  Returns False if the worker is no longer reading them.
+		"""
+		try:
+			self.process.stdin.write('\t'.join(fields) + '\n')
+			self.process.stdin.flush()
+			return True
+		except IOError as ex:
+			if ex.errno == errno.EPIPE:
+				return False
+			raise
+
+
+	def read_reply(self, timeout = None):
+		"""
+		Returns the next reply from the worker (without the prefix), or None if the worker exited (or, with a timeout in seconds, did not reply in time).
+		Any other output on the worker's stdout (e.g. from loading a package) is skipped.
+		"""
+		deadline = time.time() + timeout if timeout is not None else None
+		fd = self.process.stdout.fileno()
+		while True:
+			while '\n' in self.buffer:
+				line, self.buffer = self.buffer.split('\n', 1)
+				if line.startswith(REPLY_PREFIX):
+					return line[len(REPLY_PREFIX):].strip()
+			remaining = deadline - time.time() if deadline is not None else None
+			if remaining is not None and remaining <= 0:
+				return None
+			ready, _, _ = select.select([fd], [], [], remaining)
+			if ready:
+				data = os.read(fd, 4096)
+				if not data:
+					return None
+				self.buffer += data
+
+
+	def ping(self, timeout):
+		return self.alive() and self.send(['PING']) and self.read_reply(timeout) == 'PONG'
+
+
+	def run(self, script, args, output_path, timeout = None):
+		"""
+		Runs the script with the given arguments, its output going to output_path.  Returns the exit status and the cpu times (user and
+		system, in seconds) it used.  If the worker dies while running the script, the status is that of the worker.  If the script
+		has not finished within timeout seconds, the worker is killed (so the script fails, and the worker is restarted before its next one).
+		"""
+		reply = None
+		if self.send(['RUN', output_path, script] + [str(a) for a in args]):
+			reply = self.read_reply(timeout)
+		self.last_used = time.time()
+		if reply is None and self.alive():
+			logging.error('%s did not finish within %s seconds on R worker %s-- killing the worker.' % (script, timeout, self.name))
+			self.process.kill()
+			self.process.wait()
+			return (self.process.returncode, None, None)
+		if reply is None or not reply.startswith('DONE'):
+			self.process.wait()
+			logging.error('R worker %s died (exit status %s) while running %s' % (self.name, self.process.returncode, script))
+			return (self.process.returncode or -1, None, None)
+		status, user_time, system_time = reply.split()[1:]
+		return (int(status), float(user_time), float(system_time))
+
+
+	def stop(self):
+		if self.process is None:
+			return
+		try:
+			self.process.stdin.close()
+		except IOError:
+			pass
+		# closing its stdin ends the worker, unless it is stuck:
+		for i in range(50):
+			if self.process.poll() is not None:
+				break
+			time.sleep(0.1)
+		else:
+			self.process.kill()
+			self.process.wait()
+		self.process.stdout.close()
+
+
+class RWorkerPool(object):
+	"""
+	A fixed number of R workers, each of which runs one script at a time.  The workers start the first time they are needed and are
+	reused for the rest of the run.  Before a worker is given a script, it is checked: one which has exited (e.g. crashed while running
+	the previous script, or killed because the script ran for more than job_timeout seconds) is restarted, as is one which has been idle
+	for a while and does not answer a ping.
+	"""
+
+	def __init__(self, size, packages, log_dir, startup_timeout = DEFAULT_STARTUP_TIMEOUT, health_check_interval = DEFAULT_HEALTH_CHECK_INTERVAL, ping_timeout = DEFAULT_PING_TIMEOUT,
+			job_timeout = DEFAULT_JOB_TIMEOUT):
+		self.size = int(size)
+		self.packages = packages
+		self.log_dir = log_dir
+		self.startup_timeout = startup_timeout
+		self.health_check_interval = health_check_interval
+		self.ping_timeout = ping_timeout
+		# zero (or less) for no limit
+		self.job_timeout = job_timeout
+		self.idle_workers = Queue.Queue()
+		self.workers = []
+		self.lock = threading.Lock()
+
+
+	def acquire(self):
+		"""
+		Returns a healthy worker, starting or restarting one if needed.  Blocks until a worker is free.
+		"""
+		worker = None
+		with self.lock:
+			if self.idle_workers.empty() and len(self.workers) < self.size:
+				if not os.path.isdir(self.log_dir):
+					os.makedirs(self.log_dir)
+				worker = RWorker('r_worker_%d' % (len(self.workers) + 1), self.packages, os.path.join(self.log_dir, 'r_worker_%d.log' % (len(self.workers) + 1)), self.startup_timeout)
+				self.workers.append(worker)
+		if worker is None:
+			# the timeout lets the wait be interrupted
+			while worker is None:
+				try:
+					worker = self.idle_workers.get(True, 1)
+				except Queue.Empty:
+					pass
+		try:
+			if not worker.alive():
+				if worker.process is not None:
+					logging.warning('R worker %s had exited (status %s).  Restarting it.' % (worker.name, worker.process.returncode))
+					worker.stop()
+				worker.start()
+			elif time.time() - worker.last_used > self.health_check_interval and not worker.ping(self.ping_timeout):
+				logging.warning('R worker %s did not answer a health check.  Restarting it.' % worker.name)
+				worker.stop()
+				worker.start()
+		except:
+			# the worker is left to be started again by the next script
+			self.release(worker)
+			raise
+		return worker
+
+
+	def release(self, worker):
+		self.idle_workers.put(worker)
+
+
+	def run(self, script, args, output_path):
+		"""
+		Runs the R script (full path) with the given arguments on a worker, as 'Rscript script args' would.  Its output goes to output_path.
+		Returns the exit status and the cpu times (user and system, in seconds, or None if the worker died or was killed) it used.
+		"""
+		worker = self.acquire()
+		try:
+			return worker.run(script, args, output_path, self.job_timeout if self.job_timeout > 0 else None)
+		finally:
+			self.release(worker)
+
+
+	def shutdown(self):
+		with self.lock:
+			for worker in self.workers:
+				worker.stop()
+			self.workers = []
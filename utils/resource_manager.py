@@ -0,0 +1,104 @@
+import logging
+import threading
+import multiprocessing
+
+MEMINFO = '/proc/meminfo'
+
+
+def get_available_memory():
+	"""
+	Returns the memory (in GB) that can be used by new processes without swapping, as reported by /proc/meminfo.
+	Older kernels do not report MemAvailable, in which case the free memory plus the page cache is used.
+	"""
+	info = {}
+	with open(MEMINFO) as meminfo:
+		for line in meminfo:
+			key, value = line.split(':')
+			info[key.strip()] = int(value.strip().split()[0]) # in kB
+	if 'MemAvailable' in info:
+		available = info['MemAvailable']
+	else:
+		available = info['MemFree'] + info.get('Cached', 0)
+	return available/(1024.0*1024.0)
+
+
+def create_resource_manager(max_memory, max_cpus):
+	"""
+	Creates a ResourceManager.  A max_memory (in GB) or max_cpus of zero means "use what the machine has": the currently
+	available memory and the number of cores, respectively.
+	"""
+	max_memory = float(max_memory)
+	max_cpus = int(max_cpus)
+	if max_memory <= 0:
+		max_memory = get_available_memory()
+	if max_cpus <= 0:
+		max_cpus = multiprocessing.cpu_count()
+	logging.info('Resource manager has %.1f GB of memory and %d cpu slots to hand out.' % (max_memory, max_cpus))
+	return ResourceManager(max_memory, max_cpus)
+
+
+class ResourceManager(object):
+	"""
+	Keeps track of the memory (in GB) and cpu slots reserved by running jobs.  A job calls reserve(...) before it starts, which blocks until
+	the reservation fits alongside the ones already held, and calls release(...) when it finishes, which wakes up any waiting reservations.
+	"""
+
+	def __init__(self, total_memory, total_cpus):
+		self.total_memory = float(total_memory)
+		self.total_cpus = int(total_cpus)
+		self.reserved_memory = 0.0
+		self.reserved_cpus = 0
+		self.condition = threading.Condition()
+
+
+	def fits(self, memory, cpus):
+		return (self.reserved_memory + memory <= self.total_memory) and (self.reserved_cpus + cpus <= self.total_cpus)
+
+
+	def clamp(self, memory, cpus):
+		"""
+		Returns the reservation actually made for a request: a request larger than the totals gets all of it, and so runs alone rather than
+		never.  (With max_memory = 0, the total is the memory that happened to be available at the start.)
+		"""
+		return min(memory, self.total_memory), min(cpus, self.total_cpus)
+
+
+	def reserve(self, memory, cpus):
+		"""
+		Blocks until the requested memory and cpu slots are free, then reserves them.  A request larger than the totals is logged and waits
+		until nothing else is reserved.
+		"""
+		if (memory, cpus) != self.clamp(memory, cpus):
+			logging.warning('Requested %s GB of memory and %s cpus, but only %s GB and %s cpus can be reserved in total, so the job will run alone.  '
+				'To change this, set max_memory or max_cpus (or lower min_memory or star_threads) in the configuration.' % (memory, cpus, self.total_memory, self.total_cpus))
+		memory, cpus = self.clamp(memory, cpus)
+		with self.condition:
+			while not self.fits(memory, cpus):
+				logging.info('Waiting for %s GB of memory and %s cpus (%s GB and %s cpus already reserved).' % (memory, cpus, self.reserved_memory, self.reserved_cpus))
+				self.condition.wait()
+			self.reserved_memory += memory
+			self.reserved_cpus += cpus
+
+
+	def try_reserve(self, memory, cpus):
+		"""
+		Reserves the requested memory and cpu slots if they are free right now.  Returns whether they were reserved.
+		"""
+		memory, cpus = self.clamp(memory, cpus)
+		with self.condition:
+			if not self.fits(memory, cpus):
+				return False
+			self.reserved_memory += memory
+			self.reserved_cpus += cpus
+			return True
+
+
+	def release(self, memory, cpus):
+		"""
+		Returns a reservation made by reserve(...) and wakes up anything waiting for resources.
+		"""
+		memory, cpus = self.clamp(memory, cpus)
+		with self.condition:
+			self.reserved_memory -= memory
+			self.reserved_cpus -= cpus
+			self.condition.notify_all()
@@ -0,0 +1,292 @@
+import logging
+import os
+import shutil
+import hashlib
+import json
+import threading
+from custom_exceptions import ParameterNotFoundException
+
+# if the configuration does not give a size, the cache may hold this much (in GB)
+DEFAULT_MAX_SIZE = 500
+
+# the file in each cache entry listing the cached files.  Its modification time records when the entry was last used.
+MANIFEST = 'manifest.json'
+
+# the file (in the cache directory) holding the content digests of files that have already been read
+DIGEST_INDEX = 'digests.json'
+
+# size of the blocks read when computing content digests
+BLOCK_SIZE = 4*1024*1024
+
+
+class ContentOf(object):
+	"""
+	Marks a file that is part of a cache key through its content (e.g. a FASTQ file or a count matrix)
+	"""
+	def __init__(self, path):
+		self.path = path
+
+
+class IdentityOf(object):
+	"""
+	Marks a file or directory that is part of a cache key through its path, size, and modification time.  This is used for
+	things which are too large to read each time and which are replaced rather than edited (e.g. tools and genome indexes).
+	"""
+	def __init__(self, path):
+		self.path = path
+
+
+def create_result_cache(params):
+	"""
+	Creates a ResultCache in the directory given by 'result_cache_dir'.  If that is not set, caching is disabled and None is returned.
+	"""
+	try:
+		cache_dir = params.get('result_cache_dir')
+	except ParameterNotFoundException:
+		cache_dir = None
+	if not cache_dir:
+		return None
+	try:
+		max_size = float(params.get('result_cache_max_size'))
+	except ParameterNotFoundException:
+		max_size = DEFAULT_MAX_SIZE
+	return ResultCache(cache_dir, max_size)
+
+
+def cached_call(cache, key_parts, output_paths, method, *args, **kwargs):
+	"""
+	Calls method(*args, **kwargs), which creates the files in output_paths.  If a previous call with the same key_parts (strings, ContentOf
+	and IdentityOf objects) already created them, the files are restored from the cache instead and the method is not called.
+	Returns True if the results came from the cache.  If cache is None, the method is simply called.
+	"""
+	if cache is None:
+		method(*args, **kwargs)
+		return False
+
+	key = cache.fingerprint(key_parts)
+	if cache.fetch(key, output_paths):
+		return True
+
+	# the outputs may be hardlinks into the cache (restored by an earlier run)-- unlink them so the method cannot overwrite the cached copies
+	for path in output_paths:
+		if os.path.isfile(path):
+			os.remove(path)
+	method(*args, **kwargs)
+	cache.store(key, output_paths)
+	return False
+
+
+def cached_batch_call(cache, entries, method, *args, **kwargs):
+	"""
+	As cached_call(...), for a method which makes the outputs of several steps at once (e.g. all the contrasts of a count matrix in one
+	process).  entries is a list of (key_parts, output_paths) pairs, one per step.  The steps whose outputs are not in the cache are passed
+	to method(pending, *args, **kwargs) as a list of indexes into entries; if every step is restored, the method is not called.  Returns the
+	number of steps restored from the cache.
+	"""
+	if cache is None:
+		method(range(len(entries)), *args, **kwargs)
+		return 0
+
+	keys = [cache.fingerprint(key_parts) for key_parts, output_paths in entries]
+	pending = [i for i, (key, (key_parts, output_paths)) in enumerate(zip(keys, entries)) if not cache.fetch(key, output_paths)]
+	if pending:
+		for i in pending:
+			for path in entries[i][1]:
+				if os.path.isfile(path):
+					os.remove(path)
+		method(pending, *args, **kwargs)
+		for i in pending:
+			cache.store(keys[i], entries[i][1])
+	return len(entries) - len(pending)
+
+
+def link_file(source, destination):
+	"""
+	Hardlinks source to destination, falling back to a copy (e.g. if they are on different filesystems)
+	"""
+	if os.path.lexists(destination):
+		os.remove(destination)
+	try:
+		os.link(source, destination)
+	except OSError:
+		shutil.copy2(source, destination)
+
+
+class ResultCache(object):
+	"""
+	Stores the output files of a step (an alignment, a count file, a normalized matrix, etc) under a fingerprint of everything that
+	went into making them.  When a later run computes the same fingerprint, the files are hardlinked back into place rather than recreated.
+
+	Each entry is a directory named by its fingerprint.  The total size is bounded by max_size (in GB); once exceeded, the least recently
+	used entries are removed.
+	"""
+
+	def __init__(self, cache_dir, max_size):
+		self.cache_dir = cache_dir
+		self.max_size = float(max_size)
+		self.lock = threading.Lock()
+		self.digests = None
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+
+	def fingerprint(self, key_parts):
+		"""
+		Returns a hex digest identifying the given key parts
+		"""
+		resolved_parts = []
+		for part in key_parts:
+			if isinstance(part, ContentOf):
+				resolved_parts.append('content:' + self.file_digest(part.path))
+			elif isinstance(part, IdentityOf):
+				resolved_parts.append('identity:' + self.path_identity(part.path))
+			else:
+				resolved_parts.append(str(part))
+		return hashlib.sha1(json.dumps(resolved_parts)).hexdigest()
+
+
+	def file_digest(self, path):
+		"""
+		Returns a digest of the file's content.  Large inputs (e.g. FASTQ files) are slow to read, so digests are kept in an index
+		in the cache directory and only recomputed if the file's size or modification time changes.
+		"""
+		path = os.path.realpath(path)
+		stat = os.stat(path)
+		stamp = [stat.st_size, stat.st_mtime]
+		with self.lock:
+			if self.digests is None:
+				self.digests = self.load_digest_index()
+			entry = self.digests.get(path)
+			if entry and entry[0] == stamp:
+				return entry[1]
+
+		sha = hashlib.sha1()
+		with open(path, 'rb') as f:
+			block = f.read(BLOCK_SIZE)
+			while block:
+				sha.update(block)
+				block = f.read(BLOCK_SIZE)
+		digest = sha.hexdigest()
+
+		with self.lock:
+			self.digests[path] = [stamp, digest]
+			self.save_digest_index()
+		return digest
+
+
+	def path_identity(self, path):
+		"""
+		Returns a string identifying a file, or every file underneath a directory, by path, size, and modification time
+		"""
+		path = os.path.realpath(path)
+		if os.path.isdir(path):
+			filepaths = []
+			for root, dirs, files in os.walk(path):
+				filepaths.extend([os.path.join(root, f) for f in files])
+		else:
+			filepaths = [path]
+		identity = []
+		for f in sorted(filepaths):
+			stat = os.stat(f)
+			identity.append('%s:%d:%d' % (f, stat.st_size, int(stat.st_mtime)))
+		return hashlib.sha1('\n'.join(identity)).hexdigest()
+
+
+	def load_digest_index(self):
+		index_path = os.path.join(self.cache_dir, DIGEST_INDEX)
+		if os.path.isfile(index_path):
+			try:
+				with open(index_path) as f:
+					return json.load(f)
+			except ValueError:
+				logging.warning('Could not read the digest index at %s.  Starting a new one.' % index_path)
+		return {}
+
+
+	def save_digest_index(self):
+		index_path = os.path.join(self.cache_dir, DIGEST_INDEX)
+		tmp_path = index_path + '.%d.tmp' % os.getpid()
+		with open(tmp_path, 'w') as f:
+			json.dump(self.digests, f)
+		os.rename(tmp_path, index_path)
+
+
+	def entry_dir(self, key):
+		return os.path.join(self.cache_dir, key[:2], key)
+
+
+	def fetch(self, key, output_paths = [], output_dir = None):
+		"""
+		If there is an entry for the key, links its files to output_paths (matched by file name) and returns True.  Otherwise returns False.
+		If output_dir is given, all the files in the entry are linked into that directory instead.
+		"""
+		entry = self.entry_dir(key)
+		manifest_path = os.path.join(entry, MANIFEST)
+		if not os.path.isfile(manifest_path):
+			return False
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+
+		destinations = {os.path.basename(p): p for p in output_paths}
+		for name in manifest['files']:
+			if output_dir:
+				destination = os.path.join(output_dir, name)
+			else:
+				destination = destinations.get(name)
+			if destination is None:
+				logging.warning('Cache entry %s holds file %s, which is not one of the expected outputs.  Ignoring the entry.' % (key, name))
+				return False
+			if not os.path.isdir(os.path.dirname(destination)):
+				os.makedirs(os.path.dirname(destination))
+			link_file(os.path.join(entry, name), destination)
+
+		# record the use, for eviction:
+		os.utime(manifest_path, None)
+		logging.info('Restored %s from the result cache (entry %s)' % (manifest['files'], key))
+		return True
+
+
+	def store(self, key, output_paths):
+		"""
+		Adds the files in output_paths (those that exist) to the cache under the given key, then evicts old entries if the cache is too large
+		"""
+		files = [p for p in output_paths if os.path.isfile(p)]
+		entry = self.entry_dir(key)
+		if os.path.isdir(entry):
+			return
+		tmp_entry = entry + '.%d.%d.tmp' % (os.getpid(), threading.current_thread().ident)
+		os.makedirs(tmp_entry)
+		for f in files:
+			link_file(f, os.path.join(tmp_entry, os.path.basename(f)))
+		manifest = {'files': [os.path.basename(f) for f in files], 'size': sum([os.path.getsize(f) for f in files])}
+		with open(os.path.join(tmp_entry, MANIFEST), 'w') as f:
+			json.dump(manifest, f)
+		try:
+			os.rename(tmp_entry, entry)
+			logging.info('Added %s to the result cache (entry %s)' % (manifest['files'], key))
+		except OSError:
+			# another task stored the same result first
+			shutil.rmtree(tmp_entry)
+		self.evict()
+
+
+	def evict(self):
+		"""
+		Removes the least recently used entries until the cache is within its size limit
+		"""
+		with self.lock:
+			entries = []
+			for root, dirs, files in os.walk(self.cache_dir):
+				if MANIFEST in files and not root.endswith('.tmp'):
+					manifest_path = os.path.join(root, MANIFEST)
+					with open(manifest_path) as f:
+						size = json.load(f)['size']
+					entries.append((os.path.getmtime(manifest_path), size, root))
+			entries.sort()
+			total_size = sum([e[1] for e in entries])
+			max_bytes = self.max_size*1024**3
+			while entries and total_size > max_bytes:
+				last_used, size, root = entries.pop(0)
+				logging.info('Removing %s from the result cache to keep it under %s GB' % (root, self.max_size))
+				shutil.rmtree(root)
+				total_size -= size
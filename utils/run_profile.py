@@ -0,0 +1,138 @@
+import logging
+import os
+import json
+import time
+import datetime
+import resource
+import process_runner
+
+# the run profile, written to the output location
+PROFILE_FILE = 'run_profile.json'
+
+# getrusage(...) 'who' for the calling thread.  Python 2 does not define it, but linux does.
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+def thread_cpu_times():
+	"""
+	Returns the (user, system) cpu time of the calling thread, or None if the platform cannot report it
+	"""
+	try:
+		usage = resource.getrusage(RUSAGE_THREAD)
+		return (usage.ru_utime, usage.ru_stime)
+	except (ValueError, resource.error):
+		return None
+
+
+def thread_io():
+	"""
+	Returns the I/O counters of the calling thread, or None if the platform cannot report them
+	"""
+	try:
+		with open('/proc/thread-self/io') as f:
+			return {k.strip(): int(v) for k, v in [line.split(':') for line in f if ':' in line]}
+	except (IOError, ValueError):
+		return None
+
+
+class Measurement(object):
+	"""
+	Measures the wall time, cpu time, and I/O of a stretch of work done in the calling thread (e.g. Component.run).
+	The external tools a component runs are measured separately, by the ProcessRunner.
+	"""
+
+	def __init__(self):
+		self.start = time.time()
+		self.cpu = thread_cpu_times()
+		self.io = thread_io()
+
+
+	def finish(self):
+		"""
+		Returns the usage since this Measurement was created, as a dictionary.  Values the platform cannot report are None.
+		"""
+		cpu = thread_cpu_times()
+		io = thread_io()
+		both_cpu = self.cpu and cpu
+		both_io = self.io and io
+		return {'start': self.start,
+			'wall_time': time.time() - self.start,
+			'user_time': cpu[0] - self.cpu[0] if both_cpu else None,
+			'system_time': cpu[1] - self.cpu[1] if both_cpu else None,
+			'bytes_read': io['rchar'] - self.io['rchar'] if both_io else None,
+			'bytes_written': io['wchar'] - self.io['wchar'] if both_io else None}
+
+
+def read_task_records(records_path, since = 0):
+	"""
+	Returns the task records (see ProcessRunner.record) for the tasks started at or after 'since'
+	"""
+	records = []
+	if os.path.isfile(records_path):
+		with open(records_path) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# e.g. a partial line left by a pipeline that was killed
+					continue
+				if record['start'] >= since:
+					records.append(record)
+	return records
+
+
+def add_values(records, key):
+	values = [r[key] for r in records if r.get(key) is not None]
+	return sum(values) if values else None
+
+
+def create_run_profile(components, task_records, started):
+	"""
+	Puts the profiles of the components that ran since 'started' together with the records of their tasks
+	"""
+	component_profiles = []
+	for component in components:
+		profile = getattr(component, 'profile', None)
+		if not profile or profile['start'] < started:
+			continue
+		tasks = [r for r in task_records if r.get('component') == component.name]
+		entry = {'name': component.name}
+		entry.update(profile)
+		entry.update({'task_count': len(tasks),
+				'task_wall_time': add_values(tasks, 'wall_time'),
+				'task_user_time': add_values(tasks, 'user_time'),
+				'task_system_time': add_values(tasks, 'system_time'),
+				'task_max_rss': max([r['max_rss'] for r in tasks]) if tasks else None,
+				'task_bytes_read': add_values(tasks, 'bytes_read'),
+				'task_bytes_written': add_values(tasks, 'bytes_written')})
+		component_profiles.append(entry)
+
+	return {'started': datetime.datetime.fromtimestamp(started).isoformat(),
+		'wall_time': time.time() - started,
+		'pipeline_max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+		'components': component_profiles,
+		'tasks': sorted(task_records, key = lambda r: r['start'])}
+
+
+def write_run_profile(project, components, started):
+	"""
+	Writes the run profile (PROFILE_FILE in the output location) for the run which started at 'started'.  Returns its path.
+	"""
+	task_records = read_task_records(os.path.join(process_runner.get_task_log_dir(project.parameters), process_runner.TASK_RECORDS), started)
+	profile = create_run_profile(components, task_records, started)
+	profile_path = os.path.join(project.parameters.get('output_location'), PROFILE_FILE)
+	with open(profile_path, 'w') as f:
+		json.dump(profile, f, indent = 2)
+	logging.info('Wrote the run profile to %s' % profile_path)
+	return profile_path
+
+
+def load_run_profile(output_location):
+	"""
+	Returns the run profile in the output location, or None if there is not one
+	"""
+	profile_path = os.path.join(output_location, PROFILE_FILE)
+	if not os.path.isfile(profile_path):
+		return None
+	with open(profile_path) as f:
+		return json.load(f)
@@ -0,0 +1,164 @@
+import logging
+import os
+import glob
+import hashlib
+
+# the 'cell' holding a component's project-wide work (e.g. merging count files into a matrix), as opposed to the work for a single sample
+COHORT = '*'
+
+
+def file_stamp(path):
+	"""
+	Returns the [size, modification time] of a file, or None if it does not exist
+	"""
+	try:
+		stat = os.stat(path)
+		return [stat.st_size, stat.st_mtime]
+	except OSError:
+		return None
+
+
+def as_paths(value):
+	"""
+	Returns the file paths held by a Sample/Project attribute or a ComponentOutput, which may be a single path, a list, or a dictionary of names to paths
+	"""
+	if value is None:
+		return []
+	if isinstance(value, basestring):
+		return [value]
+	if isinstance(value, dict):
+		return [v for v in value.values() if isinstance(v, basestring)]
+	try:
+		return [v for v in value if isinstance(v, basestring)]
+	except TypeError:
+		return []
+
+
+def stamp_files(paths):
+	return {p: file_stamp(p) for p in paths}
+
+
+class StalenessChecker(object):
+	"""
+	Works out which parts of a component's work need to be (re-)done, make-style.  After a component runs, record(...) stores, for each sample
+	and for the cohort, the files it read (with their sizes and modification times), a digest of its parameters, and the files it wrote.
+	Later, stale_cells(...) compares those records against the files as they are now.  A sample is stale if it has no record, its inputs or
+	parameters changed, or one of its recorded outputs changed or disappeared.  The cohort cell also covers the project-wide inputs (e.g.
+	count matrices), the conditions and contrasts, and the component's report outputs.
+
+	sample_resources maps resource names (as in components.cfg) to the Sample attributes holding them (e.g. 'bam_files' -> ['bamfiles']).
+	A component producing a per-sample resource does per-sample work; other components only have the cohort cell.
+	signature_params are project parameters which, when changed, make every component stale (e.g. the genome).
+	"""
+
+	def __init__(self, sample_resources, signature_params):
+		self.sample_resources = sample_resources
+		self.signature_params = signature_params
+
+
+	def sample_attributes(self, resources):
+		attributes = []
+		for resource in resources:
+			attributes.extend(self.sample_resources.get(resource, []))
+		return attributes
+
+
+	def sample_files(self, sample, resources):
+		paths = []
+		for attribute in self.sample_attributes(resources):
+			paths.extend(as_paths(getattr(sample, attribute, None)))
+		return paths
+
+
+	def project_files(self, project, resources):
+		paths = []
+		for resource in resources:
+			paths.extend(as_paths(getattr(project, resource, None)))
+		return paths
+
+
+	def output_files(self, component):
+		paths = []
+		for output in component.outputs:
+			paths.extend(as_paths(getattr(output, 'files', None)))
+		return paths
+
+
+	def is_per_sample(self, component):
+		return len(self.sample_attributes(component.produces)) > 0
+
+
+	def parameter_digest(self, component, project):
+		"""
+		A digest of the component's configuration files and the parameters that affect every component
+		"""
+		sha = hashlib.sha1()
+		for cfg_file in sorted(glob.glob(os.path.join(component.location, '*.cfg'))):
+			with open(cfg_file) as f:
+				sha.update(f.read())
+		for name in self.signature_params:
+			try:
+				sha.update('%s=%s;' % (name, project.parameters.get(name)))
+			except Exception:
+				sha.update('%s=;' % name)
+		return sha.hexdigest()
+
+
+	def current_inputs(self, component, project):
+		"""
+		Returns a dictionary mapping each cell to (parameter digest, input file stamps) for the project as it is now
+		"""
+		params = self.parameter_digest(component, project)
+		inputs = {}
+		all_sample_inputs = {}
+		for sample in project.samples:
+			sample_inputs = stamp_files(self.sample_files(sample, component.consumes))
+			all_sample_inputs.update(sample_inputs)
+			if self.is_per_sample(component):
+				inputs[sample.sample_name] = (params, sample_inputs)
+
+		# the cohort also depends on which samples there are, their conditions, and the contrasts
+		cohort_params = hashlib.sha1(params)
+		cohort_params.update(repr(sorted([(s.sample_name, s.condition) for s in project.samples])))
+		cohort_params.update(repr(sorted([tuple(c) for c in (project.contrasts or [])])))
+		cohort_inputs = stamp_files(self.project_files(project, component.consumes))
+		cohort_inputs.update(all_sample_inputs)
+		inputs[COHORT] = (cohort_params.hexdigest(), cohort_inputs)
+		return inputs
+
+
+	def stale_cells(self, component, project):
+		"""
+		Returns the cells (sample names, and COHORT) whose records are missing or out of date
+		"""
+		records = getattr(component, 'records', {})
+		stale = []
+		for cell, (params, inputs) in self.current_inputs(component, project).items():
+			record = records.get(cell)
+			if record is None:
+				reason = 'it has not been run'
+			elif record['params'] != params:
+				reason = 'its parameters changed'
+			elif record['inputs'] != inputs:
+				reason = 'its inputs changed'
+			elif any([file_stamp(path) != stamp for path, stamp in record['outputs'].items()]):
+				reason = 'its outputs changed or are missing'
+			else:
+				continue
+			logging.info('Component %s needs to run for %s since %s.' % (component.name, 'the cohort' if cell == COHORT else 'sample ' + cell, reason))
+			stale.append(cell)
+		return stale
+
+
+	def record(self, component, project):
+		"""
+		Records the inputs, parameters, and outputs of a component which just finished successfully
+		"""
+		records = {}
+		for cell, (params, inputs) in self.current_inputs(component, project).items():
+			records[cell] = {'params': params, 'inputs': inputs}
+		for sample in project.samples:
+			if sample.sample_name in records:
+				records[sample.sample_name]['outputs'] = stamp_files(self.sample_files(sample, component.produces))
+		records[COHORT]['outputs'] = stamp_files(self.project_files(project, component.produces) + self.output_files(component))
+		component.records = records
@@ -0,0 +1,126 @@
+import logging
+import threading
+import multiprocessing
+import Queue
+import resource_manager
+from custom_exceptions import SampleTaskException, ParameterNotFoundException
+
+# the cores shared by the local per-sample tasks of all the components running at the same time (see get_cpu_slots(...))
+CPU_SLOTS = None
+CPU_SLOTS_LOCK = threading.Lock()
+
+
+def get_param(params, name):
+	try:
+		return params.get(name)
+	except ParameterNotFoundException:
+		return None
+
+
+def get_worker_count(params):
+	"""
+	Returns the number of workers given by the 'max_sample_workers' parameter.  If that is not set (or is zero),
+	the number of available cores is used.
+	When the tools are submitted to a cluster scheduler or a work queue (see batch_scheduler.py), the workers only wait on their jobs, so
+	'batch_max_jobs' is used instead-- the tasks run at the same time are submitted together as an array job.
+	"""
+	if get_param(params, 'job_backend') not in (None, '', 'local'):
+		worker_count = get_param(params, 'batch_max_jobs')
+	else:
+		worker_count = get_param(params, 'max_sample_workers')
+	if worker_count is None or worker_count == '' or int(worker_count) <= 0:
+		return multiprocessing.cpu_count()
+	return int(worker_count)
+
+
+def get_cpu_slots(params):
+	"""
+	Returns the cpu slots (a ResourceManager, with no memory to hand out) that the per-sample tasks of every component take from, which are
+	created the first time: 'sample_task_cpus' of them, or if that is not set (or is zero), as many as there are cores.  Several components
+	run at the same time, so each one's workers only limit that component-- these slots keep them from running more tasks than there are
+	cores between them.  Returns None when the tools are submitted to a cluster scheduler or a work queue, which decides where they run.
+	"""
+	global CPU_SLOTS
+	if get_param(params, 'job_backend') not in (None, '', 'local'):
+		return None
+	with CPU_SLOTS_LOCK:
+		if CPU_SLOTS is None:
+			cpus = get_param(params, 'sample_task_cpus')
+			if cpus is None or cpus == '' or int(cpus) <= 0:
+				cpus = multiprocessing.cpu_count()
+			CPU_SLOTS = resource_manager.ResourceManager(0, int(cpus))
+		return CPU_SLOTS
+
+
+class SampleTaskExecutor(object):
+	"""
+	Runs per-sample tasks with a bounded number of workers.  The tasks typically block on an external process (STAR, featureCounts, etc.),
+	so each worker is a thread which drives one child process at a time.
+
+	Tasks are added with submit(...) and started by wait(), which blocks until all the tasks have finished.  A failing task does not stop
+	the others-- all the failures are collected and reported together once everything has finished.
+
+	If given cpu_slots (see get_cpu_slots(...)), each task reserves task_cpus of them while it runs (at most all of them), so the executors
+	of the components running at the same time share the cores.
+	"""
+
+	def __init__(self, max_workers, cpu_slots = None, task_cpus = 1):
+		self.max_workers = max(1, int(max_workers))
+		self.cpu_slots = cpu_slots
+		self.task_cpus = min(max(1, int(task_cpus)), cpu_slots.total_cpus) if cpu_slots else max(1, int(task_cpus))
+		self.tasks = []
+
+
+	def submit(self, label, method, *args, **kwargs):
+		"""
+		Adds a task.  The label (e.g. the sample name) identifies the task in the results and in any error messages.
+		"""
+		self.tasks.append((label, method, args, kwargs))
+
+
+	def wait(self):
+		"""
+		Runs all the submitted tasks and returns a dictionary mapping each task's label to the value returned by its method.
+		Raises a SampleTaskException listing every failed task if any of them raised an exception.
+		"""
+		task_queue = Queue.Queue()
+		for task in self.tasks:
+			task_queue.put(task)
+		self.tasks = []
+
+		results = {}
+		failures = []
+		lock = threading.Lock()
+
+		def work():
+			while True:
+				try:
+					label, method, args, kwargs = task_queue.get_nowait()
+				except Queue.Empty:
+					return
+				try:
+					if self.cpu_slots:
+						self.cpu_slots.reserve(0, self.task_cpus)
+					try:
+						result = method(*args, **kwargs)
+					finally:
+						if self.cpu_slots:
+							self.cpu_slots.release(0, self.task_cpus)
+					with lock:
+						results[label] = result
+				except Exception as ex:
+					logging.error('Task for %s failed: %s' % (label, ex))
+					with lock:
+						failures.append((label, ex))
+
+		workers = [threading.Thread(target = work) for i in range(min(self.max_workers, task_queue.qsize()))]
+		[w.start() for w in workers]
+		[w.join() for w in workers]
+
+		if len(failures) > 0:
+			failures = sorted(failures, key = lambda x: str(x[0]))
+			message = '%d of %d tasks failed:\n' % (len(failures), len(failures) + len(results))
+			message += '\n'.join(['%s: %s' % (label, ex) for label, ex in failures])
+			logging.error(message)
+			raise SampleTaskException(message, failures)
+		return results
@@ -4,6 +4,7 @@ from custom_exceptions import *
 import imp
 import re
 import glob
+import task_executor
 
 CONFIG_SUFFIX = "cfg"
 
@@ -129,4 +130,29 @@ def case_insensitive_rstrip(orig_string, suffix):
 	return orig_string.rstrip(''.join(map(either_case, suffix)))
 
 
+def as_list(value):
+	"""
+	The config parser returns a string for a single value and a tuple for comma-separated values.  This returns a list in both cases.
+	"""
+	if isinstance(value, basestring):
+		return [value]
+	return list(value)
+
 
+def create_sample_executor(params, task_cpus = 1):
+	"""
+	Returns a SampleTaskExecutor for running per-sample work, sized by the 'max_sample_workers' parameter.  Its tasks (each using task_cpus
+	cores) share the cores with those of the other components running at the same time.
+	"""
+	return task_executor.SampleTaskExecutor(task_executor.get_worker_count(params), task_executor.get_cpu_slots(params), task_cpus)
+
+
+def get_samples_to_run(project, component_name):
+	"""
+	Returns the samples that the component needs to (re-)run for.  When restarting a pipeline, these are the samples whose inputs, parameters,
+	or outputs changed since the component last ran.  If the pipeline did not say, all the samples are returned.
+	"""
+	stale_samples = getattr(project, 'stale_samples', {})
+	if component_name not in stale_samples:
+		return list(project.samples)
+	return [s for s in project.samples if s.sample_name in stale_samples[component_name]]
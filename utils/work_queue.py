@@ -0,0 +1,406 @@
+import logging
+import os
+import re
+import time
+import json
+import fcntl
+import socket
+import threading
+import subprocess
+from contextlib import contextmanager
+from custom_exceptions import ParameterNotFoundException
+import config_parser
+import util_methods
+import resource_manager
+
+# the job backend (the 'job_backend' parameter) which puts the tools in a work queue for 'rnaseq_pipeline.py worker' processes
+QUEUE_BACKEND = 'queue'
+
+# defaults, if the configuration does not set them:
+DEFAULT_QUEUE_DIR = 'work_queue' # relative to the output location
+DEFAULT_POLL_INTERVAL = 5 # seconds
+DEFAULT_HEARTBEAT_INTERVAL = 30 # seconds
+DEFAULT_LEASE_TIMEOUT = 300 # seconds
+DEFAULT_MAX_ATTEMPTS = 3
+
+# a task moves from pending/ (queued) to claimed/ (a worker is running it) to done/ (its result, which the pipeline picks up)
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+
+# the file every change to the queue is made under a (POSIX, so also NFS) lock of
+LOCK_FILE = 'queue.lock'
+
+TASK_SUFFIX = '.json'
+
+# POSIX locks are held by a process, not a thread, so the threads of a process (e.g. a worker claiming tasks while others finish) also take this lock
+THREAD_LOCK = threading.Lock()
+
+
+def get_optional_param(params, name, default):
+	try:
+		value = params.get(name)
+	except ParameterNotFoundException:
+		value = None
+	if value is None or value == () or value == '':
+		return default
+	return value
+
+
+def get_queue_dir(params):
+	return os.path.join(params.get('output_location'), get_optional_param(params, 'work_queue_dir', DEFAULT_QUEUE_DIR))
+
+
+def create_work_queue(params, job_dir):
+	"""
+	Returns the WorkQueue in 'work_queue_dir' (relative to the output location), which the tools' output goes to job_dir from
+	"""
+	return WorkQueue(get_queue_dir(params), job_dir,
+			poll_interval = float(get_optional_param(params, 'work_queue_poll_interval', DEFAULT_POLL_INTERVAL)),
+			lease_timeout = float(get_optional_param(params, 'work_queue_lease_timeout', DEFAULT_LEASE_TIMEOUT)),
+			max_attempts = int(get_optional_param(params, 'work_queue_max_attempts', DEFAULT_MAX_ATTEMPTS)))
+
+
+def make_dir(path):
+	if not os.path.isdir(path):
+		try:
+			os.makedirs(path)
+		except OSError:
+			# another thread or process created it first
+			if not os.path.isdir(path):
+				raise
+
+
+def create_queue_dirs(queue_dir):
+	for name in [PENDING, CLAIMED, DONE]:
+		make_dir(os.path.join(queue_dir, name))
+
+
+@contextmanager
+def locked(queue_dir):
+	"""
+	Holds the queue's lock file for the duration of the with-block
+	"""
+	with THREAD_LOCK:
+		with open(os.path.join(queue_dir, LOCK_FILE), 'a') as lock_file:
+			fcntl.lockf(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+def write_record(path, record):
+	"""
+	Writes the record to a temporary file first, so that nothing ever reads half of one
+	"""
+	with open(path + '.tmp', 'w') as f:
+		json.dump(record, f)
+	os.rename(path + '.tmp', path)
+
+
+def read_record(path):
+	with open(path) as f:
+		return json.load(f)
+
+
+def list_tasks(directory):
+	return sorted([name for name in os.listdir(directory) if name.endswith(TASK_SUFFIX)])
+
+
+def remove_if_present(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+def requeue_expired(queue_dir, lease_timeout, max_attempts):
+	"""
+	Puts claimed tasks whose worker has not renewed its lease for lease_timeout seconds (i.e. the worker died, or its node did)
+	back in the queue.  A task which has been tried max_attempts times is failed instead.  Returns the number of tasks requeued or failed.
+	"""
+	expired = 0
+	with locked(queue_dir):
+		now = time.time()
+		for name in list_tasks(os.path.join(queue_dir, CLAIMED)):
+			claimed_path = os.path.join(queue_dir, CLAIMED, name)
+			try:
+				if now - os.path.getmtime(claimed_path) < lease_timeout:
+					continue
+				record = read_record(claimed_path)
+			except (OSError, IOError, ValueError):
+				continue
+			record['attempts'] = record.get('attempts', 0) + 1
+			worker = record.pop('worker', None)
+			if record['attempts'] >= max_attempts:
+				logging.error('Task %s was lost by worker %s, and has now been tried %d times-- failing it.' % (record['label'], worker, record['attempts']))
+				write_record(os.path.join(queue_dir, DONE, name), {'returncode': 1, 'start': None, 'end': None, 'worker': worker})
+			else:
+				logging.warning('Worker %s stopped renewing its lease on task %s-- putting the task back in the queue.' % (worker, record['label']))
+				write_record(os.path.join(queue_dir, PENDING, name), record)
+			os.remove(claimed_path)
+			expired += 1
+	return expired
+
+
+class WorkQueue(object):
+	"""
+	Runs commands by putting them in a queue of files in queue_dir, from which 'rnaseq_pipeline.py worker' processes (on any node which
+	shares the output location) claim and run them.  The pipeline itself acts as the coordinator: it starts the components as usual and
+	each component's tasks block in run(...) until a worker has left their result in the queue.
+
+	A worker renews its lease on the tasks it runs every few seconds.  If it dies, its tasks are put back in the queue once the lease has
+	expired (which the pipeline and every other worker check for), so another worker runs them again.
+	"""
+
+	def __init__(self, queue_dir, job_dir, poll_interval = DEFAULT_POLL_INTERVAL, lease_timeout = DEFAULT_LEASE_TIMEOUT, max_attempts = DEFAULT_MAX_ATTEMPTS):
+		self.queue_dir = queue_dir
+		self.job_dir = job_dir
+		self.poll_interval = poll_interval
+		self.lease_timeout = lease_timeout
+		self.max_attempts = max_attempts
+		self.lock = threading.Lock()
+		self.task_count = 0
+		self.last_expiry_check = 0
+
+
+	def task_name(self, task):
+		# the names sort by the time the tasks were queued, so the workers take them in order
+		with self.lock:
+			self.task_count += 1
+			count = self.task_count
+		return '%017.6f.%d.%s%s' % (time.time(), count, re.sub('[^\w.-]+', '_', task.label), TASK_SUFFIX)
+
+
+	def run(self, task):
+		"""
+		Queues the BatchTask and blocks until a worker has run it.  Returns the task.
+		"""
+		create_queue_dirs(self.queue_dir)
+		make_dir(self.job_dir)
+		name = self.task_name(task)
+		record = {'label': task.label, 'command': task.command, 'cwd': os.getcwd(), 'output_path': task.output_path, 'stdout_path': task.stdout_path,
+			'memory': task.memory, 'cpus': task.cpus, 'attempts': 0}
+		write_record(os.path.join(self.queue_dir, PENDING, name), record)
+		logging.info('Queued task %s in %s' % (task.label, self.queue_dir))
+
+		done_path = os.path.join(self.queue_dir, DONE, name)
+		try:
+			while not os.path.isfile(done_path):
+				self.check_expired()
+				time.sleep(self.poll_interval)
+			result = read_record(done_path)
+			os.remove(done_path)
+			task.returncode, task.start, task.end = result['returncode'], result['start'], result['end']
+			task.max_rss, task.user_time, task.system_time = result.get('max_rss'), result.get('user_time'), result.get('system_time')
+		except BaseException:
+			self.withdraw(name, task)
+			raise
+		finally:
+			if task.returncode is None:
+				task.returncode = 1
+			task.finished.set()
+		return task
+
+
+	def check_expired(self):
+		"""
+		Requeues the tasks of dead workers, at most once every poll_interval however many tasks are waiting
+		"""
+		with self.lock:
+			if time.time() - self.last_expiry_check < self.poll_interval:
+				return
+			self.last_expiry_check = time.time()
+		requeue_expired(self.queue_dir, self.lease_timeout, self.max_attempts)
+
+
+	def withdraw(self, name, task):
+		"""
+		Takes a task the pipeline stopped waiting for out of the queue.  A task a worker has already claimed runs to the end.
+		"""
+		logging.error('Stopped waiting for task %s-- removing it from the queue.' % task.label)
+		with locked(self.queue_dir):
+			remove_if_present(os.path.join(self.queue_dir, PENDING, name))
+
+
+class QueueWorker(object):
+	"""
+	Claims tasks from the work queue in queue_dir and runs them, as many at a time as fit in the memory and cpus of its ResourceManager.
+	Stops once there has been nothing to do for idle_timeout seconds (never, if idle_timeout is zero).
+	"""
+
+	def __init__(self, queue_dir, resources, poll_interval = DEFAULT_POLL_INTERVAL, heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL,
+			lease_timeout = DEFAULT_LEASE_TIMEOUT, max_attempts = DEFAULT_MAX_ATTEMPTS, idle_timeout = 0):
+		self.queue_dir = queue_dir
+		self.resources = resources
+		self.poll_interval = poll_interval
+		self.heartbeat_interval = heartbeat_interval
+		self.lease_timeout = lease_timeout
+		self.max_attempts = max_attempts
+		self.idle_timeout = idle_timeout
+		self.name = '%s.%d' % (socket.gethostname(), os.getpid())
+		self.running = {}
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.oversized = set()
+
+
+	def serve(self):
+		"""
+		Runs queued tasks until the worker has been idle for idle_timeout seconds
+		"""
+		create_queue_dirs(self.queue_dir)
+		logging.info('Worker %s is serving the work queue in %s' % (self.name, self.queue_dir))
+		heartbeat = threading.Thread(target = self.renew_leases)
+		heartbeat.daemon = True
+		heartbeat.start()
+		idle_since = time.time()
+		try:
+			while True:
+				requeue_expired(self.queue_dir, self.lease_timeout, self.max_attempts)
+				self.claim_tasks()
+				with self.lock:
+					threads = self.running.values()
+				if threads:
+					idle_since = time.time()
+				elif self.idle_timeout > 0 and time.time() - idle_since > self.idle_timeout:
+					logging.info('Worker %s has been idle for %s seconds-- stopping.' % (self.name, self.idle_timeout))
+					break
+				time.sleep(self.poll_interval)
+		finally:
+			self.stopped.set()
+			heartbeat.join()
+
+
+	def claim_tasks(self):
+		"""
+		Claims the queued tasks (oldest first) which fit in the resources that are free, and starts running them
+		"""
+		with locked(self.queue_dir):
+			for name in list_tasks(os.path.join(self.queue_dir, PENDING)):
+				if self.resources.reserved_cpus >= self.resources.total_cpus:
+					break
+				pending_path = os.path.join(self.queue_dir, PENDING, name)
+				try:
+					record = read_record(pending_path)
+				except (IOError, ValueError):
+					continue
+				memory, cpus = float(record.get('memory') or 0), int(record.get('cpus') or 1)
+				if memory > self.resources.total_memory or cpus > self.resources.total_cpus:
+					if name not in self.oversized:
+						logging.warning('Task %s needs %s GB and %s cpus, more than this worker has-- leaving it for another worker.' % (record['label'], memory, cpus))
+						self.oversized.add(name)
+					continue
+				if not self.resources.try_reserve(memory, cpus):
+					continue
+				record['worker'] = self.name
+				write_record(os.path.join(self.queue_dir, CLAIMED, name), record)
+				os.remove(pending_path)
+				logging.info('Worker %s claimed task %s' % (self.name, record['label']))
+				thread = threading.Thread(target = self.execute, args = (name, record, memory, cpus))
+				with self.lock:
+					self.running[name] = thread
+				thread.start()
+
+
+	def renew_leases(self):
+		"""
+		Touches the claimed task files of the running tasks every heartbeat_interval seconds, so they are not taken for lost
+		"""
+		while not self.stopped.wait(self.heartbeat_interval):
+			with self.lock:
+				names = self.running.keys()
+			for name in names:
+				try:
+					os.utime(os.path.join(self.queue_dir, CLAIMED, name), None)
+				except OSError:
+					pass
+
+
+	def execute(self, name, record, memory, cpus):
+		"""
+		Runs a claimed task and leaves its result in the queue
+		"""
+		start = time.time()
+		result = {'returncode': 1, 'start': start, 'end': None, 'worker': self.name}
+		try:
+			returncode, usage = self.run_command(record)
+			# ru_maxrss is in kilobytes on linux
+			result.update({'returncode': returncode, 'max_rss': usage.ru_maxrss/1024.0, 'user_time': usage.ru_utime, 'system_time': usage.ru_stime})
+		except Exception as ex:
+			logging.error('Worker %s could not run task %s: %s' % (self.name, record['label'], ex))
+		finally:
+			result['end'] = time.time()
+			logging.info('Worker %s finished task %s with exit status %d in %.1f s' % (self.name, record['label'], result['returncode'], result['end'] - start))
+			with locked(self.queue_dir):
+				self.leave_result(name, record, result)
+			self.resources.release(memory, cpus)
+			with self.lock:
+				del self.running[name]
+
+
+	def leave_result(self, name, record, result):
+		"""
+		Writes the result of a task to done/, unless the task is no longer this worker's: if it was taken for lost while it ran and
+		another worker has claimed it since, that worker's attempt owns it (and its claim is left alone); if nothing is left of it, the
+		pipeline already has a result or stopped waiting for it.  Must be called under the queue's lock.
+		"""
+		claimed_path = os.path.join(self.queue_dir, CLAIMED, name)
+		pending_path = os.path.join(self.queue_dir, PENDING, name)
+		done_path = os.path.join(self.queue_dir, DONE, name)
+		try:
+			owner = read_record(claimed_path).get('worker')
+		except (IOError, ValueError):
+			owner = None
+		if owner is not None and owner != self.name:
+			logging.warning('Task %s was taken for lost and is now run by worker %s-- dropping the result of worker %s.' % (record['label'], owner, self.name))
+			return
+		if owner is None and not os.path.isfile(pending_path) and not os.path.isfile(done_path):
+			logging.warning('Task %s is no longer in the queue-- dropping the result of worker %s.' % (record['label'], self.name))
+			return
+		write_record(done_path, result)
+		if owner == self.name:
+			os.remove(claimed_path)
+		# if the task was taken for lost (and requeued) while it ran, it does not need to run again:
+		remove_if_present(pending_path)
+
+
+	def run_command(self, record):
+		"""
+		Runs the task's command, with its output going to the task's output file.  Returns the exit status and the resource usage.
+		"""
+		with open(record['output_path'], 'w') as output:
+			stdout = open(record['stdout_path'], 'w') if record['stdout_path'] else output
+			try:
+				process = subprocess.Popen(record['command'], shell = True, cwd = record['cwd'], stdout = stdout, stderr = output)
+				# wait4 (rather than wait) also gives the resource usage of the tool and the children it waited for:
+				pid, status, usage = os.wait4(process.pid, 0)
+				process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+			finally:
+				if record['stdout_path']:
+					stdout.close()
+		return process.returncode, usage
+
+
+def run_worker(pipeline_home, options):
+	"""
+	Serves the work queue of the pipeline run in options['worker_output_location'], with the execution parameters from the
+	pipeline configuration.  Each worker logs to its own file in the output location.
+	"""
+	from util_classes import Params
+	output_location = options['worker_output_location']
+	log_path = os.path.join(output_location, '%s.%d.worker.log' % (socket.gethostname(), os.getpid()))
+	logging.basicConfig(filename = log_path, level = logging.INFO, format = "%(asctime)s:%(levelname)s:%(message)s")
+
+	params = Params()
+	params.add(config_parser.read_config(util_methods.locate_config(pipeline_home), 'execution_params'))
+	params.add(output_location = output_location)
+	resources = resource_manager.create_resource_manager(options.get('worker_memory') or 0, options.get('worker_cpus') or 0)
+	worker = QueueWorker(get_queue_dir(params), resources,
+			poll_interval = float(get_optional_param(params, 'work_queue_poll_interval', DEFAULT_POLL_INTERVAL)),
+			heartbeat_interval = float(get_optional_param(params, 'work_queue_heartbeat_interval', DEFAULT_HEARTBEAT_INTERVAL)),
+			lease_timeout = float(get_optional_param(params, 'work_queue_lease_timeout', DEFAULT_LEASE_TIMEOUT)),
+			max_attempts = int(get_optional_param(params, 'work_queue_max_attempts', DEFAULT_MAX_ATTEMPTS)),
+			idle_timeout = float(options.get('worker_idle_timeout') or 0))
+	worker.serve()